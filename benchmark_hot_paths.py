@@ -0,0 +1,86 @@
+#######################
+# Hot path benchmarks #
+#######################
+
+# This script measures the per-row costs of the tool without network: the lookups, updates,
+# saves and loads of the processing file, the resolution of the mappings of the form, the
+# cleaning of the item fields and the copy of the holding fields. It reports the ns and the
+# bytes allocated per operation. The results are written in a JSON file that can be compared
+# with a baseline.
+
+# To start the benchmarks:
+# python benchmark_hot_paths.py [--rows 10000 100000 500000] [--mapping-rows 10000] [--output results.json]
+#                               [--compare baseline.json]
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from almapiwrapper.configlog import config_log
+
+from utils import benchmark, microbench
+from utils.processmonitoring import STORAGE_MODES
+
+parser = argparse.ArgumentParser(prog='python benchmark_hot_paths.py')
+parser.add_argument('--rows', type=int, nargs='+', default=microbench.DEFAULT_ROWS, metavar='N',
+                    help=f'numbers of rows of the processing files, default is '
+                         f'{" ".join(str(nb_rows) for nb_rows in microbench.DEFAULT_ROWS)}')
+parser.add_argument('--mapping-rows', type=int, default=microbench.DEFAULT_MAPPING_ROWS, metavar='N',
+                    help=f'number of rows of the mapping sheets, default is {microbench.DEFAULT_MAPPING_ROWS}')
+parser.add_argument('--storage', choices=list(STORAGE_MODES), default='csv',
+                    help='storage mode of the processing file, default is csv')
+parser.add_argument('--min-time', type=float, default=microbench.DEFAULT_MIN_TIME, metavar='S',
+                    help=f'minimal duration of a timed run in seconds, default is {microbench.DEFAULT_MIN_TIME}')
+parser.add_argument('--seed', type=int, default=0, metavar='N',
+                    help='seed of the generated data, default is 0')
+parser.add_argument('--output', default='benchmark_hot_paths.json', metavar='FILE',
+                    help='JSON file receiving the results, default is benchmark_hot_paths.json')
+parser.add_argument('--compare', metavar='FILE',
+                    help='JSON file of a previous run: the script fails if a metric is worse by more than '
+                         'the tolerance')
+parser.add_argument('--tolerance', type=float, default=0.2, metavar='R',
+                    help='relative change of a metric considered as noise, default is 0.2')
+args = parser.parse_args()
+
+config_log('benchmark_hot_paths')
+
+parameters = {'rows': args.rows,
+              'mapping_rows': args.mapping_rows,
+              'storage': args.storage,
+              'min_time': args.min_time,
+              'seed': args.seed}
+logging.info(f'Hot path benchmarks started: {parameters}')
+
+# The generated forms and processing files are written in a temporary working directory
+output_path = os.path.abspath(args.output)
+cwd = os.getcwd()
+with tempfile.TemporaryDirectory() as work_dir:
+    os.chdir(work_dir)
+    try:
+        results = microbench.run_benchmarks(args.rows, args.mapping_rows, args.storage, args.min_time, args.seed)
+    finally:
+        os.chdir(cwd)
+
+benchmark.save_results(output_path, parameters, results)
+logging.info(f'Benchmark results written in {args.output}')
+
+if args.compare:
+    with open(args.compare) as f:
+        baseline = json.load(f)
+
+    if baseline.get('parameters') != parameters:
+        logging.warning(f"Parameters of the baseline differ: {baseline.get('parameters')}")
+
+    comparisons = benchmark.compare_results(baseline, results, args.tolerance, microbench.COMPARED_METRICS, 'key')
+    for comparison in comparisons:
+        log = logging.error if comparison['regression'] else logging.info
+        log(f"{comparison['key']} {comparison['metric']}: {comparison['baseline']} -> "
+            f"{comparison['current']} ({comparison['change']:+.1%})"
+            f"{' REGRESSION' if comparison['regression'] else ''}")
+
+    if any(comparison['regression'] for comparison in comparisons):
+        logging.critical(f'Regression compared to {args.compare}')
+        sys.exit(1)
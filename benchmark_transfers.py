@@ -0,0 +1,110 @@
+#######################
+# Transfer benchmarks #
+#######################
+
+# This script measures the transfer scripts on synthetic forms against the mock Alma API.
+# For each process type, it generates the records and the Excel form, runs the transfer
+# script and reports the rows per second, the API calls per row, the peak memory and the
+# wall time. The results are written in a JSON file that can be compared with a baseline.
+
+# To start the benchmarks:
+# python benchmark_transfers.py [--types Items PoLines] [--rows 10000] [--bibs 2000] [--output results.json]
+#                               [--compare baseline.json]
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from almapiwrapper.configlog import config_log
+
+from utils import benchmark
+
+parser = argparse.ArgumentParser(prog='python benchmark_transfers.py')
+parser.add_argument('--types', nargs='+', choices=list(benchmark.SCRIPTS), default=list(benchmark.SCRIPTS),
+                    metavar='TYPE',
+                    help=f'process types to benchmark, default is all: {", ".join(benchmark.SCRIPTS)}')
+parser.add_argument('--rows', type=int, default=1000, metavar='N',
+                    help='number of rows of each form, default is 1000')
+parser.add_argument('--bibs', type=int, metavar='N',
+                    help='number of source bibs of the holdings, items, loans and requests, default is a fifth '
+                         'of the rows')
+parser.add_argument('--zipf', type=float, default=1.1, metavar='S',
+                    help='exponent of the Zipf distribution of the rows over the bibs, default is 1.1. '
+                         '0 spreads the rows evenly')
+parser.add_argument('--batch-size', type=int, default=10, metavar='N',
+                    help='number of items of a PoLine and number of bibs of a collection, default is 10')
+parser.add_argument('--booking-rate', type=float, default=0.5, metavar='R',
+                    help='share of the requests being bookings, from 0 to 1, default is 0.5')
+parser.add_argument('--latency', type=float, default=0.0, metavar='S',
+                    help='mean duration of the API calls of the mock server in seconds, default is 0')
+parser.add_argument('--workers', type=int, default=1, metavar='N',
+                    help='number of rows processed concurrently by the items and PoLines transfers, default is 1')
+parser.add_argument('--seed', type=int, default=0, metavar='N',
+                    help='seed of the generated records, default is 0')
+parser.add_argument('--template', default=benchmark.DEFAULT_TEMPLATE, metavar='FILE',
+                    help='Excel form used as model of the generated forms')
+parser.add_argument('--work-dir', metavar='DIR',
+                    help='directory of the generated forms, processing files and logs of the transfers, '
+                         'default is a temporary directory')
+parser.add_argument('--output', default='benchmark_results.json', metavar='FILE',
+                    help='JSON file receiving the results, default is benchmark_results.json')
+parser.add_argument('--compare', metavar='FILE',
+                    help='JSON file of a previous run: the script fails if a metric is worse by more than '
+                         'the tolerance')
+parser.add_argument('--tolerance', type=float, default=0.1, metavar='R',
+                    help='relative change of a metric considered as noise, default is 0.1')
+args = parser.parse_args()
+
+config_log('benchmark_transfers')
+
+parameters = {'rows': args.rows,
+              'bibs': args.bibs,
+              'zipf': args.zipf,
+              'batch_size': args.batch_size,
+              'booking_rate': args.booking_rate,
+              'latency': args.latency,
+              'workers': args.workers,
+              'seed': args.seed}
+logging.info(f'Benchmarks of {", ".join(args.types)} started: {parameters}')
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    work_dir = os.path.abspath(args.work_dir or tmp_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    results = [benchmark.run_benchmark(process_type, args.rows, work_dir,
+                                       nb_bibs=args.bibs,
+                                       zipf_exponent=args.zipf,
+                                       batch_size=args.batch_size,
+                                       booking_rate=args.booking_rate,
+                                       latency=args.latency,
+                                       workers=args.workers,
+                                       seed=args.seed,
+                                       template=args.template)
+               for process_type in args.types]
+
+benchmark.save_results(args.output, parameters, results)
+logging.info(f'Benchmark results written in {args.output}')
+
+if any(result['exit_code'] != 0 for result in results):
+    logging.critical('At least one transfer script failed, see the log above')
+    sys.exit(1)
+
+if args.compare:
+    with open(args.compare) as f:
+        baseline = json.load(f)
+
+    if baseline.get('parameters') != parameters:
+        logging.warning(f"Parameters of the baseline differ: {baseline.get('parameters')}")
+
+    comparisons = benchmark.compare_results(baseline, results, args.tolerance)
+    for comparison in comparisons:
+        log = logging.error if comparison['regression'] else logging.info
+        log(f"{comparison['process_type']} {comparison['metric']}: {comparison['baseline']} -> "
+            f"{comparison['current']} ({comparison['change']:+.1%})"
+            f"{' REGRESSION' if comparison['regression'] else ''}")
+
+    if any(comparison['regression'] for comparison in comparisons):
+        logging.critical(f'Regression compared to {args.compare}')
+        sys.exit(1)
@@ -0,0 +1,62 @@
+########################
+# Mock Alma API server #
+########################
+
+# This script starts a local stand-in of the Alma APIs used by the transfer scripts.
+# The records are kept in memory and lost when the server stops. It allows to test
+# and to measure the transfer scripts without network and without API quota.
+
+# To start the server:
+# python mock_alma_server.py [--port 8080] [--seed seed.json] [--latency S] [--error-rate R] [--rate-429 R]
+
+# The transfer scripts use it with the --alma-url option:
+# python transfer_iz_to_iz_items.py <dataForm.xlsx> --alma-url http://localhost:8080/almaws/v1
+
+import argparse
+import logging
+
+from almapiwrapper.configlog import config_log
+
+from utils.mockalma import MockAlma, MockAlmaServer
+
+parser = argparse.ArgumentParser(prog='python mock_alma_server.py')
+parser.add_argument('--host', default='localhost',
+                    help='host name or address of the server, default is localhost')
+parser.add_argument('--port', type=int, default=8080,
+                    help='port of the server, default is 8080')
+parser.add_argument('--seed', metavar='FILE',
+                    help='JSON file with the records available at start: bibs, holdings, items, polines, '
+                         'users, loans, requests and collections')
+parser.add_argument('--latency', type=float, default=0.0, metavar='S',
+                    help='mean duration of a call in seconds, default is 0')
+parser.add_argument('--error-rate', type=float, default=0.0, metavar='R',
+                    help='share of the calls answered with a 500 error, from 0 to 1, default is 0')
+parser.add_argument('--rate-429', type=float, default=0.0, metavar='R',
+                    help='share of the calls answered with a 429 error, from 0 to 1, default is 0')
+parser.add_argument('--pol-items-delay', type=float, default=0.0, metavar='S',
+                    help='delay in seconds before the items of a new one-time PoLine are listed, default is 0')
+parser.add_argument('--random-seed', type=int, metavar='N',
+                    help='seed of the random latencies and errors, for reproducible runs')
+args = parser.parse_args()
+
+config_log('mock_alma_server')
+
+alma = MockAlma(latency=args.latency,
+                error_rate=args.error_rate,
+                rate_429=args.rate_429,
+                pol_items_delay=args.pol_items_delay,
+                seed=args.random_seed)
+if args.seed:
+    alma.load_seed(args.seed)
+
+server = MockAlmaServer(alma, args.host, args.port)
+logging.info(f'Mock Alma API available at {server.url}, stop with Ctrl+C')
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+
+logging.info(f'Mock Alma API stopped: {sum(alma.nb_calls.values())} calls, '
+             f'{alma.nb_injected["500"]} 500 errors and {alma.nb_injected["429"]} 429 errors injected')
@@ -0,0 +1,87 @@
+import json
+import unittest
+from unittest import mock
+import requests
+from utils import apicalls, apistats, planner, runner
+from utils.processmonitoring import ProcessMonitor
+
+BASE_URL = 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1'
+
+
+class TestApiCallStats(unittest.TestCase):
+    def setUp(self):
+        ProcessMonitor.reset()
+        self.pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+        self.stats = apistats.ApiCallStats()
+
+        def fake_alma(call_next, method, *args, **kwargs):
+            r = requests.Response()
+            r.status_code = 404 if 'missing' in args[0] else 200
+            r.url = args[0]
+            return r
+
+        self.fake_alma = fake_alma
+        apicalls.add_middleware(self.stats)
+        apicalls.add_middleware(self.fake_alma)
+
+    def tearDown(self):
+        import shutil
+        apicalls.remove_middleware(self.stats)
+        apicalls.remove_middleware(self.fake_alma)
+        ProcessMonitor.reset()
+        shutil.rmtree('data', ignore_errors=True)
+
+    def call(self, method, url, zone='UBS'):
+        return apicalls.call(method, url, headers=apicalls.AlmaHeaders({'accept': 'application/xml'},
+                                                                      zone, 'Bibs', 'S'))
+
+    def test_count_calls(self):
+        with runner.current_row(2):
+            self.call('get', f'{BASE_URL}/items?item_barcode=A1')
+            self.call('get', f'{BASE_URL}/items?item_barcode=missing')
+            self.call('post', f'{BASE_URL}/bibs/991/holdings/22/items', zone='ISR')
+        self.call('get', f'{BASE_URL}/acq/po-lines/POL-1')
+
+        summary = self.stats.get_summary()
+        self.assertEqual(summary['nb_calls'], 4)
+        self.assertEqual(summary['nb_errors'], 1)
+        self.assertEqual([(row['zone'], row['method'], row['record_type'], row['nb_calls'])
+                          for row in summary['endpoints']],
+                         [('UBS', 'GET', 'items', 2), ('ISR', 'POST', 'bibs', 1), ('UBS', 'GET', 'acq/po-lines', 1)])
+
+        # Only the calls made for the row are counted in its columns
+        self.assertEqual(self.pm.df.at[2, 'API_calls'], 3)
+        self.assertGreaterEqual(self.pm.df.at[2, 'API_ms'], 0)
+        self.assertEqual(self.pm.df['API_calls'].isnull().sum(), len(self.pm.df.index) - 1)
+
+        self.assertEqual(set(self.stats.get_latencies()), {'GET items', 'POST bibs', 'GET acq/po-lines'})
+
+    def test_save(self):
+        self.call('get', f'{BASE_URL}/bibs/991')
+        with mock.patch.object(planner, 'save_latencies') as save_latencies:
+            self.stats.save()
+        save_latencies.assert_called_once()
+
+        file_path = self.pm.get_report_path('api_calls')
+        self.assertEqual(file_path, 'data/test_data_IZ_to_IZ_1_PoLines_api_calls.json')
+        with open(file_path) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['process_type'], 'PoLines')
+        self.assertEqual(summary['endpoints'][0]['record_type'], 'bibs')
+
+    def test_latencies_not_saved_without_alma(self):
+        self.call('get', f'{BASE_URL}/bibs/991')
+        for base_url, transport in [('http://localhost:8080/almaws/v1', None), (None, apicalls.send)]:
+            apicalls.set_base_url(base_url)
+            apicalls.set_transport(transport)
+            try:
+                with mock.patch.object(planner, 'save_latencies') as save_latencies:
+                    self.stats.save()
+                save_latencies.assert_not_called()
+            finally:
+                apicalls.set_base_url(None)
+                apicalls.set_transport(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
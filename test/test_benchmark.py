@@ -0,0 +1,69 @@
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+from utils import benchmark, xlstools
+from utils.mockalma import MockAlma
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_draw_ranks(self):
+        ranks = benchmark.draw_ranks(random.Random(0), 1000, 10, 1.1)
+        self.assertEqual(len(ranks), 1000)
+        self.assertEqual(set(ranks), set(range(10)))
+        self.assertGreater(ranks.count(0), 5 * ranks.count(9))
+
+    def test_generate_items(self):
+        alma = MockAlma()
+        rows = benchmark.generate_scenario(alma, 'Items', 50, nb_bibs=10)
+        self.assertEqual(len(rows), 50)
+        self.assertEqual(len(alma.get_items_by_barcode(benchmark.IZ_S)), 50)
+        self.assertEqual(len([key for key in alma.bibs if key[0] == 'NZ']), 10)
+
+        # Same seed, same scenario
+        self.assertEqual(rows['Barcode'].tolist(),
+                         benchmark.generate_scenario(MockAlma(), 'Items', 50, nb_bibs=10)['Barcode'].tolist())
+
+    def test_write_form(self):
+        alma = MockAlma()
+        rows = benchmark.generate_scenario(alma, 'PoLines', 25, batch_size=10)
+        self.assertEqual(rows['PO Line Reference'].nunique(), 3)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, 'benchmark_polines.xlsx')
+            benchmark.write_form(file_path, 'PoLines', rows)
+            self.assertEqual(xlstools.get_form_version(file_path), benchmark.FORM_VERSION)
+            self.assertEqual(xlstools.get_data(file_path, 'PoLines').values.tolist(), rows.values.tolist())
+
+    def test_run_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = benchmark.run_benchmark('Bibs', 5, tmp_dir)
+        self.assertEqual(result['exit_code'], 0)
+        self.assertEqual(result['nb_copied'], 5)
+        self.assertEqual(result['calls_by_route']['POST bibs'], 5)
+        self.assertGreater(result['peak_rss_mb'], 0)
+
+    def test_run_benchmark_without_memory_measure(self):
+        # Platforms without psutil nor resource, Windows for example
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(benchmark, 'psutil', None), \
+                mock.patch.object(benchmark, 'resource', None):
+            result = benchmark.run_benchmark('Bibs', 2, tmp_dir)
+        self.assertEqual(result['exit_code'], 0)
+        self.assertIsNone(result['peak_rss_mb'])
+
+    def test_compare_results(self):
+        baseline = {'results': [{'process_type': 'Items', 'rows_per_s': 100, 'api_calls_per_row': 5.0,
+                                 'peak_rss_mb': 100, 'wall_s': 10}]}
+        results = [{'process_type': 'Items', 'rows_per_s': 80, 'api_calls_per_row': 4.0,
+                    'peak_rss_mb': 105, 'wall_s': 12.5}]
+        comparisons = {comparison['metric']: comparison
+                       for comparison in benchmark.compare_results(baseline, results, tolerance=0.1)}
+        self.assertTrue(comparisons['rows_per_s']['regression'])
+        self.assertFalse(comparisons['api_calls_per_row']['regression'])
+        self.assertFalse(comparisons['peak_rss_mb']['regression'])
+        self.assertEqual(comparisons['wall_s']['change'], 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
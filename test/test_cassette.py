@@ -0,0 +1,105 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from almapiwrapper.inventory import Item
+from utils import apicalls, cassette
+from utils.mockalma import MockAlma, MockAlmaServer
+
+
+class TestCassette(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'run.jsonl.gz')
+
+        self.alma = MockAlma()
+        mms_id = self.alma.add_bib('UBS', nz_mms_id=self.alma.add_bib('NZ'))
+        holding_id = self.alma.add_holding('UBS', mms_id, 'UBS_LIB', 'UBS_LOC')
+        self.item_id = self.alma.add_item('UBS', mms_id, holding_id, 'B001')
+
+        self.server = MockAlmaServer(self.alma).start()
+        apicalls.set_base_url(self.server.url)
+
+    def tearDown(self):
+        cassette.install()
+        apicalls.set_base_url(None)
+        self.server.stop()
+        self.tmp_dir.cleanup()
+
+    def test_record_and_replay(self):
+        recorder = cassette.install(record_path=self.file_path)
+        item = Item(barcode='B001', zone='UBS', env='S')
+        item.barcode = 'OLD_B001'
+        item.update()
+        self.assertTrue(Item(barcode='B002', zone='UBS', env='S').error)
+        self.assertEqual(Item(barcode='OLD_B001', zone='UBS', env='S').item_id, self.item_id)
+        nb_calls = sum(self.alma.nb_calls.values())
+        cassette.install()
+        self.assertEqual(recorder.nb_recorded, nb_calls)
+
+        # Compact file without API key
+        with gzip.open(self.file_path, 'rt') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0]['cassette_version'], cassette.CASSETTE_VERSION)
+        self.assertTrue(all(line['url'].startswith('/items') or line['url'].startswith('/bibs')
+                            for line in lines[1:]))
+        self.assertNotIn('apikey', json.dumps(lines))
+
+        # Replay without the server, the same responses in the same order
+        self.server.stop()
+        player = cassette.install(replay_path=self.file_path)
+        item = Item(barcode='B001', zone='UBS', env='S')
+        self.assertEqual(item.item_id, self.item_id)
+        item.barcode = 'OLD_B001'
+        self.assertFalse(item.update().error)
+        self.assertTrue(Item(barcode='B002', zone='UBS', env='S').error)
+        self.assertEqual(Item(barcode='OLD_B001', zone='UBS', env='S').item_id, self.item_id)
+        self.assertEqual(player.nb_replayed, nb_calls)
+        self.assertEqual(player.nb_missing, 0)
+
+        # Calls not recorded receive an Alma error
+        self.assertTrue(Item(barcode='B003', zone='UBS', env='S').error)
+        self.assertEqual(player.nb_missing, 1)
+
+    def test_repeat_last_response(self):
+        player_path = os.path.join(self.tmp_dir.name, 'run.jsonl')
+        with open(player_path, 'w') as f:
+            f.write(json.dumps({'cassette_version': cassette.CASSETTE_VERSION}) + '\n')
+            for status in [429, 200]:
+                f.write(json.dumps({'method': 'GET', 'zone': 'UBS', 'env': 'S', 'url': '/bibs/991',
+                                    'params': [], 'body': None, 'status': status,
+                                    'content_type': 'application/json', 'content': '{}', 'ms': 5}) + '\n')
+
+        player = cassette.Cassette(player_path)
+        headers = apicalls.AlmaHeaders({'accept': 'application/json'}, 'UBS', 'Bibs', 'S')
+        url = f'{apicalls.Record.api_base_url}/bibs/991'
+        self.assertEqual([player('get', url, headers=headers).status_code for _ in range(3)], [429, 200, 200])
+        self.assertEqual(player('get', url, headers=headers).json(), {})
+        self.assertEqual(player('get', url + '2', headers=headers).status_code, 404)
+
+    def test_replay_creations_with_different_bodies(self):
+        player_path = os.path.join(self.tmp_dir.name, 'run.jsonl')
+        url = f'{apicalls.Record.api_base_url}/bibs/1/holdings/2/items'
+        with open(player_path, 'w') as f:
+            f.write(json.dumps({'cassette_version': cassette.CASSETTE_VERSION}) + '\n')
+            for k, body in enumerate(['A', 'B'], start=1):
+                f.write(json.dumps({'method': 'POST', 'zone': 'UBS', 'env': 'S', 'url': '/bibs/1/holdings/2/items',
+                                    'params': [], 'body': cassette.get_body_hash({'data': body}),
+                                    'status': 200, 'content_type': 'application/xml',
+                                    'content': f'<item>{k}</item>', 'ms': 5}) + '\n')
+
+        # The second body differs from the recording, the response of the first item is not replayed again
+        player = cassette.Cassette(player_path)
+        headers = apicalls.AlmaHeaders({'accept': 'application/xml'}, 'UBS', 'Items', 'S')
+        self.assertEqual(player('post', url, headers=headers, data='A').text, '<item>1</item>')
+        self.assertEqual(player('post', url, headers=headers, data='B changed').text, '<item>2</item>')
+
+        # The recorded body is preferred to the recorded order
+        player = cassette.Cassette(player_path)
+        self.assertEqual(player('post', url, headers=headers, data='B').text, '<item>2</item>')
+        self.assertEqual(player('post', url, headers=headers, data='A').text, '<item>1</item>')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from utils import benchmark
+from utils.mockalma import MockAlma
+
+
+class TestCli(unittest.TestCase):
+    def test_plan_without_side_effects(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rows = benchmark.generate_scenario(MockAlma(), 'Items', 10)
+            benchmark.write_form(os.path.join(tmp_dir, 'form.xlsx'), 'Items', rows)
+            with open(os.path.join(tmp_dir, 'run.jsonl'), 'w') as f:
+                f.write('recorded calls\n')
+
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [benchmark.REPO_DIR,
+                                                                            os.environ.get('PYTHONPATH')])))
+            proc = subprocess.run([sys.executable, os.path.join(benchmark.REPO_DIR, 'transfer_iz_to_iz_items.py'),
+                                   'form.xlsx', '--plan', '--storage', 'buffered', '--record-cassette', 'run.jsonl'],
+                                  cwd=tmp_dir, env=env, capture_output=True, text=True)
+
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'data')))
+            with open(os.path.join(tmp_dir, 'run.jsonl')) as f:
+                self.assertEqual(f.read(), 'recorded calls\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+from types import SimpleNamespace
+from lxml import etree
+from utils import holdings
+
+
+def make_holding(library, location, callnumber, error=False):
+    return SimpleNamespace(library=library, location=location, callnumber=callnumber, error=error)
+
+
+class FakeBib:
+    def __init__(self, mms_id, bib_holdings):
+        self.mms_id = mms_id
+        self.bib_holdings = bib_holdings
+        self.nb_fetches = 0
+
+    def get_holdings(self):
+        self.nb_fetches += 1
+        return self.bib_holdings
+
+
+class TestHoldingsIndex(unittest.TestCase):
+    def tearDown(self):
+        holdings.holdings_indexes.clear()
+
+    def test_find(self):
+        hol_error = make_holding('rro_fili', 'MAG', 'A 1', error=True)
+        hol_1 = make_holding('rro_fili', 'MAG', ' A 1 ')
+        hol_2 = make_holding('rro_fili', 'MAG', 'A 2')
+        hol_3 = make_holding('rro_fili', 'FREE', None)
+        index = holdings.HoldingsIndex([hol_error, hol_1, hol_2, hol_3])
+
+        # First holding without error, call numbers are stripped
+        self.assertIs(index.find('rro_fili', 'MAG', 'A 1'), hol_1)
+        self.assertIs(index.find('rro_fili', 'FREE', None), hol_3)
+        self.assertIsNone(index.find('rro_fili', 'MAG', 'A 3'))
+        self.assertEqual(index.find_all('rro_fili', 'MAG'), [hol_error, hol_1, hol_2])
+
+        hol_4 = make_holding('rro_fili', 'MAG', 'A 3')
+        index.add(hol_4)
+        self.assertIs(index.find('rro_fili', 'MAG', 'A 3'), hol_4)
+
+    def test_fetched_once(self):
+        bib_d = FakeBib('991', [make_holding('rro_fili', 'MAG', 'A 1')])
+        index = holdings.get_holdings_index('991', bib_d)
+        self.assertIs(holdings.get_holdings_index('991', bib_d), index)
+        self.assertEqual(bib_d.nb_fetches, 1)
+
+        # Holdings created by Alma, the index must be built again
+        holdings.invalidate_holdings_index('991')
+        self.assertIsNot(holdings.get_holdings_index('991', bib_d), index)
+        self.assertEqual(bib_d.nb_fetches, 2)
+
+
+class TestCopyHoldingFields(unittest.TestCase):
+    def test_copy(self):
+        data_s = etree.fromstring('<holding><record>'
+                                  '<datafield tag="852" ind1="4" ind2=" "><subfield code="b">LIB_S</subfield>'
+                                  '<subfield code="h">CN 1</subfield></datafield>'
+                                  '<datafield tag="866" ind1=" " ind2="0"><subfield code="a">1-10</subfield></datafield>'
+                                  '<datafield tag="999" ind1="X" ind2=" "><subfield code="a">Local</subfield></datafield>'
+                                  '</record></holding>')
+        data_d = etree.fromstring('<holding><record>'
+                                  '<datafield tag="852" ind1="4" ind2=" "><subfield code="b">LIB_D</subfield>'
+                                  '<subfield code="h">Old</subfield><subfield code="t">1</subfield></datafield>'
+                                  '</record></holding>')
+
+        self.assertTrue(holdings.copy_holding_fields(data_s, data_d))
+        self.assertEqual([f.get('tag') for f in data_d.findall('.//datafield')], ['852', '866'])
+        self.assertEqual([(f.get('code'), f.text) for f in data_d.findall('.//datafield[@tag="852"]/subfield')],
+                         [('b', 'LIB_D'), ('h', 'CN 1')])
+
+        # No call number
+        data_s.find('.//subfield[@code="h"]').set('code', 'x')
+        self.assertFalse(holdings.copy_holding_fields(data_s, data_d))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@ from almapiwrapper.record import XmlData
 from utils import items
 from copy import deepcopy
 from lxml import etree
+from types import SimpleNamespace
 
 
 
@@ -28,3 +29,34 @@ class TestItems(unittest.TestCase):
         cleaned_item_data = items.clean_item_fields(deepcopy(item.data), rec_loc='dest', retry=True)
         pattern_type = cleaned_item_data.find('.//item_data/pattern_type')
         self.assertIsNotNone(pattern_type, 'Pattern type should not be removed ("delete if error")')
+
+    def test_get_pol_items(self):
+        def make_item(item_id, pol_number):
+            data = etree.fromstring(f'<item><item_data><pid>{item_id}</pid><po_line>{pol_number}</po_line>'
+                                    f'</item_data></item>')
+            return SimpleNamespace(item_id=item_id, data=data)
+
+        nb_fetches = []
+
+        def get_items():
+            nb_fetches.append(1)
+            return [make_item('231', 'POL-1'), make_item('232', 'POL-2'), make_item('233', 'POL-1')]
+
+        holding = SimpleNamespace(zone='UBS', holding_id='221', get_items=get_items)
+
+        pol_items = items.get_pol_items(holding, 'POL-1')
+        self.assertEqual([item.item_id for item in pol_items], ['231', '233'])
+
+        # Shared by the rows of the PoLine
+        self.assertIs(items.get_pol_items(holding, 'POL-1'), pol_items)
+        self.assertEqual(len(nb_fetches), 1)
+
+        # Empty lists are not kept, Alma may still create the items
+        self.assertEqual(items.get_pol_items(holding, 'POL-3'), [])
+        items.get_pol_items(holding, 'POL-3')
+        self.assertEqual(len(nb_fetches), 3)
+
+        items.invalidate_pol_items(holding, 'POL-1')
+        items.get_pol_items(holding, 'POL-1')
+        self.assertEqual(len(nb_fetches), 4)
+        items.invalidate_pol_items(holding, 'POL-1')
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+from utils import microbench
+from utils.processmonitoring import ProcessMonitor
+
+
+class TestMicrobench(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        ProcessMonitor.reset()
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def test_measure(self):
+        calls = []
+        result = microbench.measure('append', calls.append, lambda n: [(k,) for k in range(n)], min_time=0.01,
+                                    size=3)
+        self.assertEqual(result['key'], 'append size=3')
+        self.assertGreaterEqual(result['nb_ops'], 1)
+        self.assertGreater(result['ns_per_op'], 0)
+        self.assertGreaterEqual(result['retained_b_per_op'], 0)
+
+        # Allocations of the operation
+        result = microbench.measure('list', lambda: [0] * 10000, min_time=0.01)
+        self.assertGreater(result['alloc_b_per_op'], 10000 * 8)
+        self.assertLess(result['retained_b_per_op'], 1000)
+
+    def test_process_monitor(self):
+        results = microbench.bench_process_monitor(200, min_time=0.01)
+        self.assertEqual([result['name'] for result in results],
+                         ['pm.load', 'pm.get_corresponding_mms_id', 'pm.get_corresponding_holding_id',
+                          'pm.get_corresponding_item_id', 'pm.set_corresponding_item_id',
+                          'pm.set_corresponding_mms_id', 'pm.save'])
+        self.assertTrue(all(result['rows'] == 200 for result in results))
+        self.assertIsNone(ProcessMonitor.get_instance())
+
+    def test_mappings_and_records(self):
+        results = microbench.bench_mappings(100, min_time=0.01) + microbench.bench_records(min_time=0.01)
+        self.assertEqual(len(results), 7)
+        self.assertTrue(all(result['ns_per_op'] > 0 for result in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from copy import deepcopy
+from almapiwrapper.inventory import IzBib, Holding, Item
+from almapiwrapper.acquisitions import POLine
+from utils import apicalls
+from utils.mockalma import MockAlma, MockAlmaServer, MockAlmaError
+
+
+class TestMockAlma(unittest.TestCase):
+    def setUp(self):
+        self.alma = MockAlma(seed=1)
+        self.nz_mms_id = self.alma.add_bib('NZ', title='Mock')
+        self.mms_id_s = self.alma.add_bib('UBS', nz_mms_id=self.nz_mms_id)
+        self.holding_id_s = self.alma.add_holding('UBS', self.mms_id_s, 'UBS_LIB', 'UBS_LOC', 'CN 1')
+        self.item_id_s = self.alma.add_item('UBS', self.mms_id_s, self.holding_id_s, 'B001')
+
+        self.server = MockAlmaServer(self.alma).start()
+        apicalls.set_base_url(self.server.url)
+
+    def tearDown(self):
+        apicalls.set_base_url(None)
+        self.server.stop()
+
+    def test_copy_item(self):
+        item_s = Item(barcode='B001', zone='UBS', env='S')
+        self.assertEqual(item_s.item_id, self.item_id_s)
+        self.assertEqual(item_s.get_nz_mms_id(), self.nz_mms_id)
+        self.assertTrue(Item(barcode='B002', zone='UBS', env='S').error)
+
+        # NZ copy, then found with the NZ MMS ID
+        bib_d = IzBib(self.nz_mms_id, zone='HPH', env='S', from_nz_mms_id=True, copy_nz_rec=True)
+        self.assertFalse(bib_d.error)
+        self.assertEqual(IzBib(self.nz_mms_id, zone='HPH', env='S', from_nz_mms_id=True).mms_id, bib_d.mms_id)
+
+        holding_s = Holding(self.mms_id_s, self.holding_id_s, zone='UBS', env='S')
+        holding_d = Holding(mms_id=bib_d.mms_id, zone='HPH', env='S', data=deepcopy(holding_s.data),
+                            create_holding=True)
+        self.assertEqual(holding_d.callnumber, 'CN 1')
+        self.assertEqual(len(IzBib(bib_d.mms_id, zone='HPH', env='S').get_holdings()), 1)
+
+        item_d = Item(bib_d.mms_id, holding_d.holding_id, zone='HPH', env='S', data=deepcopy(item_s.data),
+                      create_item=True)
+        self.assertFalse(item_d.error)
+        self.assertNotEqual(item_d.item_id, self.item_id_s)
+
+        # Barcodes are unique in a zone
+        item_dup = Item(bib_d.mms_id, holding_d.holding_id, zone='HPH', env='S', data=deepcopy(item_s.data),
+                        create_item=True)
+        self.assertTrue(item_dup.error)
+
+        item_s.barcode = 'OLD_B001'
+        self.assertFalse(item_s.update().error)
+        self.assertEqual(Item(barcode='OLD_B001', zone='UBS', env='S').item_id, self.item_id_s)
+        self.assertEqual(list(self.alma.get_items_by_barcode('UBS')), ['OLD_B001'])
+
+    def test_one_time_poline(self):
+        self.alma.pol_items_delay = 0.2
+        mms_id_d = self.alma.add_bib('HPH', nz_mms_id=self.nz_mms_id)
+        pol_number_s = self.alma.add_poline('UBS', self.mms_id_s, 'UBS_LIB', 'UBS_LOC', quantity=2)
+
+        pol_data = deepcopy(POLine(pol_number_s, 'UBS', 'S').data)
+        pol_data['resource_metadata']['mms_id']['value'] = mms_id_d
+        pol_d = POLine(data=pol_data, zone='HPH', env='S').create()
+        self.assertFalse(pol_d.error)
+
+        # The holding is created at once, the items after the delay
+        holding_d = IzBib(mms_id_d, zone='HPH', env='S').get_holdings()[0]
+        self.assertEqual(holding_d.get_items(), [])
+        time.sleep(0.25)
+        items_d = Holding(mms_id_d, holding_d.holding_id, zone='HPH', env='S').get_items()
+        self.assertEqual([item.data.find('.//po_line').text for item in items_d], [pol_d.pol_number] * 2)
+
+        pol_d.receive_item(items_d[0], receive_date='2026-01-05Z')
+        self.assertFalse(pol_d.error)
+        self.assertEqual(self.alma.items[('HPH', items_d[0].item_id)].findtext('.//arrival_date'), '2026-01-05Z')
+
+    def test_injected_errors(self):
+        self.alma.rate_429 = 1.0
+        bib = IzBib(self.mms_id_s, zone='UBS', env='S')
+        _ = bib.data
+        self.assertEqual(bib.error_msg, 'PER_SECOND_THRESHOLD')
+
+        # The failed calls change nothing
+        self.alma.rate_429 = 0.0
+        self.alma.error_rate = 1.0
+        self.assertTrue(IzBib(self.nz_mms_id, zone='HPH', env='S', from_nz_mms_id=True, copy_nz_rec=True).error)
+        self.assertIsNone(self.alma.get_bib_mms_id('HPH', self.nz_mms_id))
+        self.assertEqual(self.alma.nb_injected, {'500': 2, '429': 1})
+        self.assertEqual(self.alma.nb_calls['POST bibs'], 1)
+
+    def test_load_seed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, 'seed.json')
+            with open(file_path, 'w') as f:
+                json.dump({'bibs': [{'zone': 'HPH', 'mms_id': '991'}],
+                           'holdings': [{'zone': 'HPH', 'mms_id': '991', 'holding_id': '221',
+                                         'library': 'HPH_LIB', 'location': 'HPH_LOC'}],
+                           'items': [{'zone': 'HPH', 'mms_id': '991', 'holding_id': '221', 'barcode': 'H001'}],
+                           'users': [{'zone': 'HPH', 'primary_id': 'U1'}],
+                           'loans': [{'zone': 'HPH', 'primary_id': 'U1', 'barcode': 'H001'}]}, f)
+            self.alma.load_seed(file_path)
+
+        item = Item(barcode='H001', zone='HPH', env='S')
+        self.assertEqual(item.library, 'HPH_LIB')
+        self.assertEqual(item.data.findtext('.//base_status'), '0')
+        self.assertFalse(item.scan_in('HPH_LIB', 'DESK').error)
+        self.assertEqual(list(self.alma.loans.values())[0]['loan_status'], 'COMPLETE')
+
+        with self.assertRaises(MockAlmaError):
+            self.alma.add_holding('HPH', '992', 'HPH_LIB', 'HPH_LOC')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+from utils import xlstools, planner
+from utils.processmonitoring import ProcessMonitor
+
+
+class TestPlanner(unittest.TestCase):
+    def setUp(self):
+        xlstools.set_config('test/test_data/test_data_IZ_to_IZ_1.xlsx')
+        ProcessMonitor.reset()
+        self.pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+
+    def tearDown(self):
+        import shutil
+        ProcessMonitor.reset()
+        shutil.rmtree('data', ignore_errors=True)
+
+    def test_count_polines_work(self):
+        self.assertEqual(planner.count_polines_work(self.pm),
+                         {'poline': 3, 'bib': 3, 'holding': 3, 'item': 6, 'pol_item': 0, 'rename': 6})
+
+        # Bib already copied by another row, only row of its bib and PoLine copied
+        self.pm.set_corresponding_mms_id('9972798270405504', '991')
+        self.pm.mark_copied(4)
+        work = planner.count_polines_work(self.pm)
+        self.assertEqual(work['poline'], 2)
+        self.assertEqual(work['bib'], 1)
+        self.assertEqual(work['item'], 5)
+
+    def test_make_plan(self):
+        plan = planner.make_plan(self.pm, latencies={})
+        self.assertEqual(plan['calls'], {'UBS': {'GET acq/po-lines': 3, 'GET bibs': 12, 'PUT bibs': 6},
+                                         'ISR': {'POST acq/po-lines': 3, 'GET bibs': 9, 'POST bibs': 12}})
+        self.assertEqual(plan['nb_calls'], 45)
+        self.assertEqual(plan['runtime_s'], 24.0)
+
+        # Shared among the workers, then limited by the rate of ISR
+        self.assertEqual(planner.make_plan(self.pm, 4, latencies={})['runtime_s'], 6.0)
+        self.assertEqual(planner.make_plan(self.pm, 4, {'UBS': 1, 'ISR': 1}, latencies={})['runtime_s'], 24.0)
+
+        # Measured latencies
+        plan = planner.make_plan(self.pm, latencies={'GET bibs': {'nb_calls': 10, 'mean_s': 0.1}})
+        self.assertEqual(plan['runtime_s'], 19.8)
+        self.assertEqual(plan['nb_calls_default_latency'], 24)
+
+    def test_save_latencies(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, 'latencies.json')
+            planner.save_latencies({'GET bibs': (2, 1.0)}, file_path)
+            planner.save_latencies({'GET bibs': (2, 0.2), 'POST bibs': (1, 0.8)}, file_path)
+            self.assertEqual(planner.load_latencies(file_path),
+                             {'GET bibs': {'nb_calls': 4, 'mean_s': 0.3},
+                              'POST bibs': {'nb_calls': 1, 'mean_s': 0.8}})
+
+if __name__ == '__main__':
+    unittest.main()
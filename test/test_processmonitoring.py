@@ -1,7 +1,10 @@
+import atexit
 import os
+import sqlite3
 import pandas as pd
 import unittest
-from utils.processmonitoring import ProcessMonitor
+from utils.processmonitoring import ProcessMonitor, JournaledProcessMonitor, SqliteProcessMonitor, BufferedProcessMonitor
+from utils.processmonitoring import create_process_monitor
 
 
 class TestProcessMonitor(unittest.TestCase):
@@ -21,7 +24,8 @@ class TestProcessMonitor(unittest.TestCase):
     def test_get_columns_polines(self):
         cols = self.pm.get_columns()
         self.assertEqual(cols, ['PoLine_s', 'MMS_id_s', 'Holding_id_s', 'Item_id_s', 'PoLine_d', 'MMS_id_d', 'Holding_id_d',
-                                'Item_id_d', 'Purchase_type', 'Received', 'Copied', 'Error'])
+                                'Item_id_d', 'Purchase_type', 'Received', 'Stage', 'Copied', 'Error', 'Retries',
+                                'API_calls', 'API_ms'])
 
     def test_create_and_save(self):
         self.assertIsInstance(self.pm.df, pd.DataFrame)
@@ -41,5 +45,215 @@ class TestProcessMonitor(unittest.TestCase):
         self.pm.set_corresponding_poline('POL-UBS-2025-167396', 'POL-ISR-2025-167388', 'PRINTED_BOOK_OT')
         self.assertEqual(self.pm.get_corresponding_poline('POL-UBS-2025-167396'), ('POL-ISR-2025-167388', 'PRINTED_BOOK_OT'))
 
+    def test_set_and_get_mms_id(self):
+        self.assertIsNone(self.pm.get_corresponding_mms_id('9972798270405504'))
+        self.pm.set_corresponding_mms_id('9972798270405504', '991000000000005525')
+        self.assertEqual(self.pm.get_corresponding_mms_id('9972798270405504'), '991000000000005525')
+        self.assertEqual(list(self.pm.df.loc[self.pm.df['MMS_id_s'] == '9972798270405504', 'MMS_id_d']),
+                         ['991000000000005525'] * 3)
+        self.assertIsNone(self.pm.get_corresponding_mms_id('9940475580105504'))
+
+    def test_index_updated_with_set_value(self):
+        self.assertEqual(self.pm.get_rows('Holding_id_s', '22434853660005504'), [1, 2, 3])
+        self.pm.set_value(2, 'Holding_id_s', '22459806010005504')
+        self.assertEqual(self.pm.get_rows('Holding_id_s', '22434853660005504'), [1, 3])
+        self.assertEqual(self.pm.get_rows('Holding_id_s', '22459806010005504'), [2, 4])
+        self.pm.set_corresponding_holding_id('22459806010005504', '2213180530005525')
+        self.assertEqual(self.pm.df.at[2, 'Holding_id_d'], '2213180530005525')
+        self.assertTrue(pd.isnull(self.pm.df.at[1, 'Holding_id_d']))
+
+    def test_stages(self):
+        self.assertFalse(self.pm.stage_reached(1, 'poline_created'))
+        self.pm.set_stage(1, 'holding_ready')
+        self.assertTrue(self.pm.stage_reached(1, 'poline_created'))
+        self.assertTrue(self.pm.stage_reached(1, 'holding_ready'))
+        self.assertFalse(self.pm.stage_reached(1, 'item_created'))
+
+        # A previous stage doesn't overwrite a later one
+        self.pm.set_stage(1, 'poline_created')
+        self.assertEqual(self.pm.df.at[1, 'Stage'], 'holding_ready')
+
+    def test_load_file_without_stage(self):
+        self.pm.df.drop(columns=['Stage']).to_csv(self.pm.file_path, index=False)
+        ProcessMonitor.reset()
+        self.pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+        self.assertEqual(list(self.pm.df.columns), self.pm.get_columns())
+        self.assertFalse(self.pm.stage_reached(1, 'poline_created'))
+
+    def test_increment(self):
+        self.pm.increment(2, 'Retries')
+        self.pm.increment(2, 'Retries', 2)
+        self.pm.save()
+        ProcessMonitor.reset()
+        self.pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+        self.assertEqual(self.pm.df.at[2, 'Retries'], 3)
+        self.assertTrue(pd.isnull(self.pm.df.at[1, 'Retries']))
+
+
+class TestJournaledProcessMonitor(unittest.TestCase):
+    def setUp(self):
+        ProcessMonitor.reset()
+        self.pm = JournaledProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+
+    def tearDown(self):
+        import shutil
+        atexit.unregister(self.pm.close)
+        ProcessMonitor.reset()
+        shutil.rmtree('data', ignore_errors=True)
+
+    def test_singleton_shared_with_subclass(self):
+        self.assertIs(ProcessMonitor(), self.pm)
+
+    def test_replay_journal(self):
+        self.pm.set_corresponding_mms_id('9972798270405504', '991000000000005525')
+        self.pm.mark_copied(4)
+        self.pm.save()
+        self.assertTrue(os.path.isfile('data/test_data_IZ_to_IZ_1_PoLines_processing.journal'))
+
+        # CSV file is not rewritten, only the journal
+        df = pd.read_csv(self.pm.file_path, dtype=str)
+        self.assertTrue(pd.isnull(df.at[0, 'MMS_id_d']))
+
+        # Simulate a new run after a crash
+        atexit.unregister(self.pm.close)
+        ProcessMonitor.reset()
+        self.pm = JournaledProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+        self.assertEqual(self.pm.get_corresponding_mms_id('9972798270405504'), '991000000000005525')
+        self.assertTrue(self.pm.df.at[4, 'Copied'])
+        self.assertFalse(self.pm.df.at[3, 'Copied'])
+
+    def test_compact(self):
+        self.pm.set_value(1, 'Error', 'Source Item not found')
+        self.pm.close()
+        self.assertEqual(os.path.getsize(self.pm.journal_path), 0)
+        df = pd.read_csv(self.pm.file_path, dtype=str)
+        self.assertEqual(df.at[0, 'Error'], 'Source Item not found')
+
+
+class TestSqliteProcessMonitor(unittest.TestCase):
+    def setUp(self):
+        ProcessMonitor.reset()
+        self.pm = SqliteProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+
+    def tearDown(self):
+        import shutil
+        atexit.unregister(self.pm.close)
+        self.pm.close()
+        ProcessMonitor.reset()
+        shutil.rmtree('data', ignore_errors=True)
+
+    def test_save_and_query(self):
+        self.pm.set_corresponding_poline('POL-UBS-2025-167396', 'POL-ISR-2025-167388', 'PRINTED_BOOK_OT')
+        self.pm.mark_copied(1)
+        self.pm.save()
+
+        conn = sqlite3.connect(self.pm.db_path)
+        rows = conn.execute('SELECT row_id, PoLine_d, Copied FROM processing WHERE PoLine_s = ?',
+                            ('POL-UBS-2025-167396',)).fetchall()
+        indexes = [row[1] for row in conn.execute("SELECT * FROM sqlite_master WHERE type = 'index'")]
+        conn.close()
+        self.assertEqual(rows, [(1, 'POL-ISR-2025-167388', 1),
+                                (2, 'POL-ISR-2025-167388', 0),
+                                (3, 'POL-ISR-2025-167388', 0)])
+        self.assertIn('idx_MMS_id_s', indexes)
+
+    def test_load_existing_db(self):
+        self.pm.set_corresponding_mms_id('9972798270405504', '991000000000005525')
+        self.pm.increment(2, 'Retries')
+        self.pm.save()
+        atexit.unregister(self.pm.close)
+        self.pm.conn.close()
+        ProcessMonitor.reset()
+
+        self.pm = SqliteProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+        self.assertEqual(self.pm.get_corresponding_mms_id('9972798270405504'), '991000000000005525')
+        self.assertFalse(self.pm.df.at[2, 'Copied'])
+        self.assertEqual(self.pm.df.at[2, 'Retries'], 1)
+
+        self.pm.close()
+        df = pd.read_csv(self.pm.file_path, dtype=str)
+        self.assertEqual(df.at[2, 'MMS_id_d'], '991000000000005525')
+
+
+class TestBufferedProcessMonitor(unittest.TestCase):
+    def setUp(self):
+        ProcessMonitor.reset()
+        self.pm = BufferedProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines",
+                                         flush_interval=60, flush_changes=3)
+
+    def tearDown(self):
+        import shutil
+        atexit.unregister(self.pm.close)
+        self.pm.close()
+        ProcessMonitor.reset()
+        shutil.rmtree('data', ignore_errors=True)
+
+    def read_csv(self):
+        return pd.read_csv(self.pm.file_path, dtype=str)
+
+    def test_flush_on_close(self):
+        self.pm.close()
+        self.assertTrue(os.path.isfile(self.pm.file_path))
+        self.assertFalse(os.path.isfile(f'{self.pm.file_path}.tmp'))
+
+        self.pm.set_value(1, 'Error', 'Source Item not found')
+        self.pm.save()
+        self.assertTrue(pd.isnull(self.read_csv().at[0, 'Error']))
+        self.pm.flush()
+        self.assertEqual(self.read_csv().at[0, 'Error'], 'Source Item not found')
+
+    def test_flush_after_changes(self):
+        self.pm.set_corresponding_mms_id('9972798270405504', '991000000000005525')
+        self.pm.save()
+        for _ in range(50):
+            if os.path.isfile(self.pm.file_path) and self.read_csv().at[2, 'MMS_id_d'] == '991000000000005525':
+                break
+            self.pm._writer.join(timeout=0.1)
+        self.assertEqual(self.read_csv().at[2, 'MMS_id_d'], '991000000000005525')
+
+
+class TestReadOnlyProcessMonitor(unittest.TestCase):
+    excel_filepath = 'test/test_data/test_data_IZ_to_IZ_1.xlsx'
+
+    def tearDown(self):
+        import shutil
+        ProcessMonitor.reset()
+        shutil.rmtree('data', ignore_errors=True)
+
+    def read_only(self, storage):
+        ProcessMonitor.reset()
+        return create_process_monitor(self.excel_filepath, 'PoLines', storage, read_only=True)
+
+    def test_without_previous_run(self):
+        pm = self.read_only('buffered')
+        self.assertEqual(len(pm.df.index), 6)
+        pm.set_value(1, 'Error', 'Source Item not found')
+        pm.save()
+        self.assertFalse(os.path.exists('data'))
+
+    def test_journal(self):
+        pm = JournaledProcessMonitor(self.excel_filepath, 'PoLines')
+        atexit.unregister(pm.close)
+        pm.mark_copied(4)
+        pm.save()
+        journal_size = os.path.getsize(pm.journal_path)
+
+        pm = self.read_only('journal')
+        self.assertTrue(pm.df.at[4, 'Copied'])
+        self.assertEqual(os.path.getsize(pm.journal_path), journal_size)
+
+    def test_sqlite(self):
+        pm = SqliteProcessMonitor(self.excel_filepath, 'PoLines')
+        atexit.unregister(pm.close)
+        pm.increment(2, 'Retries')
+        pm.save()
+        pm.conn.close()
+        os.remove(pm.file_path)
+
+        pm = self.read_only('sqlite')
+        self.assertEqual(pm.df.at[2, 'Retries'], 1)
+        self.assertFalse(os.path.isfile(pm.file_path))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
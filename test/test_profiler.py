@@ -0,0 +1,110 @@
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+import unittest
+from almapiwrapper.inventory import Item
+from utils import apicalls, profiler, runner, stagestats
+from utils.mockalma import MockAlma, MockAlmaServer
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.trace_path = os.path.join(self.tmp_dir.name, 'trace.json')
+        self.cprofile_path = os.path.join(self.tmp_dir.name, 'profile.pstats')
+
+    def tearDown(self):
+        profiler.install()
+        self.tmp_dir.cleanup()
+
+    def load_trace(self):
+        with open(self.trace_path) as f:
+            events = json.load(f)
+        return [event for event in events if event['ph'] == 'X']
+
+    def test_nested_spans(self):
+        # Without install, nothing is recorded
+        with profiler.span('bib_copy'):
+            pass
+
+        prof = profiler.install(self.trace_path, describe_row=lambda i: f'barcode B{i:03d}')
+        with runner.current_row(3):
+            with stagestats.timed('item_create'):
+                with profiler.span('pm.save', profiler.CATEGORY_SAVE):
+                    time.sleep(0.02)
+                    with profiler.span('pm.write_csv', profiler.CATEGORY_SAVE):
+                        time.sleep(0.01)
+        profiler.install()
+
+        events = {event['name']: event for event in self.load_trace()}
+        self.assertEqual(set(events), {'row', 'item_create', 'pm.save', 'pm.write_csv'})
+        row = events['row']
+        self.assertEqual(row['args']['row'], 3)
+        self.assertEqual(row['args']['record'], 'barcode B003')
+        self.assertEqual(events['item_create']['cat'], profiler.CATEGORY_STAGE)
+
+        # The nested write is not counted twice
+        self.assertGreaterEqual(row['args']['save_ms'], 30)
+        self.assertLess(row['args']['save_ms'], 45)
+        for name in ['item_create', 'pm.save', 'pm.write_csv']:
+            self.assertGreaterEqual(events[name]['ts'], row['ts'])
+            self.assertLessEqual(events[name]['ts'] + events[name]['dur'], row['ts'] + row['dur'] + 1)
+
+        summary = prof.get_summary()
+        self.assertEqual(summary['nb_rows'], 1)
+        self.assertEqual(summary['api_ms'], 0)
+
+    def test_threads_and_cprofile(self):
+        profiler.install(self.trace_path, self.cprofile_path)
+
+        def process(i):
+            with runner.current_row(i):
+                sum(range(10000))
+
+        threads = [threading.Thread(target=process, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profiler.install()
+
+        rows = [event for event in self.load_trace() if event['name'] == 'row']
+        self.assertEqual(sorted(event['args']['row'] for event in rows), [0, 1, 2, 3])
+        self.assertEqual(len({event['tid'] for event in rows}), 4)
+
+        stats = pstats.Stats(self.cprofile_path)
+        self.assertTrue(any('sum' in function[2] for function in stats.stats))
+
+    def test_api_spans(self):
+        alma = MockAlma()
+        mms_id = alma.add_bib('UBS', nz_mms_id=alma.add_bib('NZ'))
+        alma.add_item('UBS', mms_id, alma.add_holding('UBS', mms_id, 'UBS_LIB', 'UBS_LOC'), 'B001')
+        server = MockAlmaServer(alma).start()
+        apicalls.set_base_url(server.url)
+        try:
+            prof = profiler.install(self.trace_path)
+            with runner.current_row(0):
+                Item(barcode='B001', zone='UBS', env='S')
+            profiler.install()
+        finally:
+            apicalls.set_base_url(None)
+            server.stop()
+
+        events = self.load_trace()
+        api_events = [event for event in events if event['cat'] == profiler.CATEGORY_API]
+        self.assertEqual(len(api_events), sum(alma.nb_calls.values()))
+        self.assertTrue(all(event['args']['zone'] == 'UBS' for event in api_events))
+        self.assertEqual([event['name'] for event in api_events][0], 'GET items')
+        self.assertTrue(all(event['args']['status'] == 200 for event in api_events))
+        self.assertNotIn('apikey', json.dumps(events))
+
+        row = [event for event in events if event['name'] == 'row'][0]
+        self.assertGreater(row['args']['api_ms'], 0)
+        self.assertEqual(prof.get_summary()['nb_rows'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
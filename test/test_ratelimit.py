@@ -0,0 +1,60 @@
+import time
+import unittest
+from utils import apicalls
+from utils.ratelimit import TokenBucket, RateLimiter
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(50)
+        bucket.tokens = 0
+        bucket.timestamp = time.monotonic()
+        t0 = time.monotonic()
+        for _ in range(10):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - t0, 0.18)
+
+        metrics = bucket.get_metrics()
+        self.assertEqual(metrics['nb_calls'], 10)
+        self.assertGreaterEqual(metrics['nb_waits'], 9)
+        self.assertAlmostEqual(metrics['total_wait'], 0.2, delta=0.03)
+
+    def test_burst(self):
+        bucket = TokenBucket(5)
+        for _ in range(5):
+            self.assertEqual(bucket.acquire(), 0.0)
+        self.assertGreater(bucket.acquire(), 0.0)
+
+    def test_no_limit(self):
+        bucket = TokenBucket(0)
+        for _ in range(100):
+            self.assertEqual(bucket.acquire(), 0.0)
+        self.assertEqual(bucket.get_metrics()['nb_calls'], 100)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def tearDown(self):
+        apicalls.remove_middleware(self.limiter)
+
+    def test_budget_by_zone(self):
+        self.limiter = RateLimiter({'UBS': 5, 'ISR': 0}, default_rate=10)
+
+        def short_circuit(call_next, method, *args, **kwargs):
+            return method
+
+        apicalls.add_middleware(self.limiter)
+        apicalls.add_middleware(short_circuit)
+
+        for zone in ['UBS', 'ISR', 'ISR', 'NZ']:
+            headers = apicalls.AlmaHeaders({}, zone, 'Bibs', 'S')
+            self.assertEqual(apicalls.call('get', 'https://example.org', headers=headers), 'get')
+        apicalls.remove_middleware(short_circuit)
+
+        metrics = self.limiter.get_metrics()
+        self.assertEqual(metrics['UBS']['nb_calls'], 1)
+        self.assertEqual(metrics['ISR']['nb_calls'], 2)
+        self.assertEqual(metrics['NZ']['rate'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
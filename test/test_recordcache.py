@@ -0,0 +1,113 @@
+import unittest
+import requests
+from utils import apicalls
+from utils.recordcache import RecordCache, get_record_key
+
+BASE_URL = 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1'
+
+
+def make_response(url, status_code=200, content=b'<bib/>'):
+    r = requests.Response()
+    r.status_code = status_code
+    r.url = url
+    r._content = content
+    return r
+
+
+class TestRecordCache(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.redirects = {}
+        self.cache = RecordCache()
+
+        def fake_alma(call_next, method, *args, **kwargs):
+            self.calls.append((method, args[0]))
+            return make_response(self.redirects.get(args[0], args[0]), 404 if 'missing' in args[0] else 200)
+
+        self.fake_alma = fake_alma
+        apicalls.add_middleware(self.cache)
+        apicalls.add_middleware(self.fake_alma)
+
+    def tearDown(self):
+        apicalls.remove_middleware(self.cache)
+        apicalls.remove_middleware(self.fake_alma)
+
+    def call(self, method, url, zone='UBS'):
+        return apicalls.call(method, url, headers=apicalls.AlmaHeaders({'accept': 'application/xml'},
+                                                                      zone, 'Bibs', 'S'))
+
+    def test_get_record_key(self):
+        self.assertEqual(get_record_key(f'{BASE_URL}/bibs/991/holdings/22/items/23', 'UBS', 'S'),
+                         ('UBS', 'S', 'bibs', '991'))
+        self.assertEqual(get_record_key(f'{BASE_URL}/acq/po-lines/POL-1?op=receive', 'ISR', 'P'),
+                         ('ISR', 'P', 'acq/po-lines', 'POL-1'))
+        self.assertEqual(get_record_key(f'{BASE_URL}/items', 'UBS', 'S'), ('UBS', 'S', 'items', None))
+        self.assertIsNone(get_record_key('https://example.org/test', 'UBS', 'S'))
+
+    def test_read_through(self):
+        self.call('get', f'{BASE_URL}/bibs/991')
+        self.call('get', f'{BASE_URL}/bibs/991')
+        self.call('get', f'{BASE_URL}/bibs/991', zone='ISR')
+        self.assertEqual(len(self.calls), 2)
+
+        # Errors are not kept
+        self.call('get', f'{BASE_URL}/bibs/missing')
+        self.call('get', f'{BASE_URL}/bibs/missing')
+        self.assertEqual(len(self.calls), 4)
+        self.assertEqual(self.cache.get_metrics()['hits'], 1)
+
+    def test_write_invalidates_record(self):
+        self.call('get', f'{BASE_URL}/bibs/991')
+        self.call('get', f'{BASE_URL}/bibs/991/holdings/22')
+        self.call('get', f'{BASE_URL}/bibs/992')
+        self.call('put', f'{BASE_URL}/bibs/991/holdings/22')
+        self.call('get', f'{BASE_URL}/bibs/991')
+        self.call('get', f'{BASE_URL}/bibs/991/holdings/22')
+        self.call('get', f'{BASE_URL}/bibs/992')
+        self.assertEqual([url for method, url in self.calls if method == 'get'],
+                         [f'{BASE_URL}/bibs/991', f'{BASE_URL}/bibs/991/holdings/22', f'{BASE_URL}/bibs/992',
+                          f'{BASE_URL}/bibs/991', f'{BASE_URL}/bibs/991/holdings/22'])
+
+    def test_write_invalidates_redirected_search(self):
+        # Item fetched with its barcode, Alma redirects to the item URL
+        self.redirects[f'{BASE_URL}/items'] = f'{BASE_URL}/bibs/991/holdings/22/items/23'
+        self.call('get', f'{BASE_URL}/items')
+        self.call('get', f'{BASE_URL}/items')
+        self.assertEqual(len(self.calls), 1)
+
+        self.call('put', f'{BASE_URL}/bibs/991/holdings/22/items/23')
+        self.call('get', f'{BASE_URL}/items')
+        self.assertEqual(len(self.calls), 3)
+
+        # A loan changes the item
+        self.call('post', f'{BASE_URL}/users/123/loans')
+        self.call('get', f'{BASE_URL}/items')
+        self.assertEqual(len(self.calls), 5)
+
+    def test_size_bound(self):
+        # Room for 3 responses
+        cache = RecordCache(max_size=3 * (50 + len(f'{BASE_URL}/bibs/991')))
+        for mms_id in ['991', '992', '993']:
+            url = f'{BASE_URL}/bibs/{mms_id}'
+            cache.put((url,), [('UBS', 'S', 'bibs', mms_id)], make_response(url, content=b'x' * 50))
+        cache.get((f'{BASE_URL}/bibs/991',))
+
+        url = f'{BASE_URL}/bibs/994'
+        cache.put((url,), [('UBS', 'S', 'bibs', '994')], make_response(url, content=b'x' * 50))
+
+        # Least recently used response removed
+        self.assertIsNone(cache.get((f'{BASE_URL}/bibs/992',)))
+        self.assertIsNotNone(cache.get((f'{BASE_URL}/bibs/991',)))
+        self.assertLessEqual(cache.size, cache.max_size)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_outdated_response_not_stored(self):
+        url = f'{BASE_URL}/bibs/991'
+        cache = RecordCache()
+        cache.invalidate('UBS', 'S', 'bibs', '991')
+        self.assertFalse(cache.put((url,), [('UBS', 'S', 'bibs', '991')], make_response(url), write_number=0))
+        self.assertTrue(cache.put((url,), [('UBS', 'S', 'bibs', '991')], make_response(url), write_number=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
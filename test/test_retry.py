@@ -0,0 +1,102 @@
+import unittest
+import requests
+from utils import runner
+from utils.processmonitoring import ProcessMonitor
+from utils.retry import RetryMiddleware, is_transient_status, is_transient_exception
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.retry = RetryMiddleware(max_retries=3, base_delay=0.001)
+
+    def make_call_next(self, results):
+        results = list(results)
+        self.nb_calls = 0
+
+        def call_next(method, *args, **kwargs):
+            self.nb_calls += 1
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return call_next
+
+    def test_classification(self):
+        self.assertTrue(is_transient_status(429))
+        self.assertTrue(is_transient_status(503))
+        self.assertFalse(is_transient_status(400))
+        self.assertFalse(is_transient_status(404))
+        self.assertTrue(is_transient_status(429, 'post'))
+        self.assertFalse(is_transient_status(503, 'post'))
+        self.assertTrue(is_transient_exception(requests.exceptions.ReadTimeout()))
+        self.assertTrue(is_transient_exception(requests.exceptions.ConnectionError()))
+        self.assertFalse(is_transient_exception(requests.exceptions.InvalidURL()))
+        self.assertFalse(is_transient_exception(requests.exceptions.ReadTimeout(), 'post'))
+        self.assertTrue(is_transient_exception(requests.exceptions.ConnectTimeout(), 'post'))
+
+    def test_transient_errors_retried(self):
+        call_next = self.make_call_next([FakeResponse(503), requests.exceptions.ReadTimeout(), FakeResponse(200)])
+        r = self.retry(call_next, 'get', 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/items')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.nb_calls, 3)
+        self.assertEqual(self.retry.retries, {'HTTP 503': 1, 'ReadTimeout': 1})
+
+    def test_permanent_error_not_retried(self):
+        call_next = self.make_call_next([FakeResponse(400), FakeResponse(200)])
+        r = self.retry(call_next, 'put', 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/items')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.nb_calls, 1)
+
+    def test_post_server_error_not_retried(self):
+        # The record may have been created before the error
+        call_next = self.make_call_next([FakeResponse(503), FakeResponse(200)])
+        r = self.retry(call_next, 'post', 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/bibs/991/holdings')
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(self.nb_calls, 1)
+        self.assertEqual(self.retry.retries, {})
+
+        call_next = self.make_call_next([FakeResponse(429), FakeResponse(200)])
+        r = self.retry(call_next, 'post', 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/bibs/991/holdings')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.nb_calls, 2)
+
+    def test_retries_exhausted(self):
+        call_next = self.make_call_next([FakeResponse(429)] * 4)
+        r = self.retry(call_next, 'get', 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/items')
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(self.nb_calls, 4)
+
+        call_next = self.make_call_next([requests.exceptions.ConnectionError()] * 4)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.retry(call_next, 'get', 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/items')
+
+    def test_delay(self):
+        retry = RetryMiddleware(base_delay=1, max_delay=10)
+        for attempt in range(6):
+            self.assertLessEqual(retry.get_delay(attempt), min(10, 2 ** attempt))
+        self.assertEqual(retry.get_delay(0, '5'), 5)
+
+    def test_retries_by_row(self):
+        ProcessMonitor.reset()
+        pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+        try:
+            call_next = self.make_call_next([FakeResponse(502), FakeResponse(502), FakeResponse(200)])
+            with runner.current_row(2):
+                self.retry(call_next, 'get', 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/items')
+            self.assertEqual(pm.df.at[2, 'Retries'], 2)
+            self.assertIsNone(runner.get_current_row())
+        finally:
+            import shutil
+            ProcessMonitor.reset()
+            shutil.rmtree('data', ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
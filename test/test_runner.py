@@ -0,0 +1,247 @@
+import threading
+import time
+import unittest
+from utils.concurrency import KeyedLocks, AdaptiveLimit, AimdController, percentile
+from utils.processmonitoring import ProcessMonitor
+from utils import runner
+
+
+class TestKeyedLocks(unittest.TestCase):
+    def test_same_key_serialized(self):
+        locks = KeyedLocks()
+        active = []
+        overlaps = []
+
+        def work(key):
+            with locks.hold(key):
+                active.append(key)
+                if active.count(key) > 1:
+                    overlaps.append(key)
+                time.sleep(0.01)
+                active.remove(key)
+
+        threads = [threading.Thread(target=work, args=(key,)) for key in ['a', 'a', 'b', 'a', 'b']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(overlaps, [])
+        self.assertEqual(len(locks), 0)
+
+
+class TestAimdController(unittest.TestCase):
+    def setUp(self):
+        self.limit = AdaptiveLimit(2, 8)
+        self.controller = AimdController(self.limit, window_calls=10)
+
+    def observe_window(self, latency, nb_errors=0):
+        for k in range(10):
+            self.controller.observe(latency, error=k < nb_errors)
+
+    def test_percentile(self):
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        self.assertEqual(percentile([0.3], 95), 0.3)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_additive_increase(self):
+        for _ in range(3):
+            self.observe_window(0.2)
+        self.assertEqual(self.limit.limit, 5)
+        for _ in range(10):
+            self.observe_window(0.2)
+        self.assertEqual(self.limit.limit, 8)
+
+    def test_multiplicative_decrease(self):
+        for _ in range(4):
+            self.observe_window(0.2)
+        self.assertEqual(self.limit.limit, 6)
+        self.observe_window(0.2, nb_errors=1)
+        self.assertEqual(self.limit.limit, 3)
+        self.observe_window(1.0)
+        self.assertEqual(self.limit.limit, 1)
+
+    def test_rows_limited(self):
+        limit = AdaptiveLimit(2, 4)
+        active = []
+        max_active = []
+
+        def work():
+            with limit.slot():
+                active.append(1)
+                max_active.append(len(active))
+                time.sleep(0.01)
+                active.pop()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(max(max_active), 2)
+
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        ProcessMonitor.reset()
+        self.pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+
+    def tearDown(self):
+        import shutil
+        ProcessMonitor.reset()
+        shutil.rmtree('data', ignore_errors=True)
+
+    def test_run_rows_sequential(self):
+        processed = []
+        runner.run_rows(processed.append, str)
+        self.assertEqual(processed, list(self.pm.df.index))
+
+    def test_run_rows_parallel(self):
+        def process_row(i):
+            self.pm.set_value(i, 'Error', f'row {i}')
+            self.pm.save()
+
+        runner.run_rows(process_row, str, workers=4)
+        self.assertEqual(list(self.pm.df['Error']), [f'row {i}' for i in self.pm.df.index])
+
+    def test_run_rows_adaptive(self):
+        processed = []
+        runner.run_rows(processed.append, str, workers=4, adaptive=True)
+        self.assertEqual(sorted(processed), list(self.pm.df.index))
+
+    def test_run_rows_exception(self):
+        def process_row(i):
+            if i == 2:
+                raise SystemExit(1)
+
+        with self.assertRaises(SystemExit):
+            runner.run_rows(process_row, str, workers=2)
+
+    def test_wait_for(self):
+        results = iter([1, 2, 3, 4])
+        result = runner.wait_for(lambda: next(results), lambda n: n >= 3, 0, 'test', base_delay=0.01)
+        self.assertEqual(result, 3)
+
+        # Last result returned after the timeout
+        result = runner.wait_for(lambda: 0, bool, 0, 'test', base_delay=0.01, timeout=0.05)
+        self.assertEqual(result, 0)
+
+
+class TestGroupScheduler(unittest.TestCase):
+    def setUp(self):
+        ProcessMonitor.reset()
+        self.pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "PoLines")
+        self.created = []
+
+    def tearDown(self):
+        import shutil
+        ProcessMonitor.reset()
+        shutil.rmtree('data', ignore_errors=True)
+
+    def create_records(self, i):
+        mms_id_s = self.pm.df.at[i, 'MMS_id_s']
+        holding_id_s = self.pm.df.at[i, 'Holding_id_s']
+        # No lock: concurrent rows of the same bib would create the records twice
+        if self.pm.get_corresponding_mms_id(mms_id_s) is None:
+            time.sleep(0.01)
+            self.created.append(mms_id_s)
+            self.pm.set_corresponding_mms_id(mms_id_s, 'D' + mms_id_s)
+        if self.pm.get_corresponding_holding_id(holding_id_s) is None:
+            time.sleep(0.01)
+            self.created.append(holding_id_s)
+            self.pm.set_corresponding_holding_id(holding_id_s, 'D' + holding_id_s)
+        self.pm.mark_copied(i)
+
+    def test_plan(self):
+        self.pm.mark_copied(6)
+        bibs, unknown = runner.GroupScheduler(self.create_records, str, 4).plan()
+        self.assertEqual(bibs, {'9972798270405504': {'22434853660005504': [1, 2, 3]},
+                                '9940475580105504': {'22459806010005504': [4]},
+                                '9972977285705504': {'22458975980005504': [5]}})
+        self.assertEqual(unknown, [])
+
+    def test_records_created_once(self):
+        runner.run_grouped_rows(self.create_records, str, workers=4)
+        self.assertEqual(len(self.created), 6)
+        self.assertEqual(len(set(self.created)), 6)
+        self.assertTrue(self.pm.df['Copied'].all())
+
+    def test_next_row_leads_after_failure(self):
+        processed = []
+
+        def process_row(i):
+            processed.append(i)
+            if i != 1:
+                self.create_records(i)
+
+        runner.run_grouped_rows(process_row, str, workers=4)
+        self.assertLess(processed.index(1), processed.index(2))
+        self.assertEqual(len(set(self.created)), len(self.created))
+        self.assertEqual(list(self.pm.df['Copied']), [False, True, True, True, True, True])
+
+    def test_records_created_once_adaptive(self):
+        runner.run_grouped_rows(self.create_records, str, workers=4, adaptive=True)
+        self.assertEqual(len(set(self.created)), 6)
+        self.assertTrue(self.pm.df['Copied'].all())
+
+    def test_deferred_row_releases_worker(self):
+        finished = []
+        t0 = time.monotonic()
+
+        def process_row(i):
+            if i in [1, 4]:
+                runner.wait_for(lambda: time.monotonic() - t0 > 0.2, bool, False, f'row {i}', base_delay=0.1)
+            self.create_records(i)
+            finished.append(i)
+
+        runner.run_grouped_rows(process_row, str, workers=2)
+
+        # Both workers are free while rows 1 and 4 wait
+        self.assertLess(finished.index(5), finished.index(1))
+        self.assertLess(finished.index(5), finished.index(4))
+
+        # Row 1 still leads its bib and holding while it waits
+        self.assertLess(finished.index(1), finished.index(2))
+        self.assertEqual(len(set(self.created)), len(self.created))
+        self.assertTrue(self.pm.df['Copied'].all())
+
+    def test_fetch_keys(self):
+        ProcessMonitor.reset()
+        self.pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "Items")
+
+        def fetch_keys(i):
+            self.pm.set_value(i, 'MMS_id_s', 'bib' + str(i % 2))
+            self.pm.set_value(i, 'Holding_id_s', 'hol' + str(i % 2))
+            return True
+
+        runner.run_grouped_rows(self.create_records, str, workers=3, fetch_keys=fetch_keys)
+        self.assertEqual(sorted(self.created), ['bib0', 'bib1', 'hol0', 'hol1'])
+        self.assertTrue(self.pm.df['Copied'].all())
+
+    def test_prefetch_rows(self):
+        ProcessMonitor.reset()
+        self.pm = ProcessMonitor('test/test_data/test_data_IZ_to_IZ_1.xlsx', "Items")
+        self.pm.mark_copied(1)
+        fetched = []
+
+        def fetch_keys(i):
+            fetched.append(i)
+            if i == 2:
+                self.pm.set_value(i, 'Error', 'Source Item not found')
+                return False
+            self.pm.set_value(i, 'MMS_id_s', 'bib' + str(i % 2))
+            self.pm.set_value(i, 'Holding_id_s', 'hol' + str(i % 2))
+            return True
+
+        nb_rows = len(self.pm.df.index)
+        self.assertEqual(runner.prefetch_rows(fetch_keys, str, workers=4), nb_rows - 2)
+        self.assertEqual(sorted(fetched), list(self.pm.df.index[1:]))
+
+        # All groups known before the transfer, the failed row is fetched again
+        bibs, unknown = runner.GroupScheduler(self.create_records, str, 4, fetch_keys).plan()
+        self.assertEqual(sorted(bibs), ['bib0', 'bib1'])
+        self.assertEqual(unknown, [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
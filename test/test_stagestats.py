@@ -0,0 +1,62 @@
+import time
+import unittest
+from utils import stagestats
+from utils.stagestats import LatencyHistogram, StageStats
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+
+        summary = histogram.get_summary()
+        self.assertEqual(summary['count'], 1000)
+        self.assertEqual(summary['mean_ms'], 500.5)
+        self.assertEqual(summary['max_ms'], 1000)
+
+        # Precise to about 3%
+        for p in [50, 95, 99]:
+            self.assertLessEqual(summary[f'p{p}_ms'], p * 10)
+            self.assertGreater(summary[f'p{p}_ms'], p * 10 * 0.96)
+
+        # Small values are exact
+        self.assertEqual(LatencyHistogram.get_bucket(37.8), 37)
+        self.assertEqual(LatencyHistogram().percentile(50), 0)
+
+
+class TestStageStats(unittest.TestCase):
+    def tearDown(self):
+        stagestats.stage_stats = None
+
+    def test_inner_stage_excluded(self):
+        stats = StageStats(log_interval=0)
+        with stats.stage('poline_copy'):
+            time.sleep(0.02)
+            with stats.stage('bib_copy'):
+                time.sleep(0.05)
+
+        summary = stats.get_summary()
+        self.assertGreaterEqual(summary['bib_copy']['max_ms'], 50)
+        self.assertLess(summary['poline_copy']['max_ms'], 45)
+
+    def test_exception_not_counted(self):
+        stats = StageStats(log_interval=0)
+        with self.assertRaises(ValueError):
+            with stats.stage('item_create'):
+                raise ValueError('test')
+        self.assertEqual(stats.get_summary(), {})
+
+    def test_timed(self):
+        # Without install, nothing is measured
+        with stagestats.timed('reception'):
+            pass
+
+        stagestats.stage_stats = StageStats(log_interval=0)
+        with stagestats.timed('reception'):
+            pass
+        self.assertEqual(stagestats.stage_stats.get_summary()['reception']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
+import os
+import tempfile
 import unittest
+from unittest import mock
 from utils import xlstools
 
 import pandas as pd
@@ -27,6 +30,8 @@ class TestXlsTools(unittest.TestCase):
         self.assertEqual(xlstools.get_config().get('circ_desk_s'), 'A100_KUR')
         self.assertEqual(xlstools.get_config().get('circ_desk_d'), 'DEFAULT_CIRC_DESK')
         self.assertIsNone(xlstools.get_config().get('cancel_note'))
+        self.assertIsNone(xlstools.get_config().get('api_rate_s'))
+        self.assertIsNone(xlstools.get_config().get('api_rate_d'))
 
     def test_polines_to_transfer(self):
         excel_path = 'test/test_data/test_data_IZ_to_IZ_1.xlsx'
@@ -75,6 +80,66 @@ class TestXlsTools(unittest.TestCase):
         fund = xlstools.get_corresponding_fund('test')
         self.assertEqual(fund, 'Fundforall')
 
+    def test_mapping_resolver(self):
+        table = pd.DataFrame({'Source library code': ['*DEFAULT*', 'A100', 'A100', '*DEFAULT*'],
+                              'Destination library code': [None, None, 'rro_fili', 'rro_default']}, dtype=str)
+        resolver = xlstools.MappingResolver(table, ['Source library code'], ['Destination library code'])
+
+        # The first row is used, even without destination value
+        self.assertTrue(pd.isnull(resolver.get('A100')[0]))
+
+        # Default rows without destination value are skipped
+        self.assertEqual(resolver.get_complete('*DEFAULT*'), ('rro_default',))
+        self.assertIsNone(resolver.get('A200'))
+
+    def test_load_form(self):
+        excel_path = 'test/test_data/test_data_IZ_to_IZ_1.xlsx'
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch.object(xlstools, 'FORM_CACHE_DIR', cache_dir):
+            # Cache of a previous version of the form and cache of another form with a longer name
+            for filename in ['test_data_IZ_to_IZ_1_0123456789abcdef.pkl', 'test_data_IZ_to_IZ_1_2_0123456789abcdef.pkl']:
+                open(os.path.join(cache_dir, filename), 'wb').close()
+
+            xlstools._forms_cache.clear()
+            form = xlstools.load_form(excel_path)
+            self.assertEqual(form.get_value(6, 2), 'UBS')
+            self.assertIsNone(form.get_value(1000, 2))
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.assertIn('test_data_IZ_to_IZ_1_2_0123456789abcdef.pkl', os.listdir(cache_dir))
+
+            # Same content as read with pandas
+            pd.testing.assert_frame_equal(form.sheets['PoLines'],
+                                          pd.read_excel(excel_path, sheet_name='PoLines', dtype=str))
+
+            # Loaded from the cache of the file, the workbook is not opened again
+            xlstools._forms_cache.clear()
+            with mock.patch.object(xlstools, 'read_form', side_effect=AssertionError('form parsed again')):
+                self.assertEqual(xlstools.get_form_version(excel_path), '5.0')
+                xlstools.set_config(excel_path)
+                self.assertEqual(xlstools.get_config().get('iz_d'), 'ISR')
+
+            with self.assertRaises(ValueError):
+                xlstools.get_data(excel_path, 'Unknown')
+
+            xlstools._forms_cache.clear()
+
+    def test_api_rates(self):
+        import openpyxl
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(xlstools, 'FORM_CACHE_DIR', tmp_dir):
+            excel_path = os.path.join(tmp_dir, 'form_rates.xlsx')
+            for value, expected in [('5', 5.0), ('5/s', None)]:
+                wb = openpyxl.load_workbook('test/test_data/test_data_IZ_to_IZ_1.xlsx')
+                wb['General'].append(['API calls per second IZ source', value])
+                wb.save(excel_path)
+
+                if expected is not None:
+                    xlstools.set_config(excel_path)
+                    self.assertEqual(xlstools.get_config()['api_rate_s'], expected)
+                else:
+                    with self.assertRaises(SystemExit):
+                        xlstools.set_config(excel_path)
+
+            xlstools._forms_cache.clear()
+
     def test_create_log_filename(self):
         test_cases = [
             ("log.txt", "log"),
@@ -25,14 +25,11 @@ if 'alma_api_keys' not in os.environ:
     dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
     load_dotenv(dotenv_path=dotenv_path)
 
-from utils import xlstools
+from utils import xlstools, cli
 
-# Check if the correct number of arguments is provided
-if len(sys.argv) != 2:
-    print("Usage : python transfer_iz_to_iz_bibs.py <dataForm.xlsx>")
-    sys.exit(1)
-
-excel_filepath = sys.argv[1]
+# Parse command line arguments
+args = cli.parse_args('transfer_iz_to_iz_bibs.py')
+excel_filepath = args.excel_filepath
 
 # Logging configuration
 log_filename = xlstools.get_raw_filename(excel_filepath)
@@ -40,27 +37,17 @@ config_log(log_filename)
 
 logging.info(f'Bib records transfer from IZ to IZ started: {excel_filepath}')
 
-# Check version of the Excel form
-version = xlstools.get_form_version(excel_filepath)
-if not version or not isinstance(version, str) or not version.replace('.', '', 1).isdigit():
-    logging.critical(f"Invalid version format in the Excel file: {version}")
-    sys.exit(1)
-elif version != EXCEL_FORM_VERSION:
-    logging.critical(f"Unsupported Excel form version: {version}. Expected version: {EXCEL_FORM_VERSION}")
-    sys.exit(1)
-
-# load configuration
-xlstools.set_config(excel_filepath)
-
-from utils import processes
-from utils.processmonitoring import ProcessMonitor
+# Check the form, load the configuration and install the options of the command line
+process_monitor = cli.setup_run(args, 'Bibs', EXCEL_FORM_VERSION,
+                                lambda i: f"bib record {process_monitor.df.at[i, 'MMS_id_s']}")
 
-# Initialize process monitor
-process_monitor = ProcessMonitor(excel_filepath, 'Bibs')
+from utils import processes, runner
 
 # Iterate over the PoLine numbers
 for i in process_monitor.df.index:
-    logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: bib record {process_monitor.df.at[i, 'MMS_id_s']}")
-    processes.bib(i)
+    # The API calls are counted for the row
+    with runner.current_row(i):
+        logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: bib record {process_monitor.df.at[i, 'MMS_id_s']}")
+        processes.bib(i)
 
 logging.info('Bib records transfer from IZ to IZ terminated')
@@ -19,7 +19,7 @@ from almapiwrapper.configlog import config_log
 from almapiwrapper.inventory import IzBib, Holding, Item
 from almapiwrapper.acquisitions import POLine, Vendor, Invoice, fetch_invoices
 
-from utils import xlstools
+from utils import xlstools, cli
 
 import os
 from dotenv import load_dotenv
@@ -29,12 +29,9 @@ if 'alma_api_keys' not in os.environ:
     dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
     load_dotenv(dotenv_path=dotenv_path)
 
-# Check if the correct number of arguments is provided
-if len(sys.argv) != 2:
-    print("Usage : python transfer_iz_to_iz_collections.py <dataForm.xlsx>")
-    sys.exit(1)
-
-excel_filepath = sys.argv[1]
+# Parse command line arguments
+args = cli.parse_args('transfer_iz_to_iz_collections.py')
+excel_filepath = args.excel_filepath
 
 # Logging configuration
 log_filename = xlstools.get_raw_filename(excel_filepath)
@@ -42,28 +39,18 @@ config_log(log_filename)
 
 logging.info(f'Add bibs to collections started: {excel_filepath}')
 
-# Check version of the Excel form
-version = xlstools.get_form_version(excel_filepath)
-if not version or not isinstance(version, str) or not version.replace('.', '', 1).isdigit():
-    logging.critical(f"Invalid version format in the Excel file: {version}")
-    sys.exit(1)
-elif version != EXCEL_FORM_VERSION:
-    logging.critical(f"Unsupported Excel form version: {version}. Expected version: {EXCEL_FORM_VERSION}")
-    sys.exit(1)
-
-# load configuration
-xlstools.set_config(excel_filepath)
-
-from utils import processes
-from utils.processmonitoring import ProcessMonitor
+# Check the form, load the configuration and install the options of the command line
+process_monitor = cli.setup_run(args, 'Collections', EXCEL_FORM_VERSION,
+                                lambda i: f"collection {process_monitor.df.at[i, 'Collection_id_s']}")
 
-# Initialize process monitor
-process_monitor = ProcessMonitor(excel_filepath, 'Collections')
+from utils import processes, runner
 
 # Iterate over the PoLine numbers
 for i in process_monitor.df.index:
-    logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: collection {process_monitor.df.at[i, 'Collection_id_s']}")
-    processes.collection(i)
+    # The API calls are counted for the row
+    with runner.current_row(i):
+        logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: collection {process_monitor.df.at[i, 'Collection_id_s']}")
+        processes.collection(i)
 
 logging.info('Add bib records to collections terminated')
 
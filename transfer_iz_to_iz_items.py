@@ -7,7 +7,7 @@
 # This file should be compliant with a given format
 
 # To start the script:
-# python transfer_iz_to_iz_items.py <dataForm.xlsx>
+# python transfer_iz_to_iz_items.py <dataForm.xlsx> [--workers N [--adaptive]] [--prefetch [N]]
 
 EXCEL_FORM_VERSION = '7.0'
 
@@ -18,7 +18,7 @@ from almapiwrapper.configlog import config_log
 from almapiwrapper.inventory import IzBib, Holding, Item
 from almapiwrapper.acquisitions import POLine, Vendor, Invoice, fetch_invoices
 
-from utils import xlstools
+from utils import xlstools, cli
 
 import os
 from dotenv import load_dotenv
@@ -28,12 +28,9 @@ if 'alma_api_keys' not in os.environ:
     dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
     load_dotenv(dotenv_path=dotenv_path)
 
-# Check if the correct number of arguments is provided
-if len(sys.argv) != 2:
-    print("Usage : python transfer_iz_to_iz_items.py <dataForm.xlsx>")
-    sys.exit(1)
-
-excel_filepath = sys.argv[1]
+# Parse command line arguments
+args = cli.parse_args('transfer_iz_to_iz_items.py', parallel=True, prefetch=True)
+excel_filepath = args.excel_filepath
 
 # Logging configuration
 log_filename = xlstools.get_raw_filename(excel_filepath)
@@ -41,28 +38,26 @@ config_log(log_filename)
 
 logging.info(f'Items transfer from IZ to IZ started: {excel_filepath}')
 
-# Check version of the Excel form
-version = xlstools.get_form_version(excel_filepath)
-if not version or not isinstance(version, str) or not version.replace('.', '', 1).isdigit():
-    logging.critical(f"Invalid version format in the Excel file: {version}")
-    sys.exit(1)
-elif version != EXCEL_FORM_VERSION:
-    logging.critical(f"Unsupported Excel form version: {version}. Expected version: {EXCEL_FORM_VERSION}")
-    sys.exit(1)
 
-# load configuration
-xlstools.set_config(excel_filepath)
+def describe_row(i: int) -> str:
+    return f"items {process_monitor.df.at[i, 'Barcode']}"
+
+
+# Check the form, load the configuration and install the options of the command line
+process_monitor = cli.setup_run(args, 'Items', EXCEL_FORM_VERSION, describe_row, time_stages=True)
 
-from utils import processes
-from utils.processmonitoring import ProcessMonitor
+from utils import processes, runner
 
-# Initialize process monitor
-process_monitor = ProcessMonitor(excel_filepath, 'Items')
+# Resolve the source bibs and holdings of all the barcodes before the writes
+if args.prefetch > 0:
+    runner.prefetch_rows(processes.fetch_item_source_ids, describe_row, workers=args.prefetch)
 
-# Iterate over the PoLine numbers
-for i in process_monitor.df.index:
-    logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: items {process_monitor.df.at[i, 'Barcode']}")
-    processes.item(i)
+# Iterate over the items
+runner.run_grouped_rows(processes.item,
+                        describe_row,
+                        workers=args.workers,
+                        adaptive=args.adaptive,
+                        fetch_keys=processes.fetch_item_source_ids)
 
 logging.info('Items transfer from IZ to IZ terminated')
 
@@ -18,7 +18,7 @@ from almapiwrapper.inventory import IzBib, Holding, Item
 from almapiwrapper.acquisitions import POLine, Vendor, Invoice, fetch_invoices
 import pandas as pd
 
-from utils import xlstools
+from utils import xlstools, cli
 
 import os
 from dotenv import load_dotenv
@@ -28,12 +28,9 @@ if 'alma_api_keys' not in os.environ:
     dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
     load_dotenv(dotenv_path=dotenv_path)
 
-# Check if the correct number of arguments is provided
-if len(sys.argv) != 2:
-    print("Usage : python transfer_iz_to_iz_loans.py <dataForm.xlsx>")
-    sys.exit(1)
-
-excel_filepath = sys.argv[1]
+# Parse command line arguments
+args = cli.parse_args('transfer_iz_to_iz_loans.py')
+excel_filepath = args.excel_filepath
 
 # Logging configuration
 log_filename = xlstools.get_raw_filename(excel_filepath)
@@ -41,34 +38,29 @@ config_log(log_filename)
 
 logging.info(f'Loans transfer from IZ to IZ started: {excel_filepath}')
 
-# Check version of the Excel form
-version = xlstools.get_form_version(excel_filepath)
-if not version or not isinstance(version, str) or not version.replace('.', '', 1).isdigit():
-    logging.critical(f"Invalid version format in the Excel file: {version}")
-    sys.exit(1)
-elif version != EXCEL_FORM_VERSION:
-    logging.critical(f"Unsupported Excel form version: {version}. Expected version: {EXCEL_FORM_VERSION}")
-    sys.exit(1)
 
-# load configuration
-xlstools.set_config(excel_filepath)
+def describe_row(i: int) -> str:
+    item_ids = process_monitor.df.loc[i, ['Item_id_s', 'Barcode_s', 'Item_id_d']].dropna()
+    return f'item {item_ids.iloc[0]}' if len(item_ids) > 0 else 'no item information'
+
 
-from utils import processes
-from utils.processmonitoring import ProcessMonitor
+# Check the form, load the configuration and install the options of the command line
+process_monitor = cli.setup_run(args, 'Loans', EXCEL_FORM_VERSION, describe_row)
 
-# Initialize process monitor
-process_monitor = ProcessMonitor(excel_filepath, 'Loans')
+from utils import processes, runner
 
 # Iterate over the PoLine numbers
 for i in process_monitor.df.index:
-    if pd.notnull(process_monitor.df.at[i, 'Item_id_s']):
-        logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: circulation operation on item {process_monitor.df.at[i, 'Item_id_s']}")
-    elif pd.notnull(process_monitor.df.at[i, 'Barcode_s']):
-        logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: circulation operation on item {process_monitor.df.at[i, 'Barcode_s']}")
-    elif pd.notnull(process_monitor.df.at[i, 'Item_id_d']):
-        logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: circulation operation on item {process_monitor.df.at[i, 'Item_id_d']}")
-    else:
-        logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: circulation operation without item information")
-    processes.loan(i)
+    # The API calls are counted for the row
+    with runner.current_row(i):
+        if pd.notnull(process_monitor.df.at[i, 'Item_id_s']):
+            logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: circulation operation on item {process_monitor.df.at[i, 'Item_id_s']}")
+        elif pd.notnull(process_monitor.df.at[i, 'Barcode_s']):
+            logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: circulation operation on item {process_monitor.df.at[i, 'Barcode_s']}")
+        elif pd.notnull(process_monitor.df.at[i, 'Item_id_d']):
+            logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: circulation operation on item {process_monitor.df.at[i, 'Item_id_d']}")
+        else:
+            logging.info(f"Processing row {i} / {len(process_monitor.df.index)}: circulation operation without item information")
+        processes.loan(i)
 
 logging.info('Loans transfer from IZ to IZ terminated')
@@ -0,0 +1,292 @@
+import logging
+import sys
+import threading
+from typing import Callable, List, Optional
+
+import requests
+from almapiwrapper.record import Record, remove_apikey_from_url
+
+# Middlewares wrapping the API calls, the first one is the outermost.
+# A middleware is called with `(call_next, method, *args, **kwargs)`
+# and must return the result of `call_next(method, *args, **kwargs)`.
+_middlewares: List[Callable] = []
+_lock = threading.Lock()
+
+# Original method of almapiwrapper, set by `install`
+_build_headers: Optional[Callable] = None
+
+# Connection and read timeouts of the HTTP requests in seconds
+TIMEOUT = (10, 120)
+
+# Base URL replacing the Alma API URL of almapiwrapper, set by `set_base_url`
+_base_url: Optional[str] = None
+
+# Function replacing `send` as innermost step of the API calls, set by `set_transport`
+_transport: Optional[Callable] = None
+
+# True if the API calls never reach Alma: the API keys are not used, set by `set_transport`
+_offline = False
+
+
+class AlmaHeaders(dict):
+    """
+    Headers of an Alma API call with the parameters used to build them
+
+    almapiwrapper doesn't give the zone of the record to the function making
+    the HTTP request, but the headers are built for the zone. The middlewares
+    use these attributes to know the target of the call.
+
+    Attributes
+    ----------
+    zone : str
+        Zone of the call, IZ code or 'NZ'
+    area : str
+        Area of the API, for example 'Bibs' or 'Users'
+    env : str
+        'P' for production and 'S' for sandbox
+    """
+    def __init__(self, headers: dict, zone: str, area: str, env: str) -> None:
+        super().__init__(headers)
+        self.zone = zone
+        self.area = area
+        self.env = env
+
+
+def get_headers(kwargs: dict) -> Optional[AlmaHeaders]:
+    """
+    Returns the headers of an API call if built by almapiwrapper
+
+    Parameters
+    ----------
+    kwargs : dict
+        Keyword arguments of the API call
+
+    Returns
+    -------
+    Optional[AlmaHeaders]
+        Headers with zone, area and environment, None if not available
+    """
+    headers = kwargs.get('headers')
+    return headers if isinstance(headers, AlmaHeaders) else None
+
+
+def get_zone(kwargs: dict) -> Optional[str]:
+    """
+    Returns the zone of an API call, None if unknown
+
+    Parameters
+    ----------
+    kwargs : dict
+        Keyword arguments of the API call
+
+    Returns
+    -------
+    Optional[str]
+        Zone of the call, IZ code or 'NZ'
+    """
+    headers = get_headers(kwargs)
+    return headers.zone if headers is not None else None
+
+
+def add_middleware(middleware: Callable, outermost: bool = False) -> None:
+    """
+    Adds a middleware around all Alma API calls
+
+    The middleware added first is the outermost. `install` is called if required.
+
+    Parameters
+    ----------
+    middleware : Callable
+        Function called with `(call_next, method, *args, **kwargs)`
+    outermost : bool, optional
+        If True, the middleware is added around the existing ones
+    """
+    install()
+    with _lock:
+        if outermost:
+            _middlewares.insert(0, middleware)
+        else:
+            _middlewares.append(middleware)
+
+
+def remove_middleware(middleware: Callable) -> None:
+    """
+    Removes a middleware added with `add_middleware`
+
+    Parameters
+    ----------
+    middleware : Callable
+        The middleware to remove
+    """
+    with _lock:
+        if middleware in _middlewares:
+            _middlewares.remove(middleware)
+
+
+def send(method: str, *args, **kwargs) -> Optional[requests.Response]:
+    """
+    Makes one HTTP request, innermost step of the API calls
+
+    Unlike `Record.api_call` of almapiwrapper, the request is not repeated
+    in case of error, the middlewares of `utils.retry` take care of it.
+
+    Parameters
+    ----------
+    method : str
+        'get', 'put', 'post' or 'delete'
+
+    Returns
+    -------
+    Optional[requests.Response]
+        Response of the API call, None for an unknown method
+
+    Raises
+    ------
+    requests.exceptions.RequestException
+        If no response is received, timeout or connection reset for example
+    """
+    if method not in ['get', 'put', 'post', 'delete']:
+        return None
+
+    if _base_url is not None and args and str(args[0]).startswith(Record.api_base_url):
+        args = (_base_url + str(args[0])[len(Record.api_base_url):],) + args[1:]
+
+    kwargs.setdefault('timeout', TIMEOUT)
+    r = getattr(requests, method)(*args, **kwargs)
+    logging.info(f'{method.upper()} : {remove_apikey_from_url(r.url)} {r.status_code}')
+
+    if 'X-Exl-Api-Remaining' in r.headers and int(r.headers['X-Exl-Api-Remaining']) < 5000:
+        logging.critical(f'Limit of the number of requests allowed critical - '
+                         f'{r.headers["X-Exl-Api-Remaining"]} remaining => exiting of the program')
+        sys.exit(1)
+
+    return r
+
+
+def call(method: str, *args, **kwargs) -> Optional[requests.Response]:
+    """
+    Makes an API call through all middlewares
+
+    Replaces `Record.api_call` of almapiwrapper once installed. As with
+    almapiwrapper, the program stops if no response can be received.
+
+    Parameters
+    ----------
+    method : str
+        'get', 'put', 'post' or 'delete'
+
+    Returns
+    -------
+    Optional[requests.Response]
+        Response of the API call
+    """
+    with _lock:
+        middlewares = list(_middlewares)
+
+    def call_next_factory(position: int) -> Callable:
+        if position == len(middlewares):
+            return _transport or send
+
+        def call_next(method_next: str, *args_next, **kwargs_next) -> Optional[requests.Response]:
+            return middlewares[position](call_next_factory(position + 1), method_next, *args_next, **kwargs_next)
+
+        return call_next
+
+    try:
+        return call_next_factory(0)(method, *args, **kwargs)
+    except requests.exceptions.RequestException as err:
+        logging.critical(f'HTTP error: {method.upper()} {remove_apikey_from_url(str(args[0])) if args else ""} '
+                         f'- message: {str(err)} => exiting of the program')
+        sys.exit(1)
+
+
+def build_headers(data_format: str, zone: str, area: str, rights: str = 'RW', env: Optional[str] = 'P') -> AlmaHeaders:
+    """
+    Builds the headers with almapiwrapper and keeps the zone, area and environment
+
+    Replaces `Record.build_headers` of almapiwrapper once installed. When the
+    calls are sent to another server with `set_base_url` or don't reach Alma,
+    see `set_transport`, the API keys are not used: the key is replaced by the
+    zone, 'apikey mock:UBS' for example.
+    """
+    if _base_url is not None or _offline:
+        headers = {'content-type': f'application/{data_format}',
+                   'accept': f'application/{data_format}',
+                   'Authorization': f'apikey mock:{zone}'}
+        return AlmaHeaders(headers, zone, area, env)
+    return AlmaHeaders(_build_headers(data_format, zone, area, rights, env), zone, area, env)
+
+
+def set_base_url(base_url: Optional[str]) -> None:
+    """
+    Sends the API calls to another server than Alma, for example `mock_alma_server.py`
+
+    The Alma API URL of almapiwrapper is replaced by the given URL, the path
+    is kept: "https://api-eu.hosted.exlibrisgroup.com/almaws/v1/bibs/991..."
+    becomes "http://localhost:8080/almaws/v1/bibs/991...". `install` is called
+    if required.
+
+    Parameters
+    ----------
+    base_url : str, optional
+        URL replacing "https://api-eu.hosted.exlibrisgroup.com/almaws/v1", None
+        to send the calls to Alma again
+    """
+    global _base_url
+
+    install()
+    _base_url = base_url.rstrip('/') if base_url else None
+    if _base_url is not None:
+        logging.warning(f'API calls sent to {_base_url} instead of Alma')
+
+
+def set_transport(transport: Optional[Callable], offline: bool = False) -> None:
+    """
+    Replaces `send` as innermost step of the API calls, for example to record or replay the responses
+
+    The transport is called with `(method, *args, **kwargs)` after all
+    middlewares, it can call `send` to make the HTTP request. `install` is
+    called if required.
+
+    Parameters
+    ----------
+    transport : Callable, optional
+        Function called instead of `send`, None to make the HTTP requests again
+    offline : bool, optional
+        True if the transport never calls `send`: the API keys are not required
+    """
+    global _transport, _offline
+
+    install()
+    _transport = transport
+    _offline = offline and transport is not None
+
+
+def is_alma_called() -> bool:
+    """
+    Checks if the API calls are sent to Alma
+
+    Returns
+    -------
+    bool
+        False if the calls are sent to another server, see `set_base_url`, or
+        made by a transport, a recorded cassette for example, see `set_transport`
+    """
+    return _base_url is None and _transport is None
+
+
+def install() -> None:
+    """
+    Routes the API calls of almapiwrapper through the middlewares
+
+    `Record.api_call` and `Record.build_headers` are replaced, all records
+    (Item, Holding, IzBib, POLine, User, Request, Collection...) use them.
+    Calling it several times has no effect.
+    """
+    global _build_headers
+    with _lock:
+        if _build_headers is not None:
+            return
+        _build_headers = Record.build_headers
+        Record.api_call = staticmethod(call)
+        Record.build_headers = staticmethod(build_headers)
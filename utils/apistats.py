@@ -0,0 +1,192 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils import apicalls, planner, runner
+from utils.processmonitoring import ProcessMonitor
+from utils.recordcache import get_record_key
+
+# (zone, HTTP method, record type) of an API call, the record type is the first
+# segment of the URL, see `recordcache.get_record_key`
+EndpointKey = Tuple[str, str, str]
+
+
+class ApiCallStats:
+    """
+    Middleware counting the Alma API calls by zone, HTTP method and record type
+
+    Each HTTP request is counted, the retries included, the responses of the
+    record cache are not. The calls made for a row are added to its 'API_calls'
+    and 'API_ms' columns.
+
+    Attributes
+    ----------
+    endpoints : Dict[EndpointKey, List[float]]
+        Number of calls, number of errors and total duration in ms by endpoint
+    started : datetime
+        Start of the run
+    """
+    def __init__(self) -> None:
+        self.endpoints: Dict[EndpointKey, List[float]] = {}
+        self.started = datetime.now()
+        self.lock = threading.Lock()
+
+    def __call__(self, call_next: Callable, method: str, *args, **kwargs):
+        """
+        Makes the call and counts it with its duration
+        """
+        headers = apicalls.get_headers(kwargs)
+        zone = headers.zone if headers is not None else None
+        record_key = get_record_key(str(args[0]), zone, headers.env) if headers is not None and args else None
+
+        t0 = time.monotonic()
+        error = True
+        try:
+            r = call_next(method, *args, **kwargs)
+            error = r is None or r.status_code >= 400
+            return r
+        finally:
+            self.record(str(zone), method, record_key[2] if record_key else 'other',
+                        (time.monotonic() - t0) * 1000, error)
+
+    def record(self, zone: str, method: str, record_type: str, duration_ms: float, error: bool = False) -> None:
+        """
+        Counts a call of an endpoint and for the row processed by the thread
+
+        Parameters
+        ----------
+        zone : str
+            Zone of the call, IZ code or 'NZ'
+        method : str
+            'get', 'put', 'post' or 'delete'
+        record_type : str
+            Record type of the URL, 'bibs' or 'acq/po-lines' for example
+        duration_ms : float
+            Duration of the call in ms
+        error : bool, optional
+            True if no response or an error response was received
+        """
+        with self.lock:
+            counts = self.endpoints.setdefault((zone, method.upper(), record_type), [0, 0, 0.0])
+            counts[0] += 1
+            counts[1] += int(error)
+            counts[2] += duration_ms
+
+        i = runner.get_current_row()
+        if i is not None:
+            process_monitor = ProcessMonitor()
+            with process_monitor.lock:
+                process_monitor.increment(i, 'API_calls')
+                process_monitor.increment(i, 'API_ms', round(duration_ms))
+
+    def get_summary(self) -> dict:
+        """
+        Returns the counts of the run
+
+        Returns
+        -------
+        dict
+            Start and duration of the run, total number of calls and errors, and
+            the counts by endpoint, most called first
+        """
+        with self.lock:
+            endpoints = {key: tuple(counts) for key, counts in self.endpoints.items()}
+
+        rows = [{'zone': zone,
+                 'method': method,
+                 'record_type': record_type,
+                 'nb_calls': nb_calls,
+                 'nb_errors': nb_errors,
+                 'total_ms': round(total_ms),
+                 'mean_ms': round(total_ms / nb_calls, 1)}
+                for (zone, method, record_type), (nb_calls, nb_errors, total_ms) in endpoints.items()]
+        rows.sort(key=lambda row: (-row['nb_calls'], row['zone'], row['method'], row['record_type']))
+
+        return {'started': self.started.isoformat(timespec='seconds'),
+                'duration_s': round((datetime.now() - self.started).total_seconds(), 1),
+                'nb_calls': sum(row['nb_calls'] for row in rows),
+                'nb_errors': sum(row['nb_errors'] for row in rows),
+                'endpoints': rows}
+
+    def get_latencies(self) -> Dict[str, Tuple[int, float]]:
+        """
+        Returns the number of calls and the total duration in seconds by endpoint, all zones together
+
+        Returns
+        -------
+        Dict[str, Tuple[int, float]]
+            Counts by endpoint label, 'GET bibs' for example, see :func:`planner.save_latencies`
+        """
+        latencies: Dict[str, Tuple[int, float]] = {}
+        with self.lock:
+            for (_, method, record_type), (nb_calls, _, total_ms) in self.endpoints.items():
+                if record_type == 'other':
+                    continue
+                endpoint = planner.get_endpoint(method, record_type)
+                previous_calls, previous_total = latencies.get(endpoint, (0, 0.0))
+                latencies[endpoint] = (previous_calls + nb_calls, previous_total + total_ms / 1000)
+        return latencies
+
+    def save(self) -> None:
+        """
+        Writes the summary of the run in the log and in a JSON file, and stores the latencies
+
+        The JSON file is next to the processing file, for example
+        `data/<form>_Items_api_calls.json`. The latencies are used by `--plan`,
+        they are only stored when the calls are sent to Alma.
+        """
+        summary = self.get_summary()
+        if summary['nb_calls'] == 0:
+            return
+
+        logging.info(f"API calls: {summary['nb_calls']} calls, {summary['nb_errors']} errors "
+                     f"in {summary['duration_s']}s")
+        for row in summary['endpoints']:
+            logging.info(f"API calls {row['zone']} {row['method']} {row['record_type']}: {row['nb_calls']} calls, "
+                         f"{row['nb_errors']} errors, mean {row['mean_ms']}ms")
+
+        process_monitor = ProcessMonitor.get_instance()
+        if process_monitor is not None:
+            summary['process_type'] = process_monitor.process_type
+            file_path = process_monitor.get_report_path('api_calls')
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'w') as f:
+                json.dump(summary, f, indent=2)
+
+        # The latencies of a mock server or of a cassette would make the estimates of `--plan` too low
+        if apicalls.is_alma_called():
+            planner.save_latencies(self.get_latencies())
+
+
+# API call counter of the process, set by `install`
+api_call_stats: Optional[ApiCallStats] = None
+
+
+def install() -> ApiCallStats:
+    """
+    Counts the Alma API calls of the process by endpoint and by row
+
+    The counter is added after the rate limiter: the waits of the rate limiter
+    are not included in the durations.
+
+    Returns
+    -------
+    ApiCallStats
+        The API call counter of the process
+    """
+    global api_call_stats
+
+    if api_call_stats is not None:
+        apicalls.remove_middleware(api_call_stats)
+        atexit.unregister(api_call_stats.save)
+
+    api_call_stats = ApiCallStats()
+    apicalls.add_middleware(api_call_stats)
+    atexit.register(api_call_stats.save)
+
+    return api_call_stats
@@ -0,0 +1,598 @@
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
+
+import openpyxl
+import pandas as pd
+
+# Optional: samples the memory of the scripts on all platforms
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from utils import xlstools
+from utils.mockalma import MockAlma, MockAlmaServer
+
+# Root of the repository, the transfer scripts are there
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Excel form used as model of the generated forms, its mapping tabs are replaced
+DEFAULT_TEMPLATE = os.path.join(REPO_DIR, 'test', 'test_data', 'test_data_IZ_to_IZ_1.xlsx')
+
+# Transfer script of each process type, the process type is also the tab of the form
+SCRIPTS: Dict[str, str] = {
+    'Bibs': 'transfer_iz_to_iz_bibs.py',
+    'Holdings': 'transfer_iz_to_iz_holdings.py',
+    'Items': 'transfer_iz_to_iz_items.py',
+    'PoLines': 'transfer_iz_to_iz_polines.py',
+    'Loans': 'transfer_iz_to_iz_loans.py',
+    'Requests': 'transfer_iz_to_iz_requests.py',
+    'Collections': 'transfer_iz_to_iz_collections.py',
+}
+
+# Process types whose script has the `--workers` option
+PARALLEL_TYPES = ['Items', 'PoLines']
+
+# Version of the generated forms, the one expected by the transfer scripts
+FORM_VERSION = '7.0'
+
+# Zones and codes of the generated records, they are mapped in the generated forms
+IZ_S = 'UBS'
+IZ_D = 'HPH'
+LIBRARY_S = 'UBS_LIB'
+LIBRARY_D = 'HPH_LIB'
+NB_LOCATIONS = 5
+VENDOR = 'UBS_VENDOR'
+FUND = 'UBS_FUND'
+
+# Metrics compared between two runs, True if a higher value is better
+COMPARED_METRICS: Dict[str, bool] = {
+    'rows_per_s': True,
+    'api_calls_per_row': False,
+    'peak_rss_mb': False,
+    'wall_s': False,
+}
+
+
+def get_zipf_weights(n: int, exponent: float) -> List[float]:
+    """
+    Returns the Zipf weights of n ranks: the weight of rank k is 1 / k^exponent
+
+    Parameters
+    ----------
+    n : int
+        Number of ranks
+    exponent : float
+        Exponent of the distribution, 0 gives the same weight to all ranks
+
+    Returns
+    -------
+    List[float]
+        Weights of the ranks, the first rank has the highest weight
+    """
+    return [1 / rank ** exponent for rank in range(1, n + 1)]
+
+
+def draw_ranks(rng: random.Random, nb_draws: int, n: int, exponent: float) -> List[int]:
+    """
+    Draws ranks following a Zipf distribution, each rank is drawn at least once if possible
+
+    Parameters
+    ----------
+    rng : random.Random
+        Random generator of the scenario
+    nb_draws : int
+        Number of ranks to draw
+    n : int
+        Number of ranks
+    exponent : float
+        Exponent of the distribution, see :func:`get_zipf_weights`
+
+    Returns
+    -------
+    List[int]
+        Drawn ranks from 0 to n - 1, sorted
+    """
+    ranks = list(range(min(n, nb_draws)))
+    cum_weights = list(accumulate(get_zipf_weights(n, exponent)))
+    for _ in range(nb_draws - len(ranks)):
+        ranks.append(min(bisect_left(cum_weights, rng.random() * cum_weights[-1]), n - 1))
+    return sorted(ranks)
+
+
+def get_location(k: int) -> str:
+    """
+    Returns the source location code number k, the destination location has the same code
+    """
+    return f'LOC{k % NB_LOCATIONS}'
+
+
+def generate_scenario(alma: MockAlma,
+                      process_type: str,
+                      nb_rows: int,
+                      nb_bibs: Optional[int] = None,
+                      zipf_exponent: float = 1.1,
+                      batch_size: int = 10,
+                      booking_rate: float = 0.5,
+                      seed: int = 0) -> pd.DataFrame:
+    """
+    Adds the records of a synthetic transfer to the mock API and returns the rows of the form
+
+    Parameters
+    ----------
+    alma : MockAlma
+        Mock API receiving the source records, and the destination records
+        expected by the loans and requests transfers
+    process_type : str
+        Process type, a key of `SCRIPTS`
+    nb_rows : int
+        Number of rows of the form
+    nb_bibs : int, optional
+        Number of source bibs of the holdings and items, the rows are spread
+        over the bibs with a Zipf distribution. Default is a fifth of the rows
+    zipf_exponent : float, optional
+        Exponent of the Zipf distribution of the rows over the bibs and holdings
+    batch_size : int, optional
+        Number of items of a PoLine and number of bibs of a collection
+    booking_rate : float, optional
+        Share of the requests being bookings
+    seed : int, optional
+        Seed of the random generator, the same seed gives the same scenario
+
+    Returns
+    -------
+    pd.DataFrame
+        Rows of the tab of the process type, with the columns of the template
+    """
+    rng = random.Random(seed)
+    nb_bibs = nb_bibs or max(1, nb_rows // 5)
+
+    if process_type == 'Bibs':
+        return pd.DataFrame({'MMS Id': [_add_bibs(alma, k)[1] for k in range(nb_rows)]})
+
+    elif process_type == 'Holdings':
+        bibs = [_add_bibs(alma, k)[1] for k in range(nb_bibs)]
+        rows = []
+        for k, rank in enumerate(draw_ranks(rng, nb_rows, nb_bibs, zipf_exponent)):
+            holding_id = alma.add_holding(IZ_S, bibs[rank], LIBRARY_S, get_location(k), f'CN {k}')
+            rows.append([bibs[rank], holding_id])
+        return pd.DataFrame(rows, columns=['MMS Id', 'Holdings ID'])
+
+    elif process_type == 'Items':
+        holdings = []
+        for k in range(nb_bibs):
+            mms_id = _add_bibs(alma, k)[1]
+            holdings.append((mms_id, alma.add_holding(IZ_S, mms_id, LIBRARY_S, get_location(k), f'CN {k}')))
+        barcodes = []
+        for k, rank in enumerate(draw_ranks(rng, nb_rows, nb_bibs, zipf_exponent)):
+            barcodes.append(f'BM{k:08d}')
+            alma.add_item(IZ_S, *holdings[rank], barcodes[-1], fields={'description': f'Vol. {k}'})
+        rng.shuffle(barcodes)
+        return pd.DataFrame({'Barcode': barcodes})
+
+    elif process_type == 'PoLines':
+        # One-time and continuous orders alternate, the items of a PoLine are in the same holding
+        rows = []
+        for k in range((nb_rows + batch_size - 1) // batch_size):
+            mms_id = _add_bibs(alma, k)[1]
+            quantity = min(batch_size, nb_rows - k * batch_size)
+            purchase_type = 'PRINTED_BOOK_OT' if k % 2 == 0 else 'PRINTED_JOURNAL_CO'
+            pol_number = alma.add_poline(IZ_S, mms_id, LIBRARY_S, get_location(k), purchase_type, quantity,
+                                         vendor=VENDOR, vendor_account=VENDOR, fund=FUND)
+            holding_id = alma.add_holding(IZ_S, mms_id, LIBRARY_S, get_location(k), f'CN {k}')
+            for j in range(quantity):
+                item_id = alma.add_item(IZ_S, mms_id, holding_id, f'BP{k:06d}{j:04d}', po_line=pol_number,
+                                        received=j % 2 == 0)
+                rows.append([pol_number, mms_id, holding_id, item_id])
+        return pd.DataFrame(rows, columns=['PO Line Reference', 'MMS Id', 'Holdings ID', 'Physical Item Id'])
+
+    elif process_type == 'Loans':
+        # The items are already transferred: the source item has the barcode with the
+        # 'OLD_' prefix and is loaned, the destination item has the original barcode
+        rows = []
+        for k, barcode in enumerate(_add_transferred_items(alma, rng, nb_rows, nb_bibs, zipf_exponent)):
+            primary_id = _add_users(alma, k)
+            alma.add_loan(IZ_S, primary_id, f'OLD_{barcode}')
+            rows.append([primary_id, f'OLD_{barcode}'])
+        return pd.DataFrame(rows, columns=['Primary_id', 'Barcode'])
+
+    elif process_type == 'Requests':
+        rows = []
+        start_date = date.today() + timedelta(days=30)
+        for k, barcode in enumerate(_add_transferred_items(alma, rng, nb_rows, nb_bibs, zipf_exponent)):
+            primary_id = _add_users(alma, k)
+            item_s = alma.get_items_by_barcode(IZ_S)[f'OLD_{barcode}']
+            if rng.random() < booking_rate:
+                fields = {'booking_start_date': f'{start_date.isoformat()}T08:00:00Z',
+                          'booking_end_date': f'{(start_date + timedelta(days=7)).isoformat()}T18:00:00Z'}
+                request_id = alma.add_request(IZ_S, primary_id, item_s.findtext('bib_data/mms_id'),
+                                              f'OLD_{barcode}', 'BOOKING', LIBRARY_S, fields)
+            else:
+                request_id = alma.add_request(IZ_S, primary_id, item_s.findtext('bib_data/mms_id'),
+                                              f'OLD_{barcode}', 'HOLD', LIBRARY_S)
+            rows.append([primary_id, request_id])
+        return pd.DataFrame(rows, columns=['Primary_id', 'Request_id_s'])
+
+    elif process_type == 'Collections':
+        bibs = [_add_bibs(alma, k)[1] for k in range(nb_bibs)]
+        rows = []
+        for k in range(nb_rows):
+            mms_ids = sorted({bibs[rank] for rank in draw_ranks(rng, batch_size, nb_bibs, zipf_exponent)})
+            rows.append([alma.add_collection(IZ_S, name=f'Collection {k}', mms_ids=mms_ids),
+                         alma.add_collection(IZ_D, name=f'Collection {k}')])
+        return pd.DataFrame(rows, columns=['Collection ID source', 'Collection ID dest'])
+
+    raise ValueError(f'Unknown process type: {process_type}')
+
+
+def _add_bibs(alma: MockAlma, k: int) -> Tuple[str, str]:
+    """
+    Adds a NZ bib and the linked bib of the source IZ, returns their MMS IDs
+    """
+    nz_mms_id = alma.add_bib('NZ', title=f'Benchmark title {k}')
+    return nz_mms_id, alma.add_bib(IZ_S, nz_mms_id=nz_mms_id, title=f'Benchmark title {k}')
+
+
+def _add_users(alma: MockAlma, k: int) -> str:
+    """
+    Adds the user number k to both IZ, ten rows share a user
+    """
+    primary_id = f'user{k // 10:06d}@benchmark.ch'
+    for zone in [IZ_S, IZ_D]:
+        alma.add_user(zone, primary_id)
+    return primary_id
+
+
+def _add_transferred_items(alma: MockAlma,
+                           rng: random.Random,
+                           nb_items: int,
+                           nb_bibs: int,
+                           zipf_exponent: float) -> List[str]:
+    """
+    Adds items already copied to the destination IZ, returns their barcodes in the destination IZ
+    """
+    holdings = []
+    for k in range(nb_bibs):
+        nz_mms_id, mms_id_s = _add_bibs(alma, k)
+        mms_id_d = alma.add_bib(IZ_D, nz_mms_id=nz_mms_id, title=f'Benchmark title {k}')
+        holdings.append((mms_id_s, alma.add_holding(IZ_S, mms_id_s, LIBRARY_S, get_location(k)),
+                         mms_id_d, alma.add_holding(IZ_D, mms_id_d, LIBRARY_D, get_location(k))))
+
+    barcodes = []
+    for k, rank in enumerate(draw_ranks(rng, nb_items, nb_bibs, zipf_exponent)):
+        mms_id_s, holding_id_s, mms_id_d, holding_id_d = holdings[rank]
+        barcodes.append(f'BC{k:08d}')
+        alma.add_item(IZ_S, mms_id_s, holding_id_s, f'OLD_{barcodes[-1]}')
+        alma.add_item(IZ_D, mms_id_d, holding_id_d, barcodes[-1])
+    return barcodes
+
+
+def write_form(file_path: str, process_type: str, rows: pd.DataFrame, template: str = DEFAULT_TEMPLATE) -> None:
+    """
+    Writes an Excel form with the rows of a process type
+
+    The General tab and the configuration of the fields to delete are the ones
+    of the template. The zones, the version and the options are replaced, the
+    mapping tabs contain the codes of the generated records.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the new form
+    process_type : str
+        Process type, name of the tab receiving the rows
+    rows : pd.DataFrame
+        Rows of the tab, see :func:`generate_scenario`
+    template : str, optional
+        Path of the form used as model
+    """
+    wb = openpyxl.load_workbook(template)
+
+    general = wb['General']
+    for row, value in [(5, FORM_VERSION), (6, IZ_S), (7, IZ_D), (8, LIBRARY_S), (9, LIBRARY_D), (10, 'Sandbox'),
+                       (16, 'Yes'), (17, 'Yes'), (18, 'Yes')]:
+        general.cell(row=row, column=2, value=value)
+
+    mappings = {
+        'Locations_mapping': [['*DEFAULT*', '*DEFAULT*', LIBRARY_D, get_location(0)]]
+                             + [[LIBRARY_S, get_location(k), LIBRARY_D, get_location(k)] for k in range(NB_LOCATIONS)],
+        'Vendors_mapping': [['*DEFAULT*', '*DEFAULT*', VENDOR, VENDOR]],
+        'Funds_mapping': [['*DEFAULT*', FUND]],
+        process_type: rows.values.tolist(),
+    }
+    for sheet_name, values in mappings.items():
+        ws = wb[sheet_name]
+        ws.delete_rows(2, ws.max_row)
+        for row in values:
+            ws.append(row)
+
+    wb.save(file_path)
+
+
+def run_transfer(process_type: str,
+                 form_path: str,
+                 alma_url: str,
+                 work_dir: str,
+                 workers: int = 1,
+                 extra_args: Optional[List[str]] = None) -> Tuple[int, float, Optional[float]]:
+    """
+    Runs the transfer script of a process type against the mock API
+
+    The script runs in its own process with `work_dir` as working directory:
+    the processing files and the logs are written there. The API rate limits
+    are disabled.
+
+    Parameters
+    ----------
+    process_type : str
+        Process type, a key of `SCRIPTS`
+    form_path : str
+        Path of the Excel form
+    alma_url : str
+        Base URL of the mock API, see `MockAlmaServer.url`
+    work_dir : str
+        Working directory of the script
+    workers : int, optional
+        Number of rows processed concurrently, only used by the scripts of `PARALLEL_TYPES`
+    extra_args : List[str], optional
+        Other options of the script
+
+    Returns
+    -------
+    Tuple[int, float, Optional[float]]
+        Exit code, wall time in seconds and peak resident memory of the script in MB.
+        The memory is sampled with psutil when it is installed. Otherwise, on Unix,
+        it is the peak of the largest script run so far by the process, None on the
+        other platforms
+    """
+    args = [sys.executable, os.path.join(REPO_DIR, SCRIPTS[process_type]), form_path,
+            '--alma-url', alma_url, '--api-rate-s', '0', '--api-rate-d', '0']
+    if process_type in PARALLEL_TYPES and workers > 1:
+        args += ['--workers', str(workers)]
+    args += extra_args or []
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+
+    t0 = time.monotonic()
+    # stderr is small: the logs go to the log files
+    proc = subprocess.Popen(args, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    peak_rss_mb = None
+    if psutil is not None:
+        peak_rss_mb = sample_peak_rss(proc)
+    proc.wait()
+    wall_s = time.monotonic() - t0
+
+    if peak_rss_mb is None and resource is not None:
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        peak_rss_mb = max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    stderr = proc.stderr.read().decode(errors='replace')
+    proc.stderr.close()
+    if proc.returncode != 0:
+        logging.error(f'{SCRIPTS[process_type]} failed with exit code {proc.returncode}: {stderr[-2000:]}')
+
+    return proc.returncode, wall_s, peak_rss_mb
+
+
+def sample_peak_rss(proc: subprocess.Popen, interval: float = 0.05) -> Optional[float]:
+    """
+    Samples the resident memory of a process with psutil until it terminates
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+        Started process
+    interval : float, optional
+        Delay between two samples in seconds
+
+    Returns
+    -------
+    Optional[float]
+        Highest sampled resident memory in MB, None if the process could not be sampled
+    """
+    try:
+        process = psutil.Process(proc.pid)
+    except psutil.Error:
+        return None
+
+    peak_rss = 0
+    while proc.poll() is None:
+        try:
+            peak_rss = max(peak_rss, process.memory_info().rss)
+        except psutil.Error:
+            break
+        time.sleep(interval)
+
+    return peak_rss / (1024 * 1024) if peak_rss > 0 else None
+
+
+def run_benchmark(process_type: str,
+                  nb_rows: int,
+                  work_dir: str,
+                  nb_bibs: Optional[int] = None,
+                  zipf_exponent: float = 1.1,
+                  batch_size: int = 10,
+                  booking_rate: float = 0.5,
+                  latency: float = 0.0,
+                  workers: int = 1,
+                  seed: int = 0,
+                  template: str = DEFAULT_TEMPLATE,
+                  extra_args: Optional[List[str]] = None) -> dict:
+    """
+    Generates a scenario, runs its transfer against a new mock API and measures the run
+
+    Parameters
+    ----------
+    process_type : str
+        Process type, a key of `SCRIPTS`
+    nb_rows : int
+        Number of rows of the form
+    work_dir : str
+        Directory of the generated form, of the processing files and of the logs
+    nb_bibs : int, optional
+        Number of source bibs, see :func:`generate_scenario`
+    zipf_exponent : float, optional
+        Exponent of the Zipf distribution of the rows over the bibs and holdings
+    batch_size : int, optional
+        Number of items of a PoLine and number of bibs of a collection
+    booking_rate : float, optional
+        Share of the requests being bookings
+    latency : float, optional
+        Mean duration of the API calls in seconds
+    workers : int, optional
+        Number of rows processed concurrently by the scripts supporting it
+    seed : int, optional
+        Seed of the scenario and of the latencies of the mock API
+    template : str, optional
+        Path of the form used as model
+    extra_args : List[str], optional
+        Other options of the script
+
+    Returns
+    -------
+    dict
+        Measures of the run: rows per second, API calls per row, peak memory
+        of the script in MB, wall time in seconds, number of copied rows and
+        errors, and the API calls by route
+    """
+    alma = MockAlma(latency=latency, seed=seed)
+    rows = generate_scenario(alma, process_type, nb_rows, nb_bibs, zipf_exponent, batch_size, booking_rate, seed)
+
+    form_path = os.path.join(work_dir, f'benchmark_{process_type.lower()}.xlsx')
+    write_form(form_path, process_type, rows, template)
+    processing_path = os.path.join(work_dir, 'data', f'{xlstools.get_raw_filename(form_path)}_{process_type}_processing.csv')
+    if os.path.exists(processing_path):
+        os.remove(processing_path)
+
+    server = MockAlmaServer(alma).start()
+    try:
+        exit_code, wall_s, peak_rss_mb = run_transfer(process_type, form_path, server.url, work_dir, workers,
+                                                      extra_args)
+    finally:
+        server.stop()
+
+    nb_copied, nb_errors = 0, 0
+    if os.path.exists(processing_path):
+        df = pd.read_csv(processing_path, dtype=str)
+        nb_copied = int((df['Copied'] == 'True').sum()) if 'Copied' in df.columns else 0
+        nb_errors = int(df['Error'].notnull().sum())
+
+    nb_calls = sum(alma.nb_calls.values())
+    result = {'process_type': process_type,
+              'nb_rows': len(rows),
+              'nb_copied': nb_copied,
+              'nb_errors': nb_errors,
+              'exit_code': exit_code,
+              'wall_s': round(wall_s, 3),
+              'rows_per_s': round(len(rows) / wall_s, 2),
+              'api_calls': nb_calls,
+              'api_calls_per_row': round(nb_calls / max(len(rows), 1), 2),
+              'peak_rss_mb': round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+              'calls_by_route': dict(sorted(alma.nb_calls.items(), key=lambda item: -item[1]))}
+
+    logging.info(f"Benchmark {process_type}: {result['nb_rows']} rows, {nb_copied} copied, {nb_errors} errors, "
+                 f"{result['wall_s']}s, {result['rows_per_s']} rows/s, {result['api_calls_per_row']} calls/row, "
+                 f"peak RSS {result['peak_rss_mb'] if peak_rss_mb is not None else 'unknown'} MB")
+
+    return result
+
+
+def get_environment() -> dict:
+    """
+    Returns the description of the benchmarked version: date, git commit, Python version and platform
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform()}
+
+
+def save_results(file_path: str, parameters: dict, results: List[dict]) -> None:
+    """
+    Writes the results of the benchmarks in a JSON file, the baseline of later comparisons
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the JSON file
+    parameters : dict
+        Parameters of the benchmarks, to compare only runs of the same scenarios
+    results : List[dict]
+        Results by process type, see :func:`run_benchmark`
+    """
+    with open(file_path, 'w') as f:
+        json.dump({'environment': get_environment(),
+                   'parameters': parameters,
+                   'results': results}, f, indent=2)
+
+
+def compare_results(baseline: dict,
+                    results: List[dict],
+                    tolerance: float = 0.1,
+                    metrics: Optional[Dict[str, bool]] = None,
+                    key: str = 'process_type') -> List[dict]:
+    """
+    Compares results with the results of a baseline file
+
+    Parameters
+    ----------
+    baseline : dict
+        Content of a file written by :func:`save_results`
+    results : List[dict]
+        Results of the current version, see :func:`run_benchmark`
+    tolerance : float, optional
+        Relative change of a metric considered as noise, 0.1 for 10%
+    metrics : Dict[str, bool], optional
+        Compared metrics, True if a higher value is better, default is `COMPARED_METRICS`
+    key : str, optional
+        Field identifying the same benchmark in both runs, default is the process type
+
+    Returns
+    -------
+    List[dict]
+        Comparison of each metric for the benchmarks of both runs: baseline and
+        current values, relative change and 'regression' True if the metric got
+        worse by more than the tolerance
+    """
+    baseline_results = {result[key]: result for result in baseline.get('results', [])}
+
+    comparisons = []
+    for result in results:
+        result_b = baseline_results.get(result[key])
+        if result_b is None:
+            continue
+        for metric, higher_is_better in (metrics or COMPARED_METRICS).items():
+            value_b, value = result_b.get(metric), result.get(metric)
+            if not value_b or value is None:
+                continue
+            change = (value - value_b) / value_b
+            comparisons.append({key: result[key],
+                                'metric': metric,
+                                'baseline': value_b,
+                                'current': value,
+                                'change': round(change, 3),
+                                'regression': (-change if higher_is_better else change) > tolerance})
+    return comparisons
@@ -1,12 +1,17 @@
 from typing import Optional
 from almapiwrapper.inventory import IzBib, NzBib, Holding, Item, Collection
-from utils import xlstools
+from utils import xlstools, stagestats
 from utils.processmonitoring import ProcessMonitor
 
 import logging
+import threading
 
 config = xlstools.get_config()
 
+# Source MMS IDs for which a copy to the destination IZ has been attempted during this run
+attempted_bib_copies = set()
+attempted_bib_copies_lock = threading.Lock()
+
 
 def copy_bib_from_nz_to_dest_iz(iz_mms_id_s: str) -> Optional[IzBib]:
     """
@@ -22,40 +27,54 @@ def copy_bib_from_nz_to_dest_iz(iz_mms_id_s: str) -> Optional[IzBib]:
     -------
     IzBib, Optional
         The IzBib object of the destination IZ, or None if an error occurs.
+
+    Notes
+    -----
+    The copy is attempted only once per source bib during a run. When it fails, the
+    other rows of the bib are not retried, a failure after the creation of the
+    destination bib could otherwise create a duplicate. They are retried at the next run.
     """
 
     process_monitor = ProcessMonitor()
 
-    # We fetch source IZ Bib to get the NZ MMS ID
-    iz_bib_s = IzBib(iz_mms_id_s, zone=config['iz_s'], env=config['env'])
-    nz_mms_id = iz_bib_s.get_nz_mms_id()
-
-    if iz_bib_s.error:
-        logging.error(f"{repr(iz_bib_s)}: {iz_bib_s.error_msg}")
-        process_monitor.df.loc[process_monitor.df['MMS_id_s'] == iz_mms_id_s, 'Error'] = 'Source IZ Bib not found'
-        return None
-
-    # We make a copy of the local source record if it is not linked to the NZ
-    if nz_mms_id is None:
-        logging.error(f"{repr(iz_bib_s)}: not linked to the NZ")
-        process_monitor.df.loc[process_monitor.df['MMS_id_s'] == iz_mms_id_s, 'Error'] = 'Not linked to the NZ'
-        process_monitor.save()
-        iz_bib_d = IzBib(data=iz_bib_s.data, zone=config['iz_d'], env=config['env'], create_bib=True)
-    else:
-        # We copy the NZ Bib to the destination IZ
-        iz_bib_d = IzBib(nz_mms_id, zone=config['iz_d'], env=config['env'], from_nz_mms_id=True, copy_nz_rec=True)
-
-    if iz_bib_d.error:
-        logging.error(f"{repr(iz_bib_d)}: {iz_bib_d.error_msg}")
-        process_monitor.df.loc[process_monitor.df['MMS_id_s'] == iz_mms_id_s, 'Error'] = 'Destination IZ Bib not created'
-        process_monitor.save()
-        return None
+    with attempted_bib_copies_lock:
+        if iz_mms_id_s in attempted_bib_copies:
+            logging.warning(f"Copy of bib {iz_mms_id_s} already attempted during this run, skipped")
+            return None
+        attempted_bib_copies.add(iz_mms_id_s)
+
+    with stagestats.timed('bib_copy'):
+        # We fetch source IZ Bib to get the NZ MMS ID
+        iz_bib_s = IzBib(iz_mms_id_s, zone=config['iz_s'], env=config['env'])
+        nz_mms_id = iz_bib_s.get_nz_mms_id()
+
+        if iz_bib_s.error:
+            logging.error(f"{repr(iz_bib_s)}: {iz_bib_s.error_msg}")
+            process_monitor.set_value_by_id('MMS_id_s', iz_mms_id_s, 'Error', 'Source IZ Bib not found')
+            return None
+
+        # We make a copy of the local source record if it is not linked to the NZ
+        if nz_mms_id is None:
+            logging.error(f"{repr(iz_bib_s)}: not linked to the NZ")
+            process_monitor.set_value_by_id('MMS_id_s', iz_mms_id_s, 'Error', 'Not linked to the NZ')
+            process_monitor.save()
+            iz_bib_d = IzBib(data=iz_bib_s.data, zone=config['iz_d'], env=config['env'], create_bib=True)
+        else:
+            # We copy the NZ Bib to the destination IZ
+            iz_bib_d = IzBib(nz_mms_id, zone=config['iz_d'], env=config['env'], from_nz_mms_id=True, copy_nz_rec=True)
+
+        if iz_bib_d.error:
+            logging.error(f"{repr(iz_bib_d)}: {iz_bib_d.error_msg}")
+            process_monitor.set_value_by_id('MMS_id_s', iz_mms_id_s, 'Error', 'Destination IZ Bib not created')
+            process_monitor.save()
+            return None
 
     # Copy local extensions
-    i = process_monitor.df.index[process_monitor.df['MMS_id_s'] == iz_mms_id_s][0]
-    iz_bib_d = copy_local_extensions(iz_bib_s,
-                                     iz_bib_d,
-                                     i)
+    i = process_monitor.get_rows('MMS_id_s', iz_mms_id_s)[0]
+    with stagestats.timed('local_extensions'):
+        iz_bib_d = copy_local_extensions(iz_bib_s,
+                                         iz_bib_d,
+                                         i)
 
     return iz_bib_d
 
@@ -86,14 +105,14 @@ def get_corresponding_bib_from_col(iz_bib_s: IzBib, i: int) -> Optional[IzBib]:
 
     if iz_bib_s.error:
         logging.error(f"{repr(iz_bib_s)}: {iz_bib_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Source IZ Bib not found'
+        process_monitor.set_value(i, 'Error', 'Source IZ Bib not found')
         process_monitor.save()
         return None
 
     # We make a copy of the local source record if it is not linked to the NZ
     if nz_mms_id is None:
         logging.error(f"{repr(iz_bib_s)}: not linked to the NZ")
-        process_monitor.df.at[i, 'Error'] = 'Not linked to the NZ'
+        process_monitor.set_value(i, 'Error', 'Not linked to the NZ')
         iz_bib_d = IzBib(data=iz_bib_s.data, zone=config['iz_d'], env=config['env'], create_bib=True)
     else:
         # We copy the NZ Bib to the destination IZ
@@ -101,7 +120,7 @@ def get_corresponding_bib_from_col(iz_bib_s: IzBib, i: int) -> Optional[IzBib]:
 
     if iz_bib_d.error:
         logging.error(f"{repr(iz_bib_d)}: {iz_bib_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Destination IZ Bib not created'
+        process_monitor.set_value(i, 'Error', 'Destination IZ Bib not created')
         return None
 
     # Copy local extensions
@@ -159,7 +178,7 @@ def copy_local_extensions(iz_bib_s: IzBib, iz_bib_d: IzBib, i: int) -> Optional[
 
     if iz_bib_d.error:
         logging.error(f"{repr(iz_bib_d)}: {iz_bib_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Local extensions not copied'
+        process_monitor.set_value(i, 'Error', 'Local extensions not copied')
         return None
 
     for f998 in f998s:
@@ -168,7 +187,7 @@ def copy_local_extensions(iz_bib_s: IzBib, iz_bib_d: IzBib, i: int) -> Optional[
     iz_bib_d.sort_fields().update()
     if iz_bib_d.error:
         logging.error(f"{repr(iz_bib_d)}: {iz_bib_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Local extensions not copied'
+        process_monitor.set_value(i, 'Error', 'Local extensions not copied')
         return None
     logging.info(f"{repr(iz_bib_d)}: {len(f998s)} local extensions copied")
     return iz_bib_d
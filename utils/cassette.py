@@ -0,0 +1,364 @@
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, Hashable, IO, Optional, Tuple
+
+import requests
+from almapiwrapper.record import Record, remove_apikey_from_url
+from requests.structures import CaseInsensitiveDict
+
+from utils import apicalls
+
+# Version of the cassette format, written in the first line of the file
+CASSETTE_VERSION = 1
+
+# Error code of the responses of the calls not found in a replayed cassette
+MISSING_ERROR_CODE = 'CASSETTE_MISS'
+
+
+def get_relative_url(url: str) -> str:
+    """
+    Returns the URL of an API call without the Alma API URL and without API key
+
+    "https://api-eu.hosted.exlibrisgroup.com/almaws/v1/bibs/991..." becomes
+    "/bibs/991...". A cassette recorded with Alma can then be replayed with the
+    mock server and the opposite.
+
+    Parameters
+    ----------
+    url : str
+        URL of the API call
+
+    Returns
+    -------
+    str
+        Path of the URL after the Alma API URL, the full URL for other servers
+    """
+    url = remove_apikey_from_url(url)
+    return url[len(Record.api_base_url):] if url.startswith(Record.api_base_url) else url
+
+
+def get_body_hash(kwargs: dict) -> Optional[str]:
+    """
+    Returns the SHA-1 of the body of an API call, None without body
+
+    Parameters
+    ----------
+    kwargs : dict
+        Keyword arguments of the API call
+
+    Returns
+    -------
+    Optional[str]
+        Hexadecimal hash of the body
+    """
+    body = kwargs.get('data')
+    if body is None and kwargs.get('json') is not None:
+        body = json.dumps(kwargs['json'], sort_keys=True)
+    if body is None:
+        return None
+    return hashlib.sha1(body.encode() if isinstance(body, str) else bytes(body)).hexdigest()
+
+
+def get_call_key(method: str, url: str, kwargs: dict) -> Tuple:
+    """
+    Returns the key of an API call without its body: method, zone, environment, URL and parameters
+
+    Parameters
+    ----------
+    method : str
+        'get', 'put', 'post' or 'delete'
+    url : str
+        URL of the API call
+    kwargs : dict
+        Keyword arguments of the API call
+
+    Returns
+    -------
+    Tuple
+        Key of the call, the same for a recorded call and its replay
+    """
+    headers = apicalls.get_headers(kwargs)
+    params = tuple(sorted((str(k), str(v)) for k, v in (kwargs.get('params') or {}).items()))
+    return (method.upper(),
+            headers.zone if headers is not None else None,
+            headers.env if headers is not None else None,
+            get_relative_url(url),
+            params)
+
+
+def open_cassette(file_path: str, mode: str) -> IO[str]:
+    """
+    Opens a cassette file in text mode, compressed with gzip if its name ends with '.gz'
+    """
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, f'{mode}t', encoding='utf-8')
+    return open(file_path, mode, encoding='utf-8')
+
+
+class Cassette:
+    """
+    Transport recording the Alma API responses of a run or replaying them
+
+    The cassette is a JSON lines file, compressed with gzip if its name ends
+    with '.gz'. The first line describes the recording, each other line is one
+    HTTP request with its response: method, zone, environment, URL without the
+    Alma API URL and without API key, parameters, hash of the body, status,
+    content type, content and duration. The request headers are not recorded.
+
+    A call is replayed with the responses recorded for the same method, zone,
+    environment, URL and parameters, in the recorded order. The first response
+    recorded with the same body is preferred. When the body differs, a date
+    for example, the first response not yet replayed is used. Each response
+    is replayed once, except the last response of a call that is repeated. Calls not in the cassette receive a 404 response
+    with an Alma error.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the cassette
+    mode : str
+        'record' to make the HTTP requests and write them in the cassette,
+        'replay' to answer the calls with the responses of the cassette
+    replay_latency : bool, optional
+        In replay mode, wait for the recorded duration of each call
+
+    Attributes
+    ----------
+    nb_recorded : int
+        Number of calls written in the cassette
+    nb_replayed : int
+        Number of calls answered with a recorded response
+    nb_missing : int
+        Number of calls not found in the cassette
+    """
+    def __init__(self, file_path: str, mode: str = 'replay', replay_latency: bool = False) -> None:
+        if mode not in ['record', 'replay']:
+            raise ValueError(f'Unknown cassette mode: {mode}')
+        self.file_path = file_path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.nb_recorded = 0
+        self.nb_replayed = 0
+        self.nb_missing = 0
+        self.lock = threading.Lock()
+
+        self._file: Optional[IO[str]] = None
+        # Key of the call without body hash => recorded responses, in the recorded order
+        self._responses: Dict[Hashable, Deque[dict]] = {}
+
+        if mode == 'record':
+            self._file = open_cassette(file_path, 'w')
+            self._write({'cassette_version': CASSETTE_VERSION,
+                         'created': datetime.now().isoformat(timespec='seconds'),
+                         'api_base_url': Record.api_base_url})
+        else:
+            self.load()
+
+    def load(self) -> None:
+        """
+        Reads the recorded responses of the cassette
+
+        Raises
+        ------
+        ValueError
+            If the file is not a cassette of a supported version
+        """
+        nb_calls = 0
+        with open_cassette(self.file_path, 'r') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('cassette_version') != CASSETTE_VERSION:
+                raise ValueError(f'{self.file_path} is not a cassette of version {CASSETTE_VERSION}')
+            for line in f:
+                if line.strip() == '':
+                    continue
+                interaction = json.loads(line)
+                key = (interaction['method'], interaction['zone'], interaction['env'], interaction['url'],
+                       tuple(tuple(param) for param in interaction['params']))
+                self._responses.setdefault(key, deque()).append(interaction)
+                nb_calls += 1
+
+        logging.info(f'Cassette {self.file_path}: {nb_calls} recorded calls loaded')
+
+    def __call__(self, method: str, *args, **kwargs) -> Optional[requests.Response]:
+        """
+        Makes the call and records it, or answers it with the cassette
+        """
+        if self.mode == 'record':
+            return self.record(method, *args, **kwargs)
+        return self.replay(method, *args, **kwargs)
+
+    def record(self, method: str, *args, **kwargs) -> Optional[requests.Response]:
+        """
+        Makes the HTTP request with `apicalls.send` and writes it in the cassette
+
+        Requests failing without response, timeouts for example, are not recorded.
+        """
+        t0 = time.monotonic()
+        r = apicalls.send(method, *args, **kwargs)
+        if r is None or not args:
+            return r
+
+        method_key, zone, env, url, params = get_call_key(method, str(args[0]), kwargs)
+        self._write({'method': method_key,
+                     'zone': zone,
+                     'env': env,
+                     'url': url,
+                     'params': params,
+                     'body': get_body_hash(kwargs),
+                     'status': r.status_code,
+                     'content_type': r.headers.get('Content-Type'),
+                     'content': r.content.decode('utf-8', errors='replace'),
+                     'ms': round((time.monotonic() - t0) * 1000)})
+        return r
+
+    def replay(self, method: str, *args, **kwargs) -> Optional[requests.Response]:
+        """
+        Answers the call with the next recorded response of the same call
+        """
+        if method not in ['get', 'put', 'post', 'delete'] or not args:
+            return None
+
+        key = get_call_key(method, str(args[0]), kwargs)
+        body = get_body_hash(kwargs)
+        with self.lock:
+            interaction = None
+            responses = self._responses.get(key)
+            if responses:
+                # First response recorded with the same body, else the first response of the call
+                index = next((k for k, recorded in enumerate(responses) if recorded['body'] == body), 0)
+                interaction = responses[index]
+                if len(responses) > 1:
+                    del responses[index]
+            if interaction is None:
+                self.nb_missing += 1
+            else:
+                self.nb_replayed += 1
+
+        if interaction is None:
+            logging.warning(f'{method.upper()} : {key[3]} not in the cassette')
+            return self._get_missing_response(str(args[0]), kwargs)
+
+        if self.replay_latency:
+            time.sleep(interaction['ms'] / 1000)
+
+        r = requests.Response()
+        r.status_code = interaction['status']
+        r.headers = CaseInsensitiveDict({'Content-Type': interaction['content_type']}
+                                        if interaction['content_type'] else {})
+        r._content = interaction['content'].encode('utf-8')
+        r.encoding = 'utf-8'
+        r.url = remove_apikey_from_url(str(args[0]))
+        logging.info(f'{method.upper()} : {r.url} {r.status_code} (cassette)')
+        return r
+
+    @staticmethod
+    def _get_missing_response(url: str, kwargs: dict) -> requests.Response:
+        """
+        Returns a 404 response with an Alma error in the format of the call
+        """
+        headers = kwargs.get('headers') or {}
+        message = 'Call not recorded in the cassette.'
+        r = requests.Response()
+        r.status_code = 404
+        r.url = remove_apikey_from_url(url)
+        r.encoding = 'utf-8'
+        if 'json' in str(headers.get('accept', '')):
+            r.headers = CaseInsensitiveDict({'Content-Type': 'application/json;charset=UTF-8'})
+            r._content = json.dumps({'errorsExist': True,
+                                     'errorList': {'error': [{'errorCode': MISSING_ERROR_CODE,
+                                                              'errorMessage': message}]},
+                                     'result': None}).encode()
+        else:
+            r.headers = CaseInsensitiveDict({'Content-Type': 'application/xml;charset=UTF-8'})
+            r._content = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                          '<web_service_result xmlns="http://com/exlibris/urm/general/xmlbeans">'
+                          '<errorsExist>true</errorsExist><errorList><error>'
+                          f'<errorCode>{MISSING_ERROR_CODE}</errorCode><errorMessage>{message}</errorMessage>'
+                          '</error></errorList></web_service_result>').encode()
+        return r
+
+    def _write(self, data: dict) -> None:
+        """
+        Appends a line to the cassette
+        """
+        line = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            if self._file is None:
+                return
+            self._file.write(line + '\n')
+            if 'method' in data:
+                self.nb_recorded += 1
+
+    def close(self) -> None:
+        """
+        Closes the cassette and writes the number of recorded or replayed calls in the log
+        """
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+        if self.mode == 'record':
+            logging.info(f'Cassette {self.file_path}: {self.nb_recorded} calls recorded')
+        else:
+            logging.info(f'Cassette {self.file_path}: {self.nb_replayed} calls replayed, '
+                         f'{self.nb_missing} calls not in the cassette')
+
+
+# Cassette of the process, set by `install`
+cassette: Optional[Cassette] = None
+
+
+def install(record_path: Optional[str] = None,
+            replay_path: Optional[str] = None,
+            replay_latency: bool = False) -> Optional[Cassette]:
+    """
+    Records the Alma API calls of the process in a cassette or replays a cassette
+
+    The cassette replaces the HTTP requests, after all middlewares: the
+    retries, the rate limiter and the counters see the recorded responses as
+    real ones. In replay mode, Alma is never called and the API keys are not
+    required.
+
+    Parameters
+    ----------
+    record_path : str, optional
+        Path of the cassette to write, an existing file is replaced
+    replay_path : str, optional
+        Path of the cassette to replay
+    replay_latency : bool, optional
+        In replay mode, wait for the recorded duration of each call
+
+    Returns
+    -------
+    Optional[Cassette]
+        The cassette of the process, None if no path is given
+    """
+    global cassette
+
+    if cassette is not None:
+        apicalls.set_transport(None)
+        atexit.unregister(cassette.close)
+        cassette.close()
+        cassette = None
+
+    if replay_path is not None:
+        cassette = Cassette(replay_path, 'replay', replay_latency)
+        apicalls.set_transport(cassette, offline=True)
+        logging.warning(f'API calls answered by the cassette {replay_path}, Alma is not called')
+    elif record_path is not None:
+        cassette = Cassette(record_path, 'record')
+        apicalls.set_transport(cassette)
+        logging.info(f'API calls recorded in the cassette {record_path}')
+    else:
+        return None
+
+    atexit.register(cassette.close)
+    return cassette
@@ -0,0 +1,211 @@
+import argparse
+import logging
+import sys
+from typing import Callable
+
+from utils import xlstools
+from utils.processmonitoring import STORAGE_MODES, ProcessMonitor, create_process_monitor
+
+
+def parse_args(script_name: str, parallel: bool = False, prefetch: bool = False) -> argparse.Namespace:
+    """
+    Parses the command line arguments common to all transfer scripts.
+
+    Parameters
+    ----------
+    script_name : str
+        Name of the script, used in the usage message.
+    parallel : bool, optional
+        If True, the `--workers` option is available, the script must support
+        processing rows concurrently.
+    prefetch : bool, optional
+        If True, the `--prefetch` option is available, the script must be able
+        to fetch the source IDs of the rows before the transfer.
+
+    Returns
+    -------
+    argparse.Namespace
+        Parsed arguments, `excel_filepath` contains the path to the Excel form.
+        `workers` and `adaptive` are always set, 1 and False for scripts without
+        parallel processing. `prefetch` is always set, 0 when disabled.
+    """
+    parser = argparse.ArgumentParser(prog=f'python {script_name}')
+    parser.add_argument('excel_filepath', metavar='dataForm.xlsx',
+                        help='Excel form with the configuration and the data to transfer')
+    parser.add_argument('--storage', choices=list(STORAGE_MODES), default='csv',
+                        help='storage mode of the processing file: "csv" rewrites the whole file at each save, '
+                             '"journal" appends the changes to a journal and rewrites the file periodically, '
+                             '"sqlite" stores the state in a SQLite database and exports the csv file at the end, '
+                             '"buffered" writes the csv file in a background thread every few seconds')
+    parser.add_argument('--api-rate-s', type=float, metavar='RATE',
+                        help='maximum number of API calls per second to the source IZ, 0 for no limit. '
+                             'Overrides the value of the Excel form, default is 20')
+    parser.add_argument('--api-rate-d', type=float, metavar='RATE',
+                        help='maximum number of API calls per second to the destination IZ, 0 for no limit. '
+                             'Overrides the value of the Excel form, default is 20')
+
+    parser.add_argument('--retries', type=int, default=4, metavar='N',
+                        help='maximum number of retries of an API call failing with a transient error: timeout, '
+                             'connection reset, 429 or 5xx response, default is 4. 0 disables the retries')
+    parser.add_argument('--record-cache', type=float, default=64, metavar='MB',
+                        help='maximum size of the cache of the records read from Alma in MB, default is 64. '
+                             'A record is read only once until the tool changes it. 0 disables the cache')
+
+    parser.add_argument('--alma-url', metavar='URL',
+                        help='send the API calls to another server than Alma, for example the mock server '
+                             'started with mock_alma_server.py: http://localhost:8080/almaws/v1. '
+                             'The API keys are not sent to this server')
+
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument('--record-cassette', metavar='FILE',
+                          help='record the API calls and their responses in a cassette, JSON lines compressed with '
+                               'gzip if FILE ends with .gz. The cassette contains the records read from Alma')
+    cassette.add_argument('--replay-cassette', metavar='FILE',
+                          help='answer the API calls with the responses of a recorded cassette, Alma is not called')
+    parser.add_argument('--replay-latency', action='store_true',
+                        help='with --replay-cassette, wait for the recorded duration of each call')
+
+    parser.add_argument('--profile', action='store_true',
+                        help='record a trace of the rows with their stages, API calls and writes of the processing '
+                             'file in data/<form>_<type>_trace.json, to open with chrome://tracing or '
+                             'https://ui.perfetto.dev')
+    parser.add_argument('--profile-python', action='store_true',
+                        help='like --profile, also profile the Python code of the rows with cProfile in '
+                             'data/<form>_<type>_profile.pstats')
+
+    parser.add_argument('--plan', action='store_true',
+                        help='only report the remaining work, the estimated number of API calls by endpoint '
+                             'and the estimated runtime, no change is made in Alma')
+
+    if parallel:
+        parser.add_argument('--workers', type=positive_int, default=1, metavar='N',
+                            help='number of rows processed concurrently, default is 1. For each source bib '
+                                 'and holding, one row creates the destination records before the other '
+                                 'rows are started')
+        parser.add_argument('--adaptive', action='store_true',
+                            help='adapt the number of concurrent rows to the API latency and to the 429 and '
+                                 '5xx responses, --workers is then the maximum')
+    else:
+        parser.set_defaults(workers=1, adaptive=False)
+
+    if prefetch:
+        parser.add_argument('--prefetch', type=positive_int, nargs='?', const=16, default=0, metavar='N',
+                            help='fetch the source records of all rows with N concurrent reads, default is 16, '
+                                 'before starting the transfer. The source bib and holding of every row are '
+                                 'then known when the rows are scheduled')
+    else:
+        parser.set_defaults(prefetch=0)
+
+    return parser.parse_args()
+
+
+def setup_run(args: argparse.Namespace,
+              process_type: str,
+              form_version: str,
+              describe_row: Callable[[int], str],
+              time_stages: bool = False) -> ProcessMonitor:
+    """
+    Prepares the run of a transfer script and returns its process monitor.
+
+    Checks the version of the Excel form and loads its configuration. With `--plan`,
+    the remaining work is written in the log and the process exits. Otherwise, the
+    API calls are routed through the middlewares selected on the command line: other
+    server, retries, rate limit, record cache, call counters, stage durations,
+    cassette and profiler.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Arguments parsed with :func:`parse_args`.
+    process_type : str
+        Type of process (e.g., 'PoLines', 'Items', 'Holdings').
+    form_version : str
+        Version of the Excel form supported by the script.
+    describe_row : Callable[[int], str]
+        Function returning the description of a row, for example its barcode, used by
+        the profiler. It is only called once the rows are processed.
+    time_stages : bool, optional
+        If True, the durations of the stages of the rows are measured.
+
+    Returns
+    -------
+    ProcessMonitor
+        The process monitor of the run.
+    """
+    excel_filepath = args.excel_filepath
+
+    # The plan doesn't write any file, not even the cache of the parsed form
+    xlstools.set_form_cache_read_only(args.plan)
+
+    # Check version of the Excel form
+    version = xlstools.get_form_version(excel_filepath)
+    if not version or not isinstance(version, str) or not version.replace('.', '', 1).isdigit():
+        logging.critical(f"Invalid version format in the Excel file: {version}")
+        sys.exit(1)
+    elif version != form_version:
+        logging.critical(f"Unsupported Excel form version: {version}. Expected version: {form_version}")
+        sys.exit(1)
+
+    # load configuration
+    xlstools.set_config(excel_filepath)
+
+    # Report the remaining work without making any change in Alma nor in the files of the run
+    if args.plan:
+        from utils import planner, ratelimit
+        planner.log_plan(create_process_monitor(excel_filepath, process_type, args.storage, read_only=True),
+                         args.workers, ratelimit.get_rates(args.api_rate_s, args.api_rate_d))
+        sys.exit(0)
+
+    # Send the API calls to another server than Alma, the mock server for example
+    if args.alma_url:
+        from utils import apicalls
+        apicalls.set_base_url(args.alma_url)
+
+    # Retry the API calls failing with transient errors, limit their rate,
+    # keep the records read from Alma, count the calls and time the stages of the rows
+    from utils import retry, ratelimit, recordcache, apistats, stagestats
+    retry.install(args.retries)
+    ratelimit.install(args.api_rate_s, args.api_rate_d)
+    recordcache.install(args.record_cache)
+    apistats.install()
+    if time_stages:
+        stagestats.install()
+
+    # Record the API calls in a cassette or answer them with a recorded cassette
+    from utils import cassette
+    cassette.install(args.record_cassette, args.replay_cassette, args.replay_latency)
+
+    # Initialize process monitor
+    process_monitor = create_process_monitor(excel_filepath, process_type, args.storage)
+
+    # Record the span traces of the rows: stages, API calls and writes of the processing file
+    if args.profile or args.profile_python:
+        from utils import profiler
+        profiler.install(process_monitor.get_report_path('trace'),
+                         process_monitor.get_report_path('profile', 'pstats') if args.profile_python else None,
+                         describe_row)
+
+    return process_monitor
+
+
+def positive_int(value: str) -> int:
+    """
+    Argparse type accepting strictly positive integers.
+
+    Parameters
+    ----------
+    value : str
+        Value given on the command line.
+
+    Returns
+    -------
+    int
+        The parsed value.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid integer value: {value}')
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1: {value}')
+    return number
@@ -0,0 +1,241 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Iterator, List, Optional
+
+
+class KeyedLocks:
+    """
+    Set of locks identified by a key, for example a source MMS ID
+
+    Code holding the lock of a key is serialized with all other code using the
+    same key, other keys are not blocked. Locks are created on demand and
+    removed when no thread uses them anymore.
+
+    Examples
+    --------
+    >>> locks = KeyedLocks()
+    >>> with locks.hold('991000000000005501'):
+    ...     pass
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # key => [lock, number of threads using or waiting for the lock]
+        self._locks: Dict[Hashable, List] = {}
+
+    @contextmanager
+    def hold(self, key: Hashable) -> Iterator[None]:
+        """
+        Acquires the lock of the key for the duration of the with block
+
+        Parameters
+        ----------
+        key : Hashable
+            Key of the lock, rows with the same key are serialized
+        """
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def __len__(self) -> int:
+        """
+        Returns the number of locks currently in use
+        """
+        with self._lock:
+            return len(self._locks)
+
+
+class AdaptiveLimit:
+    """
+    Limit of the number of rows processed concurrently, can be changed at any time
+
+    The thread pool has `max_limit` threads, each row waits for a free slot
+    before running. Lowering the limit doesn't stop the running rows, the new
+    limit applies to the next rows.
+
+    Parameters
+    ----------
+    limit : int
+        Initial number of slots
+    max_limit : int
+        Maximum number of slots, usually the number of threads of the pool
+    """
+    def __init__(self, limit: int, max_limit: int) -> None:
+        self.max_limit = max_limit
+        self.limit = max(1, min(limit, max_limit))
+        self.active = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        Waits for a free slot and holds it for the duration of the with block
+        """
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.active -= 1
+                self._condition.notify()
+
+    def set_limit(self, limit: int) -> int:
+        """
+        Changes the number of slots, bounded between 1 and `max_limit`
+
+        Parameters
+        ----------
+        limit : int
+            New number of slots
+
+        Returns
+        -------
+        int
+            The number of slots applied
+        """
+        with self._condition:
+            self.limit = max(1, min(limit, self.max_limit))
+            self._condition.notify_all()
+            return self.limit
+
+
+class AimdController:
+    """
+    Middleware adapting the concurrency to the latency and errors of the API calls
+
+    The calls are observed by windows of `window_calls` calls or `window_seconds`
+    seconds. At the end of each window, the limit is:
+
+    * halved if a 429 or 5xx response or a failed call was observed
+    * halved if the p95 latency is above `spike_factor` times the baseline
+    * increased by one if the p95 latency stays below `flat_factor` times the baseline
+    * kept otherwise
+
+    The baseline is a moving average of the p95 latency of the windows without errors,
+    so a slower period of the day doesn't reduce the concurrency forever.
+
+    Parameters
+    ----------
+    limit : AdaptiveLimit
+        Limit adapted by the controller
+    window_calls : int, optional
+        Maximum number of calls of a window
+    window_seconds : float, optional
+        Maximum duration of a window in seconds
+    flat_factor : float, optional
+        p95 latency ratio to the baseline considered as flat
+    spike_factor : float, optional
+        p95 latency ratio to the baseline considered as a spike
+    """
+    def __init__(self,
+                 limit: AdaptiveLimit,
+                 window_calls: int = 50,
+                 window_seconds: float = 10.0,
+                 flat_factor: float = 1.2,
+                 spike_factor: float = 1.5) -> None:
+        self.limit = limit
+        self.window_calls = window_calls
+        self.window_seconds = window_seconds
+        self.flat_factor = flat_factor
+        self.spike_factor = spike_factor
+        self.baseline: Optional[float] = None
+
+        self._lock = threading.Lock()
+        self._latencies: List[float] = []
+        self._errors = 0
+        self._window_start = time.monotonic()
+
+    def __call__(self, call_next: Callable, method: str, *args, **kwargs):
+        """
+        Makes the call and records its latency and status
+        """
+        t0 = time.monotonic()
+        error = True
+        try:
+            r = call_next(method, *args, **kwargs)
+            error = r is None or r.status_code == 429 or r.status_code >= 500
+            return r
+        finally:
+            self.observe(time.monotonic() - t0, error)
+
+    def observe(self, latency: float, error: bool = False) -> None:
+        """
+        Records a call and adapts the limit at the end of the window
+
+        Parameters
+        ----------
+        latency : float
+            Duration of the call in seconds
+        error : bool, optional
+            True for a 429 or 5xx response or a failed call
+        """
+        with self._lock:
+            self._latencies.append(latency)
+            self._errors += int(error)
+            if (len(self._latencies) < self.window_calls
+                    and time.monotonic() - self._window_start < self.window_seconds):
+                return
+            latencies, errors = self._latencies, self._errors
+            self._latencies, self._errors = [], 0
+            self._window_start = time.monotonic()
+            self.adapt(percentile(latencies, 95), errors, len(latencies))
+
+    def adapt(self, p95: float, errors: int, nb_calls: int) -> None:
+        """
+        Applies the AIMD rule with the statistics of a window
+        """
+        old_limit = self.limit.limit
+        if errors > 0:
+            new_limit, reason = old_limit // 2, f'{errors} errors'
+        elif self.baseline is None or p95 <= self.baseline * self.flat_factor:
+            new_limit, reason = old_limit + 1, 'flat latency'
+        elif p95 > self.baseline * self.spike_factor:
+            new_limit, reason = old_limit // 2, 'latency spike'
+        else:
+            new_limit, reason = old_limit, 'rising latency'
+
+        if errors == 0:
+            self.baseline = p95 if self.baseline is None else 0.8 * self.baseline + 0.2 * p95
+
+        new_limit = self.limit.set_limit(new_limit)
+        baseline = f'{self.baseline * 1000:.0f} ms' if self.baseline is not None else 'none'
+        logging.info(f'Adaptive concurrency: {old_limit} -> {new_limit} workers ({reason}), '
+                     f'{nb_calls} calls, p95 {p95 * 1000:.0f} ms, baseline {baseline}')
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Returns the q-th percentile of the values, nearest-rank method
+
+    Parameters
+    ----------
+    values : List[float]
+        Values, not necessarily sorted
+    q : float
+        Percentile between 0 and 100
+
+    Returns
+    -------
+    float
+        The percentile, 0 if no value
+    """
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
@@ -1,14 +1,148 @@
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from almapiwrapper.inventory import IzBib, NzBib, Holding, Item, Collection
 
 from utils import xlstools
+from utils.concurrency import KeyedLocks
 from utils.processmonitoring import ProcessMonitor
+from collections import OrderedDict
 from copy import deepcopy
+from lxml import etree
 
 import logging
+import threading
 
 config = xlstools.get_config()
 
+# Maximum number of destination bibs with indexed holdings, the least recently used are removed
+MAX_INDEXED_BIBS = 500
+
+
+def normalize_callnumber(callnumber: Optional[str]) -> Optional[str]:
+    """
+    Suppresses the empty chars around a call number.
+
+    Parameters
+    ----------
+    callnumber : str, optional
+        Call number of a holding.
+
+    Returns
+    -------
+    str, optional
+        The stripped call number, None if no call number.
+    """
+    return callnumber.strip() if callnumber is not None else None
+
+
+class HoldingsIndex:
+    """
+    Holdings of a destination bib indexed by library, location and call number.
+
+    The holdings are fetched once, the rows of the same bib use the index
+    instead of fetching and scanning all the holdings of the bib again.
+
+    Parameters
+    ----------
+    holdings : List[Holding]
+        Holdings of the bib, in the order given by Alma.
+
+    Attributes
+    ----------
+    by_location : Dict[Tuple[str, str], List[Holding]]
+        Holdings by library and location, in the order given by Alma.
+    by_callnumber : Dict[Tuple[str, str, Optional[str]], Holding]
+        First holding without error by library, location and stripped call number.
+    """
+    def __init__(self, holdings: List[Holding]) -> None:
+        self.by_location: Dict[Tuple[str, str], List[Holding]] = {}
+        self.by_callnumber: Dict[Tuple[str, str, Optional[str]], Holding] = {}
+        for holding in holdings:
+            self.add(holding)
+
+    def add(self, holding: Holding) -> None:
+        """
+        Adds a holding to the index, a new holding for example.
+
+        Parameters
+        ----------
+        holding : Holding
+            Holding of the bib.
+        """
+        self.by_location.setdefault((holding.library, holding.location), []).append(holding)
+        if holding.error is False:
+            self.by_callnumber.setdefault(
+                (holding.library, holding.location, normalize_callnumber(holding.callnumber)), holding)
+
+    def find(self, library: str, location: str, callnumber: Optional[str]) -> Optional[Holding]:
+        """
+        Returns the holding with the library, location and call number, None if not found.
+        """
+        return self.by_callnumber.get((library, location, normalize_callnumber(callnumber)))
+
+    def find_all(self, library: str, location: str) -> List[Holding]:
+        """
+        Returns the holdings with the library and location.
+        """
+        return self.by_location.get((library, location), [])
+
+
+# Holdings indexes of the destination bibs by MMS ID, least recently used first
+holdings_indexes: OrderedDict = OrderedDict()
+holdings_indexes_lock = threading.Lock()
+
+# Serializes the building of the index of a bib
+holdings_index_locks = KeyedLocks()
+
+
+def get_holdings_index(mms_id_d: str, bib_d: Optional[IzBib] = None) -> HoldingsIndex:
+    """
+    Returns the holdings index of a destination bib, fetches the holdings if not indexed yet.
+
+    Parameters
+    ----------
+    mms_id_d : str
+        MMS ID of the bib in the destination IZ.
+    bib_d : IzBib, optional
+        Destination bib, created from the MMS ID if not provided.
+
+    Returns
+    -------
+    HoldingsIndex
+        Holdings of the bib.
+    """
+    with holdings_index_locks.hold(mms_id_d):
+        with holdings_indexes_lock:
+            if mms_id_d in holdings_indexes:
+                holdings_indexes.move_to_end(mms_id_d)
+                return holdings_indexes[mms_id_d]
+
+        if bib_d is None:
+            bib_d = IzBib(mms_id_d, zone=config['iz_d'], env=config['env'])
+        index = HoldingsIndex(bib_d.get_holdings())
+
+        with holdings_indexes_lock:
+            holdings_indexes[mms_id_d] = index
+            while len(holdings_indexes) > MAX_INDEXED_BIBS:
+                holdings_indexes.popitem(last=False)
+
+    return index
+
+
+def invalidate_holdings_index(mms_id_d: str) -> None:
+    """
+    Removes the holdings index of a destination bib.
+
+    Used when holdings are created outside the index, by Alma when a PoLine is created
+    for example. The holdings are fetched again at the next use.
+
+    Parameters
+    ----------
+    mms_id_d : str
+        MMS ID of the bib in the destination IZ.
+    """
+    with holdings_indexes_lock:
+        holdings_indexes.pop(mms_id_d, None)
+
 
 def get_source_holding(i: int) -> Optional[Item]:
     """
@@ -35,7 +169,7 @@ def get_source_holding(i: int) -> Optional[Item]:
 
     if holding_s.error:
         logging.error(f"{repr(holding_s)}: {holding_s.error_msg}")
-        process_monitor.df.loc[process_monitor.df['MMS_id_s'] == mms_id_s, 'Error'] = 'Source Holding not found'
+        process_monitor.set_value_by_id('MMS_id_s', mms_id_s, 'Error', 'Source Holding not found')
         process_monitor.save()
         return None
 
@@ -43,12 +177,59 @@ def get_source_holding(i: int) -> Optional[Item]:
     library_d, location_d = xlstools.get_corresponding_location(holding_s.library, holding_s.location)
     if library_d is None or location_d is None:
         logging.error(f"{repr(holding_s)}: Library or location not found in destination IZ")
-        process_monitor.df.loc[process_monitor.df['MMS_id_s'] == mms_id_s, 'Error'] = 'Library or location not found in destination IZ'
+        process_monitor.set_value_by_id('MMS_id_s', mms_id_s, 'Error', 'Library or location not found in destination IZ')
         return None
 
     return holding_s
 
 
+def copy_holding_fields(data_s: etree.Element, data_d: etree.Element) -> bool:
+    """
+    Copies the MARC fields of a source holding into the data of a destination holding.
+
+    The fields other than 852 with numeric indicators, 853 or 866 for example, are
+    appended. The call number of 852$$h, or 852$$j if missing, replaces the one of the
+    destination and the 852$$t subfields of the destination are removed.
+
+    Parameters
+    ----------
+    data_s : etree.Element
+        Data of the source holding.
+    data_d : etree.Element
+        Data of the destination holding, modified in place.
+
+    Returns
+    -------
+    bool
+        True if a call number was copied, False if the source holding has none.
+    """
+    hol_fields = [f for f in data_s.findall('.//datafield') if
+                  f.get('tag') != '852' and f.get('ind1') in ' 0123456789' and f.get('ind2') in ' 0123456789']
+
+    # Copy fields like 853 or 866
+    for f in hol_fields:
+        data_d.find('record').append(deepcopy(f))
+
+    # Copy the call number
+    # Get callnumber from 852$$h or 852$$j
+    callnumber = data_s.find('.//datafield[@tag="852"]/subfield[@code="h"]')
+    if callnumber is None:
+        callnumber = data_s.find('.//datafield[@tag="852"]/subfield[@code="j"]')
+
+    if callnumber is not None:
+        callnumber_code = callnumber.get('code')
+        if data_d.find(f'.//datafield[@tag="852"]/subfield[@code="{callnumber_code}"]') is not None:
+            data_d.find(f'.//datafield[@tag="852"]/subfield[@code="{callnumber_code}"]').text = callnumber.text
+        else:
+            data_d.find('.//datafield[@tag="852"]').append(callnumber)
+
+    # Remove $$t subfield of 852
+    for f in data_d.findall('.//datafield[@tag="852"]/subfield[@code="t"]'):
+        f.getparent().remove(f)
+
+    return callnumber is not None
+
+
 def copy_holding_data(i: int, holding_s: Holding) -> Optional[Holding]:
     """
     Copies holding data from the source IZ to the destination IZ.
@@ -76,17 +257,16 @@ def copy_holding_data(i: int, holding_s: Holding) -> Optional[Holding]:
     library_d, location_d = xlstools.get_corresponding_location(holding_s.library, holding_s.location)
     if library_d is None or location_d is None:
         logging.error(f"{repr(holding_s)}: Library or location not found in destination IZ")
-        process_monitor.df.loc[process_monitor.df['MMS_id_s'] == mms_id_s, 'Error'] = 'Library or location not found in destination IZ'
+        process_monitor.set_value_by_id('MMS_id_s', mms_id_s, 'Error', 'Library or location not found in destination IZ')
         return None
 
     # Holding should be already existing in the destination IZ, so we fetch it
-    bib_d = IzBib(mms_id_d, zone=config['iz_d'], env=config['env'])
-    hols_d = [hol for hol in bib_d.get_holdings() if hol.library == library_d and hol.location == location_d]
+    hols_d = get_holdings_index(mms_id_d).find_all(library_d, location_d)
 
     # If no matching holdings are found, the PoLine might not have been created yet
     if len(hols_d) == 0:
         logging.error(f"{repr(holding_s)}: No matching holdings found in destination IZ for {mms_id_d}, library {library_d} and location {location_d}.")
-        process_monitor.df.loc[process_monitor.df['Holding_id_s'] == holding_id_s, 'Error'] = 'No matching holdings found in destination IZ'
+        process_monitor.set_value_by_id('Holding_id_s', holding_id_s, 'Error', 'No matching holdings found in destination IZ')
         return None
 
     # If there are multiple holdings, we take the last one, it is probably the last created with the PoLine
@@ -98,42 +278,21 @@ def copy_holding_data(i: int, holding_s: Holding) -> Optional[Holding]:
 
     if holding_d.error:
         logging.error(f"{repr(holding_d)}: {holding_d.error_msg}")
-        process_monitor.df.loc[process_monitor.df['MMS_id_s'] == mms_id_s, 'Error'] = 'Destination Holding not retrieved'
+        process_monitor.set_value_by_id('MMS_id_s', mms_id_s, 'Error', 'Destination Holding not retrieved')
         return None
 
     # Update the holding data with data of the source holding
-    hol_fields = [f for f in holding_s.data.findall('.//datafield') if
-                  f.get('tag') != '852' and f.get('ind1') in ' 0123456789' and f.get('ind2') in ' 0123456789']
-
-    # Copy fields like 853 or 866
-    for f in hol_fields:
-        holding_d.data.find('record').append(deepcopy(f))
-
-    # Copy the call number
-    # Get callnumber from 852$$h or 852$$j
-    callnumber = holding_s.data.find('.//datafield[@tag="852"]/subfield[@code="h"]')
-    if callnumber is None:
-        callnumber = holding_s.data.find('.//datafield[@tag="852"]/subfield[@code="j"]')
-
-    if callnumber is None:
+    if not copy_holding_fields(holding_s.data, holding_d.data):
         logging.warning(f"{repr(holding_s)}: No call number found in source holding.")
-    else:
-        callnumber_code = callnumber.get('code')
-        if holding_d.data.find(f'.//datafield[@tag="852"]/subfield[@code="{callnumber_code}"]') is not None:
-            holding_d.data.find(f'.//datafield[@tag="852"]/subfield[@code="{callnumber_code}"]').text = callnumber.text
-        else:
-            holding_d.data.find('.//datafield[@tag="852"]').append(callnumber)
-
-    # Remove $$t subfield of 852
-    for f in holding_d.data.findall('.//datafield[@tag="852"]/subfield[@code="t"]'):
-        f.getparent().remove(f)
 
     holding_d.update()
 
     # Check if the holding was updated successfully
     if holding_d.error:
         logging.error(f"{repr(holding_d)}: {holding_d.error_msg}")
-        process_monitor.df.loc[process_monitor.df['Holding_id_s'] == holding_id_s, 'Error'] = 'Destination Holding not updated'
+        # The data of the indexed holding was changed, it is fetched again at the next use
+        invalidate_holdings_index(mms_id_d)
+        process_monitor.set_value_by_id('Holding_id_s', holding_id_s, 'Error', 'Destination Holding not updated')
         return None
 
     return holding_d
@@ -166,7 +325,7 @@ def copy_holding_to_destination_iz(i: int, bib_d: IzBib) -> Optional[Holding]:
 
     if holding_s.error:
         logging.error(f"{repr(holding_s)}: {holding_s.error_msg}")
-        process_monitor.df.loc[process_monitor.df['Holding_id_s'] == holding_id_s, 'Error'] = 'Source Holding not found'
+        process_monitor.set_value_by_id('Holding_id_s', holding_id_s, 'Error', 'Source Holding not found')
         process_monitor.save()
         return None
 
@@ -177,7 +336,7 @@ def copy_holding_to_destination_iz(i: int, bib_d: IzBib) -> Optional[Holding]:
 
     if bib_d.error:
         logging.error(f"{repr(bib_d)}: {bib_d.error_msg}")
-        process_monitor.df.loc[process_monitor.df['MMS_id_s'] == mms_id_s, 'Error'] = 'Destination Bib not found'
+        process_monitor.set_value_by_id('MMS_id_s', mms_id_s, 'Error', 'Destination Bib not found')
         process_monitor.save()
         return None
 
@@ -185,33 +344,17 @@ def copy_holding_to_destination_iz(i: int, bib_d: IzBib) -> Optional[Holding]:
     library_d, location_d = xlstools.get_corresponding_location(holding_s.library, holding_s.location)
     if library_d is None or location_d is None:
         logging.error(f"{repr(holding_s)}: Library or location not found in destination IZ")
-        process_monitor.df.loc[process_monitor.df['Holding_id_s'] == holding_id_s, 'Error'] = 'Library or location not found in destination IZ'
+        process_monitor.set_value_by_id('Holding_id_s', holding_id_s, 'Error', 'Library or location not found in destination IZ')
         process_monitor.save()
         return None
 
-    # Check if the callnumber exists already in destination holding
-    callnumber_s = holding_s.callnumber
-
-    # Suppress empty chars from call numbers
-    if callnumber_s is not None:
-        callnumber_s = callnumber_s.strip()
-
-
-    holding_d = None
-
     # Check if exists a destination holding with the same callnumber
-    for holding in bib_d.get_holdings():
-        callnumber_d = holding.callnumber
-
-        # Suppress empty chars from call numbers
-        if callnumber_d is not None:
-            callnumber_d = callnumber_d.strip()
-
-        if callnumber_d == callnumber_s and holding.library == library_d and holding.location == location_d and holding.error is False:
-            logging.warning(f'{repr(holding_s)}: holding found with same callnumber "{callnumber_s}" and corresponding library "{library_d}" and location "{location_d}" in destination IZ.')
-            holding_d = holding
-            break
+    callnumber_s = normalize_callnumber(holding_s.callnumber)
+    holdings_index = get_holdings_index(bib_d.mms_id, bib_d)
+    holding_d = holdings_index.find(library_d, location_d, callnumber_s)
 
+    if holding_d is not None:
+        logging.warning(f'{repr(holding_s)}: holding found with same callnumber "{callnumber_s}" and corresponding library "{library_d}" and location "{location_d}" in destination IZ.')
 
     # No corresponding holding found, we create a new one
     if holding_d is None:
@@ -234,8 +377,10 @@ def copy_holding_to_destination_iz(i: int, bib_d: IzBib) -> Optional[Holding]:
 
         if holding_d.error:
             logging.error(f"{repr(holding_d)}: {holding_d.error_msg}")
-            process_monitor.df.loc[process_monitor.df['Holding_id_s'] == holding_id_s, 'Error'] = 'Destination Holding not created'
+            process_monitor.set_value_by_id('Holding_id_s', holding_id_s, 'Error', 'Destination Holding not created')
             process_monitor.save()
             return None
 
+        holdings_index.add(holding_d)
+
     return holding_d
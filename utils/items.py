@@ -1,18 +1,28 @@
-from typing import Optional
+from typing import List, Optional
 from almapiwrapper.inventory import IzBib, NzBib, Holding, Item, Collection
 from almapiwrapper.acquisitions import POLine
-import time
 
-from utils import xlstools
+from utils import xlstools, recordcache, runner, stagestats, profiler
+from utils.concurrency import KeyedLocks
 from utils.processmonitoring import ProcessMonitor
+from collections import OrderedDict
 from copy import deepcopy
 from lxml import etree
 import pandas as pd
 
 import logging
+import threading
 
 config = xlstools.get_config()
 
+# Maximum number of item lists kept by get_pol_items, the least recently used are removed
+MAX_CACHED_POL_ITEMS = 200
+
+# Items of the holdings by zone, holding ID and PoLine number, shared by the rows of a one-time PoLine
+pol_items_cache: OrderedDict = OrderedDict()
+pol_items_lock = threading.Lock()
+pol_items_fetch_locks = KeyedLocks()
+
 
 def get_source_item_using_barcode(i: int) -> Optional[Item]:
     """
@@ -51,7 +61,7 @@ def get_source_item_using_barcode(i: int) -> Optional[Item]:
             error_label = 'Source Item not found'
 
         logging.error(f"{repr(item_s)}: {item_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = error_label
+        process_monitor.set_value(i, 'Error', error_label)
         process_monitor.save()
         return None
 
@@ -104,7 +114,7 @@ def copy_item_to_destination_iz(i, poline: bool = False) -> Optional[Item]:
 
     if item_s.error:
         logging.error(f"{repr(item_s)}: {item_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Source Item not found'
+        process_monitor.set_value(i, 'Error', 'Source Item not found')
         process_monitor.save()
         return None
 
@@ -114,7 +124,7 @@ def copy_item_to_destination_iz(i, poline: bool = False) -> Optional[Item]:
     library_d, location_d = xlstools.get_corresponding_location(library_s, location_s)
     if library_d is None or location_d is None:
         logging.error(f"{repr(item_s)}: Library or location not found in destination IZ")
-        process_monitor.df.at[i, 'Error'] = 'Library or location not found in destination IZ'
+        process_monitor.set_value(i, 'Error', 'Library or location not found in destination IZ')
         process_monitor.save()
         return None
 
@@ -134,40 +144,39 @@ def copy_item_to_destination_iz(i, poline: bool = False) -> Optional[Item]:
         else:
             received = True
 
-        process_monitor.df.at[i, 'Received'] = received
+        process_monitor.set_value(i, 'Received', received)
         process_monitor.save()
 
     # Clean the item fields before creating the item in the destination IZ
-    item_data = clean_item_fields(item_data, rec_loc='dest', retry=False)
-    item_d = Item(mms_id_d, holding_id_d, zone=config['iz_d'], env=config['env'], data=item_data, create_item=True)
-
-    # Retry creating the item if it failed
-    if item_d.error:
-        # Clean the item fields before creating the item in the destination IZ
-        item_data = clean_item_fields(item_data, rec_loc='dest', retry=True)
+    with profiler.span('item_fields_clean'):
+        item_data = clean_item_fields(item_data, rec_loc='dest', retry=False)
+    with stagestats.timed('item_create'):
         item_d = Item(mms_id_d, holding_id_d, zone=config['iz_d'], env=config['env'], data=item_data, create_item=True)
 
+        # Retry creating the item if it failed
+        if item_d.error:
+            # Clean the item fields before creating the item in the destination IZ
+            item_data = clean_item_fields(item_data, rec_loc='dest', retry=True)
+            item_d = Item(mms_id_d, holding_id_d, zone=config['iz_d'], env=config['env'], data=item_data,
+                          create_item=True)
+
     # Check if the item was created successfully, if not, log the error and update the process monitor
     if item_d.error:
         logging.error(f"{repr(item_d)}: {item_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Destination Item not created'
+        process_monitor.set_value(i, 'Error', 'Destination Item not created')
         process_monitor.save()
         return None
 
     process_monitor.set_corresponding_item_id(item_s.item_id, item_d.item_id)
-    process_monitor.df.at[i, 'Copied'] = True
-    error_msg = process_monitor.df.at[i, 'Error']
-    if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-        process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+    process_monitor.set_stage(i, 'item_created')
     process_monitor.save()
 
-    update_source_item(item_s)
-
-    if item_s.error:
-        logging.error(f"{repr(item_s)}: failed to update barcode of source record: {item_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Failed to update source item barcode'
+    if rename_source_item(i, item_s) is None:
         return None
 
+    process_monitor.mark_copied(i)
+    process_monitor.save()
+
     return item_d
 
 
@@ -250,6 +259,110 @@ def update_source_item(item_s: Item) -> Optional[Item]:
     return item_s
 
 
+def rename_source_item(i: int, item_s: Optional[Item] = None) -> Optional[Item]:
+    """
+    Updates the barcode of the source item of a row once the destination item is ready.
+
+    When the source item is not provided, it is fetched with the IDs of the row. It
+    is the case when an interrupted row is resumed after the creation of the destination item.
+
+    Parameters
+    ----------
+    i : int
+        The index of the row to process in the DataFrame.
+    item_s : Item, optional
+        The source item, fetched with the IDs of the row if not provided.
+
+    Returns
+    -------
+    Item, optional
+        The source item, or None if an error occurs.
+    """
+    process_monitor = ProcessMonitor()
+
+    if item_s is None:
+        item_s = Item(process_monitor.df.at[i, 'MMS_id_s'],
+                      process_monitor.df.at[i, 'Holding_id_s'],
+                      process_monitor.df.at[i, 'Item_id_s'],
+                      zone=config['iz_s'],
+                      env=config['env'])
+        _ = item_s.data
+
+        if item_s.error:
+            logging.error(f"{repr(item_s)}: {item_s.error_msg}")
+            process_monitor.set_value(i, 'Error', 'Source Item not found')
+            process_monitor.save()
+            return None
+
+    with stagestats.timed('source_rename'):
+        update_source_item(item_s)
+
+    if item_s.error:
+        logging.error(f"{repr(item_s)}: failed to update barcode of source record: {item_s.error_msg}")
+        process_monitor.set_value(i, 'Error', 'Failed to update source item barcode')
+        process_monitor.save()
+        return None
+
+    process_monitor.set_stage(i, 'source_renamed')
+    process_monitor.save()
+
+    return item_s
+
+
+def get_pol_items(holding: Holding, pol_number: str) -> List[Item]:
+    """
+    Returns the items of a holding linked to a PoLine, in the order of the holding.
+
+    The items are fetched once for all the rows of the PoLine. An empty list
+    is not kept, Alma may still be creating the items of a new PoLine.
+
+    Parameters
+    ----------
+    holding : Holding
+        The holding containing the items.
+    pol_number : str
+        The PoLine number of the items.
+
+    Returns
+    -------
+    List[Item]
+        Items of the holding with the PoLine number.
+    """
+    key = (holding.zone, holding.holding_id, pol_number)
+    with pol_items_fetch_locks.hold(key):
+        with pol_items_lock:
+            if key in pol_items_cache:
+                pol_items_cache.move_to_end(key)
+                return pol_items_cache[key]
+
+        pol_items = [item for item in holding.get_items()
+                     if item.data.find('.//item_data/po_line') is not None and
+                     item.data.find('.//item_data/po_line').text == pol_number]
+
+        if len(pol_items) > 0:
+            with pol_items_lock:
+                pol_items_cache[key] = pol_items
+                while len(pol_items_cache) > MAX_CACHED_POL_ITEMS:
+                    pol_items_cache.popitem(last=False)
+
+    return pol_items
+
+
+def invalidate_pol_items(holding: Holding, pol_number: str) -> None:
+    """
+    Removes the items of a holding linked to a PoLine from the cache of get_pol_items.
+
+    Parameters
+    ----------
+    holding : Holding
+        The holding containing the items.
+    pol_number : str
+        The PoLine number of the items.
+    """
+    with pol_items_lock:
+        pol_items_cache.pop((holding.zone, holding.holding_id, pol_number), None)
+
+
 def handle_one_time_pol_items(i: int, holding_s: Holding, holding_d: Holding) -> Optional[Item]:
     """
     Retrieves the destination item from the holding based on the index provided in the DataFrame.
@@ -271,20 +384,25 @@ def handle_one_time_pol_items(i: int, holding_s: Holding, holding_d: Holding) ->
     process_monitor = ProcessMonitor()
     item_id_s = process_monitor.df.at[i, 'Item_id_s']
     poline_id_s = process_monitor.df.at[i, 'PoLine_s']
-    poline_id_d = process_monitor.get_corresponding_poline(poline_id_s)
-
-    items_s = [item for item in holding_s.get_items()
-               if item.data.find('.//item_data/po_line') is not None and
-               item.data.find('.//item_data/po_line').text == poline_id_s]
-    items_d = [item for item in holding_d.get_items()
-               if item.data.find('.//item_data/po_line') is not None and
-               item.data.find('.//item_data/po_line').text == poline_id_d]
-
-    if len(items_d) == 0:
-        # If there are no items we need to wait a few seconds and try again
-        time.sleep(3)
-        holding_d = Holding(holding_d.bib.mms_id, holding_d.holding_id, zone=config['iz_d'], env=config['env'])
-        items_d = holding_d.get_items()
+    poline_id_d, _ = process_monitor.get_corresponding_poline(poline_id_s)
+
+    # The items are fetched once for all the rows of the PoLine
+    items_s = get_pol_items(holding_s, poline_id_s)
+    items_d = get_pol_items(holding_d, poline_id_d)
+
+    if len(items_d) < len(items_s):
+        # The items of a new PoLine are created asynchronously by Alma, we wait until they are visible
+        def fetch_items_d() -> List[Item]:
+            # The cached holding and items are outdated
+            recordcache.invalidate(config['iz_d'], config['env'], 'bibs', holding_d.bib.mms_id)
+            invalidate_pol_items(holding_d, poline_id_d)
+            holding = Holding(holding_d.bib.mms_id, holding_d.holding_id, zone=config['iz_d'], env=config['env'])
+            return get_pol_items(holding, poline_id_d)
+
+        items_d = runner.wait_for(fetch_items_d,
+                                  lambda pol_items: len(pol_items) >= len(items_s),
+                                  items_d,
+                                  f'{len(items_s)} items of PoLine {poline_id_d} in holding {holding_d.holding_id}')
 
     # get item rank in source holding
     # Idea is to get the rank of the item in the source holding with the corresponding PoLine information.
@@ -294,13 +412,13 @@ def handle_one_time_pol_items(i: int, holding_s: Holding, holding_d: Holding) ->
     if index == -1:
         # No matching item found in source holding
         logging.error(f"Item with ID {item_id_s} not found in source holding {holding_s.holding_id}")
-        process_monitor.df.at[i, 'Error'] = 'Item not found in source holding'
+        process_monitor.set_value(i, 'Error', 'Item not found in source holding')
         process_monitor.save()
         return None
     elif index >= len(items_d):
         # Not enough items in destination holding to match source item
         logging.error(f"Not enough items in destination holding {holding_s.holding_id} to match source item {item_id_s}")
-        process_monitor.df.at[i, 'Error'] = 'Not enough items in destination holding'
+        process_monitor.set_value(i, 'Error', 'Not enough items in destination holding')
         process_monitor.save()
         return None
 
@@ -320,10 +438,15 @@ def handle_one_time_pol_items(i: int, holding_s: Holding, holding_d: Holding) ->
 
     if item_d.error:
         logging.error(f"{repr(item_d)}: {item_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Failed to update destination item'
+        # The cached item was changed but not updated in Alma, the items are fetched again
+        invalidate_pol_items(holding_d, poline_id_d)
+        process_monitor.set_value(i, 'Error', 'Failed to update destination item')
         process_monitor.save()
         return None
 
+    # Keep the updated item for the other rows of the PoLine
+    items_d[index] = item_d
+
     # Get the arrival date and expected arrival date from the source item
     arrival_date = item_d.data.find('.//arrival_date')
     expected_arrival_date = item_d.data.find('.//expected_arrival_date')
@@ -335,22 +458,17 @@ def handle_one_time_pol_items(i: int, holding_s: Holding, holding_d: Holding) ->
     else:
         received = True
 
-    process_monitor.df.at[i, 'Received'] = received
+    process_monitor.set_value(i, 'Received', received)
     process_monitor.set_corresponding_item_id(item_s.item_id, item_d.item_id)
-    if not received:
-        process_monitor.df.at[i, 'Copied'] = True
-        error_msg = process_monitor.df.at[i, 'Error']
-        if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-            process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+    process_monitor.set_stage(i, 'item_created')
     process_monitor.save()
 
-    update_source_item(item_s)
+    if rename_source_item(i, item_s) is None:
+        return None
 
-    if item_s.error:
-        logging.error(f"{repr(item_s)}: failed to update barcode of source record: {item_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Failed to update source item barcode'
+    if not received:
+        process_monitor.mark_copied(i)
         process_monitor.save()
-        return None
 
     return item_d
 
@@ -388,7 +506,7 @@ def make_reception(i: int) -> Optional[POLine]:
 
     if item_s.error:
         logging.error(f"{repr(item_s)}: {item_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Source Item not found'
+        process_monitor.set_value(i, 'Error', 'Source Item not found')
         process_monitor.save()
         return None
 
@@ -396,7 +514,7 @@ def make_reception(i: int) -> Optional[POLine]:
     _ = item_d.data
     if item_d.error:
         logging.error(f"{repr(item_d)}: {item_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Destination Item not found'
+        process_monitor.set_value(i, 'Error', 'Destination Item not found')
         process_monitor.save()
         return None
 
@@ -404,7 +522,7 @@ def make_reception(i: int) -> Optional[POLine]:
     _ = pol_d.data
     if pol_d.error:
         logging.error(f"{repr(pol_d)}: {pol_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Destination PoLine not found'
+        process_monitor.set_value(i, 'Error', 'Destination PoLine not found')
         process_monitor.save()
         return None
 
@@ -422,12 +540,12 @@ def make_reception(i: int) -> Optional[POLine]:
 
     if pol_d.error:
         logging.error(f"{repr(pol_d)}: {pol_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Failed to receive item in PoLine'
+        process_monitor.set_value(i, 'Error', 'Failed to receive item in PoLine')
         process_monitor.save()
         return None
 
-    process_monitor.df.at[i, 'Copied'] = True
-    error_msg = process_monitor.df.at[i, 'Error']
-    if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-        process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+    process_monitor.set_stage(i, 'received')
+    process_monitor.mark_copied(i)
     process_monitor.save()
+
+    return pol_d
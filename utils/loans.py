@@ -51,14 +51,14 @@ def create_loan(i: int) -> Optional[Loan]:
 
     else:
         logging.error(f"Row {i}: Expected item information missing")
-        process_monitor.df.at[i, 'Error'] = 'Expected item information missing'
+        process_monitor.set_value(i, 'Error', 'Expected item information missing')
         process_monitor.save()
         return None
 
     _ = item_d.data  # Fetch the item data
     if item_d.error:
         logging.error(f"{repr(item_d)}: {item_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Source Item not found'
+        process_monitor.set_value(i, 'Error', 'Source Item not found')
         process_monitor.save()
         return None
 
@@ -66,7 +66,7 @@ def create_loan(i: int) -> Optional[Loan]:
 
     if item_d.error:
         logging.error(f"{repr(item_d)}: {item_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Source Item not found'
+        process_monitor.set_value(i, 'Error', 'Source Item not found')
         process_monitor.save()
         return None
 
@@ -111,7 +111,7 @@ def make_return(i: int) -> Optional[Item]:
             _ = item_s.data
         if item_s.error:
             logging.error(f"{repr(item_s)}: {item_s.error_msg}")
-            process_monitor.df.at[i, 'Error'] = 'Source Item not found'
+            process_monitor.set_value(i, 'Error', 'Source Item not found')
             process_monitor.save()
             return None
     elif pd.notnull(mms_id_s) and pd.notnull(holding_id_s) and pd.notnull(item_id_s):
@@ -120,7 +120,7 @@ def make_return(i: int) -> Optional[Item]:
 
     else:
         logging.error(f"Row {i}: Expected item information missing")
-        process_monitor.df.at[i, 'Error'] = 'Expected item information missing'
+        process_monitor.set_value(i, 'Error', 'Expected item information missing')
         process_monitor.save()
         return None
 
@@ -129,7 +129,7 @@ def make_return(i: int) -> Optional[Item]:
 
     if item_s.error:
         logging.error(f"{repr(item_s)}: {item_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Source Item not found'
+        process_monitor.set_value(i, 'Error', 'Source Item not found')
         process_monitor.save()
         return None
 
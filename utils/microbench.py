@@ -0,0 +1,467 @@
+import gc
+import logging
+import os
+import random
+import time
+import tracemalloc
+from copy import deepcopy
+from typing import Any, Callable, Dict, List, Optional
+
+import openpyxl
+import pandas as pd
+from lxml import etree
+
+from utils import xlstools
+from utils.benchmark import DEFAULT_TEMPLATE
+from utils.mockalma import MockAlma
+from utils.processmonitoring import ProcessMonitor, create_process_monitor
+
+# Metrics compared between two runs, True if a higher value is better
+COMPARED_METRICS: Dict[str, bool] = {
+    'ns_per_op': False,
+    'alloc_b_per_op': False,
+}
+
+# Default sizes of the processing files and of the mapping sheets
+DEFAULT_ROWS = [10000, 100000, 500000]
+DEFAULT_MAPPING_ROWS = 10000
+
+# Default minimal duration of the timed runs of a benchmark in seconds
+DEFAULT_MIN_TIME = 0.2
+
+# Maximum number of operations of a timed run
+MAX_OPS = 100000
+
+# Number of operations measured with tracemalloc, it slows down the allocations
+MAX_TRACED_OPS = 1000
+
+# Name of the form used by the benchmarks, the processing files are named after it
+FORM_NAME = 'microbench.xlsx'
+
+
+def measure(name: str,
+            op: Callable[..., Any],
+            setup: Optional[Callable[[int], List[tuple]]] = None,
+            min_time: float = DEFAULT_MIN_TIME,
+            repeat: int = 3,
+            max_ops: int = MAX_OPS,
+            **params) -> dict:
+    """
+    Measures the duration and the memory allocations of an operation
+
+    As with `timeit.Timer.autorange`, the number of operations of a run is
+    chosen so that the run lasts at least `min_time`. The best of `repeat` runs
+    is kept. The allocations are measured in another run with tracemalloc: the
+    peak of the memory allocated by each operation and the memory still
+    allocated after the operations.
+
+    Parameters
+    ----------
+    name : str
+        Name of the benchmark, 'pm.get_corresponding_mms_id' for example
+    op : Callable
+        Measured operation, called with the arguments given by `setup`
+    setup : Callable[[int], List[tuple]], optional
+        Function returning the arguments of n operations, called before each
+        run and not measured. Without setup, the operation has no argument
+    min_time : float, optional
+        Minimal duration of a timed run in seconds
+    repeat : int, optional
+        Number of timed runs
+    max_ops : int, optional
+        Maximum number of operations of a run
+    **params
+        Parameters of the benchmark written in the result, the number of rows for example
+
+    Returns
+    -------
+    dict
+        Key identifying the benchmark with its parameters, 'pm.save rows=10000
+        storage=csv' for example, name, parameters, number of operations of a
+        run, ns per operation, bytes allocated per operation and bytes
+        retained per operation
+    """
+    # The log messages of the operations are not written, the handlers would dominate the measures
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.WARNING)
+    try:
+        result = _measure(name, op, setup, min_time, repeat, max_ops, params)
+    finally:
+        logging.disable(previous_disable)
+
+    logging.info(f"Micro-benchmark {result['key']}: {result['ns_per_op']} ns/op, "
+                 f"{result['alloc_b_per_op']} B allocated/op, {result['retained_b_per_op']} B retained/op")
+
+    return result
+
+
+def _measure(name: str,
+             op: Callable[..., Any],
+             setup: Optional[Callable[[int], List[tuple]]],
+             min_time: float,
+             repeat: int,
+             max_ops: int,
+             params: dict) -> dict:
+    """
+    Runs the operations of :func:`measure` and returns its result
+    """
+    def get_args(n: int) -> List[tuple]:
+        return setup(n) if setup is not None else [()] * n
+
+    def run(args_list: List[tuple]) -> int:
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            t0 = time.perf_counter_ns()
+            for args in args_list:
+                op(*args)
+            return time.perf_counter_ns() - t0
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    # Number of operations lasting at least min_time
+    nb_ops = 1
+    while True:
+        duration_ns = run(get_args(nb_ops))
+        if duration_ns >= min_time * 1e9 or nb_ops >= max_ops:
+            break
+        nb_ops = min(max_ops, max(nb_ops * 2, int(nb_ops * min_time * 1e9 / max(duration_ns, 1) * 1.2)))
+
+    best_ns = min([duration_ns] + [run(get_args(nb_ops)) for _ in range(repeat - 1)])
+
+    nb_traced = min(nb_ops, MAX_TRACED_OPS)
+    args_list = get_args(nb_traced)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        allocated = 0
+        for args in args_list:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            op(*args)
+            allocated += tracemalloc.get_traced_memory()[1] - before
+        retained = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    return {'key': ' '.join([name] + [f'{k}={v}' for k, v in params.items()]),
+            'name': name,
+            **params,
+            'nb_ops': nb_ops,
+            'ns_per_op': round(best_ns / nb_ops),
+            'alloc_b_per_op': round(allocated / nb_traced),
+            'retained_b_per_op': round(max(retained, 0) / nb_traced)}
+
+
+def write_processing_file(nb_rows: int, seed: int = 0) -> List[str]:
+    """
+    Writes the processing file of an items transfer of the form `FORM_NAME`
+
+    Ten items share a holding and fifty items a bib, a third of the rows are
+    copied. The file is written in the `data` folder of the working directory.
+
+    Parameters
+    ----------
+    nb_rows : int
+        Number of rows of the file
+    seed : int, optional
+        Seed of the copied rows
+
+    Returns
+    -------
+    List[str]
+        Source item IDs of the rows
+    """
+    rng = random.Random(seed)
+    copied = [rng.random() < 1 / 3 for _ in range(nb_rows)]
+    df = pd.DataFrame({'Barcode': [f'BM{k:08d}' for k in range(nb_rows)],
+                       'MMS_id_s': [f'99{k // 50:012d}5501' for k in range(nb_rows)],
+                       'Holding_id_s': [f'22{k // 10:012d}5501' for k in range(nb_rows)],
+                       'Item_id_s': [f'23{k:012d}5501' for k in range(nb_rows)],
+                       'MMS_id_d': [f'99{k // 50:012d}5502' if c else None for k, c in enumerate(copied)],
+                       'Holding_id_d': [f'22{k // 10:012d}5502' if c else None for k, c in enumerate(copied)],
+                       'Item_id_d': [f'23{k:012d}5502' if c else None for k, c in enumerate(copied)],
+                       'Stage': ['source_renamed' if c else None for c in copied],
+                       'Copied': copied,
+                       'Error': None})
+
+    os.makedirs('data', exist_ok=True)
+    df.to_csv(f'data/{xlstools.get_raw_filename(FORM_NAME)}_Items_processing.csv', index=False)
+    return df['Item_id_s'].tolist()
+
+
+def open_process_monitor(storage: str = 'csv') -> ProcessMonitor:
+    """
+    Returns a new process monitor loading the processing file written by :func:`write_processing_file`
+    """
+    close_process_monitor()
+    return create_process_monitor(FORM_NAME, 'Items', storage)
+
+
+def close_process_monitor() -> None:
+    """
+    Closes the process monitor of the benchmarks and removes its instance
+    """
+    process_monitor = ProcessMonitor.get_instance()
+    if process_monitor is not None and hasattr(process_monitor, 'close'):
+        process_monitor.close()
+    ProcessMonitor.reset()
+
+
+def bench_process_monitor(nb_rows: int,
+                          storage: str = 'csv',
+                          min_time: float = DEFAULT_MIN_TIME,
+                          seed: int = 0) -> List[dict]:
+    """
+    Measures the lookups, the updates, the saves and the loads of a process monitor
+
+    The processing files are written in the `data` folder of the working directory.
+
+    Parameters
+    ----------
+    nb_rows : int
+        Number of rows of the processing file
+    storage : str, optional
+        Storage mode of the process monitor, see `STORAGE_MODES`
+    min_time : float, optional
+        Minimal duration of a timed run in seconds
+    seed : int, optional
+        Seed of the looked up IDs
+
+    Returns
+    -------
+    List[dict]
+        Results of the benchmarks, see :func:`measure`
+    """
+    rng = random.Random(seed)
+    item_ids = write_processing_file(nb_rows, seed)
+    for file_path in [f'data/{xlstools.get_raw_filename(FORM_NAME)}_Items_processing.db',
+                      f'data/{xlstools.get_raw_filename(FORM_NAME)}_Items_processing.journal']:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    params = {'rows': nb_rows, 'storage': storage}
+    results = [measure('pm.load', lambda: open_process_monitor(storage), min_time=min_time, repeat=1,
+                       max_ops=10, **params)]
+
+    process_monitor = open_process_monitor(storage)
+
+    # Source IDs of the rows and a tenth of unknown IDs, as the first lookup of a new record
+    def get_ids(column: str, n: int) -> List[tuple]:
+        ids = process_monitor.df[column].tolist()
+        return [(rng.choice(ids) if rng.random() < 0.9 else f'{rng.randrange(10 ** 12)}',) for _ in range(n)]
+
+    results += [
+        measure('pm.get_corresponding_mms_id', process_monitor.get_corresponding_mms_id,
+                lambda n: get_ids('MMS_id_s', n), min_time, **params),
+        measure('pm.get_corresponding_holding_id', process_monitor.get_corresponding_holding_id,
+                lambda n: get_ids('Holding_id_s', n), min_time, **params),
+        measure('pm.get_corresponding_item_id', process_monitor.get_corresponding_item_id,
+                lambda n: get_ids('Item_id_s', n), min_time, **params),
+        measure('pm.set_corresponding_item_id', process_monitor.set_corresponding_item_id,
+                lambda n: [(rng.choice(item_ids), f'23{rng.randrange(10 ** 12):012d}5502') for _ in range(n)],
+                min_time, **params),
+        measure('pm.set_corresponding_mms_id', process_monitor.set_corresponding_mms_id,
+                lambda n: [(mms_id, f'99{rng.randrange(10 ** 12):012d}5502')
+                           for mms_id in rng.choices(process_monitor.df['MMS_id_s'].tolist(), k=n)],
+                min_time, **params),
+    ]
+
+    # A change of a row followed by a save, as after each step of a transfer
+    def save_row(i: int) -> None:
+        process_monitor.set_value(i, 'Error', f'Error {i}')
+        process_monitor.save()
+
+    results.append(measure('pm.save', save_row, lambda n: [(rng.randrange(1, nb_rows + 1),) for _ in range(n)],
+                           min_time, repeat=1, max_ops=1000, **params))
+
+    close_process_monitor()
+    return results
+
+
+def write_mapping_form(file_path: str, nb_mapping_rows: int, template: str = DEFAULT_TEMPLATE) -> None:
+    """
+    Writes an Excel form with large mapping sheets
+
+    The locations, vendors and funds mapping tabs have `nb_mapping_rows` rows
+    and a '*DEFAULT*' row at the end. The other tabs are the ones of the template.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the new form
+    nb_mapping_rows : int
+        Number of rows of each mapping tab
+    template : str, optional
+        Path of the form used as model
+    """
+    wb = openpyxl.load_workbook(template)
+    mappings = {
+        'Locations_mapping': [[f'LIB{k // 20}', f'LOC{k}', f'DLIB{k // 20}', f'DLOC{k}'] for k in range(nb_mapping_rows)]
+                             + [['*DEFAULT*', '*DEFAULT*', 'DLIB0', 'DLOC0']],
+        'Vendors_mapping': [[f'VENDOR{k // 5}', f'ACCOUNT{k}', f'DVENDOR{k // 5}', f'DACCOUNT{k}']
+                            for k in range(nb_mapping_rows)] + [['*DEFAULT*', '*DEFAULT*', 'DVENDOR0', 'DACCOUNT0']],
+        'Funds_mapping': [[f'FUND{k}', f'DFUND{k}'] for k in range(nb_mapping_rows)] + [['*DEFAULT*', 'DFUND0']],
+    }
+    for sheet_name, values in mappings.items():
+        ws = wb[sheet_name]
+        ws.delete_rows(2, ws.max_row)
+        for row in values:
+            ws.append(row)
+    wb.save(file_path)
+
+
+def bench_mappings(nb_mapping_rows: int = DEFAULT_MAPPING_ROWS,
+                   min_time: float = DEFAULT_MIN_TIME,
+                   seed: int = 0) -> List[dict]:
+    """
+    Measures the resolution of the locations, libraries, vendors and funds with large mapping sheets
+
+    The form is written in the working directory and loaded with
+    `xlstools.set_config`. A tenth of the looked up codes are not in the
+    mapping and use the '*DEFAULT*' row.
+
+    Parameters
+    ----------
+    nb_mapping_rows : int, optional
+        Number of rows of each mapping sheet
+    min_time : float, optional
+        Minimal duration of a timed run in seconds
+    seed : int, optional
+        Seed of the looked up codes
+
+    Returns
+    -------
+    List[dict]
+        Results of the benchmarks, see :func:`measure`
+    """
+    rng = random.Random(seed)
+    form_path = f'microbench_mappings_{nb_mapping_rows}.xlsx'
+    write_mapping_form(form_path, nb_mapping_rows)
+    xlstools.set_config(form_path)
+
+    def get_codes(n: int, *formats: str) -> List[tuple]:
+        codes = []
+        for _ in range(n):
+            k = rng.randrange(nb_mapping_rows) if rng.random() < 0.9 else nb_mapping_rows + rng.randrange(10 ** 6)
+            codes.append(tuple(code_format.format(k=k, group=k // 20, vendor=k // 5) for code_format in formats))
+        return codes
+
+    params = {'mapping_rows': nb_mapping_rows}
+    return [
+        measure('xlstools.get_corresponding_location', xlstools.get_corresponding_location,
+                lambda n: get_codes(n, 'LIB{group}', 'LOC{k}'), min_time, **params),
+        measure('xlstools.get_corresponding_library', xlstools.get_corresponding_library,
+                lambda n: get_codes(n, 'LIB{group}'), min_time, **params),
+        measure('xlstools.get_corresponding_vendor', xlstools.get_corresponding_vendor,
+                lambda n: get_codes(n, 'VENDOR{vendor}', 'ACCOUNT{k}'), min_time, **params),
+        measure('xlstools.get_corresponding_fund', xlstools.get_corresponding_fund,
+                lambda n: get_codes(n, 'FUND{k}'), min_time, **params),
+    ]
+
+
+def make_records(nb_holding_fields: int = 20) -> tuple:
+    """
+    Returns an item and a pair of holdings in the format of the Alma API
+
+    The source holding has a call number and `nb_holding_fields` 866 fields,
+    the destination holding has a 852$$t subfield to remove.
+
+    Parameters
+    ----------
+    nb_holding_fields : int, optional
+        Number of fields of the source holding copied to the destination
+
+    Returns
+    -------
+    tuple
+        Item, source holding and destination holding as `etree.Element`
+    """
+    alma = MockAlma()
+    mms_id = alma.add_bib('UBS')
+    holding_id_s = alma.add_holding('UBS', mms_id, 'UBS_LIB', 'UBS_LOC', 'CN 1')
+    holding_id_d = alma.add_holding('UBS', mms_id, 'HPH_LIB', 'HPH_LOC')
+    item_id = alma.add_item('UBS', mms_id, holding_id_s, 'B001',
+                            fields={'temp_location': 'TEMP', 'temp_library': 'UBS_LIB', 'in_temp_location': 'true',
+                                    'provenance': 'PROV', 'statistics_note_1': 'STAT'})
+
+    holding_s, holding_d = alma.holdings[('UBS', holding_id_s)], alma.holdings[('UBS', holding_id_d)]
+    record_s = holding_s.find('record')
+    for k in range(nb_holding_fields):
+        field = etree.SubElement(record_s, 'datafield', tag='866', ind1=' ', ind2='0')
+        etree.SubElement(field, 'subfield', code='a').text = f'Vol. {k} ({2000 + k})'
+    etree.SubElement(holding_d.find('.//datafield[@tag="852"]'), 'subfield', code='t').text = '1'
+
+    return alma.items[('UBS', item_id)], holding_s, holding_d
+
+
+def bench_records(min_time: float = DEFAULT_MIN_TIME, nb_holding_fields: int = 20) -> List[dict]:
+    """
+    Measures the cleaning of the item fields and the copy of the holding fields
+
+    The fields to delete are the ones of the form loaded with `xlstools.set_config`,
+    :func:`bench_mappings` must be run before. The records are copied before
+    each operation, outside of the measure.
+
+    Parameters
+    ----------
+    min_time : float, optional
+        Minimal duration of a timed run in seconds
+    nb_holding_fields : int, optional
+        Number of fields of the source holding copied to the destination
+
+    Returns
+    -------
+    List[dict]
+        Results of the benchmarks, see :func:`measure`
+    """
+    from utils import holdings, items
+
+    item, holding_s, holding_d = make_records(nb_holding_fields)
+    return [
+        measure('items.clean_item_fields', items.clean_item_fields,
+                lambda n: [(deepcopy(item), 'src') for _ in range(n)], min_time),
+        measure('items.clean_item_fields retry', lambda item_data: items.clean_item_fields(item_data, 'dest', True),
+                lambda n: [(deepcopy(item),) for _ in range(n)], min_time),
+        measure('holdings.copy_holding_fields', holdings.copy_holding_fields,
+                lambda n: [(deepcopy(holding_s), deepcopy(holding_d)) for _ in range(n)], min_time,
+                fields=nb_holding_fields),
+    ]
+
+
+def run_benchmarks(rows: Optional[List[int]] = None,
+                   nb_mapping_rows: int = DEFAULT_MAPPING_ROWS,
+                   storage: str = 'csv',
+                   min_time: float = DEFAULT_MIN_TIME,
+                   seed: int = 0) -> List[dict]:
+    """
+    Runs all micro-benchmarks in the working directory
+
+    Parameters
+    ----------
+    rows : List[int], optional
+        Sizes of the processing files, default is `DEFAULT_ROWS`
+    nb_mapping_rows : int, optional
+        Number of rows of each mapping sheet
+    storage : str, optional
+        Storage mode of the process monitor
+    min_time : float, optional
+        Minimal duration of a timed run in seconds
+    seed : int, optional
+        Seed of the generated data
+
+    Returns
+    -------
+    List[dict]
+        Results of the benchmarks, see :func:`measure`
+    """
+    results = bench_mappings(nb_mapping_rows, min_time, seed)
+    results += bench_records(min_time)
+    for nb_rows in rows or DEFAULT_ROWS:
+        results += bench_process_monitor(nb_rows, storage, min_time, seed)
+    return results
+
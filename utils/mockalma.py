@@ -0,0 +1,1199 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+from copy import deepcopy
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Pattern, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+from lxml import etree
+
+# Path of the API on the server, the same as Alma
+API_PATH = '/almaws/v1'
+
+# Namespace of the XML error responses of Alma, read by almapiwrapper
+ERROR_NAMESPACE = 'http://com/exlibris/urm/general/xmlbeans'
+
+# Prefix of the NZ MMS ID in the network numbers of the items
+NETWORK_PREFIX = '(EXLNZ-41SLSP_NETWORK)'
+
+# Body of a successful response: XML element, JSON data or None for no content
+ResponseBody = Union[etree._Element, dict, None]
+
+
+class MockAlmaError(Exception):
+    """
+    Error of the mock API: answered as an Alma error response to the HTTP
+    requests, raised by the `add_*` methods when the records are not consistent
+    """
+    def __init__(self, message: str, status: int = 400, code: str = '400') -> None:
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.code = code
+
+
+class MockAlma:
+    """
+    In-memory stand-in of the Alma APIs used by the transfer scripts
+
+    The records of all zones are kept in memory, the zone of a call is given by
+    its API key: `apicalls.set_base_url` replaces the keys by 'mock:<zone>'.
+    The responses have the formats read by almapiwrapper: XML for the bibs,
+    holdings and items, JSON for the PoLines, users, loans, requests and
+    collections. The records are added with the `add_*` methods or `load_seed`.
+
+    The latency, the 500 errors and the 429 errors are injected before the
+    call is processed: a failed call doesn't change anything and can be retried.
+
+    Parameters
+    ----------
+    latency : float, optional
+        Mean duration of a call in seconds, the durations are spread between
+        half and one and a half times this value
+    error_rate : float, optional
+        Share of the calls answered with a 500 error, from 0 to 1
+    rate_429 : float, optional
+        Share of the calls answered with a 429 error, from 0 to 1
+    pol_items_delay : float, optional
+        Delay in seconds before the items created by a new one-time PoLine are
+        listed in their holding, Alma creates them asynchronously
+    seed : int, optional
+        Seed of the random latencies and errors, for reproducible runs
+
+    Attributes
+    ----------
+    nb_calls : Dict[str, int]
+        Number of calls by route, 'GET bibs/{mms_id}/holdings' for example
+    nb_injected : Dict[str, int]
+        Number of injected errors: '500' and '429'
+    """
+
+    # Routes of the API, the parameters of the path are given to the handlers
+    ROUTES: List[Tuple[str, str, str]] = [
+        ('GET', 'bibs/collections/{pid}', '_get_collection'),
+        ('GET', 'bibs/collections/{pid}/bibs', '_get_collection_bibs'),
+        ('POST', 'bibs/collections/{pid}/bibs', '_add_collection_bib'),
+        ('GET', 'bibs', '_get_bib_from_nz_mms_id'),
+        ('POST', 'bibs', '_create_bib'),
+        ('GET', 'bibs/{mms_id}', '_get_bib'),
+        ('PUT', 'bibs/{mms_id}', '_update_bib'),
+        ('GET', 'bibs/{mms_id}/holdings', '_get_holdings'),
+        ('POST', 'bibs/{mms_id}/holdings', '_create_holding'),
+        ('GET', 'bibs/{mms_id}/holdings/{holding_id}', '_get_holding'),
+        ('PUT', 'bibs/{mms_id}/holdings/{holding_id}', '_update_holding'),
+        ('GET', 'bibs/{mms_id}/holdings/{holding_id}/items', '_get_items'),
+        ('POST', 'bibs/{mms_id}/holdings/{holding_id}/items', '_create_item'),
+        ('GET', 'bibs/{mms_id}/holdings/{holding_id}/items/{item_id}', '_get_item'),
+        ('PUT', 'bibs/{mms_id}/holdings/{holding_id}/items/{item_id}', '_update_item'),
+        ('POST', 'bibs/{mms_id}/holdings/{holding_id}/items/{item_id}', '_scan_in_item'),
+        ('GET', 'items', '_get_item_by_barcode'),
+        ('GET', 'acq/po-lines/{number}', '_get_poline'),
+        ('PUT', 'acq/po-lines/{number}', '_update_poline'),
+        ('POST', 'acq/po-lines', '_create_poline'),
+        ('POST', 'acq/po-lines/{number}/items/{item_id}', '_receive_item'),
+        ('GET', 'users/{user_id}', '_get_user'),
+        ('POST', 'users/{user_id}/loans', '_create_loan'),
+        ('GET', 'users/{user_id}/loans/{loan_id}', '_get_loan'),
+        ('POST', 'users/{user_id}/requests', '_create_request'),
+        ('GET', 'users/{user_id}/requests/{request_id}', '_get_request'),
+        ('DELETE', 'users/{user_id}/requests/{request_id}', '_cancel_request'),
+    ]
+
+    # Methods adding the records of each list of a seed file, in the order of the dependencies
+    SEED_METHODS: Dict[str, str] = {
+        'bibs': 'add_bib',
+        'holdings': 'add_holding',
+        'items': 'add_item',
+        'polines': 'add_poline',
+        'users': 'add_user',
+        'loans': 'add_loan',
+        'requests': 'add_request',
+        'collections': 'add_collection',
+    }
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 rate_429: float = 0.0,
+                 pol_items_delay: float = 0.0,
+                 seed: Optional[int] = None) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.pol_items_delay = pol_items_delay
+        self.nb_calls: Dict[str, int] = {}
+        self.nb_injected: Dict[str, int] = {'500': 0, '429': 0}
+
+        self.lock = threading.RLock()
+        self._random = random.Random(seed)
+        self._next_id = 1
+        self._routes: List[Tuple[str, str, Pattern, str]] = [
+            (method, route, re.compile('^' + re.sub(r'{(\w+)}', r'(?P<\1>[^/]+)', route) + '$'), handler)
+            for method, route, handler in self.ROUTES]
+
+        # Records by zone and ID
+        self.bibs: Dict[Tuple[str, str], etree._Element] = {}
+        self.holdings: Dict[Tuple[str, str], etree._Element] = {}
+        self.items: Dict[Tuple[str, str], etree._Element] = {}
+        self.polines: Dict[Tuple[str, str], dict] = {}
+        self.users: Dict[Tuple[str, str], dict] = {}
+        self.loans: Dict[Tuple[str, str], dict] = {}
+        self.requests: Dict[Tuple[str, str], dict] = {}
+        self.collections: Dict[Tuple[str, str], dict] = {}
+
+        # Indexes by zone: IZ MMS ID by NZ MMS ID, holding IDs by MMS ID, item IDs by
+        # holding ID, item ID by barcode, MMS IDs by collection and active loan by item ID
+        self._nz_links: Dict[Tuple[str, str], str] = {}
+        self._bib_holdings: Dict[Tuple[str, str], List[str]] = {}
+        self._holding_items: Dict[Tuple[str, str], List[str]] = {}
+        self._barcodes: Dict[Tuple[str, str], str] = {}
+        self._collection_bibs: Dict[Tuple[str, str], List[str]] = {}
+        self._active_loans: Dict[Tuple[str, str], str] = {}
+
+        # Time before which the items created by a PoLine are not listed
+        self._hidden_until: Dict[Tuple[str, str], float] = {}
+
+    # ------------------
+    # Records of the API
+    # ------------------
+    def new_id(self, prefix: str) -> str:
+        """
+        Returns a new ID in the format of Alma, for example '9900000000125504'
+
+        Parameters
+        ----------
+        prefix : str
+            First digits of the ID: '99' for bibs, '22' for holdings, '23' for items
+
+        Returns
+        -------
+        str
+            New ID, unique in all zones
+        """
+        with self.lock:
+            number = self._next_id
+            self._next_id += 1
+        return f'{prefix}{number:010d}5504'
+
+    def add_bib(self,
+                zone: str,
+                mms_id: Optional[str] = None,
+                nz_mms_id: Optional[str] = None,
+                title: str = 'Mock title',
+                fields: Optional[List[Tuple[str, Dict[str, str]]]] = None) -> str:
+        """
+        Adds a bib record to a zone
+
+        Parameters
+        ----------
+        zone : str
+            IZ code or 'NZ'
+        mms_id : str, optional
+            MMS ID of the record, a new ID is used if not provided
+        nz_mms_id : str, optional
+            MMS ID of the linked NZ record
+        title : str, optional
+            Title of the record, field 245 $a
+        fields : List[Tuple[str, Dict[str, str]]], optional
+            Other datafields: tag and subfields by code, for example
+            `[('998', {'a': 'no_inventory_analytical'})]`
+
+        Returns
+        -------
+        str
+            MMS ID of the record
+        """
+        mms_id = mms_id or self.new_id('99')
+        record = etree.Element('record')
+        _sub_element(record, 'leader', '00000nam a2200000 i 4500')
+        _sub_element(record, 'controlfield', mms_id, tag='001')
+        for tag, subfields in [('245', {'a': title})] + [tuple(field) for field in fields or []]:
+            datafield = _sub_element(record, 'datafield', tag=tag, ind1=' ', ind2=' ')
+            for code, value in subfields.items():
+                _sub_element(datafield, 'subfield', value, code=code)
+
+        with self.lock:
+            self._store_bib(zone, mms_id, record, nz_mms_id)
+        return mms_id
+
+    def add_holding(self,
+                    zone: str,
+                    mms_id: str,
+                    library: str,
+                    location: str,
+                    callnumber: str = '',
+                    holding_id: Optional[str] = None) -> str:
+        """
+        Adds a holding record to a bib
+
+        Parameters
+        ----------
+        zone : str
+            IZ code
+        mms_id : str
+            MMS ID of the bib
+        library : str
+            Library code, field 852 $b
+        location : str
+            Location code, field 852 $c
+        callnumber : str, optional
+            Call number, field 852 $h
+        holding_id : str, optional
+            ID of the holding, a new ID is used if not provided
+
+        Returns
+        -------
+        str
+            Holding ID
+        """
+        with self.lock:
+            self._check_bib(zone, mms_id)
+            return self._store_holding(zone, mms_id, _make_holding_record(library, location, callnumber), holding_id)
+
+    def add_item(self,
+                 zone: str,
+                 mms_id: str,
+                 holding_id: str,
+                 barcode: str,
+                 item_id: Optional[str] = None,
+                 po_line: Optional[str] = None,
+                 received: bool = True,
+                 fields: Optional[Dict[str, str]] = None) -> str:
+        """
+        Adds an item to a holding
+
+        The library and location of the item are the ones of the holding.
+
+        Parameters
+        ----------
+        zone : str
+            IZ code
+        mms_id : str
+            MMS ID of the bib
+        holding_id : str
+            ID of the holding
+        barcode : str
+            Barcode of the item, unique in the zone
+        item_id : str, optional
+            ID of the item, a new ID is used if not provided
+        po_line : str, optional
+            Number of the PoLine of the item
+        received : bool, optional
+            If False, the item is still in acquisition: no arrival date
+        fields : Dict[str, str], optional
+            Other fields of the item data, for example `{'description': 'Vol. 1'}`
+
+        Returns
+        -------
+        str
+            Item ID
+        """
+        with self.lock:
+            holding = self._check_holding(zone, mms_id, holding_id)
+            item_data = etree.Element('item_data')
+            _sub_element(item_data, 'barcode', barcode)
+            _sub_element(item_data, 'physical_material_type', 'BOOK')
+            _sub_element(item_data, 'policy', '01')
+            _sub_element(item_data, 'po_line', po_line or '')
+            for tag, value in (fields or {}).items():
+                _sub_element(item_data, tag, value)
+            if received:
+                _sub_element(item_data, 'arrival_date', _today())
+                _sub_element(item_data, 'process_type', '')
+            else:
+                _sub_element(item_data, 'expected_arrival_date', _today())
+                _sub_element(item_data, 'process_type', 'ACQ')
+            _sub_element(item_data, 'library', _get_subfield(holding, '852', 'b'))
+            _sub_element(item_data, 'location', _get_subfield(holding, '852', 'c'))
+            return self._store_item(zone, mms_id, holding_id, item_data, item_id)
+
+    def add_poline(self,
+                   zone: str,
+                   mms_id: str,
+                   library: str,
+                   location: str,
+                   purchase_type: str = 'PRINTED_BOOK_OT',
+                   quantity: int = 1,
+                   number: Optional[str] = None,
+                   vendor: str = 'VENDOR',
+                   vendor_account: str = 'VENDOR_ACCOUNT',
+                   fund: str = 'FUND',
+                   status: str = 'SENT',
+                   interested_users: Optional[List[str]] = None) -> str:
+        """
+        Adds a PoLine without creating its inventory
+
+        Parameters
+        ----------
+        zone : str
+            IZ code
+        mms_id : str
+            MMS ID of the ordered bib
+        library : str
+            Library code of the location and owner of the PoLine
+        location : str
+            Location code
+        purchase_type : str, optional
+            Type of the PoLine, the one-time types end with '_OT' and the
+            continuous types with '_CO'
+        quantity : int, optional
+            Number of ordered copies
+        number : str, optional
+            Number of the PoLine, a new number is used if not provided
+        vendor : str, optional
+            Vendor code
+        vendor_account : str, optional
+            Vendor account code
+        fund : str, optional
+            Fund code
+        status : str, optional
+            Status of the PoLine
+        interested_users : List[str], optional
+            Primary IDs of the interested users
+
+        Returns
+        -------
+        str
+            Number of the PoLine
+        """
+        with self.lock:
+            self._check_bib(zone, mms_id)
+            number = number or f'POL-{self.new_id("")}'
+            self.polines[(zone, number)] = {
+                'number': number,
+                'type': {'value': purchase_type},
+                'status': {'value': status},
+                'owner': {'value': library},
+                'vendor': {'value': vendor},
+                'vendor_account': vendor_account,
+                'acquisition_method': {'value': 'PURCHASE'},
+                'resource_metadata': {'mms_id': {'value': mms_id}},
+                'fund_distribution': [{'fund_code': {'value': fund}, 'percent': 100}],
+                'location': [{'quantity': quantity,
+                              'library': {'value': library},
+                              'shelving_location': location,
+                              'copy': []}],
+                'interested_user': [{'primary_id': primary_id} for primary_id in interested_users or []],
+                'alert': [],
+                'po_number': '',
+            }
+        return number
+
+    def add_user(self, zone: str, primary_id: str, user_group: str = '01') -> str:
+        """
+        Adds a user to a zone
+
+        Parameters
+        ----------
+        zone : str
+            IZ code
+        primary_id : str
+            Primary ID of the user
+        user_group : str, optional
+            Code of the user group
+
+        Returns
+        -------
+        str
+            Primary ID of the user
+        """
+        with self.lock:
+            self.users[(zone, primary_id)] = {'primary_id': primary_id,
+                                              'user_group': {'value': user_group},
+                                              'status': {'value': 'ACTIVE'}}
+        return primary_id
+
+    def add_loan(self, zone: str, primary_id: str, barcode: str) -> str:
+        """
+        Adds an active loan of an item to a user
+
+        Parameters
+        ----------
+        zone : str
+            IZ code
+        primary_id : str
+            Primary ID of the user
+        barcode : str
+            Barcode of the item
+
+        Returns
+        -------
+        str
+            Loan ID
+        """
+        with self.lock:
+            return self._create_loan(zone, {'item_barcode': barcode}, None, user_id=primary_id)['loan_id']
+
+    def add_request(self,
+                    zone: str,
+                    primary_id: str,
+                    mms_id: str,
+                    barcode: Optional[str] = None,
+                    request_type: str = 'HOLD',
+                    pickup_location_library: str = '',
+                    fields: Optional[Dict[str, str]] = None) -> str:
+        """
+        Adds a request of a user on a bib or on an item
+
+        Parameters
+        ----------
+        zone : str
+            IZ code
+        primary_id : str
+            Primary ID of the user
+        mms_id : str
+            MMS ID of the requested bib
+        barcode : str, optional
+            Barcode of the requested item, request at title level if not provided
+        request_type : str, optional
+            Type of the request
+        pickup_location_library : str, optional
+            Library code of the pickup location
+        fields : Dict[str, str], optional
+            Other fields of the request, for example the 'booking_start_date'
+            and 'booking_end_date' of a booking
+
+        Returns
+        -------
+        str
+            Request ID
+        """
+        data = {'request_type': request_type,
+                'pickup_location_type': 'LIBRARY',
+                'pickup_location_library': pickup_location_library,
+                **(fields or {})}
+        params = {'mms_id': mms_id}
+        with self.lock:
+            if barcode is not None:
+                if (zone, barcode) not in self._barcodes:
+                    raise MockAlmaError(f'No items found for barcode {barcode}.', code='401689')
+                params = {'item_pid': self._barcodes[(zone, barcode)]}
+            return self._create_request(zone, params, json.dumps(data).encode(), user_id=primary_id)['request_id']
+
+    def add_collection(self,
+                       zone: str,
+                       pid: Optional[str] = None,
+                       name: str = 'Mock collection',
+                       mms_ids: Optional[List[str]] = None) -> str:
+        """
+        Adds a collection of bibs
+
+        Parameters
+        ----------
+        zone : str
+            IZ code
+        pid : str, optional
+            ID of the collection, a new ID is used if not provided
+        name : str, optional
+            Name of the collection
+        mms_ids : List[str], optional
+            MMS IDs of the bibs of the collection
+
+        Returns
+        -------
+        str
+            ID of the collection
+        """
+        with self.lock:
+            pid = pid or self.new_id('81')
+            self.collections[(zone, pid)] = {'pid': pid, 'name': name}
+            self._collection_bibs[(zone, pid)] = []
+            for mms_id in mms_ids or []:
+                self._check_bib(zone, mms_id)
+                self._collection_bibs[(zone, pid)].append(mms_id)
+        return pid
+
+    def load_seed(self, file_path: str) -> None:
+        """
+        Adds the records of a JSON seed file
+
+        The file contains lists of records by type: "bibs", "holdings", "items",
+        "polines", "users", "loans", "requests" and "collections". Each record
+        gives the parameters of the `add_*` method of its type, for example
+        `{"bibs": [{"zone": "NZ", "mms_id": "991"}, {"zone": "UBS", "nz_mms_id": "991"}]}`.
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the seed file
+        """
+        with open(file_path) as f:
+            seed = json.load(f)
+
+        for record_type, method in self.SEED_METHODS.items():
+            for record in seed.get(record_type, []):
+                getattr(self, method)(**record)
+
+        logging.info(f'Mock Alma seeded from {file_path}: '
+                     + ', '.join(f'{len(seed[record_type])} {record_type}'
+                                 for record_type in self.SEED_METHODS if record_type in seed))
+
+    def get_bib_mms_id(self, zone: str, nz_mms_id: str) -> Optional[str]:
+        """
+        Returns the MMS ID of the bib of a zone linked to a NZ record, None if not available
+        """
+        with self.lock:
+            return self._nz_links.get((zone, nz_mms_id))
+
+    def get_items_by_barcode(self, zone: str) -> Dict[str, etree._Element]:
+        """
+        Returns a copy of the items of a zone by barcode, to check the state after a run
+        """
+        with self.lock:
+            return {barcode: deepcopy(self.items[(item_zone, item_id)])
+                    for (item_zone, barcode), item_id in self._barcodes.items() if item_zone == zone}
+
+    # --------
+    # Requests
+    # --------
+    def handle(self,
+               method: str,
+               path: str,
+               params: Dict[str, str],
+               headers: Dict[str, str],
+               body: bytes) -> Tuple[int, Dict[str, str], bytes]:
+        """
+        Answers an HTTP request
+
+        Parameters
+        ----------
+        method : str
+            'GET', 'PUT', 'POST' or 'DELETE'
+        path : str
+            Path of the URL, for example '/almaws/v1/bibs/991'
+        params : Dict[str, str]
+            Parameters of the query string
+        headers : Dict[str, str]
+            Headers of the request with lower-case names, the zone is given by the API key
+        body : bytes
+            Body of the request
+
+        Returns
+        -------
+        Tuple[int, Dict[str, str], bytes]
+            Status, headers and body of the response
+        """
+        json_format = 'json' in headers.get('accept', '')
+        route, handler, path_params = self._get_route(method, path)
+        label = f'{method} {route}'
+
+        with self.lock:
+            self.nb_calls[label] = self.nb_calls.get(label, 0) + 1
+            draw = self._random.random()
+            duration = self.latency * (0.5 + self._random.random())
+
+        if duration > 0:
+            time.sleep(duration)
+
+        try:
+            if draw < self.rate_429:
+                self._count_injected('429')
+                raise MockAlmaError('PER_SECOND_THRESHOLD', status=429, code='PER_SECOND_THRESHOLD')
+            if draw < self.rate_429 + self.error_rate:
+                self._count_injected('500')
+                raise MockAlmaError('Internal server error (injected by the mock)', status=500, code='INTERNAL_SERVER_ERROR')
+            if handler is None:
+                raise MockAlmaError(f'API {method} {path} not available on the mock server', status=404, code='404')
+
+            match = re.match(r'apikey mock:(\S+)$', headers.get('authorization', ''))
+            if match is None:
+                raise MockAlmaError('Invalid API Key', status=401, code='UNAUTHORIZED')
+
+            # The response is built before another call can change the record
+            with self.lock:
+                result = getattr(self, handler)(match.group(1), params, body, **path_params)
+                return 204 if result is None else 200, *_format_body(result)
+        except MockAlmaError as err:
+            return err.status, *_format_error(err, json_format)
+
+    def _get_route(self, method: str, path: str) -> Tuple[str, Optional[str], Dict[str, str]]:
+        """
+        Returns the route, the handler and the parameters of the path of a request
+        """
+        if path.startswith(API_PATH + '/'):
+            relative_path = path[len(API_PATH) + 1:].rstrip('/')
+            for route_method, route, pattern, handler in self._routes:
+                match = pattern.match(relative_path)
+                if route_method == method and match is not None:
+                    return route, handler, match.groupdict()
+        return 'other', None, {}
+
+    def _count_injected(self, status: str) -> None:
+        with self.lock:
+            self.nb_injected[status] += 1
+
+    # ----------------
+    # Bibs and holding
+    # ----------------
+    def _store_bib(self, zone: str, mms_id: str, record: etree._Element, nz_mms_id: Optional[str] = None) -> etree._Element:
+        bib = etree.Element('bib')
+        _sub_element(bib, 'mms_id', mms_id)
+        if nz_mms_id is not None:
+            _sub_element(bib, 'linked_record_id', nz_mms_id, type='NZ')
+            self._nz_links[(zone, nz_mms_id)] = mms_id
+        _sub_element(bib, 'title', record.findtext('./datafield[@tag="245"]/subfield[@code="a"]') or '')
+        _set_controlfield_001(record, mms_id)
+        bib.append(record)
+
+        self.bibs[(zone, mms_id)] = bib
+        self._bib_holdings.setdefault((zone, mms_id), [])
+        return bib
+
+    def _check_bib(self, zone: str, mms_id: str) -> etree._Element:
+        bib = self.bibs.get((zone, mms_id))
+        if bib is None:
+            raise MockAlmaError(f'Input parameters mmsId {mms_id} is not valid.', code='402203')
+        return bib
+
+    def _get_bib(self, zone: str, params: dict, body: bytes, mms_id: str) -> etree._Element:
+        return self._check_bib(zone, mms_id)
+
+    def _get_bib_from_nz_mms_id(self, zone: str, params: dict, body: bytes) -> etree._Element:
+        mms_id = self._nz_links.get((zone, params.get('nz_mms_id')))
+        if mms_id is None:
+            raise MockAlmaError(f'No bib record found for NZ MMS ID {params.get("nz_mms_id")}.', code='402204')
+        bibs = etree.Element('bibs', total_record_count='1')
+        bibs.append(deepcopy(self.bibs[(zone, mms_id)]))
+        return bibs
+
+    def _create_bib(self, zone: str, params: dict, body: bytes) -> etree._Element:
+        nz_mms_id = params.get('from_nz_mms_id')
+        if nz_mms_id is None:
+            record = _parse_xml(body).find('.//record')
+            if record is None:
+                raise MockAlmaError('The bib has no record.', code='402210')
+            return self._store_bib(zone, self.new_id('99'), deepcopy(record))
+
+        nz_bib = self.bibs.get(('NZ', nz_mms_id))
+        if nz_bib is None:
+            raise MockAlmaError(f'Input parameters mmsId {nz_mms_id} is not valid.', code='402203')
+        if (zone, nz_mms_id) in self._nz_links:
+            raise MockAlmaError(f'Record {nz_mms_id} already exists in the institution.', code='402208')
+        return self._store_bib(zone, self.new_id('99'), deepcopy(nz_bib.find('record')), nz_mms_id)
+
+    def _update_bib(self, zone: str, params: dict, body: bytes, mms_id: str) -> etree._Element:
+        bib = self._check_bib(zone, mms_id)
+        record = _parse_xml(body).find('.//record')
+        if record is None:
+            raise MockAlmaError('The bib has no record.', code='402210')
+        record = deepcopy(record)
+        _set_controlfield_001(record, mms_id)
+        bib.replace(bib.find('record'), record)
+        return bib
+
+    def _store_holding(self, zone: str, mms_id: str, record: etree._Element, holding_id: Optional[str] = None) -> str:
+        holding_id = holding_id or self.new_id('22')
+        holding = etree.Element('holding')
+        _sub_element(holding, 'holding_id', holding_id)
+        _set_controlfield_001(record, holding_id)
+        holding.append(record)
+
+        self.holdings[(zone, holding_id)] = holding
+        self._bib_holdings[(zone, mms_id)].append(holding_id)
+        self._holding_items[(zone, holding_id)] = []
+        return holding_id
+
+    def _check_holding(self, zone: str, mms_id: str, holding_id: str) -> etree._Element:
+        self._check_bib(zone, mms_id)
+        if holding_id not in self._bib_holdings[(zone, mms_id)]:
+            raise MockAlmaError(f'Input parameters holdingId {holding_id} is not valid.', code='402215')
+        return self.holdings[(zone, holding_id)]
+
+    def _get_holdings(self, zone: str, params: dict, body: bytes, mms_id: str) -> etree._Element:
+        self._check_bib(zone, mms_id)
+        holding_ids = self._bib_holdings[(zone, mms_id)]
+        holdings = etree.Element('holdings', total_record_count=str(len(holding_ids)))
+        for holding_id in holding_ids:
+            record = self.holdings[(zone, holding_id)].find('record')
+            summary = _sub_element(holdings, 'holding')
+            _sub_element(summary, 'holding_id', holding_id)
+            _sub_element(summary, 'library', _get_subfield(record, '852', 'b'))
+            _sub_element(summary, 'location', _get_subfield(record, '852', 'c'))
+        return holdings
+
+    def _get_holding(self, zone: str, params: dict, body: bytes, mms_id: str, holding_id: str) -> etree._Element:
+        return self._check_holding(zone, mms_id, holding_id)
+
+    def _create_holding(self, zone: str, params: dict, body: bytes, mms_id: str) -> etree._Element:
+        self._check_bib(zone, mms_id)
+        record = _parse_xml(body).find('.//record')
+        if record is None:
+            raise MockAlmaError('The holding has no record.', code='402210')
+        return self.holdings[(zone, self._store_holding(zone, mms_id, deepcopy(record)))]
+
+    def _update_holding(self, zone: str, params: dict, body: bytes, mms_id: str, holding_id: str) -> etree._Element:
+        holding = self._check_holding(zone, mms_id, holding_id)
+        record = _parse_xml(body).find('.//record')
+        if record is None:
+            raise MockAlmaError('The holding has no record.', code='402210')
+        record = deepcopy(record)
+        _set_controlfield_001(record, holding_id)
+        holding.replace(holding.find('record'), record)
+        return holding
+
+    # -----
+    # Items
+    # -----
+    def _store_item(self,
+                    zone: str,
+                    mms_id: str,
+                    holding_id: str,
+                    item_data: etree._Element,
+                    item_id: Optional[str] = None) -> str:
+        barcode = item_data.findtext('barcode') or ''
+        if barcode != '' and (zone, barcode) in self._barcodes:
+            raise MockAlmaError(f'Given field barcode {barcode} already exists.', code='401873')
+
+        item_id = item_id or self.new_id('23')
+        bib = self.bibs[(zone, mms_id)]
+        item = etree.Element('item', link=f'{API_PATH}/bibs/{mms_id}/holdings/{holding_id}/items/{item_id}')
+        bib_data = _sub_element(item, 'bib_data')
+        _sub_element(bib_data, 'mms_id', mms_id)
+        _sub_element(bib_data, 'title', bib.findtext('title'))
+        nz_mms_id = bib.findtext('linked_record_id[@type="NZ"]')
+        if nz_mms_id is not None:
+            _sub_element(_sub_element(bib_data, 'network_numbers'), 'network_number', NETWORK_PREFIX + nz_mms_id)
+        holding_data = _sub_element(item, 'holding_data')
+        _sub_element(holding_data, 'holding_id', holding_id)
+        _sub_element(holding_data, 'call_number',
+                     _get_subfield(self.holdings[(zone, holding_id)].find('record'), '852', 'h'))
+
+        item_data = deepcopy(item_data)
+        for tag in ['pid', 'creation_date', 'modification_date', 'base_status']:
+            for field in item_data.findall(tag):
+                item_data.remove(field)
+        item_data.insert(0, _make_element('pid', item_id))
+        _sub_element(item_data, 'creation_date', _today())
+        _sub_element(item_data, 'modification_date', _today())
+        _sub_element(item_data, 'base_status', '1', desc='Item in place')
+        item.append(item_data)
+
+        self.items[(zone, item_id)] = item
+        self._holding_items[(zone, holding_id)].append(item_id)
+        if barcode != '':
+            self._barcodes[(zone, barcode)] = item_id
+        return item_id
+
+    def _check_item(self, zone: str, mms_id: str, holding_id: str, item_id: str) -> etree._Element:
+        self._check_holding(zone, mms_id, holding_id)
+        if item_id not in self._holding_items[(zone, holding_id)]:
+            raise MockAlmaError(f'Input parameters itemId {item_id} is not valid.', code='401690')
+        return self.items[(zone, item_id)]
+
+    def _get_items(self, zone: str, params: dict, body: bytes, mms_id: str, holding_id: str) -> etree._Element:
+        self._check_holding(zone, mms_id, holding_id)
+        now = time.monotonic()
+        item_ids = [item_id for item_id in self._holding_items[(zone, holding_id)]
+                    if self._hidden_until.get((zone, item_id), 0) <= now]
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 10))
+        items = etree.Element('items', total_record_count=str(len(item_ids)))
+        for item_id in item_ids[offset:offset + limit]:
+            items.append(deepcopy(self.items[(zone, item_id)]))
+        return items
+
+    def _get_item(self, zone: str, params: dict, body: bytes, mms_id: str, holding_id: str, item_id: str) -> etree._Element:
+        return self._check_item(zone, mms_id, holding_id, item_id)
+
+    def _get_item_by_barcode(self, zone: str, params: dict, body: bytes) -> etree._Element:
+        item_id = self._barcodes.get((zone, params.get('item_barcode')))
+        if item_id is None:
+            raise MockAlmaError(f'No items found for barcode {params.get("item_barcode")}.', code='401689')
+        return self.items[(zone, item_id)]
+
+    def _create_item(self, zone: str, params: dict, body: bytes, mms_id: str, holding_id: str) -> etree._Element:
+        self._check_holding(zone, mms_id, holding_id)
+        item_data = _parse_xml(body).find('.//item_data')
+        if item_data is None:
+            raise MockAlmaError('The item has no item data.', code='402210')
+        return self.items[(zone, self._store_item(zone, mms_id, holding_id, item_data))]
+
+    def _update_item(self, zone: str, params: dict, body: bytes, mms_id: str, holding_id: str, item_id: str) -> etree._Element:
+        item = self._check_item(zone, mms_id, holding_id, item_id)
+        item_data = _parse_xml(body).find('.//item_data')
+        if item_data is None:
+            raise MockAlmaError('The item has no item data.', code='402210')
+
+        old_barcode = item.findtext('item_data/barcode') or ''
+        new_barcode = item_data.findtext('barcode') or ''
+        if new_barcode != old_barcode:
+            if new_barcode != '' and (zone, new_barcode) in self._barcodes:
+                raise MockAlmaError(f'Given field barcode {new_barcode} already exists.', code='401873')
+            self._barcodes.pop((zone, old_barcode), None)
+            if new_barcode != '':
+                self._barcodes[(zone, new_barcode)] = item_id
+
+        # The IDs, the creation date and the status are kept
+        old_item_data = item.find('item_data')
+        item_data = deepcopy(item_data)
+        for tag in ['pid', 'creation_date', 'base_status']:
+            for field in item_data.findall(tag):
+                item_data.remove(field)
+            for field in old_item_data.findall(tag):
+                item_data.append(field)
+        modification_date = item_data.find('modification_date')
+        if modification_date is None:
+            modification_date = _sub_element(item_data, 'modification_date')
+        modification_date.text = _today()
+        item.replace(old_item_data, item_data)
+        return item
+
+    def _scan_in_item(self, zone: str, params: dict, body: bytes, mms_id: str, holding_id: str, item_id: str) -> etree._Element:
+        item = self._check_item(zone, mms_id, holding_id, item_id)
+        if params.get('op') != 'scan':
+            raise MockAlmaError(f'Operation {params.get("op")} not supported by the mock server.', code='401664')
+
+        # The active loan of the item is returned
+        loan_id = self._active_loans.pop((zone, item_id), None)
+        if loan_id is not None:
+            self.loans[(zone, loan_id)]['loan_status'] = 'COMPLETE'
+        item.find('item_data/base_status').text = '1'
+        item.find('item_data/base_status').set('desc', 'Item in place')
+        return item
+
+    # -------
+    # PoLines
+    # -------
+    def _get_poline(self, zone: str, params: dict, body: bytes, number: str) -> dict:
+        poline = self.polines.get((zone, number))
+        if poline is None:
+            raise MockAlmaError(f'PO line {number} not found.', code='402880')
+        return poline
+
+    def _create_poline(self, zone: str, params: dict, body: bytes) -> dict:
+        poline = deepcopy(_parse_json(body))
+        try:
+            mms_id = poline['resource_metadata']['mms_id']['value']
+            purchase_type = poline['type']['value']
+            locations = poline['location']
+        except (KeyError, TypeError):
+            raise MockAlmaError('Mandatory field missing in the PO line.', code='402881')
+        self._check_bib(zone, mms_id)
+
+        poline['number'] = f'POL-{self.new_id("")}'
+        poline.setdefault('status', {'value': 'SENT'})
+
+        # Alma creates the holdings and, for one-time orders, the items of the PoLine
+        hidden_until = time.monotonic() + self.pol_items_delay
+        for location in locations:
+            library = location['library']['value']
+            holding_id = next((holding_id for holding_id in self._bib_holdings[(zone, mms_id)]
+                               if _get_subfield(self.holdings[(zone, holding_id)].find('record'), '852', 'b') == library
+                               and _get_subfield(self.holdings[(zone, holding_id)].find('record'), '852', 'c')
+                               == location['shelving_location']), None)
+            if holding_id is None:
+                holding_id = self._store_holding(zone, mms_id,
+                                                 _make_holding_record(library, location['shelving_location']))
+            location['copy'] = []
+            if not purchase_type.endswith('_OT'):
+                continue
+            for _ in range(int(location.get('quantity', 1))):
+                item_data = etree.Element('item_data')
+                _sub_element(item_data, 'barcode', '')
+                _sub_element(item_data, 'po_line', poline['number'])
+                _sub_element(item_data, 'expected_arrival_date', _today())
+                _sub_element(item_data, 'process_type', 'ACQ')
+                _sub_element(item_data, 'library', library)
+                _sub_element(item_data, 'location', location['shelving_location'])
+                item_id = self._store_item(zone, mms_id, holding_id, item_data)
+                self._hidden_until[(zone, item_id)] = hidden_until
+                location['copy'].append({'pid': item_id, 'barcode': ''})
+
+        self.polines[(zone, poline['number'])] = poline
+        return poline
+
+    def _update_poline(self, zone: str, params: dict, body: bytes, number: str) -> dict:
+        self._get_poline(zone, params, body, number)
+        poline = deepcopy(_parse_json(body))
+        poline['number'] = number
+        self.polines[(zone, number)] = poline
+        return poline
+
+    def _receive_item(self, zone: str, params: dict, body: bytes, number: str, item_id: str) -> etree._Element:
+        self._get_poline(zone, params, body, number)
+        item = self.items.get((zone, item_id))
+        if params.get('op') != 'receive' or item is None or item.findtext('item_data/po_line') != number:
+            raise MockAlmaError(f'Item {item_id} cannot be received for PO line {number}.', code='401871')
+
+        item_data = item.find('item_data')
+        for tag, value in [('arrival_date', params.get('receive_date', _today())), ('process_type', '')]:
+            field = item_data.find(tag)
+            if field is None:
+                field = _sub_element(item_data, tag)
+            field.text = value
+        return item
+
+    # ---------------------------
+    # Users, loans and requests
+    # ---------------------------
+    def _get_user(self, zone: str, params: dict, body: bytes, user_id: str) -> dict:
+        user = self.users.get((zone, user_id))
+        if user is None:
+            raise MockAlmaError(f'User with identifier {user_id} was not found.', code='401861')
+        return user
+
+    def _create_loan(self, zone: str, params: dict, body: Optional[bytes], user_id: str) -> dict:
+        self._get_user(zone, params, body, user_id)
+        item_id = params.get('item_pid') or self._barcodes.get((zone, params.get('item_barcode')))
+        item = self.items.get((zone, item_id)) if item_id is not None else None
+        if item is None:
+            raise MockAlmaError(f'No items found for barcode {params.get("item_barcode")}.', code='401689')
+        if (zone, item_id) in self._active_loans:
+            raise MockAlmaError(f'Item {item.findtext("item_data/barcode")} is already loaned.', code='401651')
+
+        request = _parse_json(body) if body else {}
+        loan_id = self.new_id('21')
+        loan = {'loan_id': loan_id,
+                'user_id': user_id,
+                'item_barcode': item.findtext('item_data/barcode'),
+                'item_id': item_id,
+                'mms_id': item.findtext('bib_data/mms_id'),
+                'holding_id': item.findtext('holding_data/holding_id'),
+                'title': item.findtext('bib_data/title'),
+                'library': request.get('library', {'value': item.findtext('item_data/library')}),
+                'circ_desk': request.get('circ_desk', {'value': 'DEFAULT_CIRC_DESK'}),
+                'loan_status': 'ACTIVE',
+                'loan_date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'due_date': (datetime.utcnow() + timedelta(days=28)).strftime('%Y-%m-%dT%H:%M:%SZ')}
+        self.loans[(zone, loan_id)] = loan
+        self._active_loans[(zone, item_id)] = loan_id
+        item.find('item_data/base_status').text = '0'
+        item.find('item_data/base_status').set('desc', 'Item not in place')
+        return loan
+
+    def _get_loan(self, zone: str, params: dict, body: bytes, user_id: str, loan_id: str) -> dict:
+        loan = self.loans.get((zone, loan_id))
+        if loan is None or loan['user_id'] != user_id:
+            raise MockAlmaError(f'Loan {loan_id} not found.', code='401665')
+        return loan
+
+    def _create_request(self, zone: str, params: dict, body: bytes, user_id: str) -> dict:
+        self._get_user(zone, params, body, user_id)
+        request = deepcopy(_parse_json(body))
+        if 'item_pid' in params:
+            item = self.items.get((zone, params['item_pid']))
+            if item is None:
+                raise MockAlmaError(f'Input parameters itemId {params["item_pid"]} is not valid.', code='401690')
+            request['item_id'] = params['item_pid']
+            request['barcode'] = item.findtext('item_data/barcode')
+            request['mms_id'] = item.findtext('bib_data/mms_id')
+        else:
+            self._check_bib(zone, params.get('mms_id', ''))
+            request['mms_id'] = params['mms_id']
+
+        request['request_id'] = self.new_id('31')
+        request['user_primary_id'] = user_id
+        request['request_status'] = 'NOT_STARTED'
+        self.requests[(zone, request['request_id'])] = request
+        return request
+
+    def _get_request(self, zone: str, params: dict, body: bytes, user_id: str, request_id: str) -> dict:
+        request = self.requests.get((zone, request_id))
+        if request is None or user_id not in ['ALL', request['user_primary_id']]:
+            raise MockAlmaError(f'Request {request_id} not found.', code='401652')
+        return request
+
+    def _cancel_request(self, zone: str, params: dict, body: bytes, user_id: str, request_id: str) -> None:
+        request = self._get_request(zone, params, body, user_id, request_id)
+        if request['request_status'] == 'CANCELLED':
+            raise MockAlmaError(f'Request {request_id} already cancelled.', code='401652')
+        request['request_status'] = 'CANCELLED'
+        return None
+
+    # -----------
+    # Collections
+    # -----------
+    def _get_collection(self, zone: str, params: dict, body: bytes, pid: str) -> dict:
+        collection = self.collections.get((zone, pid))
+        if collection is None:
+            raise MockAlmaError(f'Collection {pid} not found.', code='60120')
+        return collection
+
+    def _get_collection_bibs(self, zone: str, params: dict, body: bytes, pid: str) -> dict:
+        self._get_collection(zone, params, body, pid)
+        mms_ids = self._collection_bibs[(zone, pid)]
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 10))
+        bibs = {'total_record_count': len(mms_ids)}
+        if len(mms_ids[offset:offset + limit]) > 0:
+            bibs['bib'] = [{'mms_id': mms_id} for mms_id in mms_ids[offset:offset + limit]]
+        return bibs
+
+    def _add_collection_bib(self, zone: str, params: dict, body: bytes, pid: str) -> etree._Element:
+        self._get_collection(zone, params, body, pid)
+        mms_id = _parse_xml(body).findtext('.//mms_id') or ''
+        bib = self._check_bib(zone, mms_id)
+        if mms_id in self._collection_bibs[(zone, pid)]:
+            raise MockAlmaError(f'Bib {mms_id} already in the collection {pid}.', code='60121')
+        self._collection_bibs[(zone, pid)].append(mms_id)
+        return bib
+
+
+class MockAlmaServer(ThreadingHTTPServer):
+    """
+    HTTP server of a mock Alma API
+
+    Parameters
+    ----------
+    alma : MockAlma
+        State of the API
+    host : str, optional
+        Host name or address of the server, default is 'localhost'
+    port : int, optional
+        Port of the server, 0 for a free port
+
+    Attributes
+    ----------
+    url : str
+        Base URL of the API, to give to `--alma-url` or `apicalls.set_base_url`
+    """
+    daemon_threads = True
+
+    def __init__(self, alma: MockAlma, host: str = 'localhost', port: int = 0) -> None:
+        super().__init__((host, port), _MockAlmaRequestHandler)
+        self.alma = alma
+        self.url = f'http://{host}:{self.server_address[1]}{API_PATH}'
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'MockAlmaServer':
+        """
+        Serves the requests in a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='mock-alma', daemon=True)
+        self._thread.start()
+        logging.info(f'Mock Alma API available at {self.url}')
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops the server started with `start`
+        """
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class _MockAlmaRequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of `MockAlmaServer`, the requests are answered by `MockAlma.handle`
+    """
+    server: MockAlmaServer
+
+    def _handle(self, method: str) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else b''
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        status, headers, content = self.server.alma.handle(method, url.path, params, headers, body)
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self) -> None:
+        self._handle('GET')
+
+    def do_PUT(self) -> None:
+        self._handle('PUT')
+
+    def do_POST(self) -> None:
+        self._handle('POST')
+
+    def do_DELETE(self) -> None:
+        self._handle('DELETE')
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.debug(f'Mock Alma: {format % args}')
+
+
+def _make_element(tag: str, text: Optional[str] = None, /, **attributes: str) -> etree._Element:
+    element = etree.Element(tag, **attributes)
+    if text is not None:
+        element.text = text
+    return element
+
+
+def _sub_element(parent: etree._Element, tag: str, text: Optional[str] = None, /, **attributes: str) -> etree._Element:
+    element = etree.SubElement(parent, tag, **attributes)
+    if text is not None:
+        element.text = text
+    return element
+
+
+def _make_holding_record(library: str, location: str, callnumber: str = '') -> etree._Element:
+    record = etree.Element('record')
+    _sub_element(record, 'leader', '00000nx  a2200000un 4500')
+    _sub_element(record, 'controlfield', '', tag='001')
+    field852 = _sub_element(record, 'datafield', tag='852', ind1='4', ind2=' ')
+    _sub_element(field852, 'subfield', library, code='b')
+    _sub_element(field852, 'subfield', location, code='c')
+    if callnumber:
+        _sub_element(field852, 'subfield', callnumber, code='h')
+    return record
+
+
+def _get_subfield(record: etree._Element, tag: str, code: str) -> str:
+    return record.findtext(f'.//datafield[@tag="{tag}"]/subfield[@code="{code}"]') or ''
+
+
+def _set_controlfield_001(record: etree._Element, record_id: str) -> None:
+    field001 = record.find('controlfield[@tag="001"]')
+    if field001 is None:
+        field001 = _make_element('controlfield', tag='001')
+        record.insert(1 if record.find('leader') is not None else 0, field001)
+    field001.text = record_id
+
+
+def _today() -> str:
+    return date.today().strftime('%Y-%m-%dZ')
+
+
+def _parse_xml(body: bytes) -> etree._Element:
+    try:
+        return etree.fromstring(body, parser=etree.XMLParser(remove_blank_text=True))
+    except (etree.XMLSyntaxError, ValueError):
+        raise MockAlmaError('Invalid XML in the request body.', code='402209')
+
+
+def _parse_json(body: bytes) -> dict:
+    try:
+        return json.loads(body)
+    except (json.JSONDecodeError, TypeError, ValueError):
+        raise MockAlmaError('Invalid JSON in the request body.', code='402209')
+
+
+def _format_body(body: ResponseBody) -> Tuple[Dict[str, str], bytes]:
+    if body is None:
+        return {}, b''
+    if isinstance(body, dict):
+        return {'Content-Type': 'application/json;charset=UTF-8'}, json.dumps(body).encode()
+    return ({'Content-Type': 'application/xml;charset=UTF-8'},
+            etree.tostring(body, xml_declaration=True, encoding='UTF-8', standalone=True))
+
+
+def _format_error(err: MockAlmaError, json_format: bool) -> Tuple[Dict[str, str], bytes]:
+    if json_format:
+        return _format_body({'errorsExist': True,
+                             'errorList': {'error': [{'errorCode': err.code,
+                                                      'errorMessage': err.message,
+                                                      'trackingId': 'mock'}]},
+                             'result': None})
+
+    result = etree.Element(f'{{{ERROR_NAMESPACE}}}web_service_result', nsmap={None: ERROR_NAMESPACE})
+    _sub_element(result, f'{{{ERROR_NAMESPACE}}}errorsExist', 'true')
+    error = _sub_element(_sub_element(result, f'{{{ERROR_NAMESPACE}}}errorList'), f'{{{ERROR_NAMESPACE}}}error')
+    _sub_element(error, f'{{{ERROR_NAMESPACE}}}errorCode', err.code)
+    _sub_element(error, f'{{{ERROR_NAMESPACE}}}errorMessage', err.message)
+    _sub_element(error, f'{{{ERROR_NAMESPACE}}}trackingId', 'mock')
+    return _format_body(result)
@@ -0,0 +1,391 @@
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from utils import xlstools
+from utils.processmonitoring import ProcessMonitor
+
+# Mean latencies measured during the previous runs, by endpoint
+LATENCY_FILE = 'data/api_latencies.json'
+
+# Maximum weight of the previous runs in the mean latencies, the recent runs have more weight
+LATENCY_HISTORY = 1000
+
+# Latencies in seconds used before a first measure, by HTTP method
+DEFAULT_LATENCIES = {'get': 0.3, 'put': 0.8, 'post': 0.8, 'delete': 0.5}
+
+# API calls of each operation: (IZ, HTTP method, record type, number of calls). The IZ
+# is 's' for the source IZ and 'd' for the destination IZ, the record type is the first
+# segment of the URL, see `recordcache.get_record_key`. Holdings and items are 'bibs'.
+# The actual calls of a run are counted by `apistats`.
+OPERATIONS: Dict[str, Tuple[str, List[Tuple[str, str, str, int]]]] = {
+    'source_item': ('source items to fetch with their barcode',
+                    [('s', 'get', 'items', 1)]),
+    'bib': ('bibs to copy',
+            [('s', 'get', 'bibs', 1), ('d', 'get', 'bibs', 1), ('d', 'post', 'bibs', 1)]),
+    'holding': ('holdings to create',
+                [('s', 'get', 'bibs', 1), ('d', 'get', 'bibs', 2), ('d', 'post', 'bibs', 1)]),
+    'item': ('items to create',
+             [('s', 'get', 'bibs', 1), ('d', 'post', 'bibs', 1)]),
+    'pol_item': ('items of one-time PoLines to update',
+                 [('s', 'get', 'bibs', 1), ('d', 'get', 'bibs', 1), ('d', 'put', 'bibs', 1)]),
+    'rename': ('source barcodes to rename',
+               [('s', 'put', 'bibs', 1)]),
+    'poline': ('PoLines to copy',
+               [('s', 'get', 'acq/po-lines', 1), ('d', 'post', 'acq/po-lines', 1)]),
+    'reception': ('items to receive',
+                  [('s', 'get', 'bibs', 1), ('d', 'get', 'bibs', 1), ('d', 'get', 'acq/po-lines', 1),
+                   ('d', 'post', 'acq/po-lines', 1)]),
+    'collection': ('collections to complete',
+                   [('s', 'get', 'bibs', 1), ('d', 'get', 'bibs', 1)]),
+    'loan': ('loans to create',
+             [('d', 'get', 'items', 1), ('d', 'post', 'users', 1)]),
+    'return': ('returns to make',
+               [('s', 'get', 'items', 1), ('s', 'post', 'bibs', 1)]),
+    'request': ('requests to create',
+                [('s', 'get', 'bibs', 1), ('d', 'get', 'bibs', 1), ('d', 'post', 'users', 1)]),
+    'request_cancel': ('source requests to cancel',
+                       [('s', 'get', 'users', 1), ('s', 'delete', 'users', 1)]),
+}
+
+
+def get_endpoint(method: str, record_type: str) -> str:
+    """
+    Returns the label of an endpoint, 'GET bibs' for example
+    """
+    return f'{method.upper()} {record_type}'
+
+
+def get_pending_rows(process_monitor: ProcessMonitor) -> pd.DataFrame:
+    """
+    Returns the rows of the process monitor not yet copied
+    """
+    df = process_monitor.df
+    return df.loc[df['Copied'] != True]
+
+
+def count_distinct(process_monitor: ProcessMonitor, pending: pd.DataFrame, column: str, method: str) -> int:
+    """
+    Counts the distinct source IDs of a column without corresponding destination record
+
+    Parameters
+    ----------
+    process_monitor : ProcessMonitor
+        The process monitor
+    pending : pd.DataFrame
+        Rows not yet copied
+    column : str
+        Column of the source IDs, 'MMS_id_s' for example
+    method : str
+        Method of the process monitor returning the destination ID, 'get_corresponding_mms_id' for example
+
+    Returns
+    -------
+    int
+        Number of destination records to create
+    """
+    corresponding = getattr(process_monitor, method)
+    return sum(1 for value in pending[column].dropna().unique() if corresponding(value) is None)
+
+
+def count_stage_missing(process_monitor: ProcessMonitor, rows: pd.Index, stage: str) -> int:
+    """
+    Counts the rows that have not reached a stage
+    """
+    return sum(1 for i in rows if not process_monitor.stage_reached(i, stage))
+
+
+def count_items_work(process_monitor: ProcessMonitor) -> Dict[str, int]:
+    """
+    Counts the work remaining for the items
+
+    Rows whose source item is not yet fetched count for one bib and one holding,
+    the work is then an upper bound.
+    """
+    pending = get_pending_rows(process_monitor)
+    nb_unknown = int(pending['MMS_id_s'].isnull().sum())
+
+    return {'source_item': nb_unknown,
+            'bib': count_distinct(process_monitor, pending, 'MMS_id_s', 'get_corresponding_mms_id') + nb_unknown,
+            'holding': count_distinct(process_monitor, pending, 'Holding_id_s',
+                                      'get_corresponding_holding_id') + nb_unknown,
+            'item': count_stage_missing(process_monitor, pending.index, 'item_created'),
+            'rename': count_stage_missing(process_monitor, pending.index, 'source_renamed')}
+
+
+def count_polines_work(process_monitor: ProcessMonitor) -> Dict[str, int]:
+    """
+    Counts the work remaining for the PoLines
+
+    The purchase type and the reception state are known once the PoLine is copied:
+    the items of the PoLines not yet copied count as items to create and not to receive.
+    """
+    config = xlstools.get_config()
+    pending = get_pending_rows(process_monitor)
+    pol_numbers = pending['PoLine_s'].dropna().unique()
+    with_item = pending.loc[pending['Item_id_s'].notnull()]
+    one_time = with_item['Purchase_type'].fillna('').str.endswith('_OT')
+
+    work = {'poline': sum(1 for pol_number in pol_numbers
+                          if process_monitor.get_corresponding_poline(pol_number)[0] is None),
+            'bib': count_distinct(process_monitor, pending, 'MMS_id_s', 'get_corresponding_mms_id'),
+            'holding': count_distinct(process_monitor, pending, 'Holding_id_s', 'get_corresponding_holding_id'),
+            'item': count_stage_missing(process_monitor, with_item.index[~one_time], 'item_created'),
+            'pol_item': count_stage_missing(process_monitor, with_item.index[one_time], 'item_created'),
+            'rename': count_stage_missing(process_monitor, with_item.index, 'source_renamed')}
+
+    if config['make_reception']:
+        received = with_item.index[with_item['Received'] == True]
+        work['reception'] = count_stage_missing(process_monitor, received, 'received')
+
+    return work
+
+
+def count_holdings_work(process_monitor: ProcessMonitor) -> Dict[str, int]:
+    """
+    Counts the work remaining for the holdings
+    """
+    pending = get_pending_rows(process_monitor)
+    return {'bib': count_distinct(process_monitor, pending, 'MMS_id_s', 'get_corresponding_mms_id'),
+            'holding': count_distinct(process_monitor, pending, 'Holding_id_s', 'get_corresponding_holding_id')}
+
+
+def count_bibs_work(process_monitor: ProcessMonitor) -> Dict[str, int]:
+    """
+    Counts the work remaining for the bibs
+    """
+    return {'bib': len(get_pending_rows(process_monitor))}
+
+
+def count_collections_work(process_monitor: ProcessMonitor) -> Dict[str, int]:
+    """
+    Counts the work remaining for the collections
+
+    The bibs of the collections are only known in Alma, they are not counted.
+    """
+    return {'collection': len(get_pending_rows(process_monitor))}
+
+
+def count_loans_work(process_monitor: ProcessMonitor) -> Dict[str, int]:
+    """
+    Counts the loans and returns remaining, with the conditions of `processes.loan`
+    """
+    config = xlstools.get_config()
+    pending = get_pending_rows(process_monitor)
+    work = {}
+
+    if config['make_loans']:
+        has_item_d = (pending['Barcode_d'].notnull() | pending['Barcode_s'].notnull()
+                      | (pending['Item_id_d'].notnull() & pending['Holding_id_d'].notnull()
+                         & pending['MMS_id_d'].notnull()))
+        work['loan'] = int(has_item_d.sum())
+
+    if config['make_returns']:
+        has_item_s = pending['Barcode_s'].notnull() != pending['Item_id_s'].notnull()
+        work['return'] = int(has_item_s.sum())
+
+    return work
+
+
+def count_requests_work(process_monitor: ProcessMonitor) -> Dict[str, int]:
+    """
+    Counts the requests remaining to create and to cancel
+    """
+    pending = get_pending_rows(process_monitor)
+    return {'request': int(pending['Request_id_d'].isnull().sum()),
+            'request_cancel': count_stage_missing(process_monitor, pending.index, 'source_cancelled')}
+
+
+# Functions counting the remaining work by process type
+WORK_COUNTERS: Dict[str, Callable[[ProcessMonitor], Dict[str, int]]] = {
+    'Items': count_items_work,
+    'PoLines': count_polines_work,
+    'Holdings': count_holdings_work,
+    'Bibs': count_bibs_work,
+    'Collections': count_collections_work,
+    'Loans': count_loans_work,
+    'Requests': count_requests_work,
+}
+
+
+def load_latencies(file_path: str = LATENCY_FILE) -> Dict[str, Dict[str, float]]:
+    """
+    Returns the latencies measured during the previous runs
+
+    Parameters
+    ----------
+    file_path : str, optional
+        Path of the latency file
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        Number of calls and mean latency in seconds by endpoint, empty if no run was measured
+    """
+    if not os.path.isfile(file_path):
+        return {}
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f'Latency file {file_path} not readable: {e}')
+        return {}
+
+
+def get_latency(endpoint: str, method: str, latencies: Dict[str, Dict[str, float]]) -> Tuple[float, bool]:
+    """
+    Returns the latency of an endpoint and True if it was measured
+    """
+    if endpoint in latencies:
+        return latencies[endpoint]['mean_s'], True
+    return DEFAULT_LATENCIES.get(method, DEFAULT_LATENCIES['get']), False
+
+
+def make_plan(process_monitor: ProcessMonitor,
+              workers: int = 1,
+              rates: Optional[Dict[str, float]] = None,
+              latencies: Optional[Dict[str, Dict[str, float]]] = None) -> dict:
+    """
+    Estimates the work, the API calls and the runtime of the remaining rows
+
+    Nothing is changed in Alma and no API call is made. The API calls are
+    estimated with :data:`OPERATIONS`, without the retries and the errors.
+
+    The runtime is the longest of the time of the calls shared among the workers
+    and the time imposed by the rate limit of each IZ.
+
+    Parameters
+    ----------
+    process_monitor : ProcessMonitor
+        The process monitor with the state of the rows
+    workers : int, optional
+        Number of rows processed concurrently
+    rates : Dict[str, float], optional
+        Calls per second by zone, 0 for no limit, see `ratelimit.get_rates`
+    latencies : Dict[str, Dict[str, float]], optional
+        Latencies by endpoint, default are the latencies of :func:`load_latencies`
+
+    Returns
+    -------
+    dict
+        Plan with the number of rows, the work by operation, the calls by zone and
+        endpoint and the estimated runtime in seconds
+    """
+    config = xlstools.get_config()
+    zones = {'s': config['iz_s'], 'd': config['iz_d']}
+    rates = rates or {}
+    if latencies is None:
+        latencies = load_latencies()
+
+    work = WORK_COUNTERS[process_monitor.process_type](process_monitor)
+
+    calls: Dict[str, Dict[str, int]] = {}
+    busy_time = 0.0
+    nb_measured = 0
+    nb_default = 0
+    for operation, nb in work.items():
+        for iz, method, record_type, nb_calls in OPERATIONS[operation][1]:
+            if nb == 0:
+                continue
+            endpoint = get_endpoint(method, record_type)
+            zone_calls = calls.setdefault(zones[iz], {})
+            zone_calls[endpoint] = zone_calls.get(endpoint, 0) + nb * nb_calls
+
+            latency, measured = get_latency(endpoint, method, latencies)
+            busy_time += nb * nb_calls * latency
+            if measured:
+                nb_measured += nb * nb_calls
+            else:
+                nb_default += nb * nb_calls
+
+    # With the same IZ on both sides, the zone has only one budget
+    rate_times = [sum(zone_calls.values()) / rates[zone]
+                  for zone, zone_calls in calls.items() if rates.get(zone, 0) > 0]
+
+    return {'process_type': process_monitor.process_type,
+            'nb_rows': len(process_monitor.df.index),
+            'nb_pending_rows': len(get_pending_rows(process_monitor)),
+            'work': work,
+            'calls': calls,
+            'nb_calls': sum(sum(zone_calls.values()) for zone_calls in calls.values()),
+            'nb_calls_default_latency': nb_default,
+            'workers': workers,
+            'runtime_s': round(max([busy_time / max(workers, 1)] + rate_times), 1)}
+
+
+def log_plan(process_monitor: ProcessMonitor,
+             workers: int = 1,
+             rates: Optional[Dict[str, float]] = None) -> dict:
+    """
+    Writes the plan of the remaining rows in the log, see :func:`make_plan`
+
+    Parameters
+    ----------
+    process_monitor : ProcessMonitor
+        The process monitor with the state of the rows
+    workers : int, optional
+        Number of rows processed concurrently
+    rates : Dict[str, float], optional
+        Calls per second by zone, 0 for no limit
+
+    Returns
+    -------
+    dict
+        The plan
+    """
+    latencies = load_latencies()
+    plan = make_plan(process_monitor, workers, rates, latencies)
+
+    logging.info(f"Plan {plan['process_type']}: {plan['nb_pending_rows']} rows to process "
+                 f"out of {plan['nb_rows']}, no change is made in Alma")
+    for operation, nb in plan['work'].items():
+        logging.info(f'Plan: {nb} {OPERATIONS[operation][0]}')
+
+    for zone, zone_calls in plan['calls'].items():
+        logging.info(f'Plan: {sum(zone_calls.values())} API calls to {zone}')
+        for endpoint, nb_calls in sorted(zone_calls.items()):
+            latency, measured = get_latency(endpoint, endpoint.split(' ')[0].lower(), latencies)
+            logging.info(f"Plan:   {endpoint}: {nb_calls} calls, {latency:.2f}s per call "
+                         f"({'measured' if measured else 'default'})")
+
+    runtime_s = plan['runtime_s']
+    logging.info(f"Plan: estimated runtime {int(runtime_s // 3600)}h {int(runtime_s % 3600 // 60):02d}min "
+                 f"{int(runtime_s % 60):02d}s with {workers} worker{'s' if workers > 1 else ''}")
+    if plan['nb_calls_default_latency'] > 0:
+        logging.info(f"Plan: {plan['nb_calls_default_latency']} calls estimated with default latencies, "
+                     f"the latencies are measured during the runs and stored in {LATENCY_FILE}")
+
+    return plan
+
+
+def save_latencies(measures: Dict[str, Tuple[int, float]], file_path: str = LATENCY_FILE) -> None:
+    """
+    Adds the latencies measured during a run to the latency file
+
+    The previous runs weigh at most :data:`LATENCY_HISTORY` calls by endpoint.
+
+    Parameters
+    ----------
+    measures : Dict[str, Tuple[int, float]]
+        Number of calls and total latency in seconds by endpoint, 'GET bibs' for example
+    file_path : str, optional
+        Path of the latency file
+    """
+    if len(measures) == 0:
+        return
+
+    latencies = load_latencies(file_path)
+    for endpoint, (nb_calls, total) in measures.items():
+        previous = latencies.get(endpoint, {'nb_calls': 0, 'mean_s': 0.0})
+        weight = min(previous['nb_calls'], LATENCY_HISTORY)
+        latencies[endpoint] = {'nb_calls': previous['nb_calls'] + nb_calls,
+                               'mean_s': round((previous['mean_s'] * weight + total) / (weight + nb_calls), 4)}
+
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    tmp_file_path = f'{file_path}.tmp'
+    with open(tmp_file_path, 'w') as f:
+        json.dump(latencies, f, indent=2, sort_keys=True)
+    os.replace(tmp_file_path, file_path)
@@ -40,7 +40,7 @@ def copy_poline(i: int) -> Optional[POLine]:
     # Check if the source PoLine was fetched successfully
     if pol_s.error:
         logging.error(f"{repr(pol_s)}: {pol_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'POLine not found'
+        process_monitor.set_value(i, 'Error', 'POLine not found')
         process_monitor.save()
         return None
 
@@ -48,7 +48,7 @@ def copy_poline(i: int) -> Optional[POLine]:
     if pol_s.data['resource_metadata']['mms_id']['value'] != mms_id_s:
         logging.error(f"{repr(pol_number_s)}: {pol_s.data['resource_metadata']['mms_id']['value']}"
                       f"does not match the expected provided MMS ID {mms_id_s}")
-        process_monitor.df.at[i, 'Error'] = 'MMS ID mismatch'
+        process_monitor.set_value(i, 'Error', 'MMS ID mismatch')
         process_monitor.save()
         return None
 
@@ -79,7 +79,7 @@ def copy_poline(i: int) -> Optional[POLine]:
         library_d, location_d = xlstools.get_corresponding_location(library_s, location_s)
         if library_d is None or location_d is None:
             logging.error(f"{repr(pol_s)}: Location not found in mapping for library {library_s} and location {location_s}.")
-            process_monitor.df.at[i, 'Error'] = 'Mapping: location not found'
+            process_monitor.set_value(i, 'Error', 'Mapping: location not found')
             process_monitor.save()
             return None
 
@@ -103,7 +103,7 @@ def copy_poline(i: int) -> Optional[POLine]:
     library_d = xlstools.get_corresponding_library(pol_data['owner']['value'])
     if library_d is None:
         logging.error(f"{repr(pol_s)}: Library not found in mapping for library {pol_data['owner']['value']}.")
-        process_monitor.df.at[i, 'Error'] = 'Mapping: library not found'
+        process_monitor.set_value(i, 'Error', 'Mapping: library not found')
         process_monitor.save()
         return None
     pol_data['owner']['value'] = library_d
@@ -114,7 +114,7 @@ def copy_poline(i: int) -> Optional[POLine]:
 
         if fund_code_d is None:
             logging.error(f"{repr(pol_s)}: Fund code not found in mapping for fund {fund['fund_code']['value']}.")
-            process_monitor.df.at[i, 'Error'] = 'Mapping: fund code not found'
+            process_monitor.set_value(i, 'Error', 'Mapping: fund code not found')
             process_monitor.save()
             return None
 
@@ -129,7 +129,7 @@ def copy_poline(i: int) -> Optional[POLine]:
     if vendor_code_d is None or vendor_account_d is None:
         logging.error(f"{repr(pol_s)}: Vendor or vendor account not found in mapping for vendor {pol_data['vendor']['value']} "
                       f"and account {pol_data['vendor_account']}.")
-        process_monitor.df.at[i, 'Error'] = 'Mapping: vendor or vendor account not found'
+        process_monitor.set_value(i, 'Error', 'Mapping: vendor or vendor account not found')
         process_monitor.save()
         return None
     pol_data['vendor']['value'] = vendor_code_d
@@ -142,7 +142,7 @@ def copy_poline(i: int) -> Optional[POLine]:
     # Check interested users
     pol_data = handle_interested_users(pol_data)
     if pol_data is None:
-        process_monitor.df.at[i, 'Error'] = 'Interested user not found'
+        process_monitor.set_value(i, 'Error', 'Interested user not found')
         process_monitor.save()
         return None
 
@@ -154,10 +154,13 @@ def copy_poline(i: int) -> Optional[POLine]:
     # Check if the PoLine was created successfully
     if pol_d.error:
         logging.error(f"{repr(pol_d)}: {pol_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'POLine not created'
+        process_monitor.set_value(i, 'Error', 'POLine not created')
         process_monitor.save()
         return None
 
+    # Alma creates the holding of the PoLine, the holdings of the destination bib must be fetched again
+    holdings.invalidate_holdings_index(mms_id_d)
+
     # Update the process monitor with the new PoLine number
     process_monitor.set_corresponding_poline(pol_number_s, pol_d.pol_number, pol_purchase_type)
     process_monitor.save()
@@ -6,11 +6,18 @@ from almapiwrapper.acquisitions import POLine
 from almapiwrapper.inventory import IzBib, Holding, Item, Collection
 from almapiwrapper.users import User, Request
 
-from utils import polines, bibs, holdings, items, xlstools, loans, requests
+from utils import polines, bibs, holdings, items, xlstools, loans, requests, stagestats
+from utils.concurrency import KeyedLocks
 from utils.processmonitoring import ProcessMonitor
 
 config = xlstools.get_config()
 
+# Locks by source MMS ID, a bib lock also protects the holdings of the bib
+inventory_locks = KeyedLocks()
+
+# Locks by source PoLine number
+poline_locks = KeyedLocks()
+
 
 def poline(i: int) -> None:
     """
@@ -38,13 +45,17 @@ def poline(i: int) -> None:
     item_id_s = process_monitor.df.at[i, 'Item_id_s']
     item_id_d = process_monitor.get_corresponding_item_id(item_id_s)
 
-    pol_number_d, pol_purchase_type = process_monitor.get_corresponding_poline(pol_number_s)
-
     # -----------
     # Copy PoLine
     # ------------
-    if pol_number_d is None:
-        pol_d = polines.copy_poline(i)
+    # Rows of the same PoLine are serialized so that the PoLine is copied only once
+    # when rows run in parallel
+    with poline_locks.hold(pol_number_s):
+        pol_number_d, pol_purchase_type = process_monitor.get_corresponding_poline(pol_number_s)
+        if pol_number_d is None:
+            # The bib copied with the PoLine is counted in the 'bib_copy' stage
+            with stagestats.timed('poline_copy'):
+                pol_d = polines.copy_poline(i)
 
     # The corresponding MMS ID in the destination IZ should exist now
     mms_id_d = process_monitor.get_corresponding_mms_id(mms_id_s)
@@ -54,16 +65,19 @@ def poline(i: int) -> None:
     if mms_id_d is None or pol_number_d is None:
         return None
 
+    process_monitor.set_stage(i, 'poline_created')
+
     holding_id_d = process_monitor.get_corresponding_holding_id(holding_id_s)
 
     # If the destination holding ID is None, we need to copy the holding data
     if holding_id_d is None:
         # Copy data from the source holding to the destination IZ
-        holding_s = holdings.get_source_holding(i)
-        if holding_s is None:
-            # If the source holding could not be retrieved, we skip the row
-            return None
-        holding_d = holdings.copy_holding_data(i, holding_s)
+        with stagestats.timed('holding_copy'):
+            holding_s = holdings.get_source_holding(i)
+            if holding_s is None:
+                # If the source holding could not be retrieved, we skip the row
+                return None
+            holding_d = holdings.copy_holding_data(i, holding_s)
         holding_id_d = holding_d.get_holding_id() if holding_d else None
 
         if holding_id_d is None:
@@ -80,7 +94,7 @@ def poline(i: int) -> None:
         _ = holding_d.data
         if holding_d.error:
             logging.error(f"{repr(holding_d)}: {holding_d.error_msg}")
-            process_monitor.df.at[i, 'Error'] = 'Destination Holding not found'
+            process_monitor.set_value(i, 'Error', 'Destination Holding not found')
             process_monitor.save()
             return None
 
@@ -89,13 +103,13 @@ def poline(i: int) -> None:
     if holding_id_d is None:
         return None
 
+    process_monitor.set_stage(i, 'holding_ready')
+    process_monitor.save()
+
     if pd.isnull(item_id_s):
         # If the item ID is NaN, we skip the item processing
         logging.warning(f"Item ID is NaN for row {i}, skipping item processing.")
-        process_monitor.df.at[i, 'Copied'] = True
-        error_msg = process_monitor.df.at[i, 'Error']
-        if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-            process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+        process_monitor.mark_copied(i)
         process_monitor.save()
         return None
 
@@ -107,7 +121,13 @@ def poline(i: int) -> None:
     if pol_purchase_type.endswith('_CO'):
         # In case of continuous orders, we copy the item to the destination IZ
         # The PoLine is linked to the holding and the item don't exist in the destination IZ
-        items.copy_item_to_destination_iz(i, poline=True)
+        if process_monitor.stage_reached(i, 'item_created'):
+            # The destination item already exists, only the barcode of the source item must be updated
+            if items.rename_source_item(i) is not None:
+                process_monitor.mark_copied(i)
+                process_monitor.save()
+        else:
+            items.copy_item_to_destination_iz(i, poline=True)
 
     # ------------------------------
     # Update items of one time order
@@ -130,28 +150,74 @@ def poline(i: int) -> None:
                 _ = pol_d.data  # Ensure the PoLine data is loaded
             if pol_d.error:
                 logging.error(f"{repr(pol_d)}: {pol_d.error_msg}")
-                process_monitor.df.at[i, 'Error'] = 'Destination PoLine not found'
+                process_monitor.set_value(i, 'Error', 'Destination PoLine not found')
                 process_monitor.save()
                 return None
 
-            item_d = items.handle_one_time_pol_items(i, holding_s, holding_d)
+            # Includes the wait for the items created by Alma
+            with stagestats.timed('pol_item_update'):
+                item_d = items.handle_one_time_pol_items(i, holding_s, holding_d)
             if item_d is None or item_d.error:
                 return None
 
+        elif process_monitor.stage_reached(i, 'item_created') and not process_monitor.stage_reached(i, 'source_renamed'):
+            # The destination item is already updated, only the barcode of the source item must be updated
+            if items.rename_source_item(i) is None:
+                return None
+            if not process_monitor.df.at[i, 'Received']:
+                process_monitor.mark_copied(i)
+                process_monitor.save()
+
         if config['make_reception'] and process_monitor.df.at[i, 'Received']:
-            pol_d = items.make_reception(i)
+            with stagestats.timed('reception'):
+                pol_d = items.make_reception(i)
             if pol_d is None or pol_d.error:
                 return None
     else:
         # If the purchase type is not continuous or one-time, we skip the item processing
         logging.warning(f"Unknown purchase type '{pol_purchase_type}' for row {i}, skipping item processing.")
-        process_monitor.df.at[i, 'Error'] = 'Unknown purchase type'
+        process_monitor.set_value(i, 'Error', 'Unknown purchase type')
         process_monitor.save()
         return None
 
     return None
 
 
+def fetch_item_source_ids(i: int) -> bool:
+    """
+    Retrieves the source item with the barcode of the row and stores its IDs.
+
+    Nothing is fetched if the source IDs are already known, stage 'source_fetched'.
+
+    Parameters
+    ----------
+    i : int
+        The index of the row to process.
+
+    Returns
+    -------
+    bool
+        True if the MMS ID, holding ID and item ID of the source item are available.
+    """
+    process_monitor = ProcessMonitor()
+
+    if process_monitor.stage_reached(i, 'source_fetched'):
+        return True
+
+    with stagestats.timed('source_fetch'):
+        item_s = items.get_source_item_using_barcode(i)
+    if item_s is None:
+        return False
+
+    process_monitor.set_value(i, 'Item_id_s', item_s.get_item_id())
+    process_monitor.set_value(i, 'Holding_id_s', item_s.get_holding_id())
+    process_monitor.set_value(i, 'MMS_id_s', item_s.get_mms_id())
+    process_monitor.set_stage(i, 'source_fetched')
+    process_monitor.save()
+
+    return True
+
+
 def item(i: int) -> None:
     """
     Processes all items in the process monitor DataFrame.
@@ -173,58 +239,64 @@ def item(i: int) -> None:
     # ----------------------------------------
     # Retrieve the source item and its details
     # ----------------------------------------
-    item_s = items.get_source_item_using_barcode(i)
-    if item_s is None:
+    # The source IDs may have already been retrieved by a previous run or by the scheduler
+    if not fetch_item_source_ids(i):
         # If the source item could not be retrieved, we skip the row
         return None
 
-    item_id_s = item_s.get_item_id()
-    holding_id_s = item_s.get_holding_id()
-    iz_mms_id_s = item_s.get_mms_id()
-
-    process_monitor.df.at[i, 'Item_id_s'] = item_id_s
-    process_monitor.df.at[i, 'Holding_id_s'] = holding_id_s
-    process_monitor.df.at[i, 'MMS_id_s'] = iz_mms_id_s
-    process_monitor.save()
+    holding_id_s = process_monitor.df.at[i, 'Holding_id_s']
+    iz_mms_id_s = process_monitor.df.at[i, 'MMS_id_s']
 
-    # --------
-    # Copy bib
-    # --------
-    bib_d = None
-    mms_id_d = process_monitor.get_corresponding_mms_id(iz_mms_id_s)
-
-    # Case if we don't have a destination known MMS ID
-    if mms_id_d is None:
-        bib_d = bibs.copy_bib_from_nz_to_dest_iz(iz_mms_id_s)
-        mms_id_d = bib_d.get_mms_id() if bib_d else None
+    # Rows of the same source bib are serialized so that the bib and its holdings
+    # are created only once in the destination IZ when rows run in parallel
+    with inventory_locks.hold(iz_mms_id_s):
+        # --------
+        # Copy bib
+        # --------
+        bib_d = None
+        mms_id_d = process_monitor.get_corresponding_mms_id(iz_mms_id_s)
 
+        # Case if we don't have a destination known MMS ID
         if mms_id_d is None:
-            # If the destination bib could not be created, we skip the row
-            return None
+            bib_d = bibs.copy_bib_from_nz_to_dest_iz(iz_mms_id_s)
+            mms_id_d = bib_d.get_mms_id() if bib_d else None
 
-    process_monitor.set_corresponding_mms_id(iz_mms_id_s, mms_id_d)
-    process_monitor.save()
+            if mms_id_d is None:
+                # If the destination bib could not be created, we skip the row
+                return None
 
-    # ------------
-    # Copy holding
-    # ------------
-    holding_id_d = process_monitor.get_corresponding_holding_id(holding_id_s)
-    if holding_id_d is None:
-        # Copy the holding data from the source to the destination IZ
-        holding_d = holdings.copy_holding_to_destination_iz(i, bib_d)
-        holding_id_d = holding_d.get_holding_id() if holding_d else None
+        process_monitor.set_corresponding_mms_id(iz_mms_id_s, mms_id_d)
+        process_monitor.set_stage(i, 'bib_ready')
+        process_monitor.save()
 
+        # ------------
+        # Copy holding
+        # ------------
+        holding_id_d = process_monitor.get_corresponding_holding_id(holding_id_s)
         if holding_id_d is None:
-            # If the destination holding could not be created, we skip the row
-            return None
+            # Copy the holding data from the source to the destination IZ
+            with stagestats.timed('holding_copy'):
+                holding_d = holdings.copy_holding_to_destination_iz(i, bib_d)
+            holding_id_d = holding_d.get_holding_id() if holding_d else None
 
-    process_monitor.set_corresponding_holding_id(holding_id_s, holding_id_d)
-    process_monitor.save()
+            if holding_id_d is None:
+                # If the destination holding could not be created, we skip the row
+                return None
+
+        process_monitor.set_corresponding_holding_id(holding_id_s, holding_id_d)
+        process_monitor.set_stage(i, 'holding_ready')
+        process_monitor.save()
 
     # -------------
     # Copy the item
     # -------------
-    _ = items.copy_item_to_destination_iz(i)
+    if process_monitor.stage_reached(i, 'item_created'):
+        # The destination item already exists, only the barcode of the source item must be updated
+        if items.rename_source_item(i) is not None:
+            process_monitor.mark_copied(i)
+            process_monitor.save()
+    else:
+        _ = items.copy_item_to_destination_iz(i)
 
     return None
 
@@ -274,10 +346,7 @@ def holding(i: int) -> None:
             return None
 
     process_monitor.set_corresponding_holding_id(holding_id_s, holding_id_d)
-    process_monitor.df.at[i, 'Copied'] = True
-    error_msg = process_monitor.df.at[i, 'Error']
-    if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-        process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+    process_monitor.mark_copied(i)
     process_monitor.save()
 
     return None
@@ -314,10 +383,7 @@ def bib(i: int) -> None:
 
     # Mark the row as copied
     process_monitor.set_corresponding_mms_id(iz_mms_id_s, mms_id_d)
-    process_monitor.df.at[i, 'Copied'] = True
-    error_msg = process_monitor.df.at[i, 'Error']
-    if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-        process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+    process_monitor.mark_copied(i)
     process_monitor.save()
 
     return None
@@ -349,7 +415,7 @@ def collection(i: int) -> None:
 
     if col_s.error:
         logging.error(f"{repr(col_s)}: {col_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Source Collection not found'
+        process_monitor.set_value(i, 'Error', 'Source Collection not found')
         process_monitor.save()
         return None
 
@@ -360,7 +426,7 @@ def collection(i: int) -> None:
 
     if col_d.error:
         logging.error(f"{repr(col_d)}: {col_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Destination Collection not found'
+        process_monitor.set_value(i, 'Error', 'Destination Collection not found')
         process_monitor.save()
         return None
 
@@ -384,15 +450,12 @@ def collection(i: int) -> None:
 
     # Mark the row as copied
     if len(bibs_s) == len(mms_id_col_d):
-        process_monitor.df.at[i, 'Copied'] = True
-        error_msg = process_monitor.df.at[i, 'Error']
-        if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-            process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+        process_monitor.mark_copied(i)
         process_monitor.save()
         logging.info(f'{repr(col_s)}: collection completed with {len(mms_id_col_d)} bibs')
     else:
         logging.error(f'{repr(col_s)}: collection not completed, {len(mms_id_col_d)} bibs copied out of {len(bibs_s)}')
-        process_monitor.df.at[i, 'Error'] = 'Collection not completed'
+        process_monitor.set_value(i, 'Error', 'Collection not completed')
         process_monitor.save()
 
     return None
@@ -438,17 +501,17 @@ def loan(i: int) -> None:
         if loan_d is None or loan_d.error:
             if loan_d is not None:
                 logging.error(f"{repr(loan_d)}: {loan_d.error_msg}")
-            process_monitor.df.at[i, 'Error'] = 'Destination item not loaned'
+            process_monitor.set_value(i, 'Error', 'Destination item not loaned')
             process_monitor.save()
             return None
         else:
             # If the loan was successful, we update the DataFrame
             if pd.isnull(process_monitor.df.at[i, 'Barcode_d']):
-                process_monitor.df.at[i, 'Barcode_d'] = loan_d.data['item_barcode']
+                process_monitor.set_value(i, 'Barcode_d', loan_d.data['item_barcode'])
             if pd.isnull(process_monitor.df.at[i, 'Item_id_d']):
-                process_monitor.df.at[i, 'Item_id_d'] = loan_d.data['item_id']
-                process_monitor.df.at[i, 'Holding_id_d'] = loan_d.data['holding_id']
-                process_monitor.df.at[i, 'MMS_id_d'] = loan_d.data['mms_id']
+                process_monitor.set_value(i, 'Item_id_d', loan_d.data['item_id'])
+                process_monitor.set_value(i, 'Holding_id_d', loan_d.data['holding_id'])
+                process_monitor.set_value(i, 'MMS_id_d', loan_d.data['mms_id'])
             process_monitor.save()
 
     # -----------
@@ -469,24 +532,21 @@ def loan(i: int) -> None:
         if item_s is None or item_s.error:
             if item_s is not None:
                 logging.error(f"{repr(item_s)}: {item_s.error_msg}")
-            process_monitor.df.at[i, 'Error'] = 'Source item not returned'
+            process_monitor.set_value(i, 'Error', 'Source item not returned')
             process_monitor.save()
             return None
         else:
             # If the return was successful, we update the DataFrame
             if pd.isnull(process_monitor.df.at[i, 'Barcode_s']):
-                process_monitor.df.at[i, 'Barcode_s'] = item_s.barcode
+                process_monitor.set_value(i, 'Barcode_s', item_s.barcode)
             if pd.isnull(process_monitor.df.at[i, 'Item_id_s']):
-                process_monitor.df.at[i, 'Item_id_s'] = item_s.get_item_id()
-                process_monitor.df.at[i, 'Holding_id_s'] = item_s.get_holding_id()
-                process_monitor.df.at[i, 'MMS_id_s'] = item_s.get_mms_id()
+                process_monitor.set_value(i, 'Item_id_s', item_s.get_item_id())
+                process_monitor.set_value(i, 'Holding_id_s', item_s.get_holding_id())
+                process_monitor.set_value(i, 'MMS_id_s', item_s.get_mms_id())
             process_monitor.save()
 
     # If we reach this point, we have successfully processed the loan or return
-    process_monitor.df.at[i, 'Copied'] = True
-    error_msg = process_monitor.df.at[i, 'Error']
-    if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-        process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+    process_monitor.mark_copied(i)
     process_monitor.save()
 
     return None
@@ -519,7 +579,7 @@ def request(i: int) -> None:
 
     if request_s.error:
         logging.error(f"{repr(request_s)}: {request_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Source Request not found'
+        process_monitor.set_value(i, 'Error', 'Source Request not found')
         process_monitor.save()
         return None
 
@@ -534,11 +594,12 @@ def request(i: int) -> None:
                 logging.error(f"{repr(request_d)}: {request_d.error_msg}")
             else:
                 logging.error(f"Request with ID {request_id_s} could not be created.")
-            process_monitor.df.at[i, 'Error'] = 'Source Request not created'
+            process_monitor.set_value(i, 'Error', 'Source Request not created')
             process_monitor.save()
             return None
 
-        process_monitor.df.at[i, 'Request_id_d'] = request_d.request_id
+        process_monitor.set_value(i, 'Request_id_d', request_d.request_id)
+        process_monitor.set_stage(i, 'request_created')
         process_monitor.save()
 
     # ---------------------
@@ -550,15 +611,13 @@ def request(i: int) -> None:
 
         if request_s.error:
             logging.error(f"{repr(request_s)}: {request_s.error_msg}")
-            process_monitor.df.at[i, 'Error'] = 'Source Request not cancelled'
+            process_monitor.set_value(i, 'Error', 'Source Request not cancelled')
             process_monitor.save()
             return None
 
         # Mark the row as copied
-        process_monitor.df.at[i, 'Copied'] = True
-        error_msg = process_monitor.df.at[i, 'Error']
-        if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
-            process_monitor.df.at[i, 'Error'] += ' - SOLVED'
+        process_monitor.set_stage(i, 'source_cancelled')
+        process_monitor.mark_copied(i)
         process_monitor.save()
 
     return None
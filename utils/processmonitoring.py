@@ -1,11 +1,30 @@
+import atexit
+import json
 import logging
 import os
+import signal
+import sqlite3
 import sys
-from typing import List, Optional, Tuple
+import threading
+import time
+from bisect import insort
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
 
-from utils import xlstools
+from utils import profiler, xlstools
+
+# Ordered steps of the processing of a row. The 'Stage' column contains the last completed step,
+# so an interrupted row can be resumed without repeating the API calls already made.
+STAGES = {'Items': ['source_fetched', 'bib_ready', 'holding_ready', 'item_created', 'source_renamed'],
+          'PoLines': ['poline_created', 'holding_ready', 'item_created', 'source_renamed', 'received'],
+          'Requests': ['request_created', 'source_cancelled']}
+
+# Columns containing boolean values, the other columns contain strings
+BOOL_COLUMNS = ['Copied', 'Received']
+
+# Counters of the rows, integer columns: retries, API calls and their total duration in ms
+INT_COLUMNS = ['Retries', 'API_calls', 'API_ms']
 
 
 class ProcessMonitor:
@@ -36,14 +55,23 @@ class ProcessMonitor:
     """
     _instance = None
 
+    # Source ID columns indexed in memory with their corresponding destination column
+    indexed_columns = {'PoLine_s': 'PoLine_d',
+                       'MMS_id_s': 'MMS_id_d',
+                       'Holding_id_s': 'Holding_id_d',
+                       'Item_id_s': 'Item_id_d'}
+
     def __new__(cls, *args, **kwargs):
         """
         Ensures that only one instance of ProcessMonitor is created for a given Excel file and process type.
+
+        The instance is shared with the subclasses, `ProcessMonitor()` returns the instance
+        whatever the storage mode used to create it.
         """
-        if cls._instance is None:
-            cls._instance = super(ProcessMonitor, cls).__new__(cls)
+        if ProcessMonitor._instance is None:
+            ProcessMonitor._instance = super(ProcessMonitor, cls).__new__(cls)
 
-        return cls._instance
+        return ProcessMonitor._instance
 
     def __init__(self, excel_filepath: Optional[str] = None, process_type: Optional[str] = None) -> None:
         """
@@ -54,6 +82,7 @@ class ProcessMonitor:
             self.process_type = process_type
             self.file_path = self.get_file_path(excel_filepath)
             self.df = None
+            self.lock = threading.RLock()
 
             if self.check_existing_file():
                 self.load()
@@ -66,6 +95,7 @@ class ProcessMonitor:
                 sys.exit(1)
 
             self.df.index = range(1, len(self.df) + 1)  # Reset index to start from 1
+            self.build_indexes()
 
             self._initialized = True  # Mark the instance as initialized
 
@@ -96,23 +126,44 @@ class ProcessMonitor:
         """
         if self.process_type == 'PoLines':
             return ['PoLine_s', 'MMS_id_s', 'Holding_id_s', 'Item_id_s', 'PoLine_d', 'MMS_id_d', 'Holding_id_d',
-                    'Item_id_d', 'Purchase_type', 'Received', 'Copied', 'Error']
+                    'Item_id_d', 'Purchase_type', 'Received', 'Stage', 'Copied', 'Error', 'Retries', 'API_calls',
+                    'API_ms']
         elif self.process_type == 'Items':
-            return ['Barcode', 'MMS_id_s', 'Holding_id_s', 'Item_id_s', 'MMS_id_d', 'Holding_id_d', 'Item_id_d', 'Copied', 'Error']
+            return ['Barcode', 'MMS_id_s', 'Holding_id_s', 'Item_id_s', 'MMS_id_d', 'Holding_id_d', 'Item_id_d', 'Stage',
+                    'Copied', 'Error', 'Retries', 'API_calls', 'API_ms']
         elif self.process_type == 'Holdings':
-            return ['MMS_id_s', 'Holding_id_s', 'MMS_id_d', 'Holding_id_d', 'Copied', 'Error']
+            return ['MMS_id_s', 'Holding_id_s', 'MMS_id_d', 'Holding_id_d', 'Copied', 'Error', 'Retries', 'API_calls',
+                    'API_ms']
         elif self.process_type == 'Bibs':
-            return ['MMS_id_s', 'MMS_id_d', 'Copied', 'Error']
+            return ['MMS_id_s', 'MMS_id_d', 'Copied', 'Error', 'Retries', 'API_calls', 'API_ms']
         elif self.process_type == 'Collections':
-            return ['Collection_id_s', 'Collection_id_d', 'Copied', 'Error']
+            return ['Collection_id_s', 'Collection_id_d', 'Copied', 'Error', 'Retries', 'API_calls', 'API_ms']
         elif self.process_type == 'Loans':
-            return ['Primary_id', 'Barcode_s', 'MMS_id_s', 'Holding_id_s', 'Item_id_s', 'MMS_id_d', 'Holding_id_d', 'Item_id_d', 'Barcode_d', 'Error']
+            return ['Primary_id', 'Barcode_s', 'MMS_id_s', 'Holding_id_s', 'Item_id_s', 'MMS_id_d', 'Holding_id_d', 'Item_id_d', 'Barcode_d', 'Error', 'Retries', 'API_calls', 'API_ms']
         elif self.process_type == 'Requests':
-            return ['Primary_id', 'Request_id_s', 'Request_id_d', 'Copied', 'Error']
+            return ['Primary_id', 'Request_id_s', 'Request_id_d', 'Stage', 'Copied', 'Error', 'Retries', 'API_calls', 'API_ms']
         else:
             logging.critical(f'Unknown process type: {self.process_type}')
             sys.exit(1)
 
+    def get_report_path(self, name: str, extension: str = 'json') -> str:
+        """
+        Returns the path of a report of the run next to the process file.
+
+        Parameters
+        ----------
+        name : str
+            Name of the report, for example 'api_calls'.
+        extension : str, optional
+            Extension of the report file, default is 'json'.
+
+        Returns
+        -------
+        str
+            Path to the report, for example 'data/<form>_Items_api_calls.json'.
+        """
+        return f'data/{xlstools.get_raw_filename(self.excel_filepath)}_{self.process_type}_{name}.{extension}'
+
     def check_existing_file(self) -> bool:
         """
         Checks if the process file already exists.
@@ -139,7 +190,7 @@ class ProcessMonitor:
         Loads the existing process file into a DataFrame.
         """
         columns = self.get_columns()
-        dtype_dict = {column: 'boolean' if column in ['Copied', 'Received'] else 'str' for column in columns}
+        dtype_dict = {column: get_dtype(column) for column in columns}
 
         try:
             self.df = pd.read_csv(self.file_path, dtype=dtype_dict)
@@ -153,28 +204,237 @@ class ProcessMonitor:
             logging.critical(f"Data type error (dtype): {self.file_path}: {e}")
             sys.exit(1)
 
+        self.add_missing_columns()
+
+    def add_missing_columns(self) -> None:
+        """
+        Adds the columns missing in a process file created by a previous version of the tool.
+        """
+        columns = self.get_columns()
+        missing_columns = [column for column in columns if column not in self.df.columns]
+        if len(missing_columns) == 0:
+            return
+
+        for column in missing_columns:
+            self.df[column] = pd.Series(pd.NA, index=self.df.index, dtype=get_dtype(column))
+        self.df = self.df[columns + [column for column in self.df.columns if column not in columns]]
+
     def save(self) -> None:
         """
         Saves the current DataFrame to the process file.
         """
-        self.df.to_csv(self.file_path, index=False)
+        with profiler.span('pm.save', profiler.CATEGORY_SAVE), self.lock:
+            self.write_csv()
+
+    def write_csv(self, df: Optional[pd.DataFrame] = None) -> None:
+        """
+        Writes the whole DataFrame to the process file.
+
+        The data is written to a temporary file renamed afterwards, so the process file is
+        never left truncated when the process is killed during the write.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame, optional
+            DataFrame to write, default is the current DataFrame of the monitor.
+        """
+        if df is None:
+            df = self.df
+        tmp_file_path = f'{self.file_path}.tmp'
+        with profiler.span('pm.write_csv', profiler.CATEGORY_SAVE, nb_rows=len(df)):
+            df.to_csv(tmp_file_path, index=False)
+            os.replace(tmp_file_path, self.file_path)
 
     def load_data_from_excel(self) -> None:
         """
         Loads data from the specified Excel file into the DataFrame for processing.
 
         This method reads the Excel file at the path specified by `self.excel_filepath`,
-        using the sheet named after the current process type.
+        using the sheet named after the current process type. The form is parsed only once,
+        see :func:`xlstools.load_form`.
         It aligns the columns of the loaded data with those expected for the process type,
         appends the data to the existing DataFrame, and initializes the 'Copied' column to False for all rows.
 
         No parameters are required.
         """
-        data = pd.read_excel(self.excel_filepath, sheet_name=self.process_type, dtype=str)
+        data = xlstools.get_data(self.excel_filepath, self.process_type)
         data.columns = self.get_columns()[:len(data.columns)]
         self.df = pd.concat([self.df, data], ignore_index=True)
         self.df['Copied'] = False
 
+    def build_indexes(self) -> None:
+        """
+        Builds the in-memory indexes of the source ID columns.
+
+        Each index maps a source ID to the sorted list of the rows containing it. The
+        indexes avoid scanning the whole DataFrame for each lookup. They are kept in sync
+        by :meth:`set_value`, so all changes of the source ID columns must use it.
+        """
+        self._indexes: Dict[str, Dict[str, List[int]]] = {}
+        for column in self.indexed_columns:
+            if column not in self.df.columns:
+                continue
+            index = {}
+            for i, value in self.df[column].items():
+                if pd.notnull(value):
+                    index.setdefault(value, []).append(i)
+            self._indexes[column] = index
+
+    def get_rows(self, column: str, value: str) -> List[int]:
+        """
+        Returns the indexes of the rows containing the given value in the given column.
+
+        Parameters
+        ----------
+        column : str
+            Name of the column to search in.
+        value : str
+            The value to search for.
+
+        Returns
+        -------
+        List[int]
+            Indexes of the matching rows, in the order of the DataFrame.
+        """
+        with self.lock:
+            if column in self._indexes:
+                return list(self._indexes[column].get(value, []))
+
+            return list(self.df.index[self.df[column] == value])
+
+    def set_value(self, i: int, column: str, value: Any) -> None:
+        """
+        Sets the value of a cell of the DataFrame and updates the indexes.
+
+        Parameters
+        ----------
+        i : int
+            The index of the row to update.
+        column : str
+            Name of the column to update.
+        value : Any
+            The new value of the cell.
+        """
+        with self.lock:
+            if column in self._indexes:
+                index = self._indexes[column]
+                old_value = self.df.at[i, column]
+                if pd.notnull(old_value) and i in index.get(old_value, []):
+                    index[old_value].remove(i)
+                    if len(index[old_value]) == 0:
+                        del index[old_value]
+                if pd.notnull(value):
+                    insort(index.setdefault(value, []), i)
+
+            self.df.at[i, column] = value
+            self.record_change(i, column, value)
+
+    def record_change(self, i: int, column: str, value: Any) -> None:
+        """
+        Hook called after each change of a cell with :meth:`set_value`.
+
+        The CSV storage saves the whole DataFrame, so nothing is recorded here. Storage
+        modes persisting the changes one by one override this method.
+
+        Parameters
+        ----------
+        i : int
+            The index of the updated row.
+        column : str
+            Name of the updated column.
+        value : Any
+            The new value of the cell.
+        """
+        pass
+
+    def mark_copied(self, i: int) -> None:
+        """
+        Marks the row as copied and flags the previous error of the row as solved.
+
+        Parameters
+        ----------
+        i : int
+            The index of the row to update.
+        """
+        self.set_value(i, 'Copied', True)
+        error_msg = self.df.at[i, 'Error']
+        if pd.notnull(error_msg) and len(error_msg) > 0 and ' - SOLVED' not in error_msg:
+            self.set_value(i, 'Error', error_msg + ' - SOLVED')
+
+    def increment(self, i: int, column: str, value: int = 1) -> None:
+        """
+        Adds a value to a counter column of the row, see `INT_COLUMNS`.
+
+        Parameters
+        ----------
+        i : int
+            The index of the row to update.
+        column : str
+            Name of the counter column, for example 'Retries'.
+        value : int, optional
+            Value to add, default is 1.
+        """
+        with self.lock:
+            current = self.df.at[i, column]
+            self.set_value(i, column, (0 if pd.isnull(current) else int(current)) + value)
+
+    def set_value_by_id(self, id_column: str, id_value: str, column: str, value: Any) -> None:
+        """
+        Sets the value of a column for all rows containing the given ID.
+
+        Parameters
+        ----------
+        id_column : str
+            Name of the ID column used to select the rows, for example 'MMS_id_s'.
+        id_value : str
+            The ID to match.
+        column : str
+            Name of the column to update.
+        value : Any
+            The new value of the cells.
+        """
+        for row in self.get_rows(id_column, id_value):
+            self.set_value(row, column, value)
+
+    def set_stage(self, i: int, stage: str) -> None:
+        """
+        Records that a step of the processing of the row is completed.
+
+        The stage is only updated if the new step is after the current one.
+
+        Parameters
+        ----------
+        i : int
+            The index of the row to update.
+        stage : str
+            The completed step, one of the values of `STAGES` for the process type.
+        """
+        if not self.stage_reached(i, stage):
+            self.set_value(i, 'Stage', stage)
+
+    def stage_reached(self, i: int, stage: str) -> bool:
+        """
+        Checks if a step of the processing of the row is already completed.
+
+        Parameters
+        ----------
+        i : int
+            The index of the row to check.
+        stage : str
+            The step to check, one of the values of `STAGES` for the process type.
+
+        Returns
+        -------
+        bool
+            True if the step or a later one is completed, False otherwise.
+        """
+        stages = STAGES.get(self.process_type, [])
+        current_stage = self.df.at[i, 'Stage'] if 'Stage' in self.df.columns else None
+        if pd.isnull(current_stage) or current_stage not in stages:
+            return False
+
+        return stages.index(current_stage) >= stages.index(stage)
+
     def get_corresponding_poline(self, pol_number: str) -> Tuple[Optional[str], Optional[str]]:
         """
         Returns the destination PoLine number and purchase type for the given source PoLine number.
@@ -193,10 +453,10 @@ class ProcessMonitor:
             logging.critical(f'Process type {self.process_type} does not support getting PoLine data.')
             sys.exit(1)
 
-        result = self.df.loc[self.df['PoLine_s'] == pol_number, ['PoLine_d', 'Purchase_type']]
-        if len(result) > 0:
-            poline_d = result['PoLine_d'].values[0]
-            purchase_type = result['Purchase_type'].values[0]
+        rows = self.get_rows('PoLine_s', pol_number)
+        if len(rows) > 0:
+            poline_d = self.df.at[rows[0], 'PoLine_d']
+            purchase_type = self.df.at[rows[0], 'Purchase_type']
             if pd.isnull(poline_d):
                 return None, None
             return poline_d, purchase_type
@@ -217,8 +477,8 @@ class ProcessMonitor:
         Optional[str]
             The corresponding MMS ID if found, otherwise None.
         """
-        result = self.df.loc[self.df['MMS_id_s'] == mms_id, 'MMS_id_d']
-        value = result.values[0] if len(result) > 0 else None
+        rows = self.get_rows('MMS_id_s', mms_id)
+        value = self.df.at[rows[0], 'MMS_id_d'] if len(rows) > 0 else None
         return None if pd.isnull(value) else value
 
     def get_corresponding_holding_id(self, holding_id: str) -> Optional[str]:
@@ -236,8 +496,8 @@ class ProcessMonitor:
             The corresponding Holding ID if found, otherwise None.
         """
 
-        result = self.df.loc[self.df['Holding_id_s'] == holding_id, 'Holding_id_d']
-        value = result.values[0] if len(result) > 0 else None
+        rows = self.get_rows('Holding_id_s', holding_id)
+        value = self.df.at[rows[0], 'Holding_id_d'] if len(rows) > 0 else None
         return None if pd.isnull(value) else value
 
     def get_corresponding_item_id(self, item_id: str) -> Optional[str]:
@@ -255,8 +515,8 @@ class ProcessMonitor:
             The corresponding Item ID if found, otherwise None.
         """
 
-        result = self.df.loc[self.df['Item_id_s'] == item_id, 'Item_id_d']
-        value = result.values[0] if len(result) > 0 else None
+        rows = self.get_rows('Item_id_s', item_id)
+        value = self.df.at[rows[0], 'Item_id_d'] if len(rows) > 0 else None
         return None if pd.isnull(value) else value
 
     def set_corresponding_poline(self, pol_number: str, poline_d: str, purchase_type: str) -> None:
@@ -276,8 +536,9 @@ class ProcessMonitor:
             logging.critical(f'Process type {self.process_type} does not support setting PoLine data.')
             sys.exit(1)
 
-        self.df.loc[self.df['PoLine_s'] == pol_number, 'PoLine_d'] = poline_d
-        self.df.loc[self.df['PoLine_s'] == pol_number, 'Purchase_type'] = purchase_type
+        for row in self.get_rows('PoLine_s', pol_number):
+            self.set_value(row, 'PoLine_d', poline_d)
+            self.set_value(row, 'Purchase_type', purchase_type)
 
     def set_corresponding_mms_id(self, mms_id_s: str, mms_id_d: str) -> None:
         """
@@ -290,7 +551,8 @@ class ProcessMonitor:
         mms_id_d : str
             The destination MMS ID to set.
         """
-        self.df.loc[self.df['MMS_id_s'] == mms_id_s, 'MMS_id_d'] = mms_id_d
+        for row in self.get_rows('MMS_id_s', mms_id_s):
+            self.set_value(row, 'MMS_id_d', mms_id_d)
 
     def set_corresponding_holding_id(self, holding_id_s: str, holding_id_d: str) -> None:
         """
@@ -303,7 +565,8 @@ class ProcessMonitor:
         holding_id_d : str
             The destination Holding ID to set.
         """
-        self.df.loc[self.df['Holding_id_s'] == holding_id_s, 'Holding_id_d'] = holding_id_d
+        for row in self.get_rows('Holding_id_s', holding_id_s):
+            self.set_value(row, 'Holding_id_d', holding_id_d)
 
     def set_corresponding_item_id(self, item_id_s: str, item_id_d: str) -> None:
         """
@@ -316,7 +579,18 @@ class ProcessMonitor:
         item_id_d : str
             The destination Item ID to set.
         """
-        self.df.loc[self.df['Item_id_s'] == item_id_s, 'Item_id_d'] = item_id_d
+        for row in self.get_rows('Item_id_s', item_id_s):
+            self.set_value(row, 'Item_id_d', item_id_d)
+
+    @classmethod
+    def get_instance(cls) -> Optional['ProcessMonitor']:
+        """
+        Returns the process monitor of the process, None if not yet created.
+
+        Unlike `ProcessMonitor()`, it doesn't create the process monitor.
+        """
+        instance = ProcessMonitor._instance
+        return instance if instance is not None and hasattr(instance, '_initialized') else None
 
     @classmethod
     def reset(cls):
@@ -325,5 +599,604 @@ class ProcessMonitor:
 
         This method is useful for testing purposes to ensure a fresh instance is created.
         """
-        cls._instance = None
+        ProcessMonitor._instance = None
         logging.info("ProcessMonitor instance reset.")
+
+
+class JournaledProcessMonitor(ProcessMonitor):
+    """
+    Process monitor persisting the changes in an append-only journal.
+
+    Each cell change made with :meth:`set_value` is appended as a small JSON record to
+    `data/<form>_<type>_processing.journal` when :meth:`save` is called. The CSV file is
+    only rewritten when the journal reaches `compact_every` records and when the process
+    exits. When an existing process file is loaded, the journal is replayed over the CSV
+    file, so a run can be resumed after a crash like with the CSV storage.
+
+    Attributes
+    ----------
+    compact_every : int
+        Number of journal records triggering a rewrite of the CSV file.
+    """
+    compact_every = 10000
+
+    def __init__(self, excel_filepath: Optional[str] = None, process_type: Optional[str] = None) -> None:
+        """
+        Initializes the journaled ProcessMonitor and registers the final compaction.
+        """
+        if not hasattr(self, '_initialized'):
+            self._pending_changes = []
+            self._journal_size = 0
+            super().__init__(excel_filepath, process_type)
+            atexit.register(self.close)
+
+    @property
+    def journal_path(self) -> str:
+        """
+        Path to the journal file, next to the process file.
+        """
+        return f'{os.path.splitext(self.file_path)[0]}.journal'
+
+    def create(self) -> None:
+        """
+        Creates a new process file and an empty journal.
+        """
+        super().create()
+        self.compact()
+
+    def load(self) -> None:
+        """
+        Loads the existing process file and replays the journal over it.
+        """
+        super().load()
+        self.df.index = range(1, len(self.df) + 1)
+        self.replay_journal()
+        self.compact()
+
+    def replay_journal(self) -> None:
+        """
+        Applies the records of the journal to the DataFrame.
+
+        A truncated last record, written when the process was killed, is ignored.
+        """
+        if not os.path.isfile(self.journal_path):
+            return
+
+        nb_records = 0
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f'Invalid record ignored in journal {self.journal_path}: {line.strip()}')
+                    continue
+                self.df.at[record['i'], record['c']] = record['v']
+                nb_records += 1
+
+        logging.info(f'{nb_records} changes replayed from journal {self.journal_path}')
+
+    def record_change(self, i: int, column: str, value: Any) -> None:
+        """
+        Keeps the change in memory until the next call of :meth:`save`.
+
+        Parameters
+        ----------
+        i : int
+            The index of the updated row.
+        column : str
+            Name of the updated column.
+        value : Any
+            The new value of the cell.
+        """
+        self._pending_changes.append({'i': int(i), 'c': column, 'v': to_python_value(value)})
+
+    def save(self) -> None:
+        """
+        Appends the pending changes to the journal and compacts it if required.
+        """
+        with profiler.span('pm.save', profiler.CATEGORY_SAVE), self.lock:
+            if len(self._pending_changes) > 0:
+                with open(self.journal_path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(json.dumps(record) + '\n' for record in self._pending_changes))
+                self._journal_size += len(self._pending_changes)
+                self._pending_changes = []
+
+            if self._journal_size >= self.compact_every:
+                self.compact()
+
+    def compact(self) -> None:
+        """
+        Rewrites the CSV file with the current state and empties the journal.
+        """
+        with self.lock:
+            self.write_csv()
+            open(self.journal_path, 'w').close()
+            self._journal_size = 0
+
+    def close(self) -> None:
+        """
+        Saves the pending changes and compacts the journal. Called at the end of the process.
+        """
+        if self.df is None:
+            return
+        self.save()
+        self.compact()
+
+
+class SqliteProcessMonitor(ProcessMonitor):
+    """
+    Process monitor storing the processing state in a SQLite database.
+
+    The table `processing` of `data/<form>_<type>_processing.db` has the columns of the
+    DataFrame and a `row_id` primary key corresponding to the index of the
+    DataFrame. The source ID columns (`*_s`) are indexed. Each call of :meth:`save` writes
+    the changes made since the previous call in one transaction.
+
+    The database uses the WAL mode, so the progress can be queried with SQL while a run
+    is going. The CSV file is still exported at the end of the process.
+    """
+    table_name = 'processing'
+
+    def __init__(self, excel_filepath: Optional[str] = None, process_type: Optional[str] = None) -> None:
+        """
+        Initializes the SQLite ProcessMonitor and registers the final CSV export.
+        """
+        if not hasattr(self, '_initialized'):
+            self._pending_changes = []
+            self.conn = None
+            super().__init__(excel_filepath, process_type)
+            atexit.register(self.close)
+
+    @property
+    def db_path(self) -> str:
+        """
+        Path to the SQLite database, next to the process file.
+        """
+        return f'{os.path.splitext(self.file_path)[0]}.db'
+
+    def check_existing_file(self) -> bool:
+        """
+        Checks if the database or a CSV process file from a previous run already exists.
+
+        Returns
+        -------
+        bool
+            True if the database or the CSV file exists, False otherwise.
+        """
+        return os.path.isfile(self.db_path) or os.path.isfile(self.file_path)
+
+    def connect(self) -> None:
+        """
+        Opens the connection to the database.
+        """
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        # The connection is shared by the worker threads, the accesses are serialized by the lock
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+    def create(self) -> None:
+        """
+        Creates a new database with the data of the Excel file.
+        """
+        cols = self.get_columns()
+        self.df = pd.DataFrame(columns=cols)
+        self.load_data_from_excel()
+        self.df.index = range(1, len(self.df) + 1)
+        self.connect()
+        self.write_db()
+        self.write_csv()
+
+    def load(self) -> None:
+        """
+        Loads the existing database into a DataFrame.
+
+        If only the CSV file of a previous run exists, it is loaded and the database is
+        created from it.
+        """
+        db_exists = os.path.isfile(self.db_path)
+        self.connect()
+
+        if not db_exists:
+            super().load()
+            self.df.index = range(1, len(self.df) + 1)
+            self.write_db()
+            return
+
+        self.read_db()
+
+        # Add the columns missing in a database created by a previous version of the tool
+        with self.conn:
+            for column in self.get_columns():
+                if column not in self.df.columns:
+                    self.conn.execute(f'ALTER TABLE {self.table_name} ADD COLUMN "{column}" '
+                                      f'{get_sql_type(column)}')
+        self.add_missing_columns()
+
+    def read_db(self) -> None:
+        """
+        Reads the table of the database into the DataFrame.
+        """
+        try:
+            self.df = pd.read_sql_query(f'SELECT * FROM {self.table_name} ORDER BY row_id',
+                                        self.conn, index_col='row_id')
+        except (sqlite3.Error, pd.errors.DatabaseError) as e:
+            logging.critical(f"Database error: {self.db_path}: {e}")
+            sys.exit(1)
+
+        self.df.index.name = None
+        for column in BOOL_COLUMNS + INT_COLUMNS:
+            if column in self.df.columns:
+                self.df[column] = self.df[column].astype(get_dtype(column))
+
+    def write_db(self) -> None:
+        """
+        Creates the table and its indexes and inserts all the rows of the DataFrame.
+        """
+        columns = list(self.df.columns)
+        columns_def = ', '.join(f'"{column}" {get_sql_type(column)}' for column in columns)
+
+        with self.conn:
+            self.conn.execute(f'DROP TABLE IF EXISTS {self.table_name}')
+            self.conn.execute(f'CREATE TABLE {self.table_name} (row_id INTEGER PRIMARY KEY, {columns_def})')
+            for column in columns:
+                if column.endswith('_s'):
+                    self.conn.execute(f'CREATE INDEX idx_{column} ON {self.table_name} ("{column}")')
+
+            placeholders = ', '.join(['?'] * (len(columns) + 1))
+            self.conn.executemany(
+                f'INSERT INTO {self.table_name} VALUES ({placeholders})',
+                [[int(i)] + [to_python_value(row[column]) for column in columns] for i, row in self.df.iterrows()])
+
+    def record_change(self, i: int, column: str, value: Any) -> None:
+        """
+        Keeps the change in memory until the next call of :meth:`save`.
+
+        Parameters
+        ----------
+        i : int
+            The index of the updated row.
+        column : str
+            Name of the updated column.
+        value : Any
+            The new value of the cell.
+        """
+        self._pending_changes.append((to_python_value(value), int(i), column))
+
+    def save(self) -> None:
+        """
+        Writes the pending changes to the database in one transaction.
+        """
+        with profiler.span('pm.save', profiler.CATEGORY_SAVE), self.lock:
+            if len(self._pending_changes) == 0:
+                return
+
+            with self.conn:
+                for value, i, column in self._pending_changes:
+                    self.conn.execute(f'UPDATE {self.table_name} SET "{column}" = ? WHERE row_id = ?', (value, i))
+            self._pending_changes = []
+
+    def export_csv(self) -> None:
+        """
+        Exports the current state to the CSV process file.
+        """
+        with self.lock:
+            self.write_csv()
+
+    def close(self) -> None:
+        """
+        Saves the pending changes, exports the CSV file and closes the database.
+        """
+        if self.conn is None:
+            return
+        self.save()
+        self.export_csv()
+        self.conn.close()
+        self.conn = None
+
+
+class BufferedProcessMonitor(ProcessMonitor):
+    """
+    Process monitor writing the CSV file in a background thread.
+
+    :meth:`save` only marks the DataFrame as dirty. A background thread writes the CSV
+    file at most every `flush_interval` seconds, or earlier when `flush_changes` changes
+    are waiting. A final write is forced at the end of the process and when SIGINT or
+    SIGTERM is received.
+
+    Parameters
+    ----------
+    excel_filepath : str
+        Path to the Excel file containing the configuration data.
+    process_type : str
+        Type of process to monitor (e.g., 'PoLines', 'Items', 'Holdings').
+    flush_interval : float, optional
+        Maximum delay in seconds between a save and the write of the file. Default is 5.
+    flush_changes : int, optional
+        Number of changes triggering a write before the end of the delay. Default is 1000.
+    """
+
+    def __init__(self,
+                 excel_filepath: Optional[str] = None,
+                 process_type: Optional[str] = None,
+                 flush_interval: float = 5.0,
+                 flush_changes: int = 1000) -> None:
+        """
+        Initializes the buffered ProcessMonitor and starts the writer thread.
+        """
+        if not hasattr(self, '_initialized'):
+            self.flush_interval = flush_interval
+            self.flush_changes = flush_changes
+            self._dirty = False
+            self._nb_changes = 0
+            self._stopped = False
+            self._condition = threading.Condition()
+            self._write_lock = threading.Lock()
+            super().__init__(excel_filepath, process_type)
+
+            self._writer = threading.Thread(target=self._run_writer, name='ProcessMonitorWriter', daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+            # Signal handlers can only be installed from the main thread
+            self._previous_handlers = {}
+            if threading.current_thread() is threading.main_thread():
+                for signum in [signal.SIGINT, signal.SIGTERM]:
+                    self._previous_handlers[signum] = signal.signal(signum, self._handle_signal)
+
+    def record_change(self, i: int, column: str, value: Any) -> None:
+        """
+        Counts the changes waiting to be written.
+
+        Parameters
+        ----------
+        i : int
+            The index of the updated row.
+        column : str
+            Name of the updated column.
+        value : Any
+            The new value of the cell.
+        """
+        self._nb_changes += 1
+
+    def save(self) -> None:
+        """
+        Marks the DataFrame as dirty, the file is written by the background thread.
+        """
+        with self._condition:
+            self._dirty = True
+            if self._nb_changes >= self.flush_changes:
+                self._condition.notify()
+
+    def flush(self) -> None:
+        """
+        Writes the CSV file if the DataFrame has been saved since the last write.
+        """
+        with self._write_lock:
+            with self.lock:
+                if not self._dirty:
+                    return
+                df = self.df.copy()
+                self._dirty = False
+                self._nb_changes = 0
+
+            self.write_csv(df)
+
+    def _run_writer(self) -> None:
+        """
+        Loop of the background thread writing the file.
+        """
+        while not self._stopped:
+            next_flush = time.monotonic() + self.flush_interval
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or self._nb_changes >= self.flush_changes,
+                                         timeout=max(0.0, next_flush - time.monotonic()))
+            self.flush()
+
+    def _handle_signal(self, signum: int, frame) -> None:
+        """
+        Writes the file before exiting when SIGINT or SIGTERM is received.
+        """
+        logging.warning(f'Signal {signum} received: writing {self.file_path} before exiting')
+        self.close()
+        sys.exit(128 + signum)
+
+    def close(self) -> None:
+        """
+        Stops the background thread and writes the pending changes.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._writer is not threading.current_thread():
+            self._writer.join()
+        self.flush()
+
+        if threading.current_thread() is threading.main_thread():
+            for signum, handler in self._previous_handlers.items():
+                signal.signal(signum, handler)
+        self._previous_handlers = {}
+
+
+class ReadOnlyProcessMonitor(ProcessMonitor):
+    """
+    Process monitor reading the processing state without writing any file.
+
+    Used by `--plan`: the state left by a previous run is read from the files of its
+    storage mode, the SQLite database or the CSV file with its journal, and the rows of
+    the Excel form are used when no run was made. Nothing is created, compacted or
+    exported, the changes of the DataFrame are not saved.
+
+    Parameters
+    ----------
+    excel_filepath : str
+        Path to the Excel file containing the configuration data.
+    process_type : str
+        Type of process to monitor (e.g., 'PoLines', 'Items', 'Holdings').
+    storage : str, optional
+        Storage mode of the previous runs, one of the keys of `STORAGE_MODES`. Default is 'csv'.
+    """
+    journal_path = JournaledProcessMonitor.journal_path
+    db_path = SqliteProcessMonitor.db_path
+    table_name = SqliteProcessMonitor.table_name
+    replay_journal = JournaledProcessMonitor.replay_journal
+    read_db = SqliteProcessMonitor.read_db
+
+    def __init__(self,
+                 excel_filepath: Optional[str] = None,
+                 process_type: Optional[str] = None,
+                 storage: str = 'csv') -> None:
+        """
+        Initializes the read-only ProcessMonitor.
+        """
+        if not hasattr(self, '_initialized'):
+            self.storage = storage
+            self.conn = None
+            super().__init__(excel_filepath, process_type)
+
+    def check_existing_file(self) -> bool:
+        """
+        Checks if the database of the SQLite storage or the CSV process file exists.
+
+        Returns
+        -------
+        bool
+            True if the state of a previous run exists, False otherwise.
+        """
+        return (self.storage == 'sqlite' and os.path.isfile(self.db_path)) or os.path.isfile(self.file_path)
+
+    def create(self) -> None:
+        """
+        Reads the rows of the Excel file without creating the process file.
+        """
+        self.df = pd.DataFrame(columns=self.get_columns())
+        self.load_data_from_excel()
+
+    def load(self) -> None:
+        """
+        Reads the state of the previous run according to the storage mode.
+        """
+        if self.storage == 'sqlite' and os.path.isfile(self.db_path):
+            self.conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+            try:
+                self.read_db()
+            finally:
+                self.conn.close()
+                self.conn = None
+            self.add_missing_columns()
+            return
+
+        super().load()
+        if self.storage == 'journal':
+            self.df.index = range(1, len(self.df) + 1)
+            self.replay_journal()
+
+    def save(self) -> None:
+        """
+        Does nothing, the process file is never written.
+        """
+
+    def write_csv(self, df: Optional[pd.DataFrame] = None) -> None:
+        """
+        Does nothing, the process file is never written.
+        """
+
+
+def get_dtype(column: str) -> str:
+    """
+    Returns the pandas data type of a column of the process file.
+
+    Parameters
+    ----------
+    column : str
+        Name of the column.
+
+    Returns
+    -------
+    str
+        'boolean', 'Int64' or 'str'.
+    """
+    if column in BOOL_COLUMNS:
+        return 'boolean'
+    if column in INT_COLUMNS:
+        return 'Int64'
+    return 'str'
+
+
+def get_sql_type(column: str) -> str:
+    """
+    Returns the SQLite data type of a column of the process file.
+
+    Parameters
+    ----------
+    column : str
+        Name of the column.
+
+    Returns
+    -------
+    str
+        'INTEGER' or 'TEXT'.
+    """
+    return 'INTEGER' if column in BOOL_COLUMNS + INT_COLUMNS else 'TEXT'
+
+
+def to_python_value(value: Any) -> Any:
+    """
+    Converts a value of the DataFrame to a python value that can be stored in JSON or SQLite.
+
+    Parameters
+    ----------
+    value : Any
+        Value of a cell of the DataFrame.
+
+    Returns
+    -------
+    Any
+        None for missing values, python scalar otherwise.
+    """
+    if pd.isnull(value):
+        return None
+    if hasattr(value, 'item'):
+        # Convert numpy scalars to python types
+        return value.item()
+    return value
+
+
+# Available storage modes of the process monitor
+STORAGE_MODES = {'csv': ProcessMonitor,
+                 'journal': JournaledProcessMonitor,
+                 'sqlite': SqliteProcessMonitor,
+                 'buffered': BufferedProcessMonitor}
+
+
+def create_process_monitor(excel_filepath: str,
+                           process_type: str,
+                           storage: str = 'csv',
+                           read_only: bool = False) -> ProcessMonitor:
+    """
+    Creates the process monitor with the requested storage mode.
+
+    Parameters
+    ----------
+    excel_filepath : str
+        Path to the Excel file containing the configuration data.
+    process_type : str
+        Type of process to monitor (e.g., 'PoLines', 'Items', 'Holdings').
+    storage : str, optional
+        Storage mode of the process file, one of the keys of `STORAGE_MODES`. Default is 'csv'.
+    read_only : bool, optional
+        If True, the state is read without writing any file, see :class:`ReadOnlyProcessMonitor`.
+
+    Returns
+    -------
+    ProcessMonitor
+        The process monitor instance.
+    """
+    if storage not in STORAGE_MODES:
+        logging.critical(f'Unknown storage mode: {storage}')
+        sys.exit(1)
+
+    if read_only:
+        return ReadOnlyProcessMonitor(excel_filepath, process_type, storage)
+
+    return STORAGE_MODES[storage](excel_filepath, process_type)
@@ -0,0 +1,302 @@
+import atexit
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Dict, IO, Iterator, List, Optional
+
+from utils import apicalls
+from utils.cassette import get_relative_url
+
+# Categories of the spans, the time of the rows is split between them
+CATEGORY_ROW = 'row'
+CATEGORY_STAGE = 'stage'
+CATEGORY_API = 'api'
+CATEGORY_SAVE = 'save'
+
+
+class Profiler:
+    """
+    Span traces of the rows: row, stages, API calls and writes of the processing file
+
+    The spans of a thread are nested: an API call made during a stage is a
+    child of the stage, the stage a child of the row. Each span is written
+    when it ends in a trace file in the Chrome trace format, it can be opened
+    with chrome://tracing or https://ui.perfetto.dev. The time of each row is
+    split between the API calls, the writes of the processing file and the
+    other Python code, the means are written in the log at the end.
+
+    With `cprofile_path`, the Python code of the rows is also profiled with
+    cProfile, one profile by thread merged at the end.
+
+    Parameters
+    ----------
+    trace_path : str
+        Path of the trace file
+    cprofile_path : str, optional
+        Path of the cProfile dump, readable with `pstats`
+    describe_row : Callable[[int], str], optional
+        Function returning the description of a row, written in the span of the row
+
+    Attributes
+    ----------
+    nb_rows : int
+        Number of row spans ended
+    totals_ms : Dict[str, float]
+        Total duration of the rows, of their API calls and of their writes in ms
+    """
+    def __init__(self,
+                 trace_path: str,
+                 cprofile_path: Optional[str] = None,
+                 describe_row: Optional[Callable[[int], str]] = None) -> None:
+        self.trace_path = trace_path
+        self.cprofile_path = cprofile_path
+        self.describe_row = describe_row
+        self.nb_rows = 0
+        self.totals_ms: Dict[str, float] = {CATEGORY_ROW: 0.0, CATEGORY_API: 0.0, CATEGORY_SAVE: 0.0}
+        self.lock = threading.Lock()
+
+        self._t0 = time.perf_counter_ns()
+        self._pid = os.getpid()
+        self._thread_names: Dict[int, str] = {}
+        self._profiles: List[cProfile.Profile] = []
+
+        # Open spans of the thread: [name, category, start in ns, args, API and save ms of the row]
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(trace_path) or '.', exist_ok=True)
+        self._file: Optional[IO[str]] = open(trace_path, 'w', encoding='utf-8')
+        self._file.write('[\n')
+
+    @contextmanager
+    def span(self, name: str, category: str, args: Optional[dict] = None) -> Iterator[None]:
+        """
+        Records a span for the duration of the with block
+
+        Parameters
+        ----------
+        name : str
+            Name of the span, for example 'item_create' or 'GET items'
+        category : str
+            Category of the span, one of the `CATEGORY_*` values
+        args : dict, optional
+            Attributes of the span written in the trace, record IDs for example
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+            with self.lock:
+                self._thread_names[threading.get_native_id()] = threading.current_thread().name
+
+        # The Python code of the outermost span of the thread is profiled
+        profile = None
+        if self.cprofile_path is not None and len(stack) == 0:
+            profile = self._get_thread_profile()
+            profile.enable()
+
+        current = [name, category, time.perf_counter_ns(), args if args is not None else {}, 0.0, 0.0]
+        stack.append(current)
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            stack.pop()
+            if profile is not None:
+                profile.disable()
+            self._end(current, end, stack)
+
+    def _end(self, current: list, end: int, stack: List[list]) -> None:
+        """
+        Writes an ended span and adds its duration to the row containing it
+        """
+        name, category, start, args, api_ms, save_ms = current
+        duration_ms = (end - start) / 1e6
+
+        # The API calls and writes of the row, only the outermost ones are counted
+        row = next((span for span in stack if span[1] == CATEGORY_ROW), None)
+        nested = any(span[1] in [CATEGORY_API, CATEGORY_SAVE] for span in stack)
+        if row is not None and not nested:
+            if category == CATEGORY_API:
+                row[4] += duration_ms
+            elif category == CATEGORY_SAVE:
+                row[5] += duration_ms
+
+        if category == CATEGORY_ROW:
+            if self.describe_row is not None and 'row' in args:
+                try:
+                    args['record'] = self.describe_row(args['row'])
+                except Exception:
+                    pass
+            args.update({'api_ms': round(api_ms, 3), 'save_ms': round(save_ms, 3)})
+
+        event = {'name': name,
+                 'cat': category,
+                 'ph': 'X',
+                 'ts': (start - self._t0) / 1000,
+                 'dur': (end - start) / 1000,
+                 'pid': self._pid,
+                 'tid': threading.get_native_id(),
+                 'args': args}
+        line = json.dumps(event, default=str)
+
+        with self.lock:
+            if category == CATEGORY_ROW:
+                self.nb_rows += 1
+                self.totals_ms[CATEGORY_ROW] += duration_ms
+                self.totals_ms[CATEGORY_API] += api_ms
+                self.totals_ms[CATEGORY_SAVE] += save_ms
+            if self._file is not None:
+                self._file.write(line + ',\n')
+
+    def _get_thread_profile(self) -> cProfile.Profile:
+        """
+        Returns the cProfile profiler of the current thread
+        """
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self.lock:
+                self._profiles.append(profile)
+        return profile
+
+    def __call__(self, call_next: Callable, method: str, *args, **kwargs):
+        """
+        Middleware recording a span for each API call: method, record type, URL, zone and status
+        """
+        path = get_relative_url(str(args[0])) if args else ''
+        segments = [segment for segment in path.split('?')[0].split('/') if segment != '']
+        record_type = '/'.join(segments[:2]) if segments[:1] in [['acq'], ['conf']] else (segments or ['other'])[0]
+
+        headers = apicalls.get_headers(kwargs)
+        span_args = {'url': path, 'zone': headers.zone if headers is not None else None}
+        if kwargs.get('params'):
+            span_args['params'] = {str(k): str(v) for k, v in kwargs['params'].items()}
+
+        with self.span(f'{method.upper()} {record_type}', CATEGORY_API, span_args):
+            r = call_next(method, *args, **kwargs)
+            span_args['status'] = r.status_code if r is not None else None
+            return r
+
+    def get_summary(self) -> dict:
+        """
+        Returns the number of rows and the mean duration of a row split between API calls, writes and Python
+
+        Returns
+        -------
+        dict
+            Number of rows, mean duration of a row and of its API calls, its
+            writes of the processing file and the rest in ms
+        """
+        with self.lock:
+            nb_rows = self.nb_rows
+            totals = dict(self.totals_ms)
+
+        def mean(value: float) -> float:
+            return round(value / nb_rows, 1) if nb_rows > 0 else 0.0
+
+        return {'nb_rows': nb_rows,
+                'row_ms': mean(totals[CATEGORY_ROW]),
+                'api_ms': mean(totals[CATEGORY_API]),
+                'save_ms': mean(totals[CATEGORY_SAVE]),
+                'other_ms': mean(totals[CATEGORY_ROW] - totals[CATEGORY_API] - totals[CATEGORY_SAVE])}
+
+    def close(self) -> None:
+        """
+        Ends the trace file, writes the cProfile dump and the summary in the log
+        """
+        with self.lock:
+            if self._file is None:
+                return
+            for tid, thread_name in self._thread_names.items():
+                self._file.write(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                                             'args': {'name': thread_name}}) + ',\n')
+            self._file.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': self._pid, 'tid': 0,
+                                         'args': {'name': 'transfer'}}) + '\n]\n')
+            self._file.close()
+            self._file = None
+            profiles = list(self._profiles)
+
+        summary = self.get_summary()
+        if summary['nb_rows'] > 0:
+            logging.info(f"Profile: {summary['nb_rows']} rows, mean {summary['row_ms']}ms per row: "
+                         f"API calls {summary['api_ms']}ms, processing file writes {summary['save_ms']}ms, "
+                         f"other {summary['other_ms']}ms")
+        logging.info(f'Profile trace written in {self.trace_path}')
+
+        if self.cprofile_path is not None and len(profiles) > 0:
+            for profile in profiles:
+                profile.create_stats()
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(self.cprofile_path)
+            logging.info(f'Python profile written in {self.cprofile_path}, read it with '
+                         f'"python -m pstats {self.cprofile_path}"')
+
+
+# Profiler of the process, set by `install`
+profiler: Optional[Profiler] = None
+
+
+def span(name: str, category: str = CATEGORY_STAGE, **args) -> ContextManager:
+    """
+    Records a span for the duration of the with block, see :meth:`Profiler.span`
+
+    Has no effect if the run is not profiled.
+
+    Parameters
+    ----------
+    name : str
+        Name of the span, for example 'item_create'
+    category : str, optional
+        Category of the span, one of the `CATEGORY_*` values
+    **args
+        Attributes of the span, record IDs for example
+    """
+    if profiler is None:
+        return nullcontext()
+    return profiler.span(name, category, args)
+
+
+def install(trace_path: Optional[str] = None,
+            cprofile_path: Optional[str] = None,
+            describe_row: Optional[Callable[[int], str]] = None) -> Optional[Profiler]:
+    """
+    Records the span traces of the rows of the process
+
+    The API call middleware is the outermost one: the span of a call includes
+    its retries, the waits of the rate limiter and the answers of the record
+    cache.
+
+    Parameters
+    ----------
+    trace_path : str, optional
+        Path of the trace file in the Chrome trace format, None to stop profiling
+    cprofile_path : str, optional
+        Path of the cProfile dump, None to not profile the Python code
+    describe_row : Callable[[int], str], optional
+        Function returning the description of a row, for example its barcode
+
+    Returns
+    -------
+    Optional[Profiler]
+        The profiler of the process, None if no path is given
+    """
+    global profiler
+
+    if profiler is not None:
+        apicalls.remove_middleware(profiler)
+        atexit.unregister(profiler.close)
+        profiler.close()
+        profiler = None
+
+    if trace_path is None:
+        return None
+
+    profiler = Profiler(trace_path, cprofile_path, describe_row)
+    apicalls.add_middleware(profiler, outermost=True)
+    atexit.register(profiler.close)
+
+    return profiler
@@ -0,0 +1,240 @@
+import atexit
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from utils import apicalls, xlstools
+
+# Alma allows 25 API calls per second and per institution
+DEFAULT_RATE = 20.0
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the number of calls per second
+
+    Each call takes a token, the tokens are refilled at `rate` per second up to
+    `burst`. When no token is available, the caller sleeps until its turn: the
+    tokens are reserved, so waiting callers are served in order of arrival.
+
+    Parameters
+    ----------
+    rate : float
+        Number of calls allowed per second, 0 for no limit
+    burst : float, optional
+        Maximum number of calls made without waiting, default is `rate`
+
+    Attributes
+    ----------
+    nb_calls : int
+        Number of calls
+    nb_waits : int
+        Number of calls that had to wait
+    total_wait : float
+        Total waiting time in seconds
+    max_wait : float
+        Longest waiting time in seconds
+    """
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.nb_calls = 0
+        self.nb_waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self) -> float:
+        """
+        Takes a token, waits if none is available
+
+        Returns
+        -------
+        float
+            Waiting time in seconds
+        """
+        with self.lock:
+            if self.rate <= 0:
+                self.nb_calls += 1
+                return 0.0
+
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+            self.nb_calls += 1
+            if wait > 0:
+                self.nb_waits += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+    def get_metrics(self) -> Dict[str, float]:
+        """
+        Returns the waiting time metrics of the bucket
+
+        Returns
+        -------
+        Dict[str, float]
+            Rate, number of calls and waits, total, mean and max waiting time in seconds
+        """
+        with self.lock:
+            return {'rate': self.rate,
+                    'nb_calls': self.nb_calls,
+                    'nb_waits': self.nb_waits,
+                    'total_wait': round(self.total_wait, 3),
+                    'mean_wait': round(self.total_wait / self.nb_calls, 3) if self.nb_calls > 0 else 0.0,
+                    'max_wait': round(self.max_wait, 3)}
+
+
+class RateLimiter:
+    """
+    Middleware limiting the rate of the API calls, with one budget per zone
+
+    Parameters
+    ----------
+    rates : Dict[str, float]
+        Calls per second by zone, for example {'UBS': 20, 'ISR': 10}
+    default_rate : float, optional
+        Calls per second for the other zones, NZ for example
+
+    Attributes
+    ----------
+    buckets : Dict[Optional[str], TokenBucket]
+        Token buckets by zone, None for the calls without known zone
+    """
+    def __init__(self, rates: Dict[str, float], default_rate: float = DEFAULT_RATE) -> None:
+        self.default_rate = default_rate
+        self.buckets: Dict[Optional[str], TokenBucket] = {zone: TokenBucket(rate) for zone, rate in rates.items()}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, zone: Optional[str]) -> TokenBucket:
+        """
+        Returns the bucket of the zone, creates it with the default rate if required
+
+        Parameters
+        ----------
+        zone : str, optional
+            Zone of the call, IZ code or 'NZ'
+
+        Returns
+        -------
+        TokenBucket
+            The bucket of the zone
+        """
+        with self.lock:
+            if zone not in self.buckets:
+                self.buckets[zone] = TokenBucket(self.default_rate)
+            return self.buckets[zone]
+
+    def __call__(self, call_next: Callable, method: str, *args, **kwargs):
+        """
+        Waits for a token of the zone of the call and makes the call
+        """
+        self.get_bucket(apicalls.get_zone(kwargs)).acquire()
+        return call_next(method, *args, **kwargs)
+
+    def get_metrics(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the waiting time metrics by zone
+
+        Returns
+        -------
+        Dict[str, Dict[str, float]]
+            Metrics of :meth:`TokenBucket.get_metrics` by zone
+        """
+        with self.lock:
+            buckets = dict(self.buckets)
+        return {str(zone): bucket.get_metrics() for zone, bucket in buckets.items()}
+
+    def log_metrics(self) -> None:
+        """
+        Writes the waiting time metrics in the log
+        """
+        for zone, metrics in self.get_metrics().items():
+            logging.info(f"API rate limit {zone}: {metrics['nb_calls']} calls at {metrics['rate']}/s, "
+                         f"{metrics['nb_waits']} waits, total {metrics['total_wait']}s, "
+                         f"mean {metrics['mean_wait']}s, max {metrics['max_wait']}s")
+
+
+def get_rates(rate_s: Optional[float] = None, rate_d: Optional[float] = None) -> Dict[str, float]:
+    """
+    Returns the calls per second allowed to the source and destination IZ
+
+    The rates given as arguments, usually from the command line, have the
+    priority over the rates of the General tab of the Excel form. Without
+    value, `DEFAULT_RATE` is used. When both IZ are the same, the budget is
+    shared and the lowest limit applies.
+
+    Parameters
+    ----------
+    rate_s : float, optional
+        Calls per second to the source IZ
+    rate_d : float, optional
+        Calls per second to the destination IZ
+
+    Returns
+    -------
+    Dict[str, float]
+        Calls per second by zone, 0 for no limit
+    """
+    config = xlstools.get_config()
+
+    rate_s = next(rate for rate in [rate_s, config.get('api_rate_s'), DEFAULT_RATE] if rate is not None)
+    rate_d = next(rate for rate in [rate_d, config.get('api_rate_d'), DEFAULT_RATE] if rate is not None)
+
+    if config['iz_s'] == config['iz_d']:
+        limits = [rate for rate in [rate_s, rate_d] if rate > 0]
+        return {config['iz_s']: min(limits) if len(limits) > 0 else 0}
+
+    return {config['iz_s']: rate_s, config['iz_d']: rate_d}
+
+
+# Rate limiter of the process, set by `install`
+rate_limiter: Optional[RateLimiter] = None
+
+
+def install(rate_s: Optional[float] = None, rate_d: Optional[float] = None) -> RateLimiter:
+    """
+    Limits the rate of all Alma API calls of the process
+
+    The rates given as arguments, usually from the command line, have the
+    priority over the rates of the General tab of the Excel form. Without
+    value, `DEFAULT_RATE` is used. A rate of 0 disables the limit of the zone.
+
+    Parameters
+    ----------
+    rate_s : float, optional
+        Calls per second to the source IZ
+    rate_d : float, optional
+        Calls per second to the destination IZ
+
+    Returns
+    -------
+    RateLimiter
+        The rate limiter of the process
+    """
+    global rate_limiter
+    rates = get_rates(rate_s, rate_d)
+
+    if rate_limiter is not None:
+        apicalls.remove_middleware(rate_limiter)
+        atexit.unregister(rate_limiter.log_metrics)
+
+    rate_limiter = RateLimiter(rates)
+    apicalls.add_middleware(rate_limiter)
+    atexit.register(rate_limiter.log_metrics)
+    logging.info('API rate limits: ' + ', '.join(f'{zone} {rate}/s' if rate > 0 else f'{zone} unlimited'
+                                                 for zone, rate in rates.items()))
+
+    return rate_limiter
@@ -0,0 +1,390 @@
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from almapiwrapper.record import remove_apikey_from_url
+
+from utils import apicalls
+from utils.concurrency import KeyedLocks
+
+# Default maximum size of the cached responses in MB
+DEFAULT_SIZE_MB = 64.0
+
+# Writes changing records of other types: the cached records of these types are
+# invalidated too. A loan or a receiving changes the item, a request cancellation
+# on a bib changes the requests of the user.
+SIDE_EFFECTS = {'users': ['bibs', 'items'],
+                'acq/po-lines': ['bibs', 'items'],
+                'bibs': ['users']}
+
+# (zone, env, record type, record ID), the ID is None for searches, "GET /bibs?nz_mms_id=..." for example
+RecordKey = Tuple[Optional[str], Optional[str], str, Optional[str]]
+
+
+def get_record_key(url: str, zone: Optional[str], env: Optional[str]) -> Optional[RecordKey]:
+    """
+    Returns the key of the Alma record targeted by a URL
+
+    The record is identified by the first segments of the path, the holdings
+    and items belong to their bib: "/almaws/v1/bibs/991.../holdings/22.../items/23..."
+    is the record ('bibs', '991...'). Acquisitions and configuration APIs have
+    one more segment: "/almaws/v1/acq/po-lines/POL-1" is ('acq/po-lines', 'POL-1').
+
+    Parameters
+    ----------
+    url : str
+        URL of the API call
+    zone : str, optional
+        Zone of the call, IZ code or 'NZ'
+    env : str, optional
+        'P' for production and 'S' for sandbox
+
+    Returns
+    -------
+    Optional[RecordKey]
+        Key of the record, None if the URL is not an Alma API URL
+    """
+    path = urlsplit(url).path
+    if '/almaws/v1/' not in path:
+        return None
+    segments = [segment for segment in path.split('/almaws/v1/', 1)[1].split('/') if segment != '']
+    if len(segments) == 0:
+        return None
+    if segments[0] in ['acq', 'conf'] and len(segments) > 1:
+        segments = [f'{segments[0]}/{segments[1]}'] + segments[2:]
+    return zone, env, segments[0], segments[1] if len(segments) > 1 else None
+
+
+class RecordCache:
+    """
+    Middleware keeping the records read from Alma, bounded LRU cache
+
+    The successful GET responses are kept until the tool changes the record:
+    a PUT, POST or DELETE on a record removes all cached responses of the
+    record, holdings and items included, and the cached searches of the same
+    type, see :data:`SIDE_EFFECTS` for the writes changing other types.
+
+    The cache is bounded by the size of the responses. When it is full, the
+    least recently used responses are removed. Concurrent reads of the same
+    URL make only one API call.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Maximum size of the cached responses in bytes
+
+    Attributes
+    ----------
+    size : int
+        Current size of the cached responses in bytes
+    hits : int
+        Number of calls answered by the cache
+    misses : int
+        Number of GET calls sent to Alma
+    evictions : int
+        Number of responses removed because the cache was full
+    invalidations : int
+        Number of responses removed because the record was changed
+    """
+    def __init__(self, max_size: int = int(DEFAULT_SIZE_MB * 1024 * 1024)) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self.lock = threading.Lock()
+        self.fetch_locks = KeyedLocks()
+
+        # Request key => (record keys, response, size), least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        # Record key => request keys, (zone, env, record type) => request keys
+        self._by_record: Dict[RecordKey, Set[Hashable]] = {}
+        self._by_type: Dict[Tuple, Set[Hashable]] = {}
+
+        # Number of writes and number of the last write of each record and type, a response
+        # fetched during a write of its record is not stored
+        self._write_number = 0
+        self._written_records: Dict[RecordKey, int] = {}
+        self._written_types: Dict[Tuple, int] = {}
+
+    @staticmethod
+    def get_request_key(url: str, kwargs: dict) -> Hashable:
+        """
+        Returns the key of a GET request: URL, parameters, zone, environment and format
+        """
+        headers = apicalls.get_headers(kwargs)
+        params = tuple(sorted((str(k), str(v)) for k, v in (kwargs.get('params') or {}).items()))
+        return url, params, headers.zone, headers.env, headers.get('accept')
+
+    def __call__(self, call_next: Callable, method: str, *args, **kwargs):
+        """
+        Answers the GET calls from the cache, invalidates the records changed by the other calls
+        """
+        headers = apicalls.get_headers(kwargs)
+        if headers is None or len(args) == 0:
+            return call_next(method, *args, **kwargs)
+
+        url = str(args[0])
+        record_key = get_record_key(url, headers.zone, headers.env)
+        if record_key is None:
+            return call_next(method, *args, **kwargs)
+
+        if method != 'get':
+            try:
+                return call_next(method, *args, **kwargs)
+            finally:
+                # The record may be changed even if the response is lost
+                self.invalidate_write(record_key)
+
+        request_key = self.get_request_key(url, kwargs)
+        with self.fetch_locks.hold(request_key):
+            r = self.get(request_key)
+            if r is not None:
+                logging.info(f'GET : {remove_apikey_from_url(r.url)} {r.status_code} (cache)')
+                return r
+
+            with self.lock:
+                self.misses += 1
+                write_number = self._write_number
+
+            r = call_next(method, *args, **kwargs)
+            if r is not None and r.status_code == 200:
+                response_key = get_record_key(r.url, headers.zone, headers.env) if r.url else None
+                record_keys = [key for key in {record_key, response_key} if key is not None]
+                self.put(request_key, record_keys, r, write_number)
+
+        return r
+
+    def get(self, request_key: Hashable) -> Optional[requests.Response]:
+        """
+        Returns the cached response of a request, None if not cached
+
+        Parameters
+        ----------
+        request_key : Hashable
+            Key returned by :meth:`get_request_key`
+
+        Returns
+        -------
+        Optional[requests.Response]
+            Cached response
+        """
+        with self.lock:
+            if request_key not in self._entries:
+                return None
+            self._entries.move_to_end(request_key)
+            self.hits += 1
+            return self._entries[request_key][1]
+
+    def put(self,
+            request_key: Hashable,
+            record_keys: List[RecordKey],
+            r: requests.Response,
+            write_number: int = 0) -> bool:
+        """
+        Stores a response, removes the least recently used ones if the cache is full
+
+        Parameters
+        ----------
+        request_key : Hashable
+            Key returned by :meth:`get_request_key`
+        record_keys : List[RecordKey]
+            Records of the response, the response is removed when one of them is changed
+        r : requests.Response
+            Response to store
+        write_number : int, optional
+            Number of writes when the request was sent, the response is not stored
+            if one of its records was changed since
+
+        Returns
+        -------
+        bool
+            True if the response was stored
+        """
+        size = len(r.content) + len(r.url or '')
+        with self.lock:
+            if size > self.max_size:
+                return False
+            for record_key in record_keys:
+                if (self._written_records.get(record_key, 0) > write_number
+                        or self._written_types.get(record_key[:3], 0) > write_number):
+                    return False
+
+            self._remove(request_key)
+            self._entries[request_key] = (record_keys, r, size)
+            self.size += size
+            for record_key in record_keys:
+                self._by_record.setdefault(record_key, set()).add(request_key)
+                self._by_type.setdefault(record_key[:3], set()).add(request_key)
+
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+        return True
+
+    def invalidate(self, zone: Optional[str], env: Optional[str], record_type: str,
+                   record_id: Optional[str] = None) -> int:
+        """
+        Removes the cached responses of a record
+
+        Used when a record is changed by Alma itself, the items of a PO line
+        created asynchronously for example. Without `record_id`, all records of
+        the type are removed.
+
+        Parameters
+        ----------
+        zone : str, optional
+            Zone of the record, IZ code or 'NZ'
+        env : str, optional
+            'P' for production and 'S' for sandbox
+        record_type : str
+            'bibs', 'items', 'users' or 'acq/po-lines' for example
+        record_id : str, optional
+            ID of the record, MMS ID for the bibs and their holdings and items
+
+        Returns
+        -------
+        int
+            Number of removed responses
+        """
+        if record_id is None:
+            return self._invalidate(types=[(zone, env, record_type)])
+        return self._invalidate(records=[(zone, env, record_type, record_id)])
+
+    def invalidate_write(self, record_key: RecordKey) -> int:
+        """
+        Removes the cached responses changed by a PUT, POST or DELETE on a record
+
+        The record itself, the searches of its type and the types of :data:`SIDE_EFFECTS`
+        are removed.
+
+        Parameters
+        ----------
+        record_key : RecordKey
+            Record targeted by the call
+
+        Returns
+        -------
+        int
+            Number of removed responses
+        """
+        zone, env, record_type, _ = record_key
+        return self._invalidate(records=[record_key, (zone, env, record_type, None)],
+                                types=[(zone, env, other_type) for other_type in SIDE_EFFECTS.get(record_type, [])])
+
+    def _invalidate(self, records: List[RecordKey] = None, types: List[Tuple] = None) -> int:
+        """
+        Removes the cached responses of records and types, and counts a write
+        """
+        with self.lock:
+            self._write_number += 1
+            request_keys = set()
+            for record_key in records or []:
+                self._written_records[record_key] = self._write_number
+                request_keys |= self._by_record.get(record_key, set())
+            for type_key in types or []:
+                self._written_types[type_key] = self._write_number
+                request_keys |= self._by_type.get(type_key, set())
+
+            for request_key in request_keys:
+                self._remove(request_key)
+            self.invalidations += len(request_keys)
+            return len(request_keys)
+
+    def _remove(self, request_key: Hashable) -> None:
+        """
+        Removes a response, the lock must be held
+        """
+        if request_key not in self._entries:
+            return
+        record_keys, _, size = self._entries.pop(request_key)
+        self.size -= size
+        for record_key in record_keys:
+            for index, key in [(self._by_record, record_key), (self._by_type, record_key[:3])]:
+                index[key].discard(request_key)
+                if len(index[key]) == 0:
+                    del index[key]
+
+    def get_metrics(self) -> Dict[str, float]:
+        """
+        Returns the usage metrics of the cache
+
+        Returns
+        -------
+        Dict[str, float]
+            Number of hits, misses, evictions and invalidations, hit rate, number and size of the responses
+        """
+        with self.lock:
+            nb_calls = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': round(self.hits / nb_calls, 3) if nb_calls > 0 else 0.0,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'nb_responses': len(self._entries),
+                    'size_mb': round(self.size / 1024 / 1024, 2)}
+
+    def log_metrics(self) -> None:
+        """
+        Writes the usage metrics of the cache in the log
+        """
+        metrics = self.get_metrics()
+        logging.info(f"Record cache: {metrics['hits']} hits, {metrics['misses']} misses "
+                     f"(hit rate {metrics['hit_rate']}), {metrics['evictions']} evictions, "
+                     f"{metrics['invalidations']} invalidations, {metrics['nb_responses']} responses "
+                     f"in {metrics['size_mb']} MB")
+
+
+# Record cache of the process, set by `install`
+record_cache: Optional[RecordCache] = None
+
+
+def install(size_mb: float = DEFAULT_SIZE_MB) -> Optional[RecordCache]:
+    """
+    Keeps the records read from Alma for the duration of the process
+
+    The cache is the outermost middleware: a cached record doesn't wait for
+    the rate limiter.
+
+    Parameters
+    ----------
+    size_mb : float, optional
+        Maximum size of the cached responses in MB, 0 disables the cache
+
+    Returns
+    -------
+    Optional[RecordCache]
+        The record cache of the process, None if disabled
+    """
+    global record_cache
+
+    if record_cache is not None:
+        apicalls.remove_middleware(record_cache)
+        atexit.unregister(record_cache.log_metrics)
+        record_cache = None
+
+    if size_mb <= 0:
+        return None
+
+    record_cache = RecordCache(int(size_mb * 1024 * 1024))
+    apicalls.add_middleware(record_cache, outermost=True)
+    atexit.register(record_cache.log_metrics)
+
+    return record_cache
+
+
+def invalidate(zone: Optional[str], env: Optional[str], record_type: str, record_id: Optional[str] = None) -> None:
+    """
+    Removes the cached responses of a record, see :meth:`RecordCache.invalidate`
+
+    Has no effect if the cache is not installed.
+    """
+    if record_cache is not None:
+        record_cache.invalidate(zone, env, record_type, record_id)
@@ -37,13 +37,13 @@ def create_request(i: int, request_s: Request) -> Optional[Request]:
 
     if bib_s.error:
         logging.error(f"{repr(bib_s)}: {bib_s.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'NZ MMS ID not found'
+        process_monitor.set_value(i, 'Error', 'NZ MMS ID not found')
         process_monitor.save()
         return None
 
     if nz_mms_id is None:
         logging.error(f"NZ MMS ID not found for {request_s.data['mms_id']}")
-        process_monitor.df.at[i, 'Error'] = 'NZ MMS ID not found'
+        process_monitor.set_value(i, 'Error', 'NZ MMS ID not found')
         process_monitor.save()
         return None
 
@@ -52,7 +52,7 @@ def create_request(i: int, request_s: Request) -> Optional[Request]:
 
     if bib_d.error:
         logging.error(f"{repr(bib_d)}: {bib_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Destination IZ Bib not found'
+        process_monitor.set_value(i, 'Error', 'Destination IZ Bib not found')
         process_monitor.save()
         return None
 
@@ -65,7 +65,7 @@ def create_request(i: int, request_s: Request) -> Optional[Request]:
 
         if item_d.error:
             logging.error(f"{repr(item_d)}: {item_d.error_msg}")
-            process_monitor.df.at[i, 'Error'] = 'Item not found'
+            process_monitor.set_value(i, 'Error', 'Item not found')
             process_monitor.save()
             return None
 
@@ -102,13 +102,13 @@ def create_request(i: int, request_s: Request) -> Optional[Request]:
         if end_date > max_end_date:
             data["booking_end_date"] = max_end_date.strftime("%Y-%m-%dT%H:%M:%SZ")
             request_d = Request(data=JsonData(data), zone=config['iz_d'], env=config['env']).create()
-            process_monitor.df.at[i, 'Error'] = 'Booking end date adjusted'
+            process_monitor.set_value(i, 'Error', 'Booking end date adjusted')
             process_monitor.save()
             logging.warning(f"{repr(request_d)}: Booking end date adjusted: from {end_date.strftime('%Y-%m-%dT%H:%M:%SZ')} to {data['booking_end_date']}")
 
     if request_d.error:
         logging.error(f"{repr(request_d)}: {request_d.error_msg}")
-        process_monitor.df.at[i, 'Error'] = 'Request creation failed'
+        process_monitor.set_value(i, 'Error', 'Request creation failed')
         process_monitor.save()
         return None
 
@@ -0,0 +1,218 @@
+import atexit
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import requests
+from almapiwrapper.record import remove_apikey_from_url
+
+from utils import apicalls, runner
+from utils.processmonitoring import ProcessMonitor
+
+# Default number of retries of a call failing with a transient error
+DEFAULT_RETRIES = 4
+
+
+def is_transient_status(status_code: int, method: str = 'get') -> bool:
+    """
+    Checks if an HTTP status is a transient error worth retrying
+
+    429 (too many requests) and 5xx (server errors) are transient. Other
+    errors, 400 (validation) or 404 (not found) for example, are permanent:
+    the same request would fail again.
+
+    A POST request may have created the record before a 5xx response, it is
+    only retried after a 429 response, the request was then not processed.
+
+    Parameters
+    ----------
+    status_code : int
+        HTTP status of the response
+    method : str, optional
+        'get', 'put', 'post' or 'delete'
+
+    Returns
+    -------
+    bool
+        True if the error is transient
+    """
+    if method == 'post':
+        return status_code == 429
+
+    return status_code == 429 or status_code >= 500
+
+
+def is_transient_exception(err: Exception, method: str = 'get') -> bool:
+    """
+    Checks if an exception of the HTTP request is a transient error worth retrying
+
+    Timeouts and connection errors, including connection resets, are transient.
+    Invalid requests, an invalid URL for example, are permanent.
+
+    A POST request may have created the record before a read timeout or a
+    connection reset, it is only retried if the connection could not be opened.
+
+    Parameters
+    ----------
+    err : Exception
+        Exception raised by `requests`
+    method : str, optional
+        'get', 'put', 'post' or 'delete'
+
+    Returns
+    -------
+    bool
+        True if the error is transient
+    """
+    if method == 'post':
+        return isinstance(err, requests.exceptions.ConnectTimeout)
+
+    return isinstance(err, (requests.exceptions.Timeout,
+                            requests.exceptions.ConnectionError,
+                            requests.exceptions.ChunkedEncodingError))
+
+
+class RetryMiddleware:
+    """
+    Middleware retrying the API calls failing with transient errors
+
+    The delay before a retry grows exponentially, `base_delay * 2 ** attempt`
+    bounded by `max_delay`, with full jitter: the delay is random between 0
+    and this value, so concurrent rows don't retry at the same time. If Alma
+    gives a `Retry-After` header, it is used as minimum delay.
+
+    When the retries are exhausted, the last response is returned, the record
+    gets an error as without retry. The last exception is raised again.
+
+    Each retry is counted in the 'Retries' column of the row processed by
+    the thread.
+
+    Parameters
+    ----------
+    max_retries : int, optional
+        Maximum number of retries of a call
+    base_delay : float, optional
+        Delay before the first retry in seconds
+    max_delay : float, optional
+        Maximum delay between two attempts in seconds
+
+    Attributes
+    ----------
+    retries : Dict[str, int]
+        Number of retries by reason, 'HTTP 503' or 'ReadTimeout' for example
+    """
+    def __init__(self, max_retries: int = DEFAULT_RETRIES, base_delay: float = 1.0, max_delay: float = 30.0) -> None:
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def get_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Returns the delay before the next attempt
+
+        Parameters
+        ----------
+        attempt : int
+            Number of the failed attempt, 0 for the first call
+        retry_after : str, optional
+            Value of the `Retry-After` header, in seconds
+
+        Returns
+        -------
+        float
+            Delay in seconds
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(self.max_delay, float(retry_after)))
+        return delay
+
+    def __call__(self, call_next: Callable, method: str, *args, **kwargs):
+        """
+        Makes the call and retries it in case of transient error
+        """
+        url = remove_apikey_from_url(str(args[0])) if args else ''
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                r = call_next(method, *args, **kwargs)
+            except requests.exceptions.RequestException as err:
+                if attempt >= self.max_retries or not is_transient_exception(err, method):
+                    raise
+                reason = type(err).__name__
+            else:
+                if r is None or attempt >= self.max_retries or not is_transient_status(r.status_code, method):
+                    return r
+                reason = f'HTTP {r.status_code}'
+                retry_after = r.headers.get('Retry-After')
+
+            delay = self.get_delay(attempt, retry_after)
+            attempt += 1
+            self.record_retry(reason)
+            logging.warning(f'{method.upper()} : {url} {reason} - retry {attempt} / {self.max_retries} '
+                            f'in {delay:.1f}s')
+            time.sleep(delay)
+
+    def record_retry(self, reason: str) -> None:
+        """
+        Counts a retry by reason and for the row processed by the thread
+
+        Parameters
+        ----------
+        reason : str
+            Reason of the retry, 'HTTP 503' or 'ReadTimeout' for example
+        """
+        with self.lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+        i = runner.get_current_row()
+        if i is not None:
+            ProcessMonitor().increment(i, 'Retries')
+
+    def log_metrics(self) -> None:
+        """
+        Writes the number of retries by reason in the log
+        """
+        with self.lock:
+            retries = dict(self.retries)
+        if len(retries) > 0:
+            logging.info('API retries: ' + ', '.join(f'{reason}: {nb}' for reason, nb in sorted(retries.items())))
+
+
+# Retry middleware of the process, set by `install`
+retry_middleware: Optional[RetryMiddleware] = None
+
+
+def install(max_retries: int = DEFAULT_RETRIES) -> RetryMiddleware:
+    """
+    Retries the Alma API calls failing with transient errors
+
+    The middleware is the outermost one: each attempt goes through the rate
+    limiter and is observed by the concurrency controller.
+
+    Parameters
+    ----------
+    max_retries : int, optional
+        Maximum number of retries of a call, 0 disables the retries
+
+    Returns
+    -------
+    RetryMiddleware
+        The retry middleware of the process
+    """
+    global retry_middleware
+
+    if retry_middleware is not None:
+        apicalls.remove_middleware(retry_middleware)
+        atexit.unregister(retry_middleware.log_metrics)
+
+    retry_middleware = RetryMiddleware(max_retries)
+    apicalls.add_middleware(retry_middleware, outermost=True)
+    atexit.register(retry_middleware.log_metrics)
+
+    return retry_middleware
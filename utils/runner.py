@@ -0,0 +1,626 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import pandas as pd
+
+from utils import apicalls, profiler
+from utils.concurrency import AdaptiveLimit, AimdController
+from utils.processmonitoring import ProcessMonitor
+
+# Row processed by the current thread, see `current_row` and `deferrable`
+_row_context = threading.local()
+
+T = TypeVar('T')
+
+
+class RowDeferred(Exception):
+    """
+    Raised by a row waiting for Alma, the scheduler runs the row again later
+
+    The worker is released during the wait. The row is processed again from
+    the beginning, the stages already reached are skipped.
+
+    Parameters
+    ----------
+    delay : float
+        Delay in seconds before the row runs again
+    """
+    def __init__(self, delay: float) -> None:
+        super().__init__(f'row deferred for {delay:.1f}s')
+        self.delay = delay
+
+
+def get_current_row() -> Optional[int]:
+    """
+    Returns the index of the row processed by the current thread
+
+    Returns
+    -------
+    Optional[int]
+        Index of the row, None outside the processing of a row
+    """
+    return getattr(_row_context, 'row', None)
+
+
+@contextmanager
+def current_row(i: int) -> Iterator[None]:
+    """
+    Sets the row processed by the current thread for the duration of the with block
+
+    The API call middlewares use it to attribute retries and calls to the rows,
+    the profiler records the row span.
+
+    Parameters
+    ----------
+    i : int
+        Index of the row
+    """
+    previous_row = get_current_row()
+    _row_context.row = i
+    try:
+        with profiler.span('row', profiler.CATEGORY_ROW, row=int(i)):
+            yield
+    finally:
+        _row_context.row = previous_row
+
+
+@contextmanager
+def deferrable(attempt: int) -> Iterator[None]:
+    """
+    Allows `wait_for` to defer the row of the current thread instead of sleeping
+
+    Parameters
+    ----------
+    attempt : int
+        Number of times the row was already deferred
+    """
+    _row_context.deferrals = attempt
+    try:
+        yield
+    finally:
+        _row_context.deferrals = None
+
+
+def wait_for(fetch: Callable[[], T],
+             is_done: Callable[[T], bool],
+             result: T,
+             description: str,
+             base_delay: float = 0.5,
+             max_delay: float = 8.0,
+             timeout: float = 60.0) -> T:
+    """
+    Polls Alma until a result is available, with exponential backoff
+
+    Used for records created asynchronously by Alma, the items of a new PoLine
+    for example. The delay between two attempts starts at `base_delay` and is
+    doubled up to `max_delay`. After `timeout` seconds of waiting, the last
+    result is returned even if not done.
+
+    When the row runs in a :class:`GroupScheduler`, the worker is not blocked
+    during the delay: :class:`RowDeferred` is raised and the row is processed
+    again after the delay. A row can only wait once, at the same place.
+
+    Parameters
+    ----------
+    fetch : Callable[[], T]
+        Function fetching the result again
+    is_done : Callable[[T], bool]
+        Function checking if the result is the expected one
+    result : T
+        Result already fetched by the caller
+    description : str
+        Description of the expected result for the logs
+    base_delay : float, optional
+        First delay in seconds
+    max_delay : float, optional
+        Maximum delay between two attempts in seconds
+    timeout : float, optional
+        Maximum total waiting time in seconds
+
+    Returns
+    -------
+    T
+        The result, done or the last one fetched before the timeout
+
+    Raises
+    ------
+    RowDeferred
+        If the row must be processed again later, only in a :class:`GroupScheduler`
+    """
+    deferrals = getattr(_row_context, 'deferrals', None)
+    attempt = deferrals or 0
+    waited = sum(min(max_delay, base_delay * 2 ** k) for k in range(attempt))
+    if attempt > 0:
+        # The row was deferred, the delay of the previous attempt is elapsed
+        result = fetch()
+
+    while not is_done(result):
+        delay = min(max_delay, base_delay * 2 ** attempt)
+        if waited + delay > timeout:
+            logging.warning(f'{description}: not available after {waited:.1f}s')
+            return result
+
+        logging.info(f'{description}: not available yet, new attempt in {delay:.1f}s')
+        if deferrals is not None:
+            raise RowDeferred(delay)
+
+        time.sleep(delay)
+        waited += delay
+        attempt += 1
+        result = fetch()
+
+    return result
+
+
+@contextmanager
+def adaptive_concurrency(workers: int, adaptive: bool) -> Iterator[Optional[AdaptiveLimit]]:
+    """
+    Adapts the number of concurrent rows to the API latency and errors during the with block
+
+    Parameters
+    ----------
+    workers : int
+        Maximum number of rows processed concurrently
+    adaptive : bool
+        If False, nothing is done and None is returned
+
+    Returns
+    -------
+    Optional[AdaptiveLimit]
+        The limit of concurrent rows, the rows must run in one of its slots
+    """
+    if not adaptive or workers <= 1:
+        yield None
+        return
+
+    limit = AdaptiveLimit(min(2, workers), workers)
+    controller = AimdController(limit)
+    apicalls.add_middleware(controller)
+    logging.info(f'Adaptive concurrency: starting with {limit.limit} workers, maximum {workers}')
+    try:
+        yield limit
+    finally:
+        apicalls.remove_middleware(controller)
+
+
+def run_rows(process_row: Callable[[int], None],
+             describe_row: Callable[[int], str],
+             workers: int = 1,
+             adaptive: bool = False) -> None:
+    """
+    Runs the process function on all rows of the process monitor
+
+    With one worker, rows are processed one after another in the order of the
+    processing file. With more workers, rows are processed concurrently on a
+    thread pool. The process function is responsible for serializing the rows
+    that share resources, bibs and holdings for example.
+
+    Parameters
+    ----------
+    process_row : Callable[[int], None]
+        Function processing one row, for example `processes.item`
+    describe_row : Callable[[int], str]
+        Function returning a short description of the row for the logs
+    workers : int, optional
+        Number of rows processed concurrently, default is 1
+    adaptive : bool, optional
+        If True, `workers` is the maximum and the number of concurrent rows is
+        adapted to the API latency and errors, see :class:`AimdController`
+
+    Notes
+    -----
+    If a row raises an exception, including `SystemExit`, the rows not yet
+    started are cancelled and the exception is raised again once the rows
+    already running are finished.
+    """
+    process_monitor = ProcessMonitor()
+    rows = list(process_monitor.df.index)
+    nb_rows = len(rows)
+
+    if workers <= 1:
+        for i in rows:
+            with current_row(i):
+                logging.info(f"Processing row {i} / {nb_rows}: {describe_row(i)}")
+                process_row(i)
+        return None
+
+    logging.info(f'Processing {nb_rows} rows with {workers} workers')
+
+    with adaptive_concurrency(workers, adaptive) as limit:
+        def run_row(i: int) -> None:
+            with limit.slot() if limit is not None else nullcontext(), current_row(i):
+                logging.info(f"Processing row {i} / {nb_rows}: {describe_row(i)}")
+                process_row(i)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='row') as executor:
+            futures = [executor.submit(run_row, i) for i in rows]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+
+            for future in done:
+                if future.exception() is not None:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise future.exception()
+
+    return None
+
+
+def prefetch_rows(fetch_keys: Callable[[int], bool],
+                  describe_row: Callable[[int], str],
+                  workers: int) -> int:
+    """
+    Retrieves the source IDs of all pending rows before the transfer starts
+
+    Only the rows not yet copied and without source MMS ID are fetched. The
+    fetch only reads the source IZ, the rows can run at a higher concurrency
+    than the transfer. Afterward, the groups of all rows are known when the
+    transfer is scheduled, see :class:`GroupScheduler`.
+
+    A row whose source record could not be fetched keeps its error and is
+    tried again by the transfer.
+
+    Parameters
+    ----------
+    fetch_keys : Callable[[int], bool]
+        Function retrieving the source IDs of a row, for example `processes.fetch_item_source_ids`
+    describe_row : Callable[[int], str]
+        Function returning a short description of the row for the logs
+    workers : int
+        Number of rows fetched concurrently
+
+    Returns
+    -------
+    int
+        Number of rows with known source IDs after the prefetch
+    """
+    process_monitor = ProcessMonitor()
+    df = process_monitor.df
+    rows = list(df.index[(df['Copied'] != True) & df['MMS_id_s'].isnull()])
+    if len(rows) == 0:
+        return 0
+
+    logging.info(f'Prefetching the source IDs of {len(rows)} rows with {workers} workers')
+    t0 = time.monotonic()
+
+    def fetch_row(i: int) -> bool:
+        with current_row(i):
+            logging.info(f"Fetching source IDs of row {i} / {len(df.index)}: {describe_row(i)}")
+            return fetch_keys(i)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch') as executor:
+        futures = [executor.submit(fetch_row, i) for i in rows]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+
+        for future in done:
+            if future.exception() is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise future.exception()
+
+    nb_fetched = sum(future.result() for future in futures)
+    logging.info(f'Prefetch done in {time.monotonic() - t0:.1f}s: {nb_fetched} / {len(rows)} rows with '
+                 f'known source IDs')
+
+    return nb_fetched
+
+
+class RowGroup:
+    """
+    Rows sharing a source bib or a source holding
+
+    Attributes
+    ----------
+    ready : bool
+        True when the destination record of the group exists
+    waiting : Deque[int]
+        Rows waiting for the leader of the group to create the destination record
+    """
+    def __init__(self, ready: bool = False) -> None:
+        self.ready = ready
+        self.waiting: Deque[int] = deque()
+
+
+class GroupScheduler:
+    """
+    Schedules the rows of the process monitor according to their source bib and holding
+
+    Rows are grouped by `MMS_id_s`, then by `Holding_id_s`. The first row of a group
+    is its leader: it runs alone and creates the destination bib and holding. Once they
+    exist, the other rows of the group only need to copy their own item and run in
+    parallel. If the leader could not create the record, the next row of the group
+    becomes the leader.
+
+    Rows without source MMS ID, items not yet fetched, first run the `fetch_keys`
+    function. They join their group as soon as their source IDs are known.
+
+    Parameters
+    ----------
+    process_row : Callable[[int], None]
+        Function processing one row, for example `processes.item`
+    describe_row : Callable[[int], str]
+        Function returning a short description of the row for the logs
+    workers : int
+        Number of rows processed concurrently
+    fetch_keys : Callable[[int], bool], optional
+        Function retrieving the source IDs of a row, returns False if not available
+    limit : AdaptiveLimit, optional
+        Limit of the concurrent rows, each row runs in one of its slots
+
+    Attributes
+    ----------
+    groups : Dict[Tuple[str, str], RowGroup]
+        Groups by ('MMS_id_s', source MMS ID) or ('Holding_id_s', source holding ID)
+    """
+    levels = [('MMS_id_s', 'get_corresponding_mms_id'),
+              ('Holding_id_s', 'get_corresponding_holding_id')]
+
+    def __init__(self,
+                 process_row: Callable[[int], None],
+                 describe_row: Callable[[int], str],
+                 workers: int,
+                 fetch_keys: Optional[Callable[[int], bool]] = None,
+                 limit: Optional[AdaptiveLimit] = None) -> None:
+        self.process_row = process_row
+        self.describe_row = describe_row
+        self.workers = workers
+        self.fetch_keys = fetch_keys
+        self.limit = limit
+        self.process_monitor = ProcessMonitor()
+        self.groups: Dict[Tuple[str, str], RowGroup] = {}
+        self.nb_rows = len(self.process_monitor.df.index)
+
+        self._condition = threading.Condition()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._running = 0
+        self._exception: Optional[BaseException] = None
+
+        # Number of times each row was deferred, see `wait_for`, and number of deferred tasks
+        self._deferrals: Dict[int, int] = {}
+        self._deferred = 0
+
+    def plan(self) -> Tuple[Dict[str, Dict[Optional[str], List[int]]], List[int]]:
+        """
+        Groups the rows not yet copied by source bib and holding
+
+        Returns
+        -------
+        Tuple[Dict[str, Dict[Optional[str], List[int]]], List[int]]
+            Rows by source MMS ID and source holding ID, in the order of the DataFrame,
+            and rows without source MMS ID
+        """
+        df = self.process_monitor.df
+        bibs = {}
+        unknown = []
+        for i in df.index[df['Copied'] != True]:
+            mms_id_s, holding_id_s = self.get_keys(i)
+            if mms_id_s is None:
+                unknown.append(i)
+            else:
+                bibs.setdefault(mms_id_s, {}).setdefault(holding_id_s, []).append(i)
+
+        return bibs, unknown
+
+    def get_keys(self, i: int) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Returns the source MMS ID and holding ID of the row, None if unknown
+        """
+        keys = tuple(self.process_monitor.df.at[i, column] for column, _ in self.levels)
+        return tuple(key if pd.notnull(key) else None for key in keys)
+
+    def is_ready(self, column: str, key: str) -> bool:
+        """
+        Checks if the destination record of a group exists
+        """
+        method = dict(self.levels)[column]
+        return getattr(self.process_monitor, method)(key) is not None
+
+    def run(self) -> None:
+        """
+        Processes all the rows according to the plan
+
+        The leaders of the groups are started first, the other rows are started when
+        the destination records of their groups exist.
+        """
+        bibs, unknown = self.plan()
+        logging.info(f'Processing {self.nb_rows} rows with {self.workers} workers: {len(bibs)} source bibs, '
+                     f'{sum(len(holdings) for holdings in bibs.values())} source holdings, '
+                     f'{len(unknown)} rows with unknown source bib')
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='row') as executor:
+            self._executor = executor
+            with self._condition:
+                for holdings in bibs.values():
+                    for rows in holdings.values():
+                        for i in rows:
+                            self.route(i)
+                for i in unknown:
+                    self.submit(self.run_fetch_keys, i)
+
+                while (self._running > 0 or self._deferred > 0) and self._exception is None:
+                    self._condition.wait()
+
+                if self._exception is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+        self._executor = None
+        if self._exception is not None:
+            raise self._exception
+
+    def route(self, i: int) -> None:
+        """
+        Starts the row or puts it on the waiting list of its group
+
+        Must be called with the condition held.
+
+        Parameters
+        ----------
+        i : int
+            The index of the row to route
+        """
+        keys = self.get_keys(i)
+        if keys[0] is None:
+            # Without source bib the row has no dependency
+            self.submit(self.run_row, i, [])
+            return
+
+        for level, (column, _) in enumerate(self.levels):
+            key = keys[level]
+            if key is None:
+                continue
+
+            group = self.groups.get((column, key))
+            if group is None:
+                if self.is_ready(column, key):
+                    self.groups[(column, key)] = RowGroup(ready=True)
+                    continue
+
+                # The row becomes the leader of this group and of the groups below it
+                led = []
+                columns = [column_led for column_led, _ in self.levels]
+                for column_led, key_led in zip(columns[level:], keys[level:]):
+                    if key_led is None or (column_led, key_led) in self.groups or self.is_ready(column_led, key_led):
+                        continue
+                    self.groups[(column_led, key_led)] = RowGroup()
+                    led.append((column_led, key_led))
+                self.submit(self.run_row, i, led)
+                return
+
+            if not group.ready:
+                group.waiting.append(i)
+                return
+
+        self.submit(self.run_row, i, [])
+
+    def submit(self, fn: Callable, i: int, *args) -> None:
+        """
+        Submits a task of the row `i` to the thread pool, must be called with the condition held
+        """
+        if self._exception is not None:
+            return
+        self._running += 1
+        self._executor.submit(self.run_task, fn, i, *args)
+
+    def run_task(self, fn: Callable, i: int, *args) -> None:
+        """
+        Runs a task of the row `i` in a worker thread and records its exception
+
+        A deferred task is submitted again after its delay, the worker is free in the meantime.
+        """
+        try:
+            with self._condition:
+                attempt = self._deferrals.get(i, 0)
+            with self.limit.slot() if self.limit is not None else nullcontext(), current_row(i), deferrable(attempt):
+                fn(i, *args)
+            with self._condition:
+                self._deferrals.pop(i, None)
+        except RowDeferred as deferred:
+            with self._condition:
+                self._deferrals[i] = attempt + 1
+                self._deferred += 1
+            timer = threading.Timer(deferred.delay, self.resume, (fn, i) + args)
+            timer.daemon = True
+            timer.start()
+        except BaseException as e:
+            with self._condition:
+                if self._exception is None:
+                    self._exception = e
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+    def resume(self, fn: Callable, i: int, *args) -> None:
+        """
+        Submits again a deferred task of the row `i`
+        """
+        with self._condition:
+            self._deferred -= 1
+            self.submit(fn, i, *args)
+            self._condition.notify_all()
+
+    def run_fetch_keys(self, i: int) -> None:
+        """
+        Retrieves the source IDs of the row and routes it to its group
+        """
+        if self.fetch_keys is not None:
+            logging.info(f"Fetching source IDs of row {i} / {self.nb_rows}: {self.describe_row(i)}")
+            if not self.fetch_keys(i):
+                return
+        with self._condition:
+            self.route(i)
+
+    def run_row(self, i: int, led: List[Tuple[str, str]]) -> None:
+        """
+        Processes the row and releases the rows waiting for the groups it leads
+
+        Parameters
+        ----------
+        i : int
+            The index of the row to process
+        led : List[Tuple[str, str]]
+            Groups led by the row, from the bib to the holding
+        """
+        try:
+            logging.info(f"Processing row {i} / {self.nb_rows}: {self.describe_row(i)}")
+            self.process_row(i)
+        except RowDeferred:
+            # The row runs again later and still leads its groups
+            raise
+        except BaseException:
+            self.release(led)
+            raise
+        self.release(led)
+
+    def release(self, led: List[Tuple[str, str]]) -> None:
+        """
+        Starts the rows waiting for the groups led by a finished row
+
+        Parameters
+        ----------
+        led : List[Tuple[str, str]]
+            Groups led by the row, from the bib to the holding
+        """
+        with self._condition:
+            for column, key in led:
+                group = self.groups.pop((column, key))
+                if self.is_ready(column, key):
+                    self.groups[(column, key)] = RowGroup(ready=True)
+
+                # Without destination record, the first waiting row becomes the new leader
+                for j in group.waiting:
+                    self.route(j)
+
+
+def run_grouped_rows(process_row: Callable[[int], None],
+                     describe_row: Callable[[int], str],
+                     workers: int = 1,
+                     fetch_keys: Optional[Callable[[int], bool]] = None,
+                     adaptive: bool = False) -> None:
+    """
+    Runs the process function on all rows, grouped by source bib and holding
+
+    With one worker, rows are processed in the order of the processing file, see
+    :func:`run_rows`. With more workers, rows are scheduled by :class:`GroupScheduler`.
+
+    Parameters
+    ----------
+    process_row : Callable[[int], None]
+        Function processing one row, for example `processes.item`
+    describe_row : Callable[[int], str]
+        Function returning a short description of the row for the logs
+    workers : int, optional
+        Number of rows processed concurrently, default is 1
+    fetch_keys : Callable[[int], bool], optional
+        Function retrieving the source IDs of a row, for rows without source MMS ID
+    adaptive : bool, optional
+        If True, `workers` is the maximum and the number of concurrent rows is
+        adapted to the API latency and errors, see :class:`AimdController`
+    """
+    if workers <= 1:
+        return run_rows(process_row, describe_row)
+
+    with adaptive_concurrency(workers, adaptive) as limit:
+        GroupScheduler(process_row, describe_row, workers, fetch_keys, limit).run()
@@ -0,0 +1,246 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from utils import profiler
+from utils.processmonitoring import ProcessMonitor
+
+# Interval in seconds between two summaries of the stages in the log
+DEFAULT_LOG_INTERVAL = 300.0
+
+# Number of bits of the values kept exactly, the buckets of larger values are
+# 1/32 to 1/64 of their value wide, about 3% of precision
+PRECISION_BITS = 6
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations with logarithmic buckets, HDR-like
+
+    Durations in ms are counted in buckets: values below 64 ms are exact, the
+    buckets of larger values keep 6 significant bits. The memory doesn't depend
+    on the number of values and the percentiles are precise to about 3%.
+
+    Attributes
+    ----------
+    buckets : Dict[int, int]
+        Number of values by lower bound of the bucket in ms
+    count : int
+        Number of values
+    total : float
+        Sum of the values in ms
+    max : float
+        Largest value in ms
+    """
+    def __init__(self) -> None:
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def get_bucket(value_ms: float) -> int:
+        """
+        Returns the lower bound of the bucket of a value in ms
+        """
+        value = max(0, int(value_ms))
+        shift = max(0, value.bit_length() - PRECISION_BITS)
+        return value >> shift << shift
+
+    def record(self, value_ms: float) -> None:
+        """
+        Counts a duration in ms
+        """
+        bucket = self.get_bucket(value_ms)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value_ms
+        self.max = max(self.max, value_ms)
+
+    def percentile(self, p: float) -> int:
+        """
+        Returns the lower bound of the bucket containing the percentile `p`, 0 to 100, in ms
+        """
+        if self.count == 0:
+            return 0
+        rank = max(1, p / 100 * self.count)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return bucket
+        return max(self.buckets)
+
+    def get_summary(self) -> Dict[str, float]:
+        """
+        Returns the number of values, the mean, p50, p95, p99 and the maximum in ms
+        """
+        return {'count': self.count,
+                'mean_ms': round(self.total / self.count, 1) if self.count > 0 else 0.0,
+                'p50_ms': self.percentile(50),
+                'p95_ms': self.percentile(95),
+                'p99_ms': self.percentile(99),
+                'max_ms': round(self.max, 1)}
+
+
+class StageStats:
+    """
+    Durations of the stages of the rows: bib copy, holding copy, item creation...
+
+    A stage started during another stage is not counted in the duration of the
+    outer stage: the bib copy made by the PoLine copy is only counted as bib copy.
+    A stage interrupted by an exception is not counted.
+
+    Parameters
+    ----------
+    log_interval : float, optional
+        Interval in seconds between two summaries in the log, 0 for a summary at the end only
+
+    Attributes
+    ----------
+    histograms : Dict[str, LatencyHistogram]
+        Histogram of the durations by stage, in the order of the first use
+    """
+    def __init__(self, log_interval: float = DEFAULT_LOG_INTERVAL) -> None:
+        self.log_interval = log_interval
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.lock = threading.Lock()
+        self._last_log = time.monotonic()
+
+        # Stages running in the thread: [name, start, duration of the inner stages]
+        self._running = threading.local()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Measures the duration of a stage for the duration of the with block
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage, for example 'bib_copy'
+        """
+        stack: Optional[List[list]] = getattr(self._running, 'stack', None)
+        if stack is None:
+            stack = self._running.stack = []
+        current = [name, time.monotonic(), 0.0]
+        stack.append(current)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+        # Only reached without exception
+        elapsed = time.monotonic() - current[1]
+        if len(stack) > 0:
+            stack[-1][2] += elapsed
+        self.record(name, (elapsed - current[2]) * 1000)
+
+    def record(self, name: str, duration_ms: float) -> None:
+        """
+        Counts the duration of a stage and writes the summary in the log periodically
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        duration_ms : float
+            Duration in ms
+        """
+        with self.lock:
+            self.histograms.setdefault(name, LatencyHistogram()).record(duration_ms)
+            log_now = 0 < self.log_interval <= time.monotonic() - self._last_log
+            if log_now:
+                self._last_log = time.monotonic()
+
+        if log_now:
+            self.log_summary()
+
+    def get_summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the summary of the histogram of each stage, see :meth:`LatencyHistogram.get_summary`
+        """
+        with self.lock:
+            return {name: histogram.get_summary() for name, histogram in self.histograms.items()}
+
+    def log_summary(self) -> None:
+        """
+        Writes the percentiles of the durations of each stage in the log
+        """
+        for name, summary in self.get_summary().items():
+            logging.info(f"Stage {name}: {summary['count']} times, mean {summary['mean_ms']}ms, "
+                         f"p50 {summary['p50_ms']}ms, p95 {summary['p95_ms']}ms, p99 {summary['p99_ms']}ms, "
+                         f"max {summary['max_ms']}ms")
+
+    def save(self) -> None:
+        """
+        Writes the summary in the log and in a JSON file next to the processing file,
+        for example `data/<form>_Items_stages.json`
+        """
+        summary = self.get_summary()
+        if len(summary) == 0:
+            return
+
+        self.log_summary()
+
+        process_monitor = ProcessMonitor.get_instance()
+        if process_monitor is not None:
+            file_path = process_monitor.get_report_path('stages')
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'w') as f:
+                json.dump({'process_type': process_monitor.process_type, 'stages': summary}, f, indent=2)
+
+
+# Stage durations of the process, set by `install`
+stage_stats: Optional[StageStats] = None
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """
+    Measures the duration of a stage, see :meth:`StageStats.stage`
+
+    Has no effect if the stage durations are not measured. The stage is also
+    recorded as a span if the run is profiled, see :func:`profiler.span`.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, for example 'bib_copy'
+    """
+    with profiler.span(name, profiler.CATEGORY_STAGE):
+        if stage_stats is None:
+            yield
+            return
+        with stage_stats.stage(name):
+            yield
+
+
+def install(log_interval: float = DEFAULT_LOG_INTERVAL) -> StageStats:
+    """
+    Measures the durations of the stages of the rows of the process
+
+    Parameters
+    ----------
+    log_interval : float, optional
+        Interval in seconds between two summaries in the log
+
+    Returns
+    -------
+    StageStats
+        The stage durations of the process
+    """
+    global stage_stats
+
+    if stage_stats is not None:
+        atexit.unregister(stage_stats.save)
+
+    stage_stats = StageStats(log_interval)
+    atexit.register(stage_stats.save)
+
+    return stage_stats
@@ -1,12 +1,249 @@
-import openpyxl
+import hashlib
+import logging
+import pickle
+import re
+import sys
 import pandas as pd
 import os
 
-from typing import Tuple, Optional
+from typing import Any, Dict, List, Tuple, Optional
 
 # Global variable to store process configuration, it is initialized in set_config
 _config_cache = {}
 
+# Forms already parsed by the process, by path, modification time and size
+_forms_cache: Dict[Tuple[str, int, int], 'FormData'] = {}
+
+# Folder of the parsed forms, a rerun of the same form doesn't parse it again
+FORM_CACHE_DIR = 'data/form_cache'
+
+# Version of the cached forms, to increase when FormData changes
+FORM_CACHE_VERSION = 1
+
+# If True, the cache of the parsed forms is read but never written, set by `set_form_cache_read_only`
+_form_cache_read_only = False
+
+# Optional rows of the General tab, identified by their label in the first column
+API_RATE_LABELS = {'API calls per second IZ source': 'api_rate_s',
+                   'API calls per second IZ destination': 'api_rate_d'}
+
+
+class MappingResolver:
+    """
+    Dictionaries of a mapping sheet, built once to avoid scanning the sheet at each lookup.
+
+    For each source key, the first row of the sheet is kept in `exact`, as when
+    filtering the DataFrame. `complete` only keeps the first row with all the
+    destination values, it is used for the '*DEFAULT*' fallbacks.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        Mapping sheet.
+    source_columns : List[str]
+        Columns of the source key.
+    destination_columns : List[str]
+        Columns of the destination values.
+    """
+    def __init__(self, table: pd.DataFrame, source_columns: List[str], destination_columns: List[str]) -> None:
+        self.exact: Dict[Tuple, Tuple] = {}
+        self.complete: Dict[Tuple, Tuple] = {}
+        nb_keys = len(source_columns)
+        for row in table[source_columns + destination_columns].itertuples(index=False, name=None):
+            source, destination = row[:nb_keys], row[nb_keys:]
+            if any(pd.isnull(value) for value in source):
+                # Empty source cells never match
+                continue
+            self.exact.setdefault(source, destination)
+            if all(pd.notnull(value) for value in destination):
+                self.complete.setdefault(source, destination)
+
+    def get(self, *source: str) -> Optional[Tuple]:
+        """
+        Returns the destination values of the first row with the source key.
+        """
+        return self.exact.get(source)
+
+    def get_complete(self, *source: str) -> Optional[Tuple]:
+        """
+        Returns the destination values of the first row with the source key and all destination values.
+        """
+        return self.complete.get(source)
+
+
+class FormData:
+    """
+    Content of an Excel form, read once for the whole process.
+
+    Parameters
+    ----------
+    general : List[Tuple]
+        Cell values of the rows of the 'General' tab.
+    sheets : Dict[str, pd.DataFrame]
+        Other tabs, first row as header and all values as strings.
+    """
+    def __init__(self, general: List[Tuple], sheets: Dict[str, pd.DataFrame]) -> None:
+        self.general = general
+        self.sheets = sheets
+
+    def get_value(self, row: int, column: int) -> Any:
+        """
+        Returns the value of a cell of the 'General' tab, None if empty.
+
+        Parameters
+        ----------
+        row : int
+            Row number, starting at 1 as in Excel.
+        column : int
+            Column number, starting at 1 as in Excel.
+
+        Returns
+        -------
+        Any
+            Value of the cell.
+        """
+        if row > len(self.general) or column > len(self.general[row - 1]):
+            return None
+        return self.general[row - 1][column - 1]
+
+
+def read_form(excel_filepath: str) -> FormData:
+    """
+    Reads all the tabs of an Excel form in one pass.
+
+    The workbook is opened once, in read-only mode. The tabs are parsed as with
+    `pd.read_excel(excel_filepath, sheet_name=..., dtype=str)`.
+
+    Parameters
+    ----------
+    excel_filepath : str
+        Path to the Excel file.
+
+    Returns
+    -------
+    FormData
+        Content of the form.
+    """
+    with pd.ExcelFile(excel_filepath, engine='openpyxl') as xls:
+        general = [tuple(row) for row in xls.book['General'].iter_rows(min_row=1, values_only=True)]
+        sheets = {sheet_name: xls.parse(sheet_name, dtype=str)
+                  for sheet_name in xls.sheet_names if sheet_name != 'General'}
+
+    return FormData(general, sheets)
+
+
+def get_file_hash(filepath: str) -> str:
+    """
+    Returns the SHA-256 hash of the content of a file.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the file.
+
+    Returns
+    -------
+    str
+        Hexadecimal hash.
+    """
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def load_form(excel_filepath: str) -> FormData:
+    """
+    Returns the content of an Excel form, parsed only once.
+
+    The parsed form is kept in memory for the process and saved in
+    `FORM_CACHE_DIR`, with the hash of the file in the name. When the same
+    form is processed again, it is loaded from the cache without opening the
+    workbook. A modified form has another hash and is parsed again. When the
+    cache is read-only, see `set_form_cache_read_only`, nothing is written or
+    removed in `FORM_CACHE_DIR`.
+
+    Parameters
+    ----------
+    excel_filepath : str
+        Path to the Excel file.
+
+    Returns
+    -------
+    FormData
+        Content of the form.
+    """
+    stat = os.stat(excel_filepath)
+    key = (os.path.abspath(excel_filepath), stat.st_mtime_ns, stat.st_size)
+    if key in _forms_cache:
+        return _forms_cache[key]
+
+    raw_filename = get_raw_filename(excel_filepath)
+    cache_filepath = os.path.join(FORM_CACHE_DIR, f'{raw_filename}_{get_file_hash(excel_filepath)[:16]}.pkl')
+
+    form = None
+    if os.path.isfile(cache_filepath):
+        try:
+            with open(cache_filepath, 'rb') as f:
+                version, form = pickle.load(f)
+            if version != FORM_CACHE_VERSION:
+                form = None
+        except Exception as err:
+            logging.warning(f'Cache of the form "{cache_filepath}" not readable, form parsed again: {err}')
+            form = None
+
+    if form is None:
+        form = read_form(excel_filepath)
+        if not _form_cache_read_only:
+            save_form_cache(form, raw_filename, cache_filepath)
+
+    _forms_cache[key] = form
+
+    return form
+
+
+def save_form_cache(form: FormData, raw_filename: str, cache_filepath: str) -> None:
+    """
+    Saves a parsed form in `FORM_CACHE_DIR` and removes the cache of its previous versions.
+
+    Parameters
+    ----------
+    form : FormData
+        Content of the form.
+    raw_filename : str
+        Name of the form without extension.
+    cache_filepath : str
+        Path to the cache of this version of the form.
+    """
+    # Remove the cache of the previous versions of the form, not of the forms with a longer name
+    cache_name_pattern = re.compile(rf'^{re.escape(raw_filename)}_[0-9a-f]{{16}}\.pkl$')
+    if os.path.isdir(FORM_CACHE_DIR):
+        for filename in os.listdir(FORM_CACHE_DIR):
+            if cache_name_pattern.match(filename):
+                os.remove(os.path.join(FORM_CACHE_DIR, filename))
+
+    os.makedirs(FORM_CACHE_DIR, exist_ok=True)
+    tmp_filepath = f'{cache_filepath}.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        pickle.dump((FORM_CACHE_VERSION, form), f)
+    os.replace(tmp_filepath, cache_filepath)
+
+
+def set_form_cache_read_only(read_only: bool) -> None:
+    """
+    Reads the cache of the parsed forms without writing or removing any file in `FORM_CACHE_DIR`
+
+    Used by `--plan`, which must not change the files of the run.
+
+    Parameters
+    ----------
+    read_only : bool
+        True to only read the cache, False to save the parsed forms again.
+    """
+    global _form_cache_read_only
+    _form_cache_read_only = read_only
+
 
 def get_raw_filename(filepath: str) -> str:
     """
@@ -39,11 +276,7 @@ def get_form_version(excel_filepath: str) -> str:
     str
         Version of the Excel form.
     """
-    wb = openpyxl.load_workbook(excel_filepath)
-    wb.active = wb['General']
-    sheet = wb.active
-
-    version = sheet.cell(row=5, column=2).value
+    version = load_form(excel_filepath).get_value(5, 2)
 
     return version
 
@@ -57,39 +290,37 @@ def set_config(excel_filepath: str) -> None:
     excel_filepath : str
         Path to the Excel file containing configuration data.
     """
-    global _config_cache
 
-    wb = openpyxl.load_workbook(excel_filepath)
+    form = load_form(excel_filepath)
 
     # Get General tab information
-    wb.active = wb['General']
-    sheet = wb.active
-
     config = {
-        'iz_s': sheet.cell(row=6, column=2).value,
-        'iz_d': sheet.cell(row=7, column=2).value,
-        'lib_s': sheet.cell(row=8, column=2).value,
-        'lib_d': sheet.cell(row=9, column=2).value,
-        'env': {'Production': 'P', 'Sandbox': 'S'}.get(sheet.cell(row=10, column=2).value, 'P'),
-        'circ_desk_s': sheet.cell(row=11, column=2).value,
-        'circ_desk_d': sheet.cell(row=12, column=2).value,
-        'cancel_reason': sheet.cell(row=13, column=2).value,
-        'cancel_note': sheet.cell(row=14, column=2).value,
-        'acq_department': sheet.cell(row=15, column=2).value,
-        'make_reception': True if sheet.cell(row=16, column=2).value == 'Yes' else False,
-        'make_loans': True if sheet.cell(row=17, column=2).value == 'Yes' else False,
-        'make_returns': True if sheet.cell(row=18, column=2).value == 'Yes' else False,
+        'iz_s': form.get_value(6, 2),
+        'iz_d': form.get_value(7, 2),
+        'lib_s': form.get_value(8, 2),
+        'lib_d': form.get_value(9, 2),
+        'env': {'Production': 'P', 'Sandbox': 'S'}.get(form.get_value(10, 2), 'P'),
+        'circ_desk_s': form.get_value(11, 2),
+        'circ_desk_d': form.get_value(12, 2),
+        'cancel_reason': form.get_value(13, 2),
+        'cancel_note': form.get_value(14, 2),
+        'acq_department': form.get_value(15, 2),
+        'make_reception': True if form.get_value(16, 2) == 'Yes' else False,
+        'make_loans': True if form.get_value(17, 2) == 'Yes' else False,
+        'make_returns': True if form.get_value(18, 2) == 'Yes' else False,
         'interested_users': [],
         'items_fields': {'src': {'to_delete': [], 'to_delete_if_error': []},
         'dest': {'to_delete': [], 'to_delete_if_error': []}},
-        'polines_fields': {'to_delete': [], 'to_delete_if_error': []}
+        'polines_fields': {'to_delete': [], 'to_delete_if_error': []},
+        'api_rate_s': None,
+        'api_rate_d': None
     }
 
     # Read items fields to delete from the Excel sheet
     for i in range(21, 28):
-        key = sheet.cell(row=i, column=1).value
-        value_src = sheet.cell(row=i, column=2).value
-        value_dest = sheet.cell(row=i, column=3).value
+        key = form.get_value(i, 1)
+        value_src = form.get_value(i, 2)
+        value_dest = form.get_value(i, 3)
 
         if value_src == 'Always delete':
             config['items_fields']['src']['to_delete'] += key.split(', ')
@@ -103,31 +334,57 @@ def set_config(excel_filepath: str) -> None:
 
     # Read polines fields to delete from the Excel sheet
     for i in range(30, 31):
-        key = sheet.cell(row=i, column=1).value
-        value = sheet.cell(row=i, column=3).value
+        key = form.get_value(i, 1)
+        value = form.get_value(i, 3)
 
         if value == 'Always delete':
             config['polines_fields']['to_delete'] += key.split(', ')
         elif value == 'Delete if error':
             config['polines_fields']['to_delete_if_error'] += key.split(', ')
 
+    # Read optional API rate limits, older forms don't have these rows
+    for i in range(1, len(form.general) + 1):
+        key = form.get_value(i, 1)
+        value = form.get_value(i, 2)
+        if key in API_RATE_LABELS and value is not None:
+            try:
+                config[API_RATE_LABELS[key]] = float(value)
+            except ValueError:
+                logging.critical(f'Invalid value of "{key}" in the General tab: "{value}", a number is expected')
+                sys.exit(1)
 
     # Get Locations_mapping tab information
-    config['locations_mapping'] = (pd.read_excel(excel_filepath, sheet_name='Locations_mapping', dtype=str)
+    config['locations_mapping'] = (form.sheets['Locations_mapping']
                                    .apply(lambda col: col.str.strip() if col.dtype == "object" else col))
 
     # Get item policies mapping tab information
     # config['item_policies_mapping'] = pd.read_excel(excel_filepath, sheet_name='Item_policies_mapping', dtype=str)
 
     # Get vendors mapping tab information
-    config['vendors_mapping'] = (pd.read_excel(excel_filepath, sheet_name='Vendors_mapping', dtype=str)
+    config['vendors_mapping'] = (form.sheets['Vendors_mapping']
                                  .apply(lambda col: col.str.strip() if col.dtype == "object" else col))
 
     # Get funding sources mapping tab information
-    config['Funds_mapping'] = (pd.read_excel(excel_filepath, sheet_name='Funds_mapping', dtype=str)
+    config['Funds_mapping'] = (form.sheets['Funds_mapping']
                                .apply(lambda col: col.str.strip() if col.dtype == "object" else col))
 
-    _config_cache = config
+    # Compile the mapping sheets into dictionaries, see get_corresponding_* functions
+    config['locations_resolver'] = MappingResolver(config['locations_mapping'],
+                                                   ['Source library code', 'Source location code'],
+                                                   ['Destination library code', 'Destination location code'])
+    config['libraries_resolver'] = MappingResolver(config['locations_mapping'],
+                                                   ['Source library code'],
+                                                   ['Destination library code'])
+    config['vendors_resolver'] = MappingResolver(config['vendors_mapping'],
+                                                 ['Source vendor code', 'Source vendor account'],
+                                                 ['Destination vendor code', 'Destination vendor account'])
+    config['funds_resolver'] = MappingResolver(config['Funds_mapping'],
+                                               ['Source fund code'],
+                                               ['Destination fund code'])
+
+    # Updated in place: the modules keep the dictionary returned by get_config at import
+    _config_cache.clear()
+    _config_cache.update(config)
 
 def get_config() -> dict:
     """
@@ -157,7 +414,11 @@ def get_data(excel_filepath: str, sheet_name) -> pd.DataFrame:
     pd.DataFrame
         DataFrame with order line numbers, MMS ID, holding ID, etc.
     """
-    return pd.read_excel(excel_filepath, sheet_name=sheet_name, dtype=str)
+    sheets = load_form(excel_filepath).sheets
+    if sheet_name not in sheets:
+        raise ValueError(f"Worksheet named '{sheet_name}' not found")
+
+    return sheets[sheet_name].copy()
 
 def get_corresponding_location(library_s: str, location_s: str) -> Tuple[Optional[str], Optional[str]]:
     """
@@ -175,27 +436,20 @@ def get_corresponding_location(library_s: str, location_s: str) -> Tuple[Optiona
     Tuple[Optional[str], Optional[str]]
         A tuple containing the corresponding library and location.
     """
-    locations_table = get_config()['locations_mapping']
+    resolver = get_config()['locations_resolver']
 
-    loc_temp = locations_table.loc[(locations_table['Source library code'] == library_s) &
-                                   (locations_table['Source location code'] == location_s),
-                                   ['Destination library code', 'Destination location code']]
+    loc_temp = resolver.get(library_s, location_s)
 
-    if len(loc_temp) == 0:
+    if loc_temp is None:
         # Check if default location is available
-        loc_temp = locations_table.loc[(locations_table['Source library code'] == '*DEFAULT*') &
-                                       (locations_table['Source location code'] == '*DEFAULT*') &
-                                       (~pd.isnull(locations_table['Destination library code'])) &
-                                       (~pd.isnull(locations_table['Destination location code'])),
-                                       ['Destination library code', 'Destination location code']]
+        loc_temp = resolver.get_complete('*DEFAULT*', '*DEFAULT*')
 
-    if len(loc_temp) == 0:
+    if loc_temp is None:
         # No corresponding location found => error
         return None, None
 
     # Get the new location and library of the item
-    library_d = loc_temp['Destination library code'].values[0]
-    location_d = loc_temp['Destination location code'].values[0]
+    library_d, location_d = loc_temp
 
     return library_d, location_d
 
@@ -214,23 +468,20 @@ def get_corresponding_library(library_s: str) -> Optional[str]:
         The corresponding library name, or None if no corresponding library is found.
     """
 
-    locations_table = get_config()['locations_mapping']
+    resolver = get_config()['libraries_resolver']
 
-    loc_temp = locations_table.loc[locations_table['Source library code'] == library_s,
-    ['Destination library code']]
+    loc_temp = resolver.get(library_s)
 
-    if len(loc_temp) == 0:
+    if loc_temp is None:
         # Check if default location is available
-        loc_temp = locations_table.loc[((locations_table['Source library code'] == '*DEFAULT*') &
-                                       (~pd.isnull(locations_table['Destination library code']))),
-        ['Destination library code']]
+        loc_temp = resolver.get_complete('*DEFAULT*')
 
-    if len(loc_temp) == 0:
+    if loc_temp is None:
         # No corresponding location found => error
         return None
 
     # Get the new location and library of the item
-    library_d = loc_temp['Destination library code'].values[0]
+    library_d = loc_temp[0]
 
     return library_d
 
@@ -285,35 +536,24 @@ def get_corresponding_vendor(vendor_s: str, vendor_account_s: str) -> Tuple[Opti
     Tuple[Optional[str], Optional[str]]
         A tuple containing the corresponding vendor and vendor account.
     """
-    vendors_table = get_config()['vendors_mapping']
+    resolver = get_config()['vendors_resolver']
 
-    vendor_temp = vendors_table.loc[(vendors_table['Source vendor code'] == vendor_s) &
-                                    (vendors_table['Source vendor account'] == vendor_account_s),
-                                    ['Destination vendor code', 'Destination vendor account']]
+    vendor_temp = resolver.get(vendor_s, vendor_account_s)
 
-    if len(vendor_temp) == 0:
+    if vendor_temp is None:
         # Check if default vendor is available
-        vendor_temp = vendors_table.loc[(vendors_table['Source vendor code'] == vendor_s) &
-                                        (vendors_table['Source vendor account'] == '*DEFAULT*') &
-                                        (~pd.isnull(vendors_table['Destination vendor code'])) &
-                                        (~pd.isnull(vendors_table['Destination vendor account'])),
-                                        ['Destination vendor code', 'Destination vendor account']]
+        vendor_temp = resolver.get_complete(vendor_s, '*DEFAULT*')
 
-    if len(vendor_temp) == 0:
+    if vendor_temp is None:
         # Check if default vendor is available
-        vendor_temp = vendors_table.loc[(vendors_table['Source vendor code'] == '*DEFAULT*') &
-                                        (vendors_table['Source vendor account'] == '*DEFAULT*') &
-                                        (~pd.isnull(vendors_table['Destination vendor code'])) &
-                                        (~pd.isnull(vendors_table['Destination vendor account'])),
-                                        ['Destination vendor code', 'Destination vendor account']]
+        vendor_temp = resolver.get_complete('*DEFAULT*', '*DEFAULT*')
 
-    if len(vendor_temp) == 0:
+    if vendor_temp is None:
         # No corresponding vendor found => error
         return None, None
 
     # Get the new vendor and vendor account
-    vendor_d = vendor_temp['Destination vendor code'].values[0]
-    vendor_account_d = vendor_temp['Destination vendor account'].values[0]
+    vendor_d, vendor_account_d = vendor_temp
 
     return vendor_d, vendor_account_d
 
@@ -332,21 +572,19 @@ def get_corresponding_fund(fund_code_s: str) -> Optional[str]:
     str or None
         The corresponding fund code, or None if no corresponding fund code is found.
     """
-    funds_table = get_config()['Funds_mapping']
+    resolver = get_config()['funds_resolver']
 
-    fund_temp = funds_table.loc[funds_table['Source fund code'] == fund_code_s, 'Destination fund code']
+    fund_temp = resolver.get(fund_code_s)
 
-    if len(fund_temp) == 0:
+    if fund_temp is None:
         # Check if default fund is available
-        fund_temp = funds_table.loc[(funds_table['Source fund code'] == '*DEFAULT*') &
-                                    (~pd.isnull(funds_table['Destination fund code'])),
-                                    'Destination fund code']
+        fund_temp = resolver.get_complete('*DEFAULT*')
 
-    if len(fund_temp) == 0:
+    if fund_temp is None:
         # No corresponding fund found => error
         return None
 
     # Get the new fund code
-    fund_code_d = fund_temp.values[0]
+    fund_code_d = fund_temp[0]
 
     return fund_code_d